@@ -30,6 +30,7 @@ from sockaudio import socket_audio
 
 def signal_handler(signal, frame):
    sys.stderr.write("audio.py shutting down\n")
+   sys.stderr.write("%s\n" % audio_handler.stats())
    audio_handler.stop()
    sys.exit(0)
 
@@ -41,13 +42,14 @@ parser.add_option("-2", "--two-channel", action="store_true", default=False, hel
 parser.add_option("-x", "--audio-gain", type="float", default="1.0", help="audio gain (default = 1.0)")
 parser.add_option("-s", "--stdout", action="store_true", default=False, help="write to stdout instead of audio device")
 parser.add_option("-S", "--silence", action="store_true", default=False, help="suppress output of zeros after timeout")
+parser.add_option("-j", "--jitter-ms", type="int", default=60, help="audio buffered per channel before playing (default = 60)")
  
 (options, args) = parser.parse_args()
 if len(args) != 0:
    parser.print_help()
    sys.exit(1)
 
-audio_handler = socket_audio(options.host_ip, options.wireshark_port, options.audio_output, options.two_channel, options.audio_gain, options.stdout, silent_flag=options.silence)
+audio_handler = socket_audio(options.host_ip, options.wireshark_port, options.audio_output, options.two_channel, options.audio_gain, options.stdout, silent_flag=options.silence, jitter_ms=options.jitter_ms)
 
 if __name__ == "__main__":
    signal.signal(signal.SIGINT, signal_handler)
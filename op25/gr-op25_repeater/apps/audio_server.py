@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+# This file is part of OP25
+#
+# OP25 is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# OP25 is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OP25; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Boston, MA
+# 02110-1301, USA.
+
+# Audio of many voice channels in one process.
+#
+# A stream is the udp audio of one voice channel, as p25_decoder sends it
+# (port, and port + 2 for TDMA slot B); a sink is a pcm device (ALSA or
+# PulseAudio), stdout or a .wav file.  One epoll loop receives every
+# stream into the jitter buffers of one sockaudio.audio_mixer, whose
+# playout clock mixes a frame of each stream into each of its sinks every
+# 20 ms.  Where more than one stream is active on a sink, those of lower
+# priority (a higher prio value, as in the trunking tsv) than the best are
+# ducked by duck_gain.  The priority of a stream is that of the talkgroup
+# it carries, set by multi_rx on each voice grant (set_talkgroup()), or
+# else the one configured.
+#
+# config ("audio" in the multi_rx config, or a file of its own):
+#
+#   "audio": {
+#       "host": "127.0.0.1",
+#       "jitter_ms": 60,
+#       "duck_gain": 0.2,		0 mutes the streams of lower priority
+#       "control_port": 0,		udp port for commands and stats
+#       "sinks": [{"name": "speaker", "type": "alsa", "device": "default"},
+#                 {"name": "log", "type": "file", "device": "mix.wav"}],
+#       "streams": [{"name": "vc0", "port": 23456, "sinks": ["speaker", "log"],
+#                    "pan": "both", "gain": 1.0, "priority": 0, "slots": 2}]
+#   }
+#
+# Sink types are alsa, pulse, stdout and file.  pan is both, left, right,
+# or slots (slot A left, slot B right); "slots": 1 ignores slot B audio, as
+# audio.py does without -2.  A stream goes to every sink unless its sinks
+# are given.  Without "streams" multi_rx makes one stream per voice
+# channel, and without "sinks" one sink, the audio_output of the channel
+# the udp player would use.
+#
+# The stats of each stream (the jitter buffer counters of each slot and
+# the frames ducked) go to the terminal as json_type audio_stats with
+# each update.  The control port answers {"command": "stats"} with the
+# same, and takes {"command": "talkgroup", "port": p, "tgid": t, "prio": n}.
+#
+# usage:
+#     ./audio_server.py <config.json>
+#     ./audio_server.py check			four streams over loopback into .wav sinks
+#     ./audio_server.py bench [streams]	mixing cost of a frame
+
+import os
+import sys
+import time
+import json
+import select
+import socket
+import threading
+from ctypes import c_char
+import numpy as np
+
+from sockaudio import audio_mixer, alsasound, pa_sound, stdout_wrapper, wav_file, rc_value, SILENCE
+from sockaudio import SND_PCM_FORMAT_S16_LE, PCM_RATE, PCM_BUFFER_SIZE, FRAME_SAMPLES, FRAME_BYTES, JITTER_MS, MAX_SUPERFRAME_SIZE
+
+SINK_TYPES = {'alsa': alsasound, 'pulse': pa_sound, 'stdout': stdout_wrapper, 'file': wav_file}
+PAN_GAINS = {'both': [(1, 1), (1, 1)], 'left': [(1, 0), (1, 0)], 'right': [(0, 1), (0, 1)], 'slots': [(1, 0), (0, 1)]}	# (left, right) of slots A and B
+LINGER_FRAMES = PCM_BUFFER_SIZE // FRAME_SAMPLES + 1	# silence written after the last stream stops, before the sinks are dropped
+
+class audio_sink(object):
+    def __init__(self, config):
+        self.name = config['name']
+        self.type = config.get('type', 'alsa')
+        self.device = config.get('device', 'default')
+        if self.type not in SINK_TYPES:
+            raise ValueError('audio sink %s: unknown type %s' % (self.name, self.type))
+        self.frames = 0
+        self.errors = 0
+        if self.type == 'stdout':
+            sys.stdout = os.fdopen(sys.stdout.fileno(), 'wb', 0) # reopen stdout with buffering disabled
+        self.pcm = SINK_TYPES[self.type]()
+        if self.pcm.open(self.device) < 0 or self.pcm.setup(SND_PCM_FORMAT_S16_LE.value, 2, PCM_RATE, PCM_BUFFER_SIZE) < 0:
+            sys.stderr.write('audio sink %s: failed to open %s %s\n' % (self.name, self.type, self.device))
+            self.pcm = None
+        # the stereo frame written, and the float sum it is clipped from
+        self.out = (c_char * (FRAME_BYTES * 2))()
+        frame = np.frombuffer(self.out, dtype=np.int16)
+        self.out_lr = [frame[0::2], frame[1::2]]
+        self.acc = np.zeros((2, FRAME_SAMPLES), dtype=np.float32)
+
+    def write(self):
+        for ch in range(2):
+            np.minimum(self.acc[ch], 32766, out=self.acc[ch])
+            np.maximum(self.acc[ch], -32767, out=self.acc[ch])
+            np.copyto(self.out_lr[ch], self.acc[ch], casting='unsafe')
+        self.frames += 1
+        if self.pcm is not None and rc_value(self.pcm.write(self.out)) < 0:
+            self.errors += 1
+
+    def drop(self):
+        if self.pcm is not None:
+            self.pcm.drop()
+
+    def close(self):
+        if self.pcm is not None:
+            self.pcm.close()
+
+    def stats(self):
+        return {'name': self.name, 'type': self.type, 'device': self.device, 'frames': self.frames, 'errors': self.errors,
+                'underruns': getattr(self.pcm, 'underruns', 0)}
+
+class audio_stream(object):
+    def __init__(self, config, slot, host):
+        self.port = int(config['port'])
+        self.name = config.get('name', str(self.port))
+        self.gain = float(config.get('gain', 1.0))
+        self.pan = config.get('pan', 'both')
+        if self.pan not in PAN_GAINS:
+            raise ValueError('audio stream %s: unknown pan %s' % (self.name, self.pan))
+        self.priority = int(config.get('priority', 0))
+        self.nslots = int(config.get('slots', 2))
+        self.sink_names = config.get('sinks')
+        self.slot = slot	# mixer slot of slot A; slot B is the next
+        self.tgid = None
+        self.prio = None	# of the talkgroup, when known
+        self.ducked = 0
+        self.socks = []
+        for port in [self.port, self.port + 2]:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            sock.bind((host, port))
+            self.socks.append(sock)
+
+    def current_priority(self):
+        return self.priority if self.prio is None else self.prio
+
+class audio_server(object):
+    def __init__(self, config):
+        self.keep_running = True
+        host = config.get('host', '127.0.0.1')
+        self.duck_gain = float(config.get('duck_gain', 0.2))
+        self.sinks = [audio_sink(c) for c in config['sinks']]
+        sinks_by_name = dict([(s.name, s) for s in self.sinks])
+        self.streams = []
+        self.epoll = select.epoll()
+        self.receivers = {}	# fd -> (stream, 0 or 1 for slot A or B)
+        for c in config['streams']:
+            stream = audio_stream(c, 2 * len(self.streams), host)
+            if stream.sink_names is None:
+                stream.sinks = self.sinks
+            else:
+                unknown = [n for n in stream.sink_names if n not in sinks_by_name]
+                if unknown:
+                    raise ValueError('audio stream %s: unknown sinks %s' % (stream.name, ', '.join(unknown)))
+                stream.sinks = [sinks_by_name[n] for n in stream.sink_names]
+            for i in range(2):
+                self.receivers[stream.socks[i].fileno()] = (stream, i)
+                self.epoll.register(stream.socks[i].fileno(), select.EPOLLIN)
+            self.streams.append(stream)
+        self.streams_by_port = dict([(s.port, s) for s in self.streams])
+        for sink in self.sinks:
+            sink.streams = [s for s in self.streams if sink in s.sinks]
+        self.mixer = audio_mixer(config.get('jitter_ms', JITTER_MS), 2 * len(self.streams), LINGER_FRAMES)
+        self.gained = np.zeros(FRAME_SAMPLES, dtype=np.float32)
+        self.control = None
+        if config.get('control_port'):
+            self.control = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.control.setblocking(0)
+            self.control.bind((host, int(config['control_port'])))
+            self.epoll.register(self.control.fileno(), select.EPOLLIN)
+        self.clock_running = False
+        sys.stderr.write('audio server: %d streams, sinks %s\n' % (len(self.streams), ', '.join([s.name for s in self.sinks])))
+
+    def run(self):
+        while self.keep_running:
+            timeout = self.mixer.timeout(time.monotonic())
+            events = self.epoll.poll(1.0 if timeout is None else timeout)
+            for fd, event in events:
+                if fd in self.receivers:
+                    stream, i = self.receivers[fd]
+                    self.receive(stream, i)
+                else:
+                    self.control_request()
+            for frames in self.mixer.due(time.monotonic()):
+                self.mix(frames)
+                self.clock_running = True
+            if self.clock_running and self.mixer.next_frame is None:
+                # the sinks have played out the silence after the last stream
+                self.clock_running = False
+                for sink in self.sinks:
+                    sink.drop()
+            self.mixer.drained()	# end of call: the clock lingers instead of draining the sinks
+        self.close()
+
+    def receive(self, stream, i):
+        while True:
+            try:
+                data = stream.socks[i].recvfrom(MAX_SUPERFRAME_SIZE)[0]
+            except (BlockingIOError, InterruptedError):
+                return
+            if i == 1 and stream.nslots == 1 and len(data) != 2:
+                continue
+            self.mixer.receive(stream.slot + i, data)
+
+    def mix(self, frames):
+        # a frame of every stream into each of its sinks, those of lower
+        # priority than the best active on the sink ducked
+        active = [s for s in self.streams if frames[s.slot] is not SILENCE or frames[s.slot + 1] is not SILENCE]
+        ducked = set()
+        for sink in self.sinks:
+            sink.acc.fill(0)
+            streams = [s for s in active if sink in s.sinks]
+            best = min([s.current_priority() for s in streams]) if streams else 0
+            for stream in streams:
+                gain = stream.gain
+                if stream.current_priority() > best:
+                    gain *= self.duck_gain
+                    ducked.add(stream)
+                for i in range(stream.nslots):
+                    frame = frames[stream.slot + i]
+                    if frame is SILENCE:
+                        continue
+                    np.multiply(frame, np.float32(gain), out=self.gained)
+                    for ch, g in enumerate(PAN_GAINS[stream.pan][i]):
+                        if g:
+                            np.add(sink.acc[ch], self.gained, out=sink.acc[ch])
+            sink.write()
+        for stream in ducked:
+            stream.ducked += 1
+
+    def set_talkgroup(self, port, tgid, prio=None):
+        # the talkgroup now carried by the stream of a udp port
+        stream = self.streams_by_port.get(port)
+        if stream is None:
+            return
+        stream.tgid = tgid
+        stream.prio = prio
+
+    def control_request(self):
+        while True:
+            try:
+                data, addr = self.control.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                d = json.loads(data)
+                if d['command'] == 'stats':
+                    self.control.sendto(json.dumps(self.stats()).encode(), addr)
+                elif d['command'] == 'talkgroup':
+                    self.set_talkgroup(int(d['port']), d.get('tgid'), d.get('prio'))
+            except (ValueError, KeyError, TypeError) as ex:
+                sys.stderr.write('audio server: bad request from %s: %s\n' % (addr[0], ex))
+
+    def stats(self):
+        d = {'json_type': 'audio_stats', 'time': time.time(), 'skipped': self.mixer.skipped, 'streams': [], 'sinks': [s.stats() for s in self.sinks]}
+        for stream in self.streams:
+            d['streams'].append({'name': stream.name, 'port': stream.port, 'tgid': stream.tgid, 'priority': stream.current_priority(),
+                                 'ducked': stream.ducked, 'a': self.mixer.slots[stream.slot].stats(), 'b': self.mixer.slots[stream.slot + 1].stats()})
+        return d
+
+    def stop(self):
+        self.keep_running = False
+
+    def close(self):
+        for stream in self.streams:
+            for sock in stream.socks:
+                sock.close()
+        if self.control is not None:
+            self.control.close()
+        self.epoll.close()
+        for sink in self.sinks:
+            sink.close()
+
+class audio_server_thread(threading.Thread):
+    def __init__(self, config, **kwds):
+        threading.Thread.__init__(self, **kwds)
+        self.daemon = True
+        self.server = audio_server(config)
+        self.start()
+
+    def run(self):
+        self.server.run()
+
+    def stop(self):
+        self.server.stop()
+
+def check():
+    # four streams, sent in real time with up to 20 ms of jitter: stream 0
+    # alone on a sink, slot A left and B right, must come out intact; 1, 2
+    # and 3 share a sink, where 2 and 3 are ducked while 1 is active
+    import random
+    import tempfile
+    import shutil
+    import wave
+    from sockaudio import synthetic_capture, played_audio
+    base_port = 34600
+    tmpdir = tempfile.mkdtemp()
+    try:
+        config = {'jitter_ms': 60, 'control_port': base_port - 1,
+                  'sinks': [{'name': 'solo', 'type': 'file', 'device': os.path.join(tmpdir, 'solo.wav')},
+                            {'name': 'mix', 'type': 'file', 'device': os.path.join(tmpdir, 'mix.wav')}],
+                  'streams': [{'name': 'vc%d' % i, 'port': base_port + 4 * i, 'sinks': ['solo' if i == 0 else 'mix'],
+                               'pan': 'slots' if i == 0 else 'both', 'priority': min(i, 2)} for i in range(4)]}
+        th = audio_server_thread(config)
+        rng = random.Random(1)
+        captures = [synthetic_capture(random.Random(i), calls=3) for i in range(4)]
+        packets = []
+        for i in range(4):
+            last = [0.0, 0.0]	# delayed in order within a slot
+            for t, slot, data in captures[i]:
+                last[slot] = max(last[slot], t + rng.uniform(0, 0.02))
+                packets.append((last[slot], i, slot, data))
+        packets.sort(key=lambda p: p[0])
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        t0 = time.monotonic()
+        for t, i, slot, data in packets:
+            dt = t - (time.monotonic() - t0)
+            if dt > 0:
+                time.sleep(dt)
+            sock.sendto(data, ('127.0.0.1', base_port + 4 * i + 2 * slot))
+        time.sleep(1.0)
+        sock.settimeout(1.0)
+        sock.sendto(json.dumps({'command': 'stats'}).encode(), ('127.0.0.1', base_port - 1))
+        d = json.loads(sock.recv(65536))
+        th.stop()
+        th.join()
+        for s in d['streams']:
+            sys.stderr.write('%s: ducked %d, a %s, b %s\n' % (s['name'], s['ducked'], s['a'], s['b']))
+        for s in d['sinks']:
+            sys.stderr.write('%s: %d frames\n' % (s['name'], s['frames']))
+        assert len(d['streams']) == 4
+        assert all([s[slot]['underruns'] == 0 for s in d['streams'] for slot in 'ab'])
+        assert d['streams'][0]['ducked'] == d['streams'][1]['ducked'] == 0
+        assert d['streams'][2]['ducked'] > 0 and d['streams'][3]['ducked'] > 0
+        w = wave.open(os.path.join(tmpdir, 'solo.wav'))
+        solo = np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16)
+        for slot in range(2):
+            sent = b''.join([data for t, s, data in captures[0] if s == slot and len(data) != 2])
+            assert played_audio(solo[slot::2].tobytes()) == sent, slot
+    finally:
+        shutil.rmtree(tmpdir)
+    sys.stderr.write('ok\n')
+
+def bench(nstreams=16, n=5000):
+    # cost of a 20 ms frame with every stream active into one sink, against
+    # the 20 ms it has to be done in
+    import tempfile
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        config = {'sinks': [{'name': 'null', 'type': 'file', 'device': os.path.join(tmpdir, 'null.wav')}],
+                  'streams': [{'port': 35000 + 4 * i, 'priority': i % 3} for i in range(nstreams)]}
+        server = audio_server(config)
+        data = (np.arange(FRAME_SAMPLES) * 10).astype(np.int16).tobytes()
+        now = 0.0
+        t0 = time.time()
+        for k in range(n):
+            for stream in server.streams:
+                server.mixer.receive(stream.slot, data)
+            for frames in server.mixer.due(now):
+                server.mix(frames)
+            now += 0.02
+        dt = time.time() - t0
+        sys.stderr.write('%d streams: %.0f us per frame, %.1f%% of real time\n' % (nstreams, dt / n * 1e6, dt / n / 0.02 * 100))
+        server.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        check()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 16)
+    elif len(sys.argv) > 1:
+        config = json.loads(open(sys.argv[1]).read())
+        server = audio_server(config.get('audio', config))
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            sys.stderr.write('%s\n' % json.dumps(server.stats()))
+            server.close()
+    else:
+        sys.stderr.write('usage: %s <config.json> | check | bench [streams]\n' % sys.argv[0])
+
+if __name__ == '__main__':
+    main()
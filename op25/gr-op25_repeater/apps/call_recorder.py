@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+
+# This file is part of OP25
+#
+# OP25 is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# OP25 is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OP25; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Boston, MA
+# 02110-1301, USA.
+
+# Compressed, indexed recordings of the calls followed by the logfile
+# workers (rx.py -L ... --record-dir).
+#
+# rx_ctl.logging_scheduler starts a recording for each talkgroup it
+# assigns to a worker, with the metadata of the frequency_tracking call
+# record (tgid, srcaddr, sysid, nac, frequency, slot, encryption), and
+# ends it when the talkgroup is released.  The 8 kHz pcm of the worker's
+# decoder (p25_decoder dest='recorder') is queued to a pool of encoder
+# threads - each call stays on one thread, so its audio is kept in order -
+# which write it as FLAC (lossless) or Opus (a sixth of the size of pcm),
+# or .wav without soundfile.  A long call is split into segments of
+# segment_sec.  Queueing never blocks the flowgraph: past buffer_mb of
+# pcm waiting for the encoders, audio is dropped and counted, per call
+# and in the stats.
+#
+# Files go to <dir>/<yyyy-mm-dd>/<tgid>-<hhmmss.mmm>-<slot>[.<segment>].<ext>
+# and each ended call, with its segments, is one transaction of the
+# SQLite index <dir>/calls.db, written by its own thread:
+#
+#   calls (id, start, end, sysid, nac, tgid, tag, srcaddr, frequency,
+#          slot, encrypted, format, samples, dropped, bytes)
+#   segments (call_id, seq, path, start, samples, bytes)
+#
+# Retention: every _def_retention_interval the calls that started more
+# than retention_days ago, and the oldest calls while the recordings take
+# more than max_size_mb, are deleted, files and rows (0: no limit).
+#
+# FLAC and Opus need soundfile (pip3 install soundfile) and libsndfile;
+# Opus needs libsndfile 1.0.29 or later.
+#
+# usage:
+#     ./call_recorder.py check			record, index and prune synthetic calls
+#     ./call_recorder.py bench [format] [calls]	encode calls concurrently, report rate and size
+#     ./call_recorder.py list <dir> [tgid]	recorded calls, most recent first
+
+import sys
+import os
+import time
+import queue
+import sqlite3
+import threading
+import wave
+import numpy as np
+
+try:
+    import soundfile
+except (ImportError, OSError):	# OSError: libsndfile itself is missing
+    soundfile = None
+
+SAMPLE_RATE = 8000
+INDEX_FILE = 'calls.db'
+# format: (soundfile format, subtype, file name extension)
+FORMATS = {'flac': ('FLAC', 'PCM_16', '.flac'),
+           'opus': ('OGG', 'OPUS', '.opus'),
+           'wav': (None, None, '.wav')}
+
+_def_format = 'flac'
+_def_workers = 2		# encoder threads
+_def_buffer_mb = 8		# pcm waiting for the encoders (about 9 minutes of audio)
+_def_segment_sec = 300		# longest file of a call
+_def_retention_interval = 600	# check the retention policy this often (sec.)
+_def_prune_calls = 500		# calls deleted per transaction
+_stop = object()
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS calls (id INTEGER PRIMARY KEY, start REAL NOT NULL, end REAL NOT NULL, '
+    'sysid INTEGER, nac INTEGER, tgid INTEGER, tag TEXT, srcaddr INTEGER, frequency INTEGER, slot INTEGER, '
+    'encrypted INTEGER, format TEXT, samples INTEGER, dropped INTEGER, bytes INTEGER)',
+    'CREATE INDEX IF NOT EXISTS calls_start ON calls (start)',
+    'CREATE INDEX IF NOT EXISTS calls_tgid ON calls (tgid, start)',
+    'CREATE TABLE IF NOT EXISTS segments (call_id INTEGER NOT NULL, seq INTEGER NOT NULL, path TEXT NOT NULL, '
+    'start REAL, samples INTEGER, bytes INTEGER, PRIMARY KEY (call_id, seq))',
+]
+CALL_COLUMNS = 'start end sysid nac tgid tag srcaddr frequency slot encrypted'.split()
+
+def require_soundfile(fmt):
+    if fmt not in FORMATS:
+        raise ValueError('call_recorder: unknown format %s (one of %s)' % (fmt, ', '.join(sorted(FORMATS))))
+    if FORMATS[fmt][0] is not None and soundfile is None:
+        raise RuntimeError('call_recorder: %s needs soundfile (pip3 install soundfile)' % fmt)
+
+def connect(filename):
+    conn = sqlite3.connect(filename, timeout=5.0, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    for sql in SCHEMA:
+        conn.execute(sql)
+    conn.commit()
+    return conn
+
+class recording(object):
+    # one call: the metadata, given to call_recorder.start_call() and
+    # updated by end_call(), and what became of its audio
+    def __init__(self, recorder, seq, meta):
+        self.recorder = recorder
+        self.seq = seq
+        self.meta = meta
+        self.queued = 0		# samples accepted
+        self.dropped = 0	# samples refused, the encoders being too far behind
+        self.ended = False
+
+    def write(self, pcm):
+        # pcm: int16 samples (ndarray) or their bytes; never blocks
+        return self.recorder.write(self, pcm)
+
+class encoder(threading.Thread):
+    # writes the pcm of the calls given to it, in the order queued
+    def __init__(self, recorder, **kwds):
+        threading.Thread.__init__(self, **kwds)
+        self.daemon = True
+        self.recorder = recorder
+        self.q = queue.Queue()	# bounded by the recorder's byte budget
+        self.files = {}		# recording -> [file, segments, samples in segment]
+        self.start()
+
+    def run(self):
+        while True:
+            item = self.q.get()
+            if item is _stop:
+                break
+            rec, pcm = item
+            try:
+                if pcm is None:
+                    self.finish(rec)
+                else:
+                    self.encode(rec, pcm)
+            except Exception as e:
+                self.recorder.failed(rec, e)
+            if pcm is not None:
+                self.recorder.done(len(pcm))
+
+    def open_segment(self, rec):
+        r = self.recorder
+        start = rec.meta['start']
+        segments = self.files[rec][1] if rec in self.files else []
+        name = '%d-%s.%03d-%d' % (rec.meta['tgid'] or 0, time.strftime('%H%M%S', time.localtime(start)), int(start * 1000) % 1000, rec.meta['slot'] or 0)
+        path = os.path.join(time.strftime('%Y-%m-%d', time.localtime(start)), name)
+        if segments:
+            path += '.%d' % len(segments)
+        path += FORMATS[r.format][2]
+        full = os.path.join(r.directory, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        fmt, subtype = FORMATS[r.format][:2]
+        if fmt is None:
+            f = wave.open(full, 'wb')
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(SAMPLE_RATE)
+        else:
+            f = soundfile.SoundFile(full, 'w', samplerate=SAMPLE_RATE, channels=1, format=fmt, subtype=subtype)
+        elapsed = sum([s[2] for s in segments]) / float(SAMPLE_RATE)
+        segments.append([path, start + elapsed, 0])
+        self.files[rec] = [f, segments, 0]
+
+    def close_segment(self, rec):
+        f = self.files[rec][0]
+        if f is not None:
+            f.close()
+            self.files[rec][0] = None
+
+    def encode(self, rec, pcm):
+        r = self.recorder
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        while len(samples):
+            entry = self.files.get(rec)
+            if entry is None or entry[0] is None:
+                self.open_segment(rec)
+                entry = self.files[rec]
+            n = min(len(samples), r.segment_samples - entry[2])
+            if FORMATS[r.format][0] is None:
+                entry[0].writeframesraw(samples[:n].tobytes())
+            else:
+                entry[0].write(samples[:n])
+            entry[2] += n
+            entry[1][-1][2] += n
+            samples = samples[n:]
+            if entry[2] >= r.segment_samples:
+                self.close_segment(rec)
+
+    def finish(self, rec):
+        entry = self.files.pop(rec, None)
+        if entry is None:	# no audio
+            self.recorder.indexed(rec, [])
+            return
+        f, segments, n = entry
+        if f is not None:
+            f.close()
+        for s in segments:
+            try:
+                s.append(os.path.getsize(os.path.join(self.recorder.directory, s[0])))
+            except OSError:
+                s.append(None)
+        self.recorder.indexed(rec, segments)
+
+class indexer(threading.Thread):
+    # writes the ended calls to the index, and applies the retention policy
+    def __init__(self, recorder, retention_days=0, max_size_mb=0, **kwds):
+        threading.Thread.__init__(self, **kwds)
+        self.daemon = True
+        self.recorder = recorder
+        self.q = queue.Queue()
+        self.retention_days = retention_days
+        self.max_size_mb = max_size_mb
+        self.retain_at = time.time() + 60 if retention_days or max_size_mb else None
+        self.conn = connect(os.path.join(recorder.directory, INDEX_FILE))
+        self.start()
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.retain_at is not None:
+                timeout = max(0, self.retain_at - time.time())
+            try:
+                item = self.q.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _stop:
+                break
+            if item is not None:
+                self.add(*item)
+            if self.retain_at is not None and time.time() >= self.retain_at and self.q.empty():
+                if not self.prune():
+                    self.retain_at = time.time() + _def_retention_interval
+        self.conn.close()
+
+    def add(self, rec, segments):
+        c = self.recorder.counters
+        try:
+            with self.conn:
+                values = [rec.meta.get(k) for k in CALL_COLUMNS]
+                values += [self.recorder.format, sum([s[2] for s in segments]), rec.dropped, sum([s[3] or 0 for s in segments])]
+                cursor = self.conn.execute('INSERT INTO calls (%s, format, samples, dropped, bytes) VALUES (%s)' % (', '.join(CALL_COLUMNS), ', '.join(['?'] * (len(CALL_COLUMNS) + 4))), values)
+                rec.id = cursor.lastrowid
+                self.conn.executemany('INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?)', [[rec.id, i] + s for i, s in enumerate(segments)])
+            c['indexed'] += 1
+        except sqlite3.Error as e:
+            c['index_errors'] += 1
+            sys.stderr.write('call_recorder: index write failed (%s), tgid %s start %f not indexed\n' % (e, rec.meta.get('tgid'), rec.meta['start']))
+
+    def prune(self, now=None):
+        # one step of the retention policy: the oldest calls, those too old
+        # and then as many as it takes to get back under max_size_mb;
+        # returns True if there may be more
+        if now is None:
+            now = time.time()
+        cutoff = now - self.retention_days * 86400 if self.retention_days else None
+        try:
+            over = 0	# bytes to free
+            if self.max_size_mb:
+                over = self.conn.execute('SELECT TOTAL(bytes) FROM calls').fetchone()[0] - self.max_size_mb * (1 << 20)
+            if cutoff is None and over <= 0:
+                return False
+            ids = []
+            freed = 0
+            for id, start, nbytes in self.conn.execute('SELECT id, start, bytes FROM calls ORDER BY start LIMIT %d' % _def_prune_calls).fetchall():
+                if not ((cutoff is not None and start < cutoff) or freed < over):
+                    break
+                ids.append(id)
+                freed += nbytes or 0
+            if not ids:
+                return False
+            marks = ', '.join(['?'] * len(ids))
+            paths = [row[0] for row in self.conn.execute('SELECT path FROM segments WHERE call_id IN (%s)' % marks, ids)]
+            with self.conn:
+                self.conn.execute('DELETE FROM segments WHERE call_id IN (%s)' % marks, ids)
+                self.conn.execute('DELETE FROM calls WHERE id IN (%s)' % marks, ids)
+        except sqlite3.Error as e:
+            sys.stderr.write('call_recorder: retention policy failed (%s), retrying later\n' % e)
+            return False
+        for path in paths:	# the rows go first: a file left behind is only wasted space
+            try:
+                os.remove(os.path.join(self.recorder.directory, path))
+            except OSError:
+                pass
+        self.recorder.counters['pruned'] += len(ids)
+        return len(ids) == _def_prune_calls or freed < over
+
+class call_recorder(object):
+    def __init__(self, directory, format=_def_format, workers=_def_workers, buffer_mb=_def_buffer_mb, segment_sec=_def_segment_sec, retention_days=0, max_size_mb=0):
+        require_soundfile(format)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.format = format
+        self.segment_samples = int(segment_sec * SAMPLE_RATE)
+        self.buffer_limit = int(buffer_mb * (1 << 20))
+        self.pending = 0	# bytes queued to the encoders
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.active = set()
+        self.counters = {'calls': 0, 'indexed': 0, 'samples': 0, 'dropped': 0, 'max_pending': 0,
+                         'errors': 0, 'index_errors': 0, 'pruned': 0}
+        self.indexer = indexer(self, retention_days=retention_days, max_size_mb=max_size_mb)
+        self.encoders = [encoder(self) for i in range(max(1, workers))]
+
+    def start_call(self, tgid, frequency=None, slot=None, sysid=None, nac=None, srcaddr=None, encrypted=None, tag=None, start=None):
+        meta = {'tgid': tgid, 'frequency': frequency, 'slot': slot, 'sysid': sysid, 'nac': nac,
+                'srcaddr': srcaddr, 'encrypted': encrypted, 'tag': tag,
+                'start': time.time() if start is None else start, 'end': None}
+        with self.lock:
+            self.seq += 1
+            rec = recording(self, self.seq, meta)
+            self.active.add(rec)
+            self.counters['calls'] += 1
+        return rec
+
+    def write(self, rec, pcm):
+        if rec.ended:
+            return False
+        if not isinstance(pcm, bytes):
+            pcm = np.ascontiguousarray(pcm, dtype=np.int16).tobytes()
+        n = len(pcm)
+        with self.lock:
+            if self.pending + n > self.buffer_limit:
+                rec.dropped += n // 2
+                self.counters['dropped'] += n // 2
+                return False
+            self.pending += n
+            self.counters['max_pending'] = max(self.counters['max_pending'], self.pending)
+        rec.queued += n // 2
+        self.encoders[rec.seq % len(self.encoders)].q.put((rec, pcm))
+        return True
+
+    def end_call(self, rec, end=None, **meta):
+        # meta: what has become known since start_call (srcaddr, encrypted ...)
+        if rec.ended:
+            return
+        for k in meta:
+            if meta[k] is not None:
+                rec.meta[k] = meta[k]
+        rec.meta['end'] = time.time() if end is None else end
+        rec.ended = True
+        self.encoders[rec.seq % len(self.encoders)].q.put((rec, None))
+
+    def done(self, n):
+        with self.lock:
+            self.pending -= n
+            self.counters['samples'] += n // 2
+
+    def failed(self, rec, e):
+        self.counters['errors'] += 1
+        sys.stderr.write('call_recorder: tgid %s start %f: %s\n' % (rec.meta.get('tgid'), rec.meta['start'], e))
+
+    def indexed(self, rec, segments):
+        with self.lock:
+            self.active.discard(rec)
+        if segments or rec.dropped:
+            self.indexer.q.put((rec, segments))
+
+    def stats(self):
+        d = dict(self.counters)
+        with self.lock:
+            d['active'] = len(self.active)
+            d['pending'] = self.pending
+        return d
+
+    def stop(self):
+        # ends the calls still open, finishes their files and the index
+        for rec in list(self.active):
+            self.end_call(rec)
+        for e in self.encoders:
+            e.q.put(_stop)
+        for e in self.encoders:
+            e.join()
+        self.indexer.q.put(_stop)
+        self.indexer.join()
+
+def read_pcm(filename):
+    if filename.endswith('.wav'):
+        f = wave.open(filename, 'rb')
+        pcm = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+        f.close()
+        return pcm
+    return soundfile.read(filename, dtype='int16')[0]
+
+def voice(rng, n):
+    # something like speech: a few harmonics of a wandering pitch, bursts of noise
+    t = np.arange(n) / float(SAMPLE_RATE)
+    f0 = 110 + 40 * np.sin(2 * np.pi * rng.uniform(0.5, 2.0) * t)
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    x = sum([np.sin(k * phase) / k for k in range(1, 8)])
+    x *= 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(2, 5) * t) ** 2
+    x += rng.normal(0, 0.05, n)
+    return np.clip(x * 8000, -32768, 32767).astype(np.int16)
+
+def list_calls(directory, tgid=None, limit=50):
+    conn = sqlite3.connect('file:%s?mode=ro' % os.path.join(directory, INDEX_FILE), uri=True)
+    sql = 'SELECT id, start, end, sysid, tgid, tag, srcaddr, frequency, slot, encrypted, samples, dropped, bytes FROM calls'
+    args = []
+    if tgid is not None:
+        sql += ' WHERE tgid = ?'
+        args.append(tgid)
+    sql += ' ORDER BY start DESC LIMIT %d' % limit
+    for row in conn.execute(sql, args):
+        id, start, end, sysid, tg, tag, src, freq, slot, enc, samples, dropped, nbytes = row
+        files = [r[0] for r in conn.execute('SELECT path FROM segments WHERE call_id = ? ORDER BY seq', (id,))]
+        print('%s %6.1fs sysid %s tgid %s %s src %s freq %s slot %s%s %s%s' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)), end - start, '%x' % sysid if sysid is not None else '-',
+            tg, tag or '', src, freq, slot, ' encrypted' if enc else '', ' '.join(files),
+            ' (%d samples dropped)' % dropped if dropped else ''))
+    conn.close()
+
+def check():
+    import tempfile
+    import shutil
+    rng = np.random.RandomState(24)
+    formats = ['wav'] + [f for f in ('flac', 'opus') if soundfile is not None]
+    for fmt in formats:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            r = call_recorder(tmpdir, format=fmt, workers=3, segment_sec=2)
+            calls = []
+            for i in range(8):	# interleaved calls, as from several workers
+                rec = r.start_call(tgid=100 + i, frequency=851000000 + 12500 * i, slot=i & 1, sysid=0x3a1, nac=0x293, srcaddr=None, encrypted=False, start=1700000000.0 + i)
+                calls.append((rec, voice(rng, int(SAMPLE_RATE * rng.uniform(0.5, 5.0)))))
+            pos = 0
+            while any([pos < len(pcm) for rec, pcm in calls]):
+                for rec, pcm in calls:
+                    if pos < len(pcm):
+                        rec.write(pcm[pos:pos + 160])
+                pos += 160
+            for i, (rec, pcm) in enumerate(calls):
+                r.end_call(rec, end=rec.meta['start'] + len(pcm) / float(SAMPLE_RATE), srcaddr=5000 + i, encrypted=(i == 3))
+            silent = r.start_call(tgid=999)	# no audio: not indexed
+            r.end_call(silent)
+            r.stop()
+            conn = sqlite3.connect(os.path.join(tmpdir, INDEX_FILE))
+            assert conn.execute('SELECT COUNT(*) FROM calls').fetchone()[0] == len(calls)
+            for rec, pcm in calls:
+                row = conn.execute('SELECT id, tgid, srcaddr, sysid, frequency, slot, encrypted, samples, dropped FROM calls WHERE tgid = ?', (rec.meta['tgid'],)).fetchone()
+                assert row[1:] == (rec.meta['tgid'], rec.meta['srcaddr'], 0x3a1, rec.meta['frequency'], rec.meta['slot'], int(rec.meta['tgid'] == 103), len(pcm), 0), row
+                segments = conn.execute('SELECT path, start, samples, bytes FROM segments WHERE call_id = ? ORDER BY seq', (row[0],)).fetchall()
+                assert len(segments) == (len(pcm) - 1) // (2 * SAMPLE_RATE) + 1, (len(pcm), segments)
+                assert segments[-1][1] == rec.meta['start'] + 2.0 * (len(segments) - 1)
+                decoded = [read_pcm(os.path.join(tmpdir, s[0])) for s in segments]
+                assert [len(d) for d in decoded if fmt != 'opus'] == [s[2] for s in segments if fmt != 'opus']
+                if fmt != 'opus':	# lossless
+                    assert np.array_equal(np.concatenate(decoded), pcm), fmt
+                else:
+                    assert abs(sum([len(d) for d in decoded]) - len(pcm)) < 0.1 * SAMPLE_RATE * len(segments)
+                for s in segments:
+                    assert s[3] == os.path.getsize(os.path.join(tmpdir, s[0]))
+            conn.close()
+            print('%s: %d calls, %d bytes' % (fmt, len(calls), sum([os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(tmpdir) for f in files if f.endswith(FORMATS[fmt][2])])))
+
+            # retention: days, then size
+            conn = sqlite3.connect(os.path.join(tmpdir, INDEX_FILE))
+            first = [os.path.join(tmpdir, p[0]) for p in conn.execute('SELECT path FROM segments JOIN calls ON call_id = id WHERE tgid = 100')]
+            conn.close()
+            r = call_recorder(tmpdir, format=fmt, retention_days=1, max_size_mb=0)
+            r.indexer.prune(now=1700000000.0 + 86400 + 4.5)	# the first five started more than a day before
+            remaining = sqlite3.connect(os.path.join(tmpdir, INDEX_FILE)).execute('SELECT tgid FROM calls ORDER BY tgid').fetchall()
+            assert [t[0] for t in remaining] == [105, 106, 107], remaining
+            assert first and not [p for p in first if os.path.exists(p)]
+            r.indexer.retention_days = 0
+            r.indexer.max_size_mb = 0
+            assert not r.indexer.prune()
+            r.indexer.max_size_mb = 1	# (they take less)
+            assert not r.indexer.prune()
+            sizes = r.indexer.conn.execute('SELECT bytes FROM calls ORDER BY start').fetchall()
+            r.indexer.max_size_mb = (sum([b[0] for b in sizes]) - 1) / float(1 << 20)	# one byte over: only the oldest goes
+            assert not r.indexer.prune()
+            remaining = r.indexer.conn.execute('SELECT tgid FROM calls ORDER BY tgid').fetchall()
+            assert [t[0] for t in remaining] == [106, 107], remaining
+            r.indexer.max_size_mb = 1e-9
+            while r.indexer.prune():
+                pass
+            assert r.stats()['pruned'] == len(calls)
+            r.stop()
+            left = [f for d, _, files in os.walk(tmpdir) for f in files if f.endswith(FORMATS[fmt][2])]
+            assert not left, left
+        finally:
+            shutil.rmtree(tmpdir)
+
+    # bounded memory: encoders that can't keep up lose audio, the caller never waits
+    tmpdir = tempfile.mkdtemp()
+    try:
+        r = call_recorder(tmpdir, format='wav', workers=1, buffer_mb=0.01)
+        blocked = threading.Event()
+        r.encoders[0].encode = lambda rec, pcm: blocked.wait()	# wedge the only encoder
+        rec = r.start_call(tgid=1)
+        pcm = voice(rng, SAMPLE_RATE)
+        t0 = time.time()
+        accepted = sum([rec.write(pcm[i:i + 160]) for i in range(0, len(pcm), 160)])
+        assert time.time() - t0 < 1.0
+        assert accepted == 0.01 * (1 << 20) // 320, accepted
+        assert rec.dropped == len(pcm) - accepted * 160 and r.counters['dropped'] == rec.dropped
+        blocked.set()
+        r.stop()
+    finally:
+        shutil.rmtree(tmpdir)
+    print('call_recorder check ok (%s)' % ', '.join(formats))
+
+def bench(fmt='flac', ncalls=16, seconds=30):
+    import tempfile
+    import shutil
+    rng = np.random.RandomState(1)
+    pcm = voice(rng, SAMPLE_RATE * seconds)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        r = call_recorder(tmpdir, format=fmt, workers=_def_workers)
+        t0 = time.time()
+        calls = [r.start_call(tgid=i, slot=0, start=t0 + i / 1000.0) for i in range(ncalls)]
+        for pos in range(0, len(pcm), 160):	# 20 ms of each call in turn, as the workers deliver it
+            for rec in calls:
+                rec.write(pcm[pos:pos + 160])
+        t1 = time.time()
+        for rec in calls:
+            r.end_call(rec)
+        r.stop()
+        t2 = time.time()
+        stats = r.stats()
+        nbytes = sum([os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(tmpdir) for f in files if f.endswith(FORMATS[fmt][2])])
+        audio = ncalls * seconds
+        print('%s: %d calls x %d s: queued in %.3f s, encoded in %.2f s (%.0fx real time), %d dropped' % (fmt, ncalls, seconds, t1 - t0, t2 - t0, audio / (t2 - t0), stats['dropped']))
+        print('%s: %d bytes, %.1f kbit/s per call (pcm: 128.0 kbit/s)' % (fmt, nbytes, nbytes * 8 / 1000.0 / audio))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        check()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(sys.argv[2] if len(sys.argv) > 2 else _def_format, int(sys.argv[3]) if len(sys.argv) > 3 else 16)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'list':
+        list_calls(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    else:
+        sys.stderr.write('usage: %s check | bench [format] [calls] | list <dir> [tgid]\n' % sys.argv[0])
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -22,36 +22,214 @@
 
 """ generate named image file consisting of multi-line text """
 
+# status_renderer renders off the caller's thread: update() only hands
+# over the text, and wakes the renderer if it differs from the text last
+# rendered.  The font and the background are made once; each png is kept
+# in memory, published under its name for http_server (static_cache), and
+# if imgfile is given also written to disk.
+
 from PIL  import Image, ImageDraw, ImageFont
 import os
+import io
+import sys
+import time
+import threading
+import static_cache
 
 _TTF_FILE = '/usr/share/fonts/truetype/freefont/FreeSerif.ttf'
+_MARGIN = 4
 
-def create_image(textlist=["Blank"], imgfile="test.png", bgcolor='red', fgcolor='black', windowsize=(400,300)):
-    global _TTF_FILE
-    width=windowsize[0]
-    height=windowsize[1]
+_fonts = {}	# (ttf file, size) -> font
 
-    margin      = 4
-    if not os.access(_TTF_FILE, os.R_OK):
-        font        = ImageFont.load_default()
-    else:
-        font        = ImageFont.truetype(_TTF_FILE, 16)
-    img        = Image.new('RGB', (width, height), bgcolor)
-    draw        = ImageDraw.Draw(img)
+def load_font(size=16):
+    key = (_TTF_FILE, size)
+    if key not in _fonts:
+        if not os.access(_TTF_FILE, os.R_OK):
+            _fonts[key] = ImageFont.load_default()
+        else:
+            _fonts[key] = ImageFont.truetype(_TTF_FILE, size)
+    return _fonts[key]
+
+def line_height(draw, font):
+    if hasattr(font, 'getmetrics'):
+        ascent, descent = font.getmetrics()
+        return ascent + descent
+    return draw.textsize('Ay', font)[1]	# (older PIL bitmap fonts)
+
+def draw_text(img, textlist, font, fgcolor='black'):
+    draw = ImageDraw.Draw(img)
+    h = line_height(draw, font)
     cursor = 0
     for line in textlist:
-        w,h         = draw.textsize(line, font)
         # TODO: overwidth check needed?
-        if cursor+h >= height:
+        if cursor+h >= img.size[1]:
             break
-        draw.text((margin, cursor), line,'black',font)
-        cursor += h + margin // 2
+        draw.text((_MARGIN, cursor), line, fgcolor, font)
+        cursor += h + _MARGIN // 2
 
+def create_image(textlist=["Blank"], imgfile="test.png", bgcolor='red', fgcolor='black', windowsize=(400,300)):
+    img = Image.new('RGB', windowsize, bgcolor)
+    draw_text(img, textlist, load_font(), fgcolor)
     img.save(imgfile)
 
+class status_renderer(threading.Thread):
+    def __init__(self, name, imgfile=None, bgcolor='red', fgcolor='black', windowsize=(400,300), **kwds):
+        threading.Thread.__init__(self, **kwds)
+        self.daemon = True
+        self.name = name
+        self.imgfile = imgfile
+        self.fgcolor = fgcolor
+        self.font = load_font()
+        self.background = Image.new('RGB', windowsize, bgcolor)
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.pending = None	# text to render next
+        self.rendered = None	# text of self.png
+        self.png = None
+        self.mtime = 0
+        self.counts = {'updates': 0, 'unchanged': 0, 'renders': 0, 'render_ms': 0.0, 'errors': 0}
+        static_cache.publish(name, self.get)
+        self.start()
+
+    def update(self, textlist):
+        with self.lock:
+            self.counts['updates'] += 1
+            if textlist == (self.rendered if self.pending is None else self.pending):
+                self.counts['unchanged'] += 1
+                return
+            self.pending = textlist
+        self.dirty.set()
+
+    def run(self):
+        while True:
+            self.dirty.wait()
+            self.dirty.clear()
+            with self.lock:
+                textlist = self.pending
+            if textlist is None:
+                continue
+            try:
+                self.render(textlist)
+            except Exception as e:
+                self.counts['errors'] += 1
+                sys.stderr.write('%f %s: render failed: %s\n' % (time.time(), self.name, e))
+            with self.lock:
+                self.rendered = textlist
+                if self.pending is textlist:
+                    self.pending = None
+
+    def render(self, textlist):
+        t0 = time.time()
+        img = self.background.copy()
+        draw_text(img, textlist, self.font, self.fgcolor)
+        buf = io.BytesIO()
+        img.save(buf, 'PNG')
+        png = buf.getvalue()
+        self.png, self.mtime = png, time.time()	# (one assignment: readers see a matching pair)
+        if self.imgfile:
+            tmp = os.path.join(os.path.dirname(self.imgfile), 'tmp-' + os.path.basename(self.imgfile))
+            with open(tmp, 'wb') as f:
+                f.write(png)
+            os.replace(tmp, self.imgfile)
+        self.counts['renders'] += 1
+        self.counts['render_ms'] += (time.time() - t0) * 1000.0
+
+    def get(self):
+        # (png, mtime) last rendered, or None before the first
+        png, mtime = self.png, self.mtime
+        if png is None:
+            return None
+        return png, mtime
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+def sample_status(n):
+    s = ['OP25-hls hacks (c) Copyright 2020, 2021, KA1RBI', '', '====== NAC 0x293 ====== sample ======']
+    s.append('rf: syid 3a1 rfid 1 stid 1 frequency 851.012500 uplink 806.012500')
+    s.append('stats: tsbks %d crc 0' % n)
+    for f in range(8):
+        s.append('voice frequency %f tgid(s) %d None %4.1fs ago count %d' % (851.0125 + f * 0.0125, 100 + f, (n + f) % 7 / 2.0, n + f))
+    return s
+
+def check():
+    import tempfile
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        imgfile = os.path.join(tmpdir, 'status.png')
+        r = status_renderer('check.png', imgfile=imgfile, bgcolor='#c0c0c0', windowsize=(640,480))
+        assert static_cache.published['check.png']() is None
+        r.update(sample_status(1))
+        for i in range(100):
+            if r.stats()['renders']:
+                break
+            time.sleep(0.01)
+        png, mtime = r.get()
+        assert png[:8] == b'\x89PNG\r\n\x1a\n' and open(imgfile, 'rb').read() == png
+        assert Image.open(io.BytesIO(png)).size == (640, 480)
+        r.update(sample_status(1))	# same text: not rendered again
+        r.update(list(sample_status(1)))
+        time.sleep(0.1)
+        c = r.stats()
+        assert c['renders'] == 1 and c['unchanged'] == 2, c
+        for i in range(2, 50):	# faster than it renders: the latest text wins
+            r.update(sample_status(i))
+        for i in range(200):
+            if r.rendered == sample_status(49):
+                break
+            time.sleep(0.01)
+        assert r.rendered == sample_status(49) and r.get()[0] != png
+        assert r.stats()['renders'] <= 49
+        # the same pixels as create_image()
+        create_image(sample_status(49), imgfile=os.path.join(tmpdir, 'direct.png'), bgcolor='#c0c0c0', windowsize=(640,480))
+        assert Image.open(os.path.join(tmpdir, 'direct.png')).tobytes() == Image.open(io.BytesIO(r.get()[0])).tobytes()
+        sys.stderr.write('%s\n' % r.stats())
+    finally:
+        shutil.rmtree(tmpdir)
+    print('create_image check ok')
+
+def bench(n=50):
+    # time on the caller's thread, per status update: before (create_image
+    # to disk, font loaded each time) and now (status_renderer.update)
+    import tempfile
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    try:
+        imgfile = os.path.join(tmpdir, 'status.png')
+        tmpfile = os.path.join(tmpdir, 'tmp-status.png')
+        t0 = time.time()
+        for i in range(n):
+            _fonts.clear()
+            create_image(sample_status(i), imgfile=tmpfile, bgcolor='#c0c0c0', windowsize=(640,480))
+            os.rename(tmpfile, imgfile)
+        t1 = time.time()
+        r = status_renderer('bench.png', imgfile=imgfile, bgcolor='#c0c0c0', windowsize=(640,480))
+        t2 = time.time()
+        for i in range(n):
+            r.update(sample_status(i))
+        t3 = time.time()
+        r.update(sample_status(-1))
+        while r.rendered != sample_status(-1):
+            time.sleep(0.001)
+        t4 = time.time()
+        c = r.stats()
+        print('synchronous create_image: %.2f ms per update' % ((t1 - t0) * 1000.0 / n))
+        print('status_renderer.update: %.4f ms per update on the caller\'s thread' % ((t3 - t2) * 1000.0 / n))
+        print('background: %d renders of %d updates, %.2f ms per render, %.2f s to catch up' % (c['renders'], c['updates'], c['render_ms'] / max(1, c['renders']), t4 - t3))
+    finally:
+        shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
-    s = []
-    s.append('Starting...')
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        check()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        if len(sys.argv) > 2:
+            _TTF_FILE = sys.argv[2]
+        bench()
+    else:
+        s = []
+        s.append('Starting...')
 
-    create_image(textlist=s, bgcolor='#c0c0c0')
+        create_image(textlist=s, bgcolor='#c0c0c0')
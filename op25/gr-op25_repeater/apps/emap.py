@@ -1,5 +1,7 @@
 #sql_dbi events map
 
+import sys
+
 events_map = {
 	"grp_v_ch_grant_mbt":	[
 		['time', 'time'],
@@ -381,3 +383,41 @@ cc_desc = {
 	"u_reg_cmd":				"Unit Registration Command (Force Unit Registration) - 0x2D",
 	"u_reg_resp":				"Unit Registration Response - 0x2C"
 }
+
+def event_columns(d):
+	# map a cc_event dict to (data_store column names, row values)
+	# returns None for events that are not logged
+	if d['cc_event'] not in events_map:
+		return None
+	row = []
+	column_names = []
+	for col in events_map[d['cc_event']]:
+		colname = col[0]
+		k = col[1]
+		# special mappings: unwrap tgid and srcid objects
+		if colname.startswith('tgid') and type(d[k]) is dict:
+			val = d[k]['tg_id']
+		elif colname.startswith('suid') and type(d[k]) is dict:
+			val = d[k]['unit_id']
+		elif type(d[k]) is not dict:
+			val = d[k]
+		else:
+			sys.stderr.write('value retrieval error %s %s %s\n' % (d['cc_event'], type(d[k]) is dict, k))
+			val = -1
+		# special mappings: map cc_event tag to an int
+		if colname == 'cc_event':
+			val = cc_events[d[k]]
+		# special mappings: map affiliation to int
+		if k == 'affiliation':
+			if d[k] == 'global':
+				val = 1
+			elif d[k] == 'local':
+				val = 0
+			else:
+				val = -1
+		# special mappings: map duration to int(msec).
+		if k == 'duration':
+			val = int(d[k] * 1000)
+		row.append(val)
+		column_names.append(colname)
+	return column_names, row
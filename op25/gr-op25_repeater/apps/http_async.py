@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# This file is part of OP25
+#
+# OP25 is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# OP25 is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OP25; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Boston, MA
+# 02110-1301, USA.
+
+# asyncio http server for the http terminal (python3 only).
+#
+# Selected with an endpoint of host:port:asyncio (rx.py -l http:host:port:asyncio).
+# Serves the same requests as http_server.application, but every
+# connection - including any number of /stream clients - is a task on one
+# event loop instead of a thread from the waitress pool.  Stream clients
+# are woken by the event_broadcaster; static files are read in the
+# default executor, and POSTed commands go to my_output_q (which is never
+# waited on) as before.
+#
+# usage:
+#     ./http_async.py loadtest [clients] [seconds]	SSE clients against a stub backend
+
+import sys
+import time
+import json
+import asyncio
+import threading
+import traceback
+
+import http_server
+
+MAX_HEADER_LINES = 100
+MAX_BODY = 1 << 20
+
+class async_http_server(object):
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.streams = set()	# asyncio.Event of each /stream client
+        self.wake_pending = False
+        self.ready = threading.Event()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start())
+        self.ready.set()
+        self.loop.run_forever()
+
+    async def start(self):
+        http_server.my_broadcaster.listeners.append(self.notify)
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+
+    def notify(self):
+        # broadcaster thread: new event(s); one wakeup per loop iteration
+        if self.wake_pending:
+            return
+        self.wake_pending = True
+        self.loop.call_soon_threadsafe(self.wake_streams)
+
+    def wake_streams(self):
+        self.wake_pending = False
+        for ev in self.streams:
+            ev.set()
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                environ = await self.read_request(reader)
+                if environ is None:
+                    break
+                environ['REMOTE_ADDR'] = peer[0] if peer else None
+                if not await self.respond(environ, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        # request line and headers as a (partial) wsgi environ, None at eof
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, target, version = line.decode('latin-1').split()
+        path, _, query = target.partition('?')
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query, 'SERVER_PROTOCOL': version}
+        for i in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            environ['HTTP_' + name.strip().upper().replace('-', '_')] = value.strip()
+        else:
+            raise ValueError('too many headers')
+        length = int(environ.get('HTTP_CONTENT_LENGTH', 0))
+        if length > MAX_BODY:
+            raise ValueError('request body too large')
+        environ['body'] = await reader.readexactly(length) if length else b''
+        return environ
+
+    async def respond(self, environ, writer):
+        # returns False when the connection is finished
+        keep_alive = environ['SERVER_PROTOCOL'] == 'HTTP/1.1' and environ.get('HTTP_CONNECTION', '').lower() != 'close'
+        method = environ['REQUEST_METHOD']
+        extra = []
+        try:
+            if method == 'GET' and environ['PATH_INFO'] == '/stream-stats':
+                status, content_type, output = '200 OK', 'application/json', json.dumps(http_server.my_broadcaster.stats())
+            elif method == 'GET' and '/stream' in environ['PATH_INFO']:
+                await self.stream(environ, writer)
+                return False
+            elif method == 'GET':
+                status, content_type, output, extra = await self.loop.run_in_executor(None, http_server.static_file, environ, None)
+            elif method == 'POST':
+                resp_msg = await self.loop.run_in_executor(None, http_server.post_commands, environ['body'])	# config-* commands do file i/o
+                await asyncio.sleep(0.2)	# as post_req(), without holding a thread
+                status, content_type, output = '200 OK', 'application/json', json.dumps(resp_msg)
+            else:
+                status, content_type, output = '200 OK', 'text/plain', '200 OK'
+                sys.stderr.write('http_request: unexpected input %s\n' % environ['PATH_INFO'])
+        except ConnectionError:
+            raise
+        except Exception:
+            sys.stderr.write('application: request failed:\n%s\n' % traceback.format_exc())
+            status, content_type, output = '500 Internal Server Error', 'text/plain', '500 Internal Server Error'
+        if isinstance(output, str):
+            output = output.encode()
+        if not [h for h in extra if h[0] == 'Content-Length']:
+            extra.append(('Content-Length', str(len(output))))
+        headers = ['HTTP/1.1 %s' % status,
+                   'Content-type: %s' % content_type,
+                   'Access-Control-Allow-Origin: *',
+                   'Connection: %s' % ('keep-alive' if keep_alive else 'close')] + ['%s: %s' % h for h in extra]
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode())
+        if hasattr(output, 'read'):	# large file: sendfile() straight from disk
+            try:
+                await writer.drain()
+                await self.loop.sendfile(writer.transport, output)
+            finally:
+                output.close()
+        else:
+            writer.write(output)
+            await writer.drain()
+        return keep_alive
+
+    async def stream(self, environ, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-type: text/event-stream\r\nCache-Control: no-cache\r\nAccess-Control-Allow-Origin: *\r\n\r\n')
+        client = http_server.stream_iterator(environ)
+        ev = asyncio.Event()
+        self.streams.add(ev)
+        try:
+            while True:
+                s = client.frame(0)
+                if s is None:
+                    ev.clear()
+                    s = client.frame(0)	# an event may have arrived before the clear
+                if s is None:
+                    try:
+                        await asyncio.wait_for(ev.wait(), client.KEEPALIVE)
+                        continue
+                    except asyncio.TimeoutError:
+                        s = b':\r\n\r\n'
+                writer.write(s)
+                await writer.drain()	# a slow client waits here and falls behind in the ring
+        finally:
+            self.streams.discard(ev)
+            client.close()
+
+def percentiles(values):
+    if not values:
+        return 'n/a'
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))] * 1000.0
+    return 'p50 %.1f ms p95 %.1f ms p99 %.1f ms max %.1f ms' % (pick(0.5), pick(0.95), pick(0.99), values[-1] * 1000.0)
+
+def loadtest(nclients=100, seconds=10.0, port=18080):
+    # stub backend: a thread posting timestamped cc_events (and one
+    # trunk_update a second) to the input queue, and draining the
+    # commands the server puts on the output queue
+    from gnuradio import gr
+    from json_types import json_type_code
+    input_q = gr.msg_queue(20)
+    output_q = gr.msg_queue(20)
+    server = http_server.http_server(input_q, output_q, '127.0.0.1:%d:asyncio' % port)
+    threading.Thread(target=server.run, daemon=True).start()
+    server.server.ready.wait()
+    done = threading.Event()
+
+    def backend():
+        n = 0
+        next_update = 0
+        while not done.is_set():
+            now = time.time()
+            d = {'json_type': 'cc_event', 'cc_event': 'grp_v_ch_grant', 'n': n, 'time': now}
+            input_q.insert_tail(gr.message().make_from_string(json.dumps(d), -4, 0, json_type_code('cc_event')))
+            if now >= next_update:
+                next_update = now + 1.0
+                d = {'json_type': 'trunk_update', '1006': {'tsbks': n, 'talkgroup_data': dict([(str(t), {'time': now}) for t in range(n % 50)])}, 'time': now}
+                input_q.insert_tail(gr.message().make_from_string(json.dumps(d), -4, 0, json_type_code('trunk_update')))
+            while not output_q.empty_p():
+                output_q.delete_head()
+            n += 1
+            time.sleep(0.02)
+    threading.Thread(target=backend, daemon=True).start()
+
+    latencies = []
+    counts = []
+    request_latencies = {'GET': [], 'POST': []}
+
+    async def sse_client():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'GET /stream HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        await writer.drain()
+        await reader.readuntil(b'\r\n\r\n')
+        n = 0
+        end = time.time() + seconds
+        try:
+            while time.time() < end:
+                frame = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), end - time.time())
+                now = time.time()
+                for line in frame.split(b'\r\n'):
+                    if not line.startswith(b'data:'):
+                        continue
+                    for d in json.loads(line[5:]):
+                        if d['json_type'] == 'cc_event':
+                            latencies.append(now - d['time'])
+                            n += 1
+        except asyncio.TimeoutError:
+            pass
+        counts.append(n)
+        writer.close()
+
+    async def requester():
+        # static and POST requests while the streams are open
+        end = time.time() + seconds
+        while time.time() < end:
+            for req in [b'GET /stream-stats HTTP/1.1\r\nConnection: close\r\n\r\n',
+                        b'POST / HTTP/1.1\r\nConnection: close\r\nContent-Length: 2\r\n\r\n[]']:
+                t0 = time.time()
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(req)
+                await reader.read()
+                request_latencies[req.split()[0].decode()].append(time.time() - t0)
+                writer.close()
+            await asyncio.sleep(0.25)
+
+    async def run_clients():
+        await asyncio.gather(*([sse_client() for i in range(nclients)] + [requester()]))
+
+    asyncio.run(run_clients())
+    done.set()
+    stats = http_server.my_broadcaster.stats()
+    sys.stderr.write('%d SSE clients for %.0f s: %d events received, min %d max %d per client\n' % (nclients, seconds, sum(counts), min(counts), max(counts)))
+    sys.stderr.write('event latency: %s\n' % percentiles(latencies))
+    sys.stderr.write('GET /stream-stats latency: %s\n' % percentiles(request_latencies['GET']))
+    sys.stderr.write('POST latency (includes the 0.2 s reply wait): %s\n' % percentiles(request_latencies['POST']))
+    sys.stderr.write('dropped %d, coalesced %d\n' % (sum([c['dropped'] for c in stats['clients']]), sum([c['coalesced'] for c in stats['clients']])))
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'loadtest':
+        nclients = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10.0
+        loadtest(nclients, seconds)
+    else:
+        sys.stderr.write('usage: %s loadtest [clients] [seconds]\n' % sys.argv[0])
+
+if __name__ == '__main__':
+    main()
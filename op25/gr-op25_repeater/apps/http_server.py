@@ -27,6 +27,8 @@ import json
 import socket
 import traceback
 import threading
+import itertools
+import collections
 import glob
 import subprocess
 import zmq
@@ -37,6 +39,9 @@ from waitress.server import create_server
 from optparse import OptionParser
 from multi_rx import byteify
 from tsvfile import load_tsv, make_config
+from trunk_delta import trunk_state
+from json_types import json_type_of
+from static_cache import static_cache
 
 import logging
 logging.basicConfig()
@@ -46,8 +51,12 @@ my_output_q = None
 my_recv_q = None
 my_port = None
 my_backend = None
+my_trunk_state = trunk_state()
+my_broadcaster = None
+my_static_cache = static_cache()
 CFG_DIR = '../www/config/'
 TSV_DIR = './'
+STREAM_BLOCK = 65536	# read size for files streamed from disk
 
 """
 fake http and ajax server module
@@ -61,36 +70,151 @@ def ensure_str(s):	# for python 2/3
         ns += chr(s[i])
     return ns
 
+class event_broadcaster(threading.Thread):
+    # sole reader of my_input_q.  Encoded events go into one ring buffer
+    # that every /stream client reads at its own pace; a client that falls
+    # more than ring_size events behind skips ahead and counts the drops.
+    # trunk_updates go into my_trunk_state instead, and each client is
+    # sent the changes since its last one.
+    def __init__(self, input_q, ring_size=512, **kwds):
+        threading.Thread.__init__ (self, **kwds)
+        self.setDaemon(1)
+        self.input_q = input_q
+        self.ring = collections.deque(maxlen=ring_size)	# (seq, json_type, encoded msg)
+        self.seq = 0	# seq of the newest event
+        self.cond = threading.Condition()
+        self.clients = set()
+        self.listeners = []	# called (from this thread) after each new event
+        self.db_stats = None	# the latest db_stats message, for /stream-stats
+        self.start()
+
+    def run(self):
+        while True:
+            msg = self.input_q.delete_head()
+            if msg.type() != -4:
+                continue
+            s = msg.to_string()
+            json_type = json_type_of(s, msg.arg2())
+            if json_type == 'trunk_update':
+                # the one message that is decoded: the delta state needs it
+                my_trunk_state.update(json.loads(s))
+                with self.cond:
+                    self.cond.notify_all()
+            else:
+                if json_type == 'db_stats':
+                    self.db_stats = s
+                with self.cond:
+                    self.seq += 1
+                    self.ring.append((self.seq, json_type, s))
+                    self.cond.notify_all()
+            for listener in self.listeners:
+                listener()
+
+    def read(self, client, timeout):
+        # events after client.cursor, waiting up to timeout sec. for one;
+        # returns (events, number skipped because the ring overran)
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.seq == client.cursor and not client.trunk_pending():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return [], 0
+                self.cond.wait(remaining)
+            if not self.ring or self.seq == client.cursor:
+                return [], 0
+            first = self.ring[0][0]
+            skipped = max(0, first - client.cursor - 1)
+            events = list(itertools.islice(self.ring, max(0, client.cursor + 1 - first), None))
+            client.cursor = self.seq
+        return events, skipped
+
+    def stats(self):
+        with self.cond:
+            clients = list(self.clients)
+            seq = self.seq
+        db_stats = self.db_stats
+        return {'seq': seq, 'trunk_seq': my_trunk_state.seq, 'ring': len(self.ring), 'ring_size': self.ring.maxlen,
+                'clients': [c.stats(seq) for c in clients], 'db': json.loads(db_stats) if db_stats else None}
+
 class event_iterator:
+    COALESCE = ['rx_update']	# json_types where only the latest matters to a client that is behind
+    KEEPALIVE = 15.0	# sec. between frames when idle, so dead connections are noticed
+
+    def __init__(self, last_event_id=None, json_types=None, remote=None):
+        # trunk_update seq this client has seen, from the SSE id of its last
+        # connection if the browser is reconnecting to this same server
+        self.trunk_seq = my_trunk_state.parse_event_id(last_event_id)
+        self.json_types = json_types	# json_types to send, None for all
+        self.want_trunk = json_types is None or 'trunk_update' in json_types
+        self.remote = remote
+        self.connected = time.time()
+        self.frames = 0
+        self.dropped = 0
+        self.coalesced = 0
+        with my_broadcaster.cond:
+            self.cursor = my_broadcaster.seq	# only events from now on
+            my_broadcaster.clients.add(self)
+
     def __iter__(self):
         return self
 
+    def trunk_pending(self):
+        return self.want_trunk and my_trunk_state.seq != 0 and my_trunk_state.seq != self.trunk_seq
+
     def __next__(self):
+        s = self.frame(self.KEEPALIVE)
+        if s is None:
+            return b':\r\n\r\n'	# keepalive comment
+        return s
+
+    next = __next__	# for python2
+
+    def frame(self, timeout):
+        # next SSE frame, waiting up to timeout sec.; None if there is nothing to send
         _jslog_file = None	 # set to str(filename) to enable json log
-        msgs = []
-        while True:
-            msg = my_input_q.delete_head()
-            assert msg.type() == -4
-            d = json.loads(msg.to_string())
-            msgs.append(d)
-            if my_input_q.empty_p():
-                break
-        js = json.dumps(msgs)
-        # TODO: json.loads followed by dumps is redundant - 
-        #       can this be optimized?
-        s = 'data:%s\r\n\r\n' % (js)
+        events, skipped = my_broadcaster.read(self, timeout)
+        msgs = []	# messages as encoded by the sender, spliced into the frame as is
+        if skipped:
+            self.dropped += skipped
+            d = {'json_type': 'stream_status', 'dropped': self.dropped, 'coalesced': self.coalesced, 'time': time.time()}
+            msgs.append(json.dumps(d).encode())
+        latest = {}
+        for i, e in enumerate(events):
+            if e[1] in self.COALESCE:
+                latest[e[1]] = i
+        for i, (seq, json_type, s) in enumerate(events):
+            if self.json_types is not None and json_type not in self.json_types:
+                continue
+            if json_type in latest and latest[json_type] != i:
+                self.coalesced += 1
+                continue
+            msgs.append(s)
+        event_id = None
+        if self.want_trunk:
+            js, self.trunk_seq = my_trunk_state.encoded_since(self.trunk_seq)
+            if js is not None:
+                msgs.append(js.encode() if sys.version[0] != '2' else js)
+                event_id = my_trunk_state.event_id(self.trunk_seq)
+        if not msgs:
+            return None
+        self.frames += 1
+        s = b'data:[' + b','.join(msgs) + b']\r\n\r\n'
+        if event_id is not None:
+            s = b'id:' + event_id.encode() + b'\r\n' + s
 
         if _jslog_file:
-            t = json.dumps(msgs, indent=4, separators=[',',':'], sort_keys=True)
+            t = json.dumps([json.loads(m) for m in msgs], indent=4, separators=[',',':'], sort_keys=True)
             with open(_jslog_file, 'a') as logfd:
                 logfd.write('%s\n' % t)
-        
-        if sys.version[0] != '2':
-            if isinstance(s, str):
-                s = s.encode()
         return s
 
-    next = __next__	# for python2
+    def close(self):	# called by the server when the client goes away
+        with my_broadcaster.cond:
+            my_broadcaster.clients.discard(self)
+
+    def stats(self, seq):
+        return {'remote': self.remote, 'connected': self.connected, 'behind': seq - self.cursor, 'trunk_seq': self.trunk_seq,
+                'frames': self.frames, 'dropped': self.dropped, 'coalesced': self.coalesced}
 
 def static_file(environ, start_response):
     content_types = {'tsv': 'text/tab-separated-values', 'json': 'application/json', 'png': 'image/png', 'jpeg': 'image/jpeg', 'jpg': 'image/jpeg', 'gif': 'image/gif', 'css': 'text/css', 'js': 'application/javascript', 'html': 'text/html', 'ico': 'image/vnd.microsoft.icon'}
@@ -107,16 +231,23 @@ def static_file(environ, start_response):
     elif suf in data_types:
         pathname = TSV_DIR
     pathname = '%s/%s' % (pathname, filename)
-    if suf not in content_types.keys() or '..' in filename or not os.access(pathname, os.R_OK):
+    headers = []
+    published = None
+    if suf in img_types:	# e.g. status.png, rendered in this process
+        published = my_static_cache.published_response(environ, filename.lstrip('/'))
+    if published is not None:
+        content_type = content_types[suf]
+        status, output, headers = published
+    elif suf not in content_types.keys() or '..' in filename or not os.access(pathname, os.R_OK):
         sys.stderr.write('404 %s\n' % pathname)
         status = '404 NOT FOUND - PATHNAME: %s FILENAME: %s CWD: %s' % (pathname, filename, os. getcwd())
         content_type = 'text/plain'
         output = status
     else:
-        output = open(pathname, 'rb').read()
+        # output is an open file for files too large to cache
         content_type = content_types[suf]
-        status = '200 OK'
-    return status, content_type, output
+        status, output, headers = my_static_cache.response(environ, pathname, content_type)
+    return status, content_type, output, headers
 
 def valid_tsv(filename):
     if not os.access(filename, os.R_OK):
@@ -218,6 +349,16 @@ def do_request(d):
         return None
 
 def post_req(environ, start_response, postdata):
+    resp_msg = post_commands(postdata)
+    time.sleep(0.2)
+
+    status = '200 OK'
+    content_type = 'application/json'
+    output = json.dumps(resp_msg)
+    return status, content_type, output
+
+def post_commands(postdata):
+    # queue the commands in a POST body, returns the list of replies
     global my_input_q, my_output_q, my_recv_q, my_port
     resp_msg = []
     data = []
@@ -247,23 +388,38 @@ def post_req(environ, start_response, postdata):
             my_output_q.delete_head_nowait()   # ignores result
         if not my_output_q.full_p():
             my_output_q.insert_tail(msg)
-    time.sleep(0.2)
+    return resp_msg
 
-    status = '200 OK'
-    content_type = 'application/json'
-    output = json.dumps(resp_msg)
-    return status, content_type, output
+def stream_iterator(environ):
+    # /stream?types=cc_event,trunk_update limits the stream to those json_types
+    m = re.search(r'(?:^|&)types=([a-z_,]+)', environ.get('QUERY_STRING', ''))
+    json_types = set(m.group(1).split(',')) if m else None
+    return event_iterator(environ.get('HTTP_LAST_EVENT_ID'), json_types, environ.get('REMOTE_ADDR'))
 
 def http_request(environ, start_response):
-    if environ['REQUEST_METHOD'] == 'GET' and '/stream' in environ['PATH_INFO']:
+    if environ['REQUEST_METHOD'] == 'GET' and environ['PATH_INFO'] == '/stream-stats':
+        status = '200 OK'
+        content_type = 'application/json'
+        output = json.dumps(my_broadcaster.stats())
+    elif environ['REQUEST_METHOD'] == 'GET' and '/stream' in environ['PATH_INFO']:
         status = '200 OK'
         content_type = 'text/event-stream'
         response_headers = [('Content-type', content_type),
                             ('Access-Control-Allow-Origin', '*')]
         start_response(status, response_headers)
-        return iter(event_iterator())
+        return stream_iterator(environ)
     elif environ['REQUEST_METHOD'] == 'GET':
-        status, content_type, output = static_file(environ, start_response)
+        status, content_type, output, headers = static_file(environ, start_response)
+        if hasattr(output, 'read'):
+            start_response(status, [('Content-type', content_type), ('Access-Control-Allow-Origin', '*')] + headers)
+            if 'wsgi.file_wrapper' in environ:
+                return environ['wsgi.file_wrapper'](output, STREAM_BLOCK)
+            return iter(lambda: output.read(STREAM_BLOCK), b'')
+        if headers:
+            response_headers = [('Content-type', content_type),
+                                ('Access-Control-Allow-Origin', '*')] + headers
+            start_response(status, response_headers)
+            return [output]
     elif environ['REQUEST_METHOD'] == 'POST':
         postdata = environ['wsgi.input'].read()
         status, content_type, output = post_req(environ, start_response, postdata)
@@ -311,16 +467,27 @@ def process_qmsg(msg):
 
 class http_server(object):
     def __init__(self, input_q, output_q, endpoint, **kwds):
-        global my_input_q, my_output_q, my_recv_q, my_port
-        host, port = endpoint.split(':')
+        # endpoint is host:port, or host:port:asyncio to serve from one
+        # asyncio event loop (python3) instead of the waitress thread pool
+        global my_input_q, my_output_q, my_recv_q, my_port, my_broadcaster
+        endpoint = endpoint.split(':')
+        host, port = endpoint[:2]
+        server_type = endpoint[2] if len(endpoint) > 2 else 'waitress'
         if my_port is not None:
             raise AssertionError('this server is already active on port %s' % my_port)
         my_input_q = input_q
+        my_broadcaster = event_broadcaster(input_q)
         my_output_q = output_q
         my_port = int(port)
 
         my_recv_q = gr.msg_queue(10)
 
+        if server_type == 'asyncio':
+            from http_async import async_http_server
+            self.server = async_http_server(host, my_port)
+            return
+        elif server_type != 'waitress':
+            raise AssertionError('unknown http server type %s' % server_type)
         SEND_BYTES = 1024
         NTHREADS = 10	# TODO: make #threads a function of #plots ?
         self.server = create_server(application, host=host, port=my_port, send_bytes=SEND_BYTES, expose_tracebacks=True, threads=NTHREADS)
@@ -451,6 +618,7 @@ class Backend(threading.Thread):
                 'audio-gain': 'float',
                 'freq-error-tracking': 'bool',
                 'nocrypt': 'bool',
+                'tsbk-file': 'str',
                 'wireshark-port': 'int'
             }
             self.backend = '%s/%s' % (os.getcwd(), 'rx.py')
@@ -562,7 +730,7 @@ def http_main():
     # command line argument parsing
     parser = OptionParser()
     parser.add_option("-c", "--config", type="string", default=None, help="config json name, without prefix/suffix")
-    parser.add_option("-e", "--endpoint", type="string", default="127.0.0.1:8080", help="address:port to listen on (use addr 0.0.0.0 to enable external clients)")
+    parser.add_option("-e", "--endpoint", type="string", default="127.0.0.1:8080", help="address:port to listen on (use addr 0.0.0.0 to enable external clients), append :asyncio to serve from an asyncio event loop")
     parser.add_option("-v", "--verbosity", type="int", default=0, help="message debug level")
     parser.add_option("-p", "--pause", action="store_true", default=False, help="block on startup")
     parser.add_option("-z", "--zmq-port", type="int", default=25000, help="backend sub port")
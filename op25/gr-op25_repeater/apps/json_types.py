@@ -0,0 +1,43 @@
+
+# This file is part of OP25
+#
+# OP25 is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# OP25 is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OP25; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Boston, MA
+# 02110-1301, USA.
+
+# json_type header for the -4 (json) messages sent to the terminals.
+#
+# The sender puts json_type_code(json_type) in the message's arg2 so the
+# http terminal can route and filter a message without decoding it.
+# Messages without a code (arg2 == 0, e.g. relayed over zmq) fall back to
+# a regex search of the encoded text.
+
+import re
+
+JSON_TYPES = [None, 'trunk_update', 'change_freq', 'rx_update', 'cc_event', 'freq_error_tracking', 'config_data', 'config_list', 'audio_stats', 'db_stats']
+_codes = dict([(t, i) for i, t in enumerate(JSON_TYPES) if t])
+_json_type_re = re.compile(br'"json_type":\s*"([^"]*)"')
+
+def json_type_code(json_type):
+    return _codes.get(json_type, 0)
+
+def json_type_of(s, code=0):
+    # json_type of the encoded message s (bytes) given its arg2 code
+    code = int(code)
+    if 0 < code < len(JSON_TYPES):
+        return JSON_TYPES[code]
+    m = _json_type_re.search(s)
+    if m is None:
+        return None
+    return m.group(1).decode()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+# This file is part of OP25
+#
+# OP25 is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# OP25 is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OP25; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Boston, MA
+# 02110-1301, USA.
+
+# Columnar archive of the control channel event log (data_store).
+#
+# export() writes the data_store rows in (time, id) order to one Parquet
+# or Arrow IPC file per day and receiver, in hive style partitions:
+# <dir>/day=YYYY-MM-DD/<source>.parquet (or .arrow).  The trees of several
+# receivers can be copied into one directory and read as one dataset
+# (pyarrow.dataset, duckdb, ...).  cc_event is written as its name;
+# cc_event, sysid, tgid and suid are dictionary encoded.  Days are UTC, as
+# the sqlite_store rollups; re-exporting a day replaces its file.
+#
+# import_files() appends archive files to a database, e.g. to merge the
+# logs of several receivers into one for oplog.  A row whose (time, sysid,
+# cc_event, opcode, tgid, suid) is already in data_store is skipped, so
+# importing a file again, or an event two trees both hold, adds nothing.
+#
+# Both read and write BATCH_ROWS rows at a time (the export a keyset page
+# per read transaction, so the event writer's WAL is checkpointed as
+# usual), so memory use does not depend on the size of the log.
+#
+# pyarrow is needed for this module only.
+#
+# usage:
+#     ./log_archive.py export <db> <dir> [parquet|arrow] [source] [days]
+#				days: the last days only (0: all)
+#     ./log_archive.py import <db> <dir or file>...
+#     ./log_archive.py bench [rows]	file size and scan speed against sqlite
+
+import os
+import sys
+import time
+import socket
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+import sqlite_store
+
+COLUMNS = 'time cc_event opcode sysid mfrid p p2 p3 wacn frequency tgid tgid2 suid suid2 tsbk_sysid'.split()
+DICTIONARY_COLUMNS = ['sysid', 'tgid', 'suid']	# (and cc_event)
+NOT_NULL = ['time', 'cc_event', 'opcode', 'sysid']
+NATURAL_KEY = ['time', 'sysid', 'cc_event', 'opcode', 'tgid', 'suid']	# duplicate rows, for import_files()
+BATCH_ROWS = 65536
+COMPRESSION = 'zstd'
+SUFFIX = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+def require_pyarrow():
+	if pa is None:
+		raise RuntimeError('log_archive needs pyarrow (pip3 install pyarrow)')
+
+def schema(source=''):
+	fields = [pa.field('time', pa.float64(), False),
+		pa.field('cc_event', pa.dictionary(pa.int8(), pa.string()), False)]
+	for col in COLUMNS[2:]:
+		t = pa.dictionary(pa.int32(), pa.int64()) if col in DICTIONARY_COLUMNS else pa.int64()
+		fields.append(pa.field(col, t, col not in NOT_NULL))
+	return pa.schema(fields, metadata={'op25.source': source})
+
+def event_names(cursor):
+	# cc_event id -> name, as a list indexed by id (the cc_event dictionary)
+	keys = dict(cursor.execute('SELECT id, tag FROM event_keys').fetchall())
+	return [keys.get(i, str(i)) for i in range(max(keys) + 1 if keys else 0)]
+
+def encode(values, index, dictionary):
+	# a DictionaryArray of values on a dictionary that only grows within a
+	# file, so that each batch's dictionary extends the one before (an
+	# Arrow IPC file can't replace a dictionary, only add to it)
+	codes = []
+	for v in values:
+		if v is None:
+			codes.append(None)
+			continue
+		c = index.get(v)
+		if c is None:
+			c = index[v] = len(dictionary)
+			dictionary.append(v)
+		codes.append(c)
+	return pa.DictionaryArray.from_arrays(pa.array(codes, pa.int32()), pa.array(dictionary, pa.int64()))
+
+def record_batch(rows, names, sch, dictionaries):
+	# data_store rows (in COLUMNS order) to a RecordBatch of schema sch;
+	# dictionaries: column -> (index, values) of the file
+	columns = list(zip(*rows))
+	arrays = [pa.array(columns[0], pa.float64()),
+		pa.DictionaryArray.from_arrays(pa.array(columns[1], pa.int8()), names)]
+	for col, values in zip(COLUMNS[2:], columns[2:]):
+		if col in DICTIONARY_COLUMNS:
+			arrays.append(encode(values, *dictionaries[col]))
+		else:
+			arrays.append(pa.array(values, pa.int64()))
+	return pa.RecordBatch.from_arrays(arrays, schema=sch)
+
+def partition(directory, day):
+	return os.path.join(directory, 'day=%s' % time.strftime('%Y-%m-%d', time.gmtime(day * sqlite_store.DAY)))
+
+class archive_writer(object):
+	# the file of one day at a time (rows arrive in time order); each is
+	# written as .tmp and renamed when complete
+	def __init__(self, directory, fmt, sch):
+		self.directory = directory
+		self.fmt = fmt
+		self.schema = sch
+		self.source = sch.metadata[b'op25.source'].decode()
+		self.day = None
+		self.writer = None
+		self.sink = None
+		self.files = []
+
+	def write(self, day, rows, names):
+		if day != self.day:
+			self.close()
+			self.open(day)
+		self.writer.write_batch(record_batch(rows, names, self.schema, self.dictionaries))
+
+	def open(self, day):
+		d = partition(self.directory, day)
+		if not os.path.isdir(d):
+			os.makedirs(d)
+		self.day = day
+		self.dictionaries = dict([(col, ({}, [])) for col in DICTIONARY_COLUMNS])
+		self.filename = os.path.join(d, self.source + SUFFIX[self.fmt])
+		if self.fmt == 'parquet':
+			self.writer = pq.ParquetWriter(self.filename + '.tmp', self.schema, compression=COMPRESSION)
+		else:
+			self.sink = pa.OSFile(self.filename + '.tmp', 'wb')
+			self.writer = pa.ipc.new_file(self.sink, self.schema, options=pa.ipc.IpcWriteOptions(compression=COMPRESSION, emit_dictionary_deltas=True))
+
+	def close(self):
+		if self.writer is None:
+			return
+		self.writer.close()
+		if self.sink is not None:
+			self.sink.close()
+		os.replace(self.filename + '.tmp', self.filename)
+		self.files.append(self.filename)
+		self.writer = self.sink = None
+
+def export(db_filename, directory, fmt='parquet', source=None, since=0):
+	# data_store rows from time since on; returns (rows, files written)
+	require_pyarrow()
+	conn = sqlite_store.connect(db_filename)
+	cursor = conn.cursor()
+	names = pa.array(event_names(cursor), pa.string())
+	writer = archive_writer(directory, fmt, schema(source or socket.gethostname()))
+	q = 'SELECT id, %s FROM data_store WHERE time >= ? AND (time > ? OR id > ?) ORDER BY time, id LIMIT %d' % (', '.join(COLUMNS), BATCH_ROWS)
+	key = (since, since, -1)
+	n = 0
+	try:
+		while True:
+			rows = cursor.execute(q, key).fetchall()
+			if not rows:
+				break
+			key = (rows[-1][1], rows[-1][1], rows[-1][0])
+			# split the page at day boundaries
+			start = 0
+			while start < len(rows):
+				day = int(rows[start][1]) // sqlite_store.DAY
+				end = start
+				while end < len(rows) and int(rows[end][1]) // sqlite_store.DAY == day:
+					end += 1
+				writer.write(day, [r[1:] for r in rows[start:end]], names)
+				start = end
+			n += len(rows)
+	finally:
+		writer.close()
+		conn.close()
+	return n, writer.files
+
+def archive_files(paths):
+	# the archive files named in paths or under the directories in paths
+	files = []
+	for path in paths:
+		if not os.path.isdir(path):
+			files.append(path)
+			continue
+		for d, subdirs, names in os.walk(path):
+			subdirs.sort()
+			files += [os.path.join(d, f) for f in sorted(names) if os.path.splitext(f)[1] in SUFFIX.values()]
+	return files
+
+def read_batches(filename):
+	if filename.endswith(SUFFIX['parquet']):
+		f = pq.ParquetFile(filename)
+		try:
+			for batch in f.iter_batches(BATCH_ROWS):
+				yield batch
+		finally:
+			f.close()
+	else:
+		with pa.memory_map(filename) as source:
+			reader = pa.ipc.open_file(source)
+			for i in range(reader.num_record_batches):
+				yield reader.get_batch(i)
+
+def batch_rows(batch, event_ids):
+	# a RecordBatch to data_store rows (in COLUMNS order)
+	columns = []
+	for col in COLUMNS:
+		i = batch.schema.get_field_index(col)
+		columns.append(batch.column(i).to_pylist() if i >= 0 else [None] * batch.num_rows)
+	try:
+		columns[1] = [event_ids[name] for name in columns[1]]
+	except KeyError as e:
+		raise ValueError('unknown cc_event %s' % e)
+	return list(zip(*columns))
+
+def import_files(db_filename, paths, progress=None):
+	# append the rows of the archive files to data_store (and its rollups),
+	# one batch per transaction, less those already there (NATURAL_KEY);
+	# returns the number of rows added.  Each batch goes through a temp
+	# table, to be checked against data_store (ds_time_idx) in one statement.
+	require_pyarrow()
+	conn = sqlite_store.connect(db_filename)
+	cursor = conn.cursor()
+	event_ids = dict([(tag, i) for i, tag in cursor.execute('SELECT id, tag FROM event_keys').fetchall()])
+	cols = ','.join(COLUMNS)
+	cursor.execute('CREATE TEMP TABLE IF NOT EXISTS import_rows AS SELECT %s FROM data_store WHERE 0' % cols)
+	load = 'INSERT INTO import_rows(%s) VALUES(%s)' % (cols, ','.join(['?'] * len(COLUMNS)))
+	command = 'INSERT INTO data_store(%s) SELECT %s FROM import_rows i WHERE NOT EXISTS (SELECT 1 FROM data_store d WHERE %s) ORDER BY i.rowid' % (
+		cols, ','.join(['i.' + c for c in COLUMNS]), ' AND '.join(['d.time = i.time'] + ['d.%s IS i.%s' % (c, c) for c in NATURAL_KEY[1:]]))
+	n = 0
+	try:
+		for filename in archive_files(paths):
+			for batch in read_batches(filename):
+				rows = batch_rows(batch, event_ids)
+				cursor.execute('BEGIN IMMEDIATE')
+				rollups = sqlite_store.track_rollups(cursor)
+				cursor.execute('DELETE FROM import_rows')
+				cursor.executemany(load, rows)
+				added = cursor.execute(command).rowcount
+				if rollups and added:
+					sqlite_store.update_rollups(cursor)
+				conn.commit()
+				n += added
+			if progress:
+				progress(filename, n)
+	finally:
+		conn.close()
+	return n
+
+def du(path):
+	if not os.path.isdir(path):
+		return os.path.getsize(path)
+	return sum([os.path.getsize(os.path.join(d, f)) for d, subdirs, names in os.walk(path) for f in names])
+
+def bench(rows=2000000):
+	# a synthetic log (query_plans.fill) exported to both formats and
+	# imported back; sizes, and a full scan (voice grants per talkgroup and
+	# system) from each.  Checks the round trip and rollups on the way.
+	import shutil
+	import tempfile
+	import pyarrow.dataset as ds
+	import pyarrow.compute as pc
+	import sql_dbi
+	import query_plans
+	require_pyarrow()
+	tmpdir = tempfile.mkdtemp()
+	try:
+		db_filename = sql_dbi.scratch_db(tmpdir)
+		conn = sqlite_store.connect(db_filename)
+		query_plans.fill(conn, rows)
+		sqlite_store.rebuild_rollups(conn.cursor())
+		conn.commit()
+		conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+		sizes = [('sqlite (with indexes)', du(db_filename))]
+		print('%d rows' % rows)
+		for fmt in ('parquet', 'arrow'):
+			t0 = time.time()
+			n, files = export(db_filename, os.path.join(tmpdir, fmt), fmt, 'rx1')
+			dt = time.time() - t0
+			sizes.append((fmt, du(os.path.join(tmpdir, fmt))))
+			print('export %s: %d rows in %d files, %.1f s (%.0f rows/s)' % (fmt, n, len(files), dt, n / dt))
+			assert n == rows
+		for name, size in sizes:
+			print('%-22s %8.1f MB  %5.1f bytes/row' % (name, size / 1e6, size / float(rows)))
+
+		# full scan: voice grants per (sysid, tgid)
+		t0 = time.time()
+		ref = conn.execute('SELECT sysid, tgid, COUNT(*) FROM data_store WHERE cc_event = (SELECT id FROM event_keys WHERE tag = "grp_v_ch_grant") GROUP BY sysid, tgid').fetchall()
+		print('scan sqlite: %.2f s' % (time.time() - t0))
+		ref = sorted(ref)
+		for fmt in ('parquet', 'arrow'):
+			t0 = time.time()
+			dataset = ds.dataset(os.path.join(tmpdir, fmt), format='parquet' if fmt == 'parquet' else 'ipc', partitioning='hive')
+			table = dataset.to_table(columns=['sysid', 'tgid', 'cc_event'], filter=pc.field('cc_event') == 'grp_v_ch_grant')
+			table = pa.table({'sysid': table['sysid'].cast(pa.int64()), 'tgid': table['tgid'].cast(pa.int64())})
+			counts = table.group_by(['sysid', 'tgid']).aggregate([([], 'count_all')])
+			print('scan %s: %.2f s' % (fmt, time.time() - t0))
+			assert sorted(zip(*[counts[c].to_pylist() for c in ('sysid', 'tgid', 'count_all')])) == ref
+
+		# round trip: each tree imported into an empty db (with the indexes
+		# and rollups of the event writer, which bound the import rate)
+		cols = ', '.join(COLUMNS)
+		for fmt in ('parquet', 'arrow'):
+			copy_filename = os.path.join(tmpdir, fmt + '.db')
+			copy = sql_dbi.sql_dbi(copy_filename)
+			copy.q_runner.stop()
+			copy.reset_db()
+			t0 = time.time()
+			n = import_files(copy_filename, [os.path.join(tmpdir, fmt)])
+			dt = time.time() - t0
+			print('import %s: %d rows, %.1f s (%.0f rows/s)' % (fmt, n, dt, n / dt))
+			assert n == rows
+			t0 = time.time()
+			n = import_files(copy_filename, [os.path.join(tmpdir, fmt)])	# again: nothing new
+			print('import %s again: %d rows, %.1f s' % (fmt, n, time.time() - t0))
+			assert n == 0
+			conn.execute('ATTACH ? AS copy', (copy_filename,))
+			assert conn.execute('SELECT COUNT(*) FROM (SELECT %s FROM data_store EXCEPT SELECT %s FROM copy.data_store)' % (cols, cols)).fetchone()[0] == 0
+			for table, keys, where in sqlite_store._present(conn.cursor()):
+				assert conn.execute('SELECT COUNT(*) FROM (SELECT * FROM %s EXCEPT SELECT * FROM copy.%s)' % (table, table)).fetchone()[0] == 0, table
+			conn.execute('DETACH copy')
+		conn.close()
+	finally:
+		shutil.rmtree(tmpdir)
+	print('ok')
+
+def main():
+	if len(sys.argv) > 3 and sys.argv[1] == 'export':
+		fmt = sys.argv[4] if len(sys.argv) > 4 else 'parquet'
+		source = sys.argv[5] if len(sys.argv) > 5 else None
+		days = int(sys.argv[6]) if len(sys.argv) > 6 else 0
+		since = (int(time.time()) // sqlite_store.DAY - days + 1) * sqlite_store.DAY if days else 0
+		n, files = export(sys.argv[2], sys.argv[3], fmt, source, since)
+		print('%d events exported to %d files' % (n, len(files)))
+	elif len(sys.argv) > 3 and sys.argv[1] == 'import':
+		n = import_files(sys.argv[2], sys.argv[3:], lambda f, n: sys.stderr.write('%s: %d\n' % (f, n)))
+		print('%d events imported' % n)
+	elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+		bench(int(float(sys.argv[2])) if len(sys.argv) > 2 else 2000000)
+	else:
+		sys.stderr.write('usage: %s export <db> <dir> [parquet|arrow] [source] [days] | import <db> <dir or file>... | bench [rows]\n' % sys.argv[0])
+
+if __name__ == '__main__':
+	main()
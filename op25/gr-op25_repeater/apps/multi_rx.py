@@ -40,6 +40,7 @@ import op25_repeater
 import p25_demodulator
 import p25_decoder
 from sockaudio  import audio_thread
+from audio_server import audio_server_thread
 
 from sql_dbi import sql_dbi
 
@@ -55,6 +56,7 @@ from gr_gnuplot import cpm_sink_c
 from nxdn_trunking import cac_message
 
 from terminal import op25_terminal
+from json_types import json_type_code
 
 sys.path.append('tdma')
 import lfsr
@@ -461,7 +463,8 @@ class rx_block (gr.top_block):
         self.trunk_rx = None
         self.track_errors = track_errors
         self.last_change_freq = 0
-        self.sql_db = sql_dbi()
+        db_config = config.get('database', {})    # optional retention policy, see sql_dbi
+        self.sql_db = sql_dbi(retention_days=db_config.get('retention_days', 0), max_size_mb=db_config.get('max_size_mb', 0))
         self.input_q = gr.msg_queue(20)
         self.output_q = gr.msg_queue(20)
         self.last_voice_channel_id = 0
@@ -479,7 +482,9 @@ class rx_block (gr.top_block):
                 sink.gnuplot.set_interval(_def_interval)
                 sink.gnuplot.set_output_dir(_def_file_dir)
 
-        if udp_player:
+        if 'audio' in config:
+            self.audio = audio_server_thread(self.audio_server_config(config['audio']))
+        elif udp_player:
             chan = self.find_audio_channel()	# find chan used for audio
             self.audio = audio_thread("127.0.0.1", chan.audio_port, chan.audio_output, False, chan.audio_gain)
         else:
@@ -540,7 +545,7 @@ class rx_block (gr.top_block):
         for chan in self.channels:
             d = chan.error_tracking(self.last_change_freq)
             if d is not None and not self.input_q.full_p():
-                msg = gr.message().make_from_string(json.dumps(d), -4, 0, 0)
+                msg = gr.message().make_from_string(json.dumps(d), -4, 0, json_type_code(d.get('json_type')))
                 self.input_q.insert_tail(msg)
 
     def change_freq(self, params):
@@ -565,6 +570,8 @@ class rx_block (gr.top_block):
             self.freq_update()
             if channel_type == 'vc':
                 self.last_voice_channel_id = chan.msgq_id
+                if isinstance(self.audio, audio_server_thread):
+                    self.audio.server.set_talkgroup(chan.audio_port, params.get('tgid'), params.get('prio'))
         #return
         if self.trunk_rx is None:
             return
@@ -647,7 +654,7 @@ class rx_block (gr.top_block):
             if hasattr(chan.demod, 'get_freq_error'):
                 error.append(chan.demod.get_freq_error())
         d = {'json_type': 'rx_update', 'error': error, 'files': filenames, 'time': time.time()}
-        msg = gr.message().make_from_string(json.dumps(d), -4, 0, 0)
+        msg = gr.message().make_from_string(json.dumps(d), -4, 0, json_type_code('rx_update'))
         self.input_q.insert_tail(msg)
 
     def process_update(self):
@@ -662,15 +669,32 @@ class rx_block (gr.top_block):
         if self.trunk_rx is None:
             return ## possible race cond - just ignore
         js = self.trunk_rx.to_json()
-        msg = gr.message().make_from_string(js, -4, 0, 0)
+        msg = gr.message().make_from_string(js, -4, 0, json_type_code('trunk_update'))
         self.input_q.insert_tail(msg)
         self.process_ajax()
+        self.audio_update()
+        self.db_update()
+
+    def audio_update(self):
+        if not isinstance(self.audio, audio_server_thread) or self.input_q.full_p():
+            return
+        msg = gr.message().make_from_string(json.dumps(self.audio.server.stats()), -4, 0, json_type_code('audio_stats'))
+        self.input_q.insert_tail(msg)
+
+    def db_update(self):
+        if self.input_q.full_p():
+            return
+        d = self.sql_db.stats()
+        d['json_type'] = 'db_stats'
+        d['time'] = time.time()
+        msg = gr.message().make_from_string(json.dumps(d), -4, 0, json_type_code('db_stats'))
+        self.input_q.insert_tail(msg)
 
     def send_event(self, d):	## called from trunking module to send json msgs / updates to client
         if d is not None:
             self.sql_db.event(d)
         if d and not self.input_q.full_p():
-            msg = gr.message().make_from_string(json.dumps(d), -4, 0, 0)
+            msg = gr.message().make_from_string(json.dumps(d), -4, 0, json_type_code(d.get('json_type')))
             self.input_q.insert_tail(msg)
         self.process_update()
 
@@ -681,7 +705,7 @@ class rx_block (gr.top_block):
         params['json_type'] = 'change_freq'
         params['current_time'] = time.time()
         js = json.dumps(params)
-        msg = gr.message().make_from_string(js, -4, 0, 0)
+        msg = gr.message().make_from_string(js, -4, 0, json_type_code('change_freq'))
         self.input_q.insert_tail(msg)
 
     def process_msg(self, msg):
@@ -794,6 +818,23 @@ class rx_block (gr.top_block):
                 chan.logfile = blocks.file_sink(gr.sizeof_char, cfg['log_symbols'])
                 self.connect(chan.demod, chan.logfile)
 
+    def audio_server_config(self, config):
+        # the audio server config, by default a stream per voice channel
+        # into the audio output of the channel the udp player would use
+        config = dict(config)
+        if 'streams' not in config:
+            config['streams'] = []
+            for chan in self.channels:
+                if chan.role == 'vc' and chan.audio_port not in [s['port'] for s in config['streams']]:
+                    config['streams'].append({'name': chan.name, 'port': chan.audio_port, 'gain': chan.audio_gain})
+            if not config['streams']:
+                chan = self.find_audio_channel()
+                config['streams'].append({'name': chan.name, 'port': chan.audio_port, 'gain': chan.audio_gain})
+        if 'sinks' not in config:
+            output = self.find_audio_channel().audio_output
+            config['sinks'] = [{'name': output, 'type': 'pulse' if output.lower() == 'pulse' else 'alsa', 'device': output}]
+        return config
+
     def find_audio_channel(self):
         for chan in self.channels:	# pass1 - look for 'vc'
             if chan.role == 'vc' and chan.audio_port:
@@ -818,7 +859,7 @@ class rx_main(object):
         parser.add_option("-p", "--pause", action="store_true", default=False, help="block on startup")
         parser.add_option("-M", "--monitor-stdin", action="store_false", default=True, help="enable press ENTER to quit")
         parser.add_option("-T", "--trunk-conf-file", type="string", default=None, help="trunking config file name")
-        parser.add_option("-l", "--terminal-type", type="string", default="curses", help="'curses' or udp port or 'http:host:port'")
+        parser.add_option("-l", "--terminal-type", type="string", default="curses", help="'curses' or udp port or 'http:host:port[:asyncio]'")
         parser.add_option("-X", "--freq-error-tracking", action="store_true", default=False, help="enable experimental frequency error tracking")
         parser.add_option("-U", "--udp-player", action="store_true", default=False, help="enable built-in udp audio player")
         (options, args) = parser.parse_args()
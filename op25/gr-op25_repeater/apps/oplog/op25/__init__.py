@@ -31,17 +31,26 @@ import math
 import json
 import click
 import datetime
+import threading
+import collections
 from datatables import ColumnDT, DataTables
 from flask import Flask, jsonify, render_template, request, redirect, session
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, desc, and_, or_, case, delete, insert, update, exc
+from sqlalchemy import func, desc, and_, or_, case, delete, insert, update, exc, select, type_coerce
 from sqlalchemy.orm import Query
+from sqlalchemy.engine import Engine
+from sqlalchemy import event as sa_event
 from sqlalchemy.exc import OperationalError
 import sqlalchemy.types as types
-from shutil import copyfile
 
 sys.path.append('..')   # for emap
 from emap import oplog_map, cc_events, cc_desc
+import sqlite_store
+
+@sa_event.listens_for(Engine, 'connect')
+def sqlite_pragmas(dbapi_connection, connection_record):
+    # busy timeout and cache settings shared with the event writer (sql_dbi)
+    sqlite_store.configure(dbapi_connection)
 
 app = Flask(__name__)
 app.config.from_pyfile("../app.cfg")
@@ -73,6 +82,129 @@ class column_helper(object):
         for k in cols.keys():
             setattr(self, k, cols[k])
 
+def has_rollups(table='data_store_days'):
+    # per-day summary tables kept by the sql_dbi writer (sqlite_store);
+    # databases made before them need ./sql_dbi.py upgrade_db
+    return table in db.metadata.tables
+
+class keyset_pages(object):
+    # (time, id) of the last row of each page /data has served, by query,
+    # so that the next page is a seek on an index that ends with (time, id)
+    # rather than an OFFSET past every row before it.  The query includes
+    # data_version(), which changes when rows are deleted.  Rows added
+    # after the page ends were cached only shift the pages of a window
+    # that reaches back to them: each query keeps the last data_store id
+    # it was checked against (checked()/get())
+    def __init__(self, max_queries=100):
+        self.max_queries = max_queries
+        self.queries = collections.OrderedDict()   # query -> [last id, {position: (time, id)}], LRU order
+        self.lock = threading.Lock()
+
+    def checked(self, query):
+        # the last id the page ends of query were checked against, or None
+        with self.lock:
+            entry = self.queries.get(query)
+            return entry[0] if entry else None
+
+    def get(self, query, start, last_id, valid=True):
+        # (position, key) of the nearest page end at or before start; the
+        # page ends are dropped unless valid for the rows up to last_id
+        with self.lock:
+            entry = self.queries.pop(query, None)
+            if entry is None or not valid:
+                entry = [last_id, {}]
+            entry[0] = max(entry[0], last_id)
+            self.queries[query] = entry
+            while len(self.queries) > self.max_queries:
+                self.queries.popitem(last=False)
+            pages = entry[1]
+            position = max([p for p in pages if p <= start] or [0])
+            return position, pages.get(position)
+
+    def put(self, query, position, key):
+        with self.lock:
+            if query in self.queries:
+                self.queries[query][1][position] = key
+
+my_pages = keyset_pages()
+
+def data_version():
+    # changes whenever data_store rows are deleted (purge, retention:
+    # sqlite_store.delete_batch()); None on a database older than the
+    # count, whose page ends are not kept
+    if not has_rollups('data_store_state') or 'deleted' not in db.metadata.tables['data_store_state'].columns:
+        return None
+    State = column_helper('data_store_state')
+    return db.session.query(State.deleted).scalar()
+
+class purge_job(threading.Thread):
+    # /purge in the background on its own connection: the backup (sqlite
+    # backup api), the rows deleted in batches while the event writer keeps
+    # logging, and the freed pages returned to the file system.
+    # /purge_status polls status()
+    def __init__(self, database, sd, ed, where, args, query, backup_file=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.database = database
+        self.sd = sd
+        self.ed = ed
+        self.where = where
+        self.args = args
+        self.query = query
+        self.backup_file = backup_file
+        self.state = 'starting'     # backup, count, delete, vacuum, done or failed
+        self.count = 0
+        self.deleted = 0
+        self.free_pages = 0
+        self.error = ''
+        self.started = time.time()
+        self.finished = None
+
+    def run(self):
+        try:
+            if self.backup_file:
+                self.state = 'backup'
+                sqlite_store.backup(self.database, self.backup_file)
+            conn = sqlite_store.connect(self.database)
+            try:
+                self.state = 'count'
+                self.count = conn.execute('SELECT COUNT(*) FROM data_store WHERE time >= ? AND time <= ? AND (%s)' % self.where, (self.sd, self.ed) + tuple(self.args)).fetchone()[0]
+                self.state = 'delete'
+                self.deleted = sqlite_store.delete_rows(conn, self.sd, self.ed, self.where, self.args, progress=self.progress)
+                self.state = 'vacuum'
+                self.free_pages = sqlite_store.release_space(conn)
+                while self.free_pages:
+                    self.free_pages = sqlite_store.release_space(conn)
+                sqlite_store.truncate_wal(conn)
+            finally:
+                conn.close()
+            self.state = 'done'
+        except Exception as e:
+            traceback.print_exc()
+            self.error = str(e)
+            self.state = 'failed'
+        self.finished = time.time()
+
+    def progress(self, deleted):
+        self.deleted = deleted
+
+    def status(self):
+        backup_bytes = 0
+        if self.backup_file and os.path.isfile(self.backup_file):
+            backup_bytes = os.path.getsize(self.backup_file)
+        return {'state': self.state,
+                'count': self.count,
+                'deleted': self.deleted,
+                'free_pages': self.free_pages,
+                'backup_file': os.path.basename(self.backup_file) if self.backup_file else '',
+                'backup_bytes': backup_bytes,
+                'db_bytes': os.path.getsize(self.database),
+                'elapsed': (self.finished or time.time()) - self.started,
+                'query': self.query,
+                'error': self.error}
+
+my_purge = None     # the purge_job running or last run
+
 def dbstate():
     database = app.config['SQLALCHEMY_DATABASE_URI'][10:]
     if not os.path.isfile(database):
@@ -80,8 +212,12 @@ def dbstate():
     fs = os.path.getsize(database)  
     if fs < 1024:
         return 2 # file size too small
-    DataStore = column_helper('data_store')
-    rows = db.session.query(DataStore.id).count()
+    if has_rollups():
+        Days = column_helper('data_store_days')
+        rows = db.session.query(func.sum(Days.events)).scalar() or 0
+    else:
+        DataStore = column_helper('data_store')
+        rows = db.session.query(DataStore.id).count()
     if rows < 1:
         return 4 # no rows present
     return 0 
@@ -115,6 +251,8 @@ def convert_size(size_bytes):
    return "%s %s" % (s, size_name[i])
 
 def dbStats():
+    if has_rollups():
+        return rollupStats()
     DataStore = column_helper('data_store')
     DataStore = column_helper('data_store')
     SysIDTags  = column_helper('sysid_tags')
@@ -146,7 +284,140 @@ def dbStats():
     dbsize = convert_size(os.path.getsize(f))
     return(rows, sys_count, talkgroups, subs, firstRec, lastRec, dbsize, f)
 
+def rollupStats():
+    # dbStats() from the rollup tables: O(days) rather than O(rows)
+    Days = column_helper('data_store_days')
+    RollupSysid = column_helper('rollup_sysid')
+    RollupTgid = column_helper('rollup_tgid')
+    RollupSuid = column_helper('rollup_suid')
+    rows = db.session.query(func.sum(Days.events)).scalar() or 0
+    if rows == 0:
+        return(0, 0, 0, 0, 0, 0, 0)
+    sys_count = db.session.query(func.count(func.distinct(RollupSysid.sysid))) \
+        .filter(RollupSysid.sysid != 0) \
+        .scalar()
+    # TODO: talkgroups and subs should be distinct by system
+    talkgroups = db.session.query(func.count(func.distinct(RollupTgid.tgid))).scalar()
+    subs = db.session.query(func.count(func.distinct(RollupSuid.suid))).scalar()
+    firstRec = MyDateType().process_result_value(db.session.query(func.min(Days.first_time)).scalar(), None)
+    lastRec = MyDateType().process_result_value(db.session.query(func.max(Days.last_time)).scalar(), None)
+    f = app.config['SQLALCHEMY_DATABASE_URI'][10:]  # db file name
+    dbsize = convert_size(os.path.getsize(f))
+    return(rows, sys_count, talkgroups, subs, firstRec, lastRec, dbsize, f)
+
+# cc_events counted for the estimated size of the time ordered /data views
+view_events = {
+    'logs_calls': ['grp_v_ch_grant', 'grp_v_ch_grant_mbt'],
+    'logs_joins': ['grp_aff_resp', 'loc_reg_resp'],
+    'logs_call_detail': ['grp_v_ch_grant', 'grp_v_ch_grant_mbt', 'mot_grg_cn_grant'],
+}
+
+def window_events(table, stime, etime, *filters):
+    # events in rollup table (a column_helper) between stime and etime; a
+    # day partly in the window counts in proportion to the time it overlaps
+    overlap = (func.min(table.last_time, etime) - func.max(table.first_time, stime) + 1) / (table.last_time - table.first_time + 1)
+    return db.session.query(func.sum(table.events * func.max(0, func.min(1, overlap)))) \
+        .filter(table.day >= int(stime) // sqlite_store.DAY, table.day <= int(etime) // sqlite_store.DAY, *filters) \
+        .scalar() or 0
+
+def estimate_rows(events, stime, etime, sysid, id_filters):
+    # row count of a time ordered /data view from the rollups: the events of
+    # its cc_event types, times the share of all events in the window that
+    # match each of id_filters, a list of (tgids, suids) as search_ids()
+    Days = column_helper('data_store_days')
+    RollupSysid = column_helper('rollup_sysid')
+    RollupTgid = column_helper('rollup_tgid')
+    RollupSuid = column_helper('rollup_suid')
+    RollupEvent = column_helper('rollup_cc_event')
+    by_sysid = lambda t: [t.sysid == sysid] if sysid else []
+    if sysid:
+        total = window_events(RollupSysid, stime, etime, RollupSysid.sysid == sysid)
+    else:
+        total = window_events(Days, stime, etime)
+    n = window_events(RollupEvent, stime, etime, RollupEvent.cc_event.in_([cc_events[e] for e in events]), *by_sysid(RollupEvent))
+    for tgids, suids in id_filters:
+        matched = 0
+        if tgids is not None:
+            matched += window_events(RollupTgid, stime, etime, RollupTgid.tgid.in_(tgids), *by_sysid(RollupTgid))
+        if suids is not None:
+            matched += window_events(RollupSuid, stime, etime, RollupSuid.suid.in_(suids), *by_sysid(RollupSuid))
+        n *= min(1.0, matched / total) if total else 0
+    return int(round(n))
+
+def search_ids(value):
+    # the DataTables search box matches a talkgroup or unit id, or part of
+    # a tag: (tgids, suids), each a list or a subquery of ids, so that it
+    # is looked up on the tgid / suid indexes rather than by the text of
+    # every row
+    if value.isdigit():
+        return [int(value)], [int(value)]
+    TGIDTags   = column_helper('tgid_tags')
+    UnitIDTags = column_helper('unit_id_tags')
+    like = '%' + value + '%'
+    return select(TGIDTags.rid).where(TGIDTags.tag.like(like)), select(UnitIDTags.rid).where(UnitIDTags.tag.like(like))
+
+def keyset_page(params, q, ncols, time_col, id_col, stime, etime, estimate):
+    # one page of a time ordered /data view in the DataTables server side
+    # format, ordered by (time, id) and found by seeking past the end of
+    # the page before it (my_pages).  estimate() is the (total, filtered)
+    # row count; an exact count would read every row of the window.
+    start = int(params['start'])
+    length = int(params['length'])
+    descending = params.get('order[0][column]', '0') == '0' and params.get('order[0][dir]') == 'desc'
+    version = data_version()
+    query = (version,) + tuple(sorted([(k, v) for k, v in params.items() if k not in ('draw', 'start', 'length', '_')]))
+    position, key = 0, None
+    if version is not None:
+        # the rows added since the last check (ids past it) leave the
+        # cached pages as they are if they are all after the window: a
+        # live receiver's are, as long as the window ends in the past.
+        # (time + 0: a range of the primary key, not a walk of the time
+        # index from its start)
+        last_id = db.session.query(func.max(id_col)).scalar() or 0
+        checked = my_pages.checked(query)
+        valid = checked is None or checked >= last_id or \
+            db.session.query(func.min(time_col + 0)).filter(id_col > checked).scalar() > etime
+        position, key = my_pages.get(query, start, last_id, valid)
+    lo, hi = stime, etime
+    if key is not None:
+        t, i = key
+        if descending:
+            hi = t
+            q = q.filter(or_(time_col < t, id_col < i))
+        else:
+            lo = t
+            q = q.filter(or_(time_col > t, id_col > i))
+    q = q.filter(time_col >= lo, time_col <= hi)    # the seek is the index range, not a filter on it
+    if descending:
+        q = q.order_by(desc(time_col), desc(id_col))
+    else:
+        q = q.order_by(time_col, id_col)
+    q = q.add_columns(type_coerce(time_col, types.REAL), id_col).offset(start - position)
+    if length >= 0:
+        q = q.limit(length)
+    rows = q.all()
+    if rows and version is not None:
+        my_pages.put(query, start + len(rows), tuple(rows[-1][-2:]))
+    total, filtered = estimate()
+    searched = total != filtered
+    if len(rows) < length or length < 0:
+        filtered = start + len(rows)    # the end: now known exactly
+    elif filtered <= start + len(rows):
+        filtered = start + len(rows) + 1    # there may be more
+    total = max(total, filtered) if searched else filtered
+    return {'draw': str(int(params.get('draw', 1))),
+            'recordsTotal': str(total),
+            'recordsFiltered': str(filtered),
+            'data': [dict([(str(i), v) for i, v in enumerate(row[:ncols])]) for row in rows]}
+
 def sysList():
+    if has_rollups():
+        SysIDTags  = column_helper('sysid_tags')
+        RollupSysid = column_helper('rollup_sysid')
+        return db.session.query(RollupSysid.sysid, SysIDTags.tag.label('tag')) \
+            .distinct() \
+            .outerjoin(SysIDTags.table_, SysIDTags.sysid == RollupSysid.sysid) \
+            .filter(RollupSysid.sysid != 0)
     DataStore = column_helper('data_store')
     rows = db.session.query(func.count(DataStore.id)).scalar()
     if rows == 0:
@@ -176,51 +447,28 @@ def read_tsv(filename): # used by import_tsv and inspect_tsv, careful w/ changes
             rows.append(s)
     return rows
 
-def import_tsv(argv):
-    UnitIDTags = column_helper('unit_id_tags')
-    TGIDTags   = column_helper('tgid_tags')
+def import_tsv(argv, sync=False):
+    # upserts the tags of the file for the system (sqlite_store.import_tags),
+    # with sync also deleting the system's tags that are not in the file;
+    # returns the diff, with a few of the changes of each kind
     cmd = argv[1]
     filename = argv[2]
     sysid = int(argv[3])
     if cmd == 'import_tgid':
-        tbl = TGIDTags
+        table = 'tgid_tags'
     elif cmd == 'import_unit':
-        tbl = UnitIDTags
+        table = 'unit_id_tags'
     else:
         print('%s unsupported' % (cmd))
         return
-    rows = read_tsv(filename)
-    rm = 0  # records matched
-    nr = 0  # new records
-    dr = 0  # duplicate records
-    if len(rows):
-        for i in rows:
-            recCount = db.session.query(tbl.table_).where(and_(tbl.rid == i[0], tbl.sysid == argv[3])).count()
-            if recCount == 1:
-                # update record
-                q = update(tbl.table_) \
-                    .where(and_(tbl.rid == i[0], tbl.sysid == argv[3])) \
-                    .values(rid = int(i[0]), sysid = int(argv[3]), tag = i[1], priority = int(i[2]))
-                db.session.execute(q)
-                db.session.commit()
-                rm +=1
-            elif recCount == 0:
-                # insert record
-                q = insert(tbl.table_).values(rid = int(i[0]), sysid = int(argv[3]), tag = i[1], priority = int(i[2]))
-                db.session.execute(q)
-                db.session.commit()
-                nr += 1
-            else: 
-                # delete all of the duplicates and insert new (duplicates break things)
-                print('command %s - db error - %s records for %s %s' % (cmd, recCount, i[0], i[1]))
-                delRec = delete(TGIDTags.table_).where(and_(tbl.rid == i[0], tbl.sysid == argv[3]))
-                db.session.execute(delRec)
-                db.session.commit()                
-                q = insert(tbl.table_).values(rid = int(i[0]), sysid = int(argv[3]), tag = i[1], priority = int(i[2]))
-                db.session.execute(q)
-                db.session.commit()
-                dr += 1
-    return(rm, nr, dr)
+    conn = sqlite_store.connect(app.config['SQLALCHEMY_DATABASE_URI'][10:])
+    try:
+        diff = sqlite_store.import_tags(conn, table, sysid, read_tsv(filename), delete_missing=sync)
+    finally:
+        conn.close()
+    for kind in diff['changes']:    # (the results are kept in the session cookie)
+        diff['changes'][kind] = diff['changes'][kind][:10]
+    return diff
 
 @app.route("/")
 def home():
@@ -365,7 +613,7 @@ def itt():
     params['ekeys'] = sorted(oplog_map.keys())
     cmd = params['cmd']
     argv = [ None, 'import_' + cmd, os.getcwd() + '/../' + params['file'], params['sysid'] ]
-    session['imp_results'] = import_tsv(argv)
+    session['imp_results'] = import_tsv(argv, params.get('sync') == 'true')
     session['sm'] = 3
     return redirect('/edit_tags?cmd=' + cmd) 
     
@@ -457,17 +705,21 @@ def asd():
 # purge database functions
 @app.route("/purge")
 def purge():
+    global my_purge
     params = request.args.to_dict()
     params['ekeys'] = sorted(oplog_map.keys())
     DataStore  = column_helper('data_store')
     destfile = ''
     b = False
+    recCount = 0
+    successMessage = 0
+    dispQuery = ''
+    src = app.config['SQLALCHEMY_DATABASE_URI'][10:]
     if 'bu' in params.keys():
         if params['bu'] == 'true':
             b = True
             t = strftime("%Y%m%d_%H%M%S")
             destfile = 'op25-backup-%s.db' % t
-            src = app.config['SQLALCHEMY_DATABASE_URI'][10:]
             s = src.split('/')
             f = s[-1]
             dst = src.replace(f, destfile)
@@ -480,29 +732,35 @@ def purge():
             sysid = int(params['sysid'])
             delRec = delete(DataStore.table_).where(DataStore.time >= int(sd), DataStore.time <= int(ed))
             recCount = db.session.query(DataStore.id).filter(and_(DataStore.time >= int(sd), DataStore.time <= int(ed)))
+            where = ['1']   # the same filters for the purge_job, which deletes in batches
+            args = []
             if sysid != 0:
                 recCount = recCount.filter(DataStore.sysid == sysid)
                 delRec = delRec.where(DataStore.sysid == sysid)
+                where.append('sysid = ?')
+                args.append(sysid)
             if 'kv' in params.keys(): # keep voice calls
                 if params['kv'] == 'true':
                     recCount = recCount.where(and_(DataStore.opcode != 0, DataStore.opcode != 2))
                     delRec = delRec.where(and_(DataStore.opcode != 0, DataStore.opcode != 2))
-            recCount = recCount.count()
-            dispQuery = delRec.compile(compile_kwargs={"literal_binds": True})
+                    where.append('opcode != 0 AND opcode != 2')
+            dispQuery = str(delRec.compile(compile_kwargs={"literal_binds": True}))
             if simulate == 'false':
-                if b == True:
-                    copyfile(src, dst)
-                db.session.execute(delRec)
-                db.session.commit()
-                db.session.execute("VACUUM") # sqlite3 clean up -- reduces file size
-                successMessage = 1
+                if my_purge is None or not my_purge.is_alive():
+                    my_purge = purge_job(src, int(sd), int(ed), ' AND '.join(where), args, dispQuery, dst if b else None)
+                    my_purge.start()
+                # the job's progress page; a reload doesn't start it again
+                return redirect('/purge?action=status')
             else:
+                recCount = recCount.count()
                 successMessage = 2
-    else:
-        recCount = 0
-        successMessage = 0
-        dispQuery = ''
-        
+        elif params['action'] == 'status' and my_purge is not None:
+            successMessage = 1
+            dispQuery = my_purge.query
+            if my_purge.backup_file:
+                params['bu'] = 'true'
+                destfile = os.path.basename(my_purge.backup_file)
+
     return render_template("purge.html", \
         project="op25", \
         params=params, \
@@ -513,6 +771,12 @@ def purge():
         dispQuery=dispQuery, \
         destfile=destfile )
 
+@app.route("/purge_status")
+def purge_status():
+    if my_purge is None:
+        return jsonify({'state': 'idle'})
+    return jsonify(my_purge.status())
+
 # displays all logs w/ datatables
 @app.route("/logs")
 def logs():
@@ -535,6 +799,7 @@ def logs():
     if params['r'] == 'cc_event':
         mapl = oplog_map[params['p'].strip()]
         params['ckeys'] = [s[1] for s in mapl if s[0] != 'opcode' and s[0] != 'cc_event']
+    params['keyset'] = params['r'] == 'cc_event' or 'logs_%s' % params['r'] in view_events  # sorted by time only
         
     return render_template("logs.html", \
         project="logs", \
@@ -655,7 +920,7 @@ def data():
             .outerjoin(TGIDTags.table_, and_(DataStore.tgid == TGIDTags.rid, DataStore.sysid == TGIDTags.sysid))
             .outerjoin(UnitIDTags.table_, and_(DataStore.suid == UnitIDTags.rid, DataStore.sysid == UnitIDTags.sysid))
             .filter(and_(DataStore.tgid != 0), (DataStore.frequency != None) )
-            .filter(or_(DataStore.opcode == 0, and_(DataStore.opcode == 2, DataStore.mfrid == 144)) ),
+            .filter(or_(DataStore.opcode + 0 == 0, and_(DataStore.opcode + 0 == 2, DataStore.mfrid == 144)) ),
 
             
         'logs_tgid': db.session.query(DataStore.suid, \
@@ -674,7 +939,7 @@ def data():
                                        TGIDTags.tag, \
                                        DataStore.frequency, \
                                        DataStore.suid )
-            .join(EventKeys.table_, and_(or_( EventKeys.tag == 'grp_v_ch_grant', EventKeys.tag == 'grp_v_ch_grant_mbt'),EventKeys.id == DataStore.cc_event))
+            .join(EventKeys.table_, and_(or_( EventKeys.tag == 'grp_v_ch_grant', EventKeys.tag == 'grp_v_ch_grant_mbt'),EventKeys.id == DataStore.cc_event + 0))
             .outerjoin(TGIDTags.table_, and_(TGIDTags.rid == DataStore.tgid, TGIDTags.sysid == DataStore.sysid))
             .outerjoin(SysIDTags.table_, DataStore.sysid == SysIDTags.sysid),
 
@@ -691,9 +956,15 @@ def data():
             .outerjoin(SysIDTags.table_, DataStore.sysid == SysIDTags.sysid)
             .outerjoin(TGIDTags.table_, and_(DataStore.tgid == TGIDTags.rid, DataStore.sysid == TGIDTags.sysid))
             .outerjoin(UnitIDTags.table_, and_(DataStore.suid == UnitIDTags.rid, DataStore.sysid == UnitIDTags.sysid))
-            .filter(or_(DataStore.opcode == 40, DataStore.opcode == 43)) # joins
+            .filter(or_(DataStore.opcode + 0 == 40, DataStore.opcode + 0 == 43)) # joins
     } # end query_d
 
+    # the time ordered views walk an index on (time, id), or (sysid, time,
+    # id), in order and test each row for the event type: "+ 0" keeps
+    # sqlite from collecting every row of the type(s) in the window from
+    # the cc_event / opcode index and sorting them for each page
+    keyset = k in view_events or host_function_type == 'cc_event'
+
     if host_function_type != 'cc_event':
         q = query_d[k]
 
@@ -744,9 +1015,14 @@ def data():
 
         column_dt = [ColumnDT(s) for s in columns]
 
+        # one event type: (cc_event, time, id) is in time order; but with a
+        # talkgroup or unit id (or search) sort the few rows of its index
+        cc_event = DataStore.cc_event
+        if filter_tgid or filter_suid or params.get('search[value]', '').strip():
+            cc_event = DataStore.cc_event + 0
         q = db.session.query(*columns
-            ).join(
-                EventKeys.table_, and_( EventKeys.tag == host_function_param, EventKeys.id == DataStore.cc_event)
+            ).select_from(DataStore.table_
+            ).filter(cc_event == cc_events[host_function_param]
             ).outerjoin(
                 SysIDTags.table_, DataStore.sysid == SysIDTags.sysid
             )
@@ -787,7 +1063,7 @@ def data():
         if filter_suid is not None and int(filter_suid) != 0:
             q = q.filter(DataStore.suid == filter_suid)
 
-    if cl:
+    if cl and not keyset:
         c = int(params['order[0][column]'])
         d = params['order[0][dir]']	# asc or desc
         if d == 'asc':
@@ -795,11 +1071,36 @@ def data():
         else:
             q = q.order_by(desc(cl[c]))
     
-    q = q.filter(and_(DataStore.time >= int(stime), DataStore.time <= int(etime)))
-
     if sysid != 0:
         q = q.filter(DataStore.sysid == sysid)
 
+    id_filters = []
+    if host_function_type == 'cc_event':
+        if filter_tgid:
+            id_filters.append(([filter_tgid], None))
+        if filter_suid:
+            id_filters.append((None, [filter_suid]))
+    search = params.get('search[value]', '').strip()
+    if search:
+        tgids, suids = search_ids(search)
+        q = q.filter(or_(DataStore.tgid.in_(tgids), DataStore.suid.in_(suids)))
+
+    if keyset:
+        events = [host_function_param] if host_function_type == 'cc_event' else view_events[k]
+        def estimate():
+            if not has_rollups('rollup_cc_event'):
+                n = q.filter(DataStore.time >= int(stime), DataStore.time <= int(etime)).count()
+                return n, n
+            total = estimate_rows(events, stime, etime, sysid, id_filters)
+            if search:
+                return total, estimate_rows(events, stime, etime, sysid, id_filters + [search_ids(search)])
+            return total, total
+        ncols = len(columns) if host_function_type == 'cc_event' else len(column_d[k])
+        return jsonify(keyset_page(params, q, ncols, DataStore.time, DataStore.id, stime, etime, estimate))
+
+    q = q.filter(and_(DataStore.time >= int(stime), DataStore.time <= int(etime)))
+
+    params['search[value]'] = ''    # applied above
     if host_function_type == 'cc_event':
         rowTable = DataTables(params, q, column_dt)
     else:
@@ -832,7 +1133,7 @@ def switch_db():
         s = src.split('/')
         curr_file = s[-1]
         dst = src.replace(curr_file, destfile)
-        copyfile(src, dst)
+        sqlite_store.backup(src, dst)   # consistent while the event writer is logging
         return render_template("switch_db.html", params=params, destfile=destfile, curr_file=curr_file, files=files, sm=1)
     if params['cmd'] == 'switch':
         new_f = params['file']
@@ -140,6 +140,35 @@ function doPurge(sim) {
  	
 }
 
+function purgeStatus() {
+	// progress of the background purge job, polled until it is finished
+	$.getJSON('/purge_status', function(st) {
+		var states = {'starting': 'Purge starting...', 'backup': 'Creating backup...', 'count': 'Counting records...',
+			'delete': 'Deleting records...', 'vacuum': 'Releasing free space...', 'done': 'Operation completed.', 'failed': 'Purge failed.'};
+		$('#purgeState').html(states[st.state] || st.state);
+		var pct = 0;
+		if (st.state == 'backup' && st.db_bytes > 0)
+			pct = 100 * st.backup_bytes / st.db_bytes;
+		else if (st.state == 'delete' && st.count > 0)
+			pct = 100 * st.deleted / st.count;
+		else if (st.state == 'vacuum' || st.state == 'done')
+			pct = 100;
+		$('#purgeBar').css('width', Math.min(pct, 100) + '%');
+		if (st.state == 'delete' || st.state == 'vacuum' || st.state == 'done')
+			$('#purgeDetail').html(comma(st.deleted) + ' of ' + comma(st.count) + ' records deleted in ' + Math.round(st.elapsed) + ' s.');
+		if (st.backup_bytes > 0)
+			$('#purgeBackup').html('(' + comma(st.backup_bytes) + ' bytes)');
+		if (st.state == 'failed') {
+			$('#purgeDetail').html(st.error);
+			$('#purgeStatus').removeClass('alert-primary').addClass('alert-danger');
+		}
+		if (st.state == 'done' || st.state == 'failed' || st.state == 'idle')
+			$('#purgeBar').removeClass('progress-bar-animated');
+		else
+			setTimeout(purgeStatus, 1000);
+	});
+}
+
 function addNewSystemTag() {
 	if ($('#newSysId').val() == '' || $('#newSysTag').val() == '') {
 			alert('System ID (dec) and System Tag are required.');
@@ -171,7 +200,8 @@ function importTalkgroupTsv(cmd) {
 	
 	var sysid = $('#systemSelect2').val();
 	var tsvfile = $('#selTsv').val();	
-	window.location.href='/itt?sysid=' + sysid + '&file=' + tsvfile + '&cmd=' + cmd;
+	var sync = $('#syncTags').prop('checked');
+	window.location.href='/itt?sysid=' + sysid + '&file=' + tsvfile + '&cmd=' + cmd + '&sync=' + sync;
 }
 
 function deleteTags(cmd) {
@@ -27,6 +27,7 @@ P25 decoding block.
 """
 
 import time
+import numpy as np
 from gnuradio import gr, eng_notation
 from gnuradio import blocks, audio
 from gnuradio.eng_option import eng_option
@@ -44,6 +45,23 @@ _def_audio_rate = 8000
 _def_audio_output = 'plughw:0,0'
 _def_max_tdma_timeslots = 2
 
+class pcm_sink_s(gr.sync_block):
+    """
+    Hands the decoded audio to the recording set, if any
+    """
+    def __init__(self):
+        gr.sync_block.__init__(self,
+            name="pcm_sink_s",
+            in_sig=[np.int16],
+            out_sig=None)
+        self.recording = None
+
+    def work(self, input_items, output_items):
+        recording = self.recording
+        if recording is not None:
+            recording.write(input_items[0])	# copies, never blocks
+        return len(input_items[0])
+
 # /////////////////////////////////////////////////////////////////////////////
 #                           decoder
 # /////////////////////////////////////////////////////////////////////////////
@@ -73,7 +91,7 @@ class p25_decoder_sink_b(gr.hier_block2):
 				gr.io_signature(0, 0, 0)) # Output signature
 
         assert 0 <= num_ambe <= _def_max_tdma_timeslots
-        assert not (num_ambe > 1 and dest != 'wav')
+        assert not (num_ambe > 1 and dest not in ('wav', 'recorder'))
 
         self.debug = debug
         self.dest = dest
@@ -115,6 +133,9 @@ class p25_decoder_sink_b(gr.hier_block2):
                 self.scaler.append(blocks.multiply_const_ff(1 / 32768.0))
                 self.audio_sink.append(blocks.wavfile_sink(filename, n_channels, sample_rate, bits_per_sample))
                 self.connect(self, self.p25_decoders[slot], self.audio_s2f[slot], self.scaler[slot], self.audio_sink[slot])
+            elif dest == 'recorder':	# pcm to a call_recorder recording, see set_recording()
+                self.audio_sink.append(pcm_sink_s())
+                self.connect(self, self.p25_decoders[slot], self.audio_sink[slot])
             elif dest == 'audio':
                 self.connect(self, self.p25_decoders[slot])
 
@@ -131,6 +152,12 @@ class p25_decoder_sink_b(gr.hier_block2):
             return
         self.audio_sink[index].open(filename)
 
+    def set_recording(self, recording, index=0):
+        # None discards the audio
+        if self.dest != 'recorder':
+            return
+        self.audio_sink[index].recording = recording
+
     def set_nac(self, nac, index=0):
         self.p25_decoders[index].set_nac(nac)
 
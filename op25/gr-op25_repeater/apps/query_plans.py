@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# This file is part of OP25
+#
+# OP25 is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# OP25 is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OP25; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Boston, MA
+# 02110-1301, USA.
+
+# Query plan regression check for the oplog data() queries.
+#
+# Renders the SQL of every oplog query_d entry and of the cc_event view of
+# every oplog_map event - with and without a sysid, for each sort column,
+# and for the talkgroup / unit id filters and an id search - as data()
+# builds it, and runs EXPLAIN QUERY PLAN on each.  A query fails if its plan scans data_store
+# or a tag table instead of searching an index, or if it sorts a page of
+# a time ordered view that has no talkgroup / unit id filter (each page
+# must come straight off the index, in order).  event_keys,
+# loc_reg_resp_rv and sysid_tags (one row per system) are a few rows
+# each and may be scanned.
+#
+# usage:
+#     ./query_plans.py [rows]	build a synthetic db of an old schema version
+#				with rows events (default 10M), upgrade it in
+#				place (sql_dbi upgrade_db) and check the plans
+#     ./query_plans.py db <file>	check the plans on an existing db
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+
+import sqlite_store
+from emap import oplog_map, cc_events
+
+SMALL_TABLES = ['event_keys', 'loc_reg_resp_rv', 'sysid_tags']
+
+SYSID_JOIN = 'LEFT OUTER JOIN sysid_tags ON data_store.sysid = sysid_tags.sysid'
+TGID_JOIN = 'LEFT OUTER JOIN tgid_tags ON data_store.%s = tgid_tags.rid AND data_store.sysid = tgid_tags.sysid'
+UNIT_JOIN = 'LEFT OUTER JOIN unit_id_tags ON data_store.%s = unit_id_tags.rid AND data_store.sysid = unit_id_tags.sysid'
+
+# the time ordered views are read a page at a time by keyset_page(): by
+# (time, id), from the end of the page before
+KEYSET = ['keyset', 'keyset DESC']
+
+# query_d in oplog data(): (select list, from/joins, where, group by, sort columns (dt_cols))
+query_d = {
+	'logs_total_tgid': ('data_store.sysid, sysid_tags.tag, data_store.tgid, tgid_tags.tag, count(data_store.tgid) AS count',
+		'data_store %s LEFT OUTER JOIN tgid_tags ON data_store.tgid = tgid_tags.rid' % SYSID_JOIN,
+		['data_store.tgid != 0', 'data_store.frequency IS NOT NULL'], 'data_store.tgid',
+		['data_store.sysid', 'sysid_tags.tag', 'data_store.tgid', 'tgid_tags.tag', 'count']),
+	'logs_call_detail': ('data_store.time, data_store.opcode, data_store.sysid, sysid_tags.tag, data_store.tgid, tgid_tags.tag, data_store.suid, unit_id_tags.tag, data_store.frequency',
+		'data_store %s %s %s' % (SYSID_JOIN, TGID_JOIN % 'tgid', UNIT_JOIN % 'suid'),
+		['data_store.tgid != 0', 'data_store.frequency IS NOT NULL', '(data_store.opcode + 0 = 0 OR data_store.opcode + 0 = 2 AND data_store.mfrid = 144)'], None,
+		KEYSET),
+	'logs_tgid': ('data_store.suid, unit_id_tags.tag, count(data_store.suid) AS count, max(data_store.time) AS last',
+		'data_store %s' % (UNIT_JOIN % 'suid'),
+		['data_store.suid IS NOT NULL'], 'data_store.suid',
+		['data_store.suid', 'unit_id_tags.tag', 'count']),
+	'logs_su': ('tgid_tags.tag, data_store.tgid, count(data_store.tgid) AS count',
+		'data_store LEFT OUTER JOIN tgid_tags ON data_store.tgid = tgid_tags.rid',
+		['data_store.suid IS NOT NULL'], 'data_store.tgid',
+		['tgid_tags.tag', 'data_store.tgid', 'count']),
+	'logs_calls': ('data_store.time, sysid_tags.tag, data_store.tgid, tgid_tags.tag, data_store.frequency, data_store.suid',
+		"data_store JOIN event_keys ON (event_keys.tag = 'grp_v_ch_grant' OR event_keys.tag = 'grp_v_ch_grant_mbt') AND event_keys.id = data_store.cc_event + 0"
+		" LEFT OUTER JOIN tgid_tags ON tgid_tags.rid = data_store.tgid AND tgid_tags.sysid = data_store.sysid %s" % SYSID_JOIN,
+		[], None,
+		KEYSET),
+	'logs_joins': ('data_store.time, data_store.opcode, data_store.sysid, sysid_tags.tag, loc_reg_resp_rv.tag, data_store.tgid, tgid_tags.tag, data_store.suid, unit_id_tags.tag',
+		'data_store JOIN loc_reg_resp_rv ON data_store.p = loc_reg_resp_rv.rv %s %s %s' % (SYSID_JOIN, TGID_JOIN % 'tgid', UNIT_JOIN % 'suid'),
+		['(data_store.opcode + 0 = 40 OR data_store.opcode + 0 = 43)'], None,
+		KEYSET),
+}
+
+def cc_event_query(p, filtered):
+	# the host_function_type == 'cc_event' query of data() for event p,
+	# filtered: with a talkgroup, unit id or search
+	columns = []
+	for row in oplog_map[p]:
+		col = 'data_store.%s' % row[0]
+		if row[0] == 'sysid':
+			col = 'sysid_tags.tag'
+		elif row[1] == 'Talkgroup':
+			col = 'tgid_tags.tag'
+		elif row[1] == 'Source' or row[1] == 'Target':
+			col = 'unit_id_tags.tag'
+		elif row[0] in ('cc_event', 'opcode'):
+			continue
+		elif p == 'loc_reg_resp' and row[0] == 'p':
+			col = 'loc_reg_resp_rv.tag'
+		columns.append(col)
+	tgid, suid = 'tgid', 'suid'
+	if p == 'grp_aff_resp':
+		tgid = 'tgid2'
+	elif p in ('ack_resp_fne', 'grp_aff_q', 'u_reg_cmd'):
+		tgid, suid = 'tgid2', 'suid2'
+	joins = 'data_store %s %s %s' % (SYSID_JOIN, TGID_JOIN % tgid, UNIT_JOIN % suid)
+	if p == 'loc_reg_resp':
+		joins += ' JOIN loc_reg_resp_rv ON loc_reg_resp_rv.rv = data_store.p'
+	where = ['data_store.cc_event %s= %d' % ('+ 0 ' if filtered else '', cc_events[p])]
+	return ', '.join(columns), joins, where, None, KEYSET
+
+def render(select, joins, where, group_by, order_by, sysid):
+	if order_by in KEYSET:
+		# a page after the first: the seek is the lower (upper) time bound
+		seek = ['data_store.time >= ?', '(data_store.time > ? OR data_store.id > ?)', 'data_store.time <= ?']
+		if order_by.endswith('DESC'):
+			seek = ['data_store.time <= ?', '(data_store.time < ? OR data_store.id < ?)', 'data_store.time >= ?']
+		where = where + seek
+		order_by = 'data_store.time%s, data_store.id%s' % ((order_by[6:],) * 2)
+	else:
+		where = where + ['data_store.time >= ?', 'data_store.time <= ?']
+	if sysid:
+		where.append('data_store.sysid = ?')
+	q = 'SELECT %s FROM %s WHERE %s' % (select, joins, ' AND '.join(where))
+	if group_by:
+		q += ' GROUP BY %s' % group_by
+	if order_by:
+		q += ' ORDER BY %s' % order_by
+	return q + ' LIMIT 25 OFFSET 0'
+
+SEARCH = '(data_store.tgid IN (?) OR data_store.suid IN (?))'	# an id in the search box
+
+def queries():
+	# (name, sql, args, in order) for every variant data() can produce; in
+	# order: a keyset page that must be read in index order, not sorted
+	views = [(k, query_d[k], [[], [SEARCH]]) for k in sorted(query_d)]
+	views[[v[0] for v in views].index('logs_tgid')][2][:] = [['data_store.tgid = ?'], ['data_store.tgid >= ?', 'data_store.tgid <= ?'], ['data_store.tgid = ?', SEARCH]]
+	views[[v[0] for v in views].index('logs_su')][2][:] = [['data_store.suid = ?'], ['data_store.suid >= ?', 'data_store.suid <= ?'], ['data_store.suid = ?', SEARCH]]
+	for p in sorted(oplog_map):
+		views.append(('cc_event %s' % p, cc_event_query(p, False), [[]]))
+		views.append(('cc_event %s' % p, cc_event_query(p, True), [['data_store.tgid = ?'], ['data_store.suid = ?'], [SEARCH]]))
+	for name, (select, joins, where, group_by, sort_columns), filters in views:
+		for f in filters:
+			for order_by in sort_columns:
+				for sysid in (0, 1):
+					q = render(select, joins, where + f, group_by, order_by, sysid)
+					in_order = order_by in KEYSET and not f
+					yield '%s %s order by %s%s' % (name, ' and '.join(f), order_by, ' sysid' if sysid else ''), q, (1,) * q.count('?'), in_order
+
+def scans(plan, in_order):
+	# tables that the plan reads in full, and sorts of a keyset page
+	bad = []
+	for row in plan:
+		m = re.match(r'SCAN (\w+)', row[-1])
+		if m and m.group(1) not in SMALL_TABLES:
+			bad.append(row[-1])
+		elif in_order and row[-1].startswith('USE TEMP B-TREE FOR'):
+			bad.append(row[-1])
+	return bad
+
+def check_plans(conn):
+	failed = 0
+	n = 0
+	for name, q, args, in_order in queries():
+		plan = conn.execute('EXPLAIN QUERY PLAN ' + q, args).fetchall()
+		bad = scans(plan, in_order)
+		n += 1
+		if bad:
+			failed += 1
+			sys.stderr.write('FAIL %s: %s\n    %s\n' % (name, '; '.join(bad), q))
+	sys.stderr.write('%d queries, %d full scans or sorts\n' % (n, failed))
+	return failed == 0
+
+def old_schema(conn):
+	# a database as reset_db made it before the rollups, indexes and unique tags
+	for t in ('data_store_days', 'rollup_sysid', 'rollup_tgid', 'rollup_suid', 'rollup_cc_event', 'data_store_state'):
+		conn.execute('DROP TABLE %s' % t)
+	for q in sqlite_store.INDEXES + sqlite_store.UNIQUE_TAG_INDEXES:
+		conn.execute('DROP INDEX %s' % q.split(' ON ')[0].split()[-1])
+	for name, on in zip(sqlite_store.REDUNDANT_INDEXES, ['data_store(tgid)', 'data_store(suid)', 'tgid_tags(rid)', 'unit_id_tags(rid)']):
+		conn.execute('CREATE INDEX %s ON %s' % (name, on))
+	conn.execute('PRAGMA user_version = 0')
+	conn.commit()
+
+def fill(conn, rows, t0=1.7e9):
+	# rows events, 0.3 s apart, mostly voice grants and updates on 3
+	# systems with 2000 talkgroups and 20000 units, plus their tags
+	conn.execute('''INSERT INTO data_store(time, cc_event, opcode, sysid, mfrid, p, p2, frequency, tgid, tgid2, suid, suid2)
+		WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?),
+		e(i, cc_event) AS (SELECT i, CASE WHEN x < 50 THEN 8 WHEN x < 70 THEN 10 WHEN x < 80 THEN 7 WHEN x < 88 THEN 12 WHEN x < 92 THEN 3 ELSE x % 16 + 1 END
+			FROM (SELECT i, abs(random()) % 100 AS x FROM n))
+		SELECT ? + i * 0.3, cc_event, CASE cc_event WHEN 8 THEN 0 WHEN 10 THEN 2 WHEN 7 THEN 40 WHEN 12 THEN 43 ELSE 50 END,
+			1 + abs(random()) % 3, CASE WHEN abs(random()) % 10 = 0 THEN 144 ELSE 0 END, abs(random()) % 4, abs(random()) % 1000,
+			CASE WHEN cc_event IN (8, 9, 10, 16) THEN 851000000 + 12500 * (abs(random()) % 20) END,
+			abs(random()) % 2000, CASE WHEN cc_event = 7 THEN abs(random()) % 2000 END,
+			CASE WHEN cc_event != 10 THEN abs(random()) % 20000 END, CASE WHEN cc_event IN (1, 6, 14, 15) THEN abs(random()) % 20000 END
+		FROM e''', (rows, t0))
+	conn.executemany('INSERT INTO sysid_tags(sysid, tag) VALUES(?, ?)', [(s, 'system %d' % s) for s in range(1, 4)])
+	conn.executemany('INSERT INTO tgid_tags(rid, sysid, tag, priority) VALUES(?, ?, ?, 0)', [(t, s, 'tg %d' % t) for t in range(2000) for s in range(1, 4)])
+	conn.executemany('INSERT INTO unit_id_tags(rid, sysid, tag, priority) VALUES(?, ?, ?, 0)', [(u, s, 'unit %d' % u) for u in range(0, 20000, 3) for s in range(1, 4)])
+	conn.commit()
+
+def synthetic(rows):
+	import sql_dbi
+	tmpdir = tempfile.mkdtemp()
+	try:
+		db_filename = sql_dbi.scratch_db(tmpdir)
+		conn = sqlite_store.connect(db_filename, writer=True)
+		old_schema(conn)
+		t0 = time.time()
+		fill(conn, rows)
+		# tags imported twice, as imports did before the unique index
+		conn.executemany('INSERT INTO tgid_tags(rid, sysid, tag, priority) VALUES(?, 1, ?, 0)', [(t, 'tg %d again' % t) for t in range(100)])
+		conn.commit()
+		t1 = time.time()
+		sys.stderr.write('%d rows in %.0f s\n' % (rows, t1 - t0))
+		db = sql_dbi.sql_dbi(db_filename)
+		db.q_runner.stop()
+		db.connect()
+		db.upgrade_db()
+		db.disconnect()
+		sys.stderr.write('upgraded in %.0f s, %.0f MB\n' % (time.time() - t1, os.path.getsize(db_filename) / 1e6))
+		days = conn.execute('SELECT COUNT(*), SUM(events) FROM data_store_days').fetchone()
+		assert days[1] == rows, 'rollups not built'
+		assert conn.execute('SELECT COUNT(*), (SELECT tag FROM tgid_tags WHERE rid = 5 AND sysid = 1) FROM tgid_tags WHERE rid = 5').fetchone() == (3, 'tg 5 again'), 'duplicate tags kept'
+		ok = check_plans(conn)
+		conn.close()
+	finally:
+		shutil.rmtree(tmpdir)
+	return ok
+
+def main():
+	if len(sys.argv) > 2 and sys.argv[1] == 'db':
+		ok = check_plans(sqlite_store.connect(sys.argv[2]))
+	else:
+		ok = synthetic(int(float(sys.argv[1])) if len(sys.argv) > 1 else 10000000)
+	sys.stderr.write('ok\n' if ok else 'FAILED\n')
+	sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+	main()
@@ -70,6 +70,7 @@ from gr_gnuplot import sync_plot
 
 from terminal import op25_terminal
 from sockaudio  import audio_thread
+from json_types import json_type_code
 
 from sql_dbi import sql_dbi
 
@@ -118,6 +119,7 @@ class p25_rx_block (gr.top_block):
 
         self.trunk_rx = None
         self.plot_sinks = []
+        self.call_recorder = None
 
         gr.top_block.__init__(self)
 
@@ -352,16 +354,21 @@ class p25_rx_block (gr.top_block):
         logfile_workers = []
         if self.options.phase2_tdma:
             num_ambe = 2
+        dest = 'wav'
+        if self.options.record_dir:
+            from call_recorder import call_recorder
+            self.call_recorder = call_recorder(self.options.record_dir, format=self.options.record_format, retention_days=self.options.record_days, max_size_mb=self.options.record_mb)
+            dest = 'recorder'
         if self.options.logfile_workers:
             for i in range(self.options.logfile_workers):
                 demod = p25_demodulator.p25_demod_cb(input_rate=capture_rate,
                                                      demod_type=self.options.demod_type,
                                                      offset=self.options.offset)
-                decoder = p25_decoder.p25_decoder_sink_b(debug = self.options.verbosity, do_imbe = vocoder, num_ambe=num_ambe)
+                decoder = p25_decoder.p25_decoder_sink_b(dest=dest, debug = self.options.verbosity, do_imbe = vocoder, num_ambe=num_ambe)
                 logfile_workers.append({'demod': demod, 'decoder': decoder, 'active': False})
                 self.connect(source, demod, decoder)
 
-        self.trunk_rx = trunking.rx_ctl(frequency_set = self.change_freq, debug = self.options.verbosity, conf_file = self.options.trunk_conf_file, logfile_workers=logfile_workers, send_event=self.send_event)
+        self.trunk_rx = trunking.rx_ctl(frequency_set = self.change_freq, debug = self.options.verbosity, conf_file = self.options.trunk_conf_file, logfile_workers=logfile_workers, send_event=self.send_event, tsbk_file=self.options.tsbk_file, call_recorder=self.call_recorder)
 
         self.du_watcher = du_queue_watcher(self.rx_q, self.preprocess_qmsg)
 
@@ -463,7 +470,7 @@ class p25_rx_block (gr.top_block):
             if self.options.verbosity > 0:
                 sys.stderr.write('%f error_tracking: qfull\n' % (time.time()))
             return
-        msg = gr.message().make_from_string(js, -4, 0, 0)
+        msg = gr.message().make_from_string(js, -4, 0, json_type_code('freq_error_tracking'))
         self.input_q.insert_tail(msg)
 
     def adjust_lo_freq(self):
@@ -536,7 +543,7 @@ class p25_rx_block (gr.top_block):
         params['fine_tune'] = self.options.fine_tune
         params['current_time'] = time.time()
         js = json.dumps(params)
-        msg = gr.message().make_from_string(js, -4, 0, 0)
+        msg = gr.message().make_from_string(js, -4, 0, json_type_code('change_freq'))
         self.input_q.insert_tail(msg)
 
     def hamlib_attach(self, model):
@@ -739,7 +746,7 @@ class p25_rx_block (gr.top_block):
         if self.options.demod_type == 'cqpsk':
             error = self.demod.get_freq_error()
         d = {'json_type': 'rx_update', 'error': error, 'fine_tune': self.options.fine_tune, 'files': filenames, 'time': time.time()}
-        msg = gr.message().make_from_string(json.dumps(d), -4, 0, 0)
+        msg = gr.message().make_from_string(json.dumps(d), -4, 0, json_type_code('rx_update'))
         self.input_q.insert_tail(msg)
 
     def process_update(self):
@@ -758,15 +765,25 @@ class p25_rx_block (gr.top_block):
         if self.input_q.full_p():
             return
         js = self.trunk_rx.to_json()
-        msg = gr.message().make_from_string(js, -4, 0, 0)
+        msg = gr.message().make_from_string(js, -4, 0, json_type_code('trunk_update'))
         self.input_q.insert_tail(msg)
         self.process_ajax()
+        self.db_update()
+
+    def db_update(self):
+        if self.input_q.full_p():
+            return
+        d = self.sql_db.stats()
+        d['json_type'] = 'db_stats'
+        d['time'] = time.time()
+        msg = gr.message().make_from_string(json.dumps(d), -4, 0, json_type_code('db_stats'))
+        self.input_q.insert_tail(msg)
 
     def send_event(self, d):	## called from trunking module to send json msgs / updates to client
         if d is not None:
             self.sql_db.event(d)
         if d and not self.input_q.full_p():
-            msg = gr.message().make_from_string(json.dumps(d), -4, 0, 0)
+            msg = gr.message().make_from_string(json.dumps(d), -4, 0, json_type_code(d.get('json_type')))
             self.input_q.insert_tail(msg)
         self.process_update()
 
@@ -851,6 +868,10 @@ class rx_main(object):
         if self.tb.audio:
             self.tb.audio.stop()
         self.tb.stop()
+        if self.tb.trunk_rx:
+            self.tb.trunk_rx.close()
+        if self.tb.call_recorder:
+            self.tb.call_recorder.stop()
         for sink in self.tb.plot_sinks:
             sink.kill()
 
@@ -872,7 +893,7 @@ class rx_main(object):
         parser.add_option("-F", "--ifile", type="string", default=None, help="read input from complex capture file")
         parser.add_option("-H", "--hamlib-model", type="int", default=None, help="specify model for hamlib")
         parser.add_option("-s", "--seek", type="int", default=0, help="ifile seek in K")
-        parser.add_option("-l", "--terminal-type", type="string", default='curses', help="'curses' or udp port or 'http:host:port'")
+        parser.add_option("-l", "--terminal-type", type="string", default='curses', help="'curses' or udp port or 'http:host:port[:asyncio]'")
         parser.add_option("-L", "--logfile-workers", type="int", default=None, help="number of demodulators to instantiate")
         parser.add_option("-S", "--sample-rate", type="int", default=320e3, help="source samp rate")
         parser.add_option("-t", "--tone-detect", action="store_true", default=False, help="use experimental tone detect algorithm")
@@ -897,10 +918,17 @@ class rx_main(object):
         parser.add_option("-d", "--fine-tune", type="eng_float", default=0.0, help="fine tuning")
         parser.add_option("-2", "--phase2-tdma", action="store_true", default=False, help="enable phase2 tdma decode")
         parser.add_option("-Z", "--decim-amt", type="int", default=1, help="spectrum decimation")
+        parser.add_option("--record-dir", type="string", default=None, help="record the calls of the logfile workers to this directory, indexed (call_recorder.py)")
+        parser.add_option("--record-format", type="choice", default="flac", choices=('flac', 'opus', 'wav'), help="flac | opus | wav")
+        parser.add_option("--record-days", type="int", default=0, help="delete recorded calls older than this many days (0: keep)")
+        parser.add_option("--record-mb", type="int", default=0, help="delete the oldest recorded calls while the recordings take more than this many MB (0: no limit)")
+        parser.add_option("--tsbk-file", type="string", default=None, help="record raw TSBK/MBT messages to file for offline replay (tsbk_batch.py)")
         (options, args) = parser.parse_args()
         if len(args) != 0:
             parser.print_help()
             sys.exit(1)
+        if options.record_dir and not options.logfile_workers:
+            parser.error('--record-dir records the calls of the logfile workers: it needs -L')
         self.options = options
 
 # Start the receiver
@@ -40,6 +40,18 @@ PCM_BUFFER_SIZE = 4000      # size of ALSA buffer in frames
 
 MAX_SUPERFRAME_SIZE = 320   # maximum size of incoming UDP audio buffer
 
+# Playout
+FRAME_MS = 20               # audio is written to the PCM device in frames of this length
+FRAME_SAMPLES = PCM_RATE * FRAME_MS // 1000
+FRAME_BYTES = FRAME_SAMPLES * 2
+JITTER_MS = 60              # default depth buffered per channel before it starts playing
+JITTER_SLACK = 5            # frames buffered beyond the target before the oldest are dropped
+PLC_FRAMES = 3              # missing frames concealed in a row before a channel is taken as gone quiet
+MAX_CATCHUP = 0.2           # sec. behind the playout clock before the frames due are skipped
+
+SILENCE = np.zeros(FRAME_SAMPLES, dtype=np.int16)
+SILENCE.flags.writeable = False
+
 # Debug
 LOG_AUDIO_XRUNS = True      # log audio underruns to stderr
 
@@ -119,6 +131,7 @@ class alsasound(object):
         self.channels = 0
         self.rate = 0
         self.framesize = 0
+        self.underruns = 0
 
     def open(self, hwdev):
         b_hwdev = create_string_buffer(str.encode(hwdev))
@@ -200,7 +213,7 @@ class alsasound(object):
     def write(self, pcm_data):
         datalen = len(pcm_data)
         n_frames = c_ulong(datalen // self.framesize)
-        c_data = c_char_p(pcm_data)
+        c_data = pcm_data if isinstance(pcm_data, Array) else c_char_p(pcm_data)
         ret = 0
 
         if (self.c_pcm.value == None):
@@ -210,6 +223,7 @@ class alsasound(object):
         ret = self.libasound.snd_pcm_writei(self.c_pcm, cast(c_data, POINTER(c_void_p)), n_frames)
         if (ret < 0):
             if (ret == -errno.EPIPE): # underrun
+                self.underruns += 1
                 if (LOG_AUDIO_XRUNS):
                     sys.stderr.write("%s PCM underrun\n" % log_ts.get())
                 ret = self.libasound.snd_pcm_recover(self.c_pcm, ret, 1)
@@ -369,12 +383,253 @@ class stdout_wrapper(object):
     def dump(self):
         pass
 
+# Wrapper to emulate pcm writes to a .wav file
+class wav_file(object):
+    def __init__(self):
+        self.wav = None
+
+    def open(self, filename):
+        import wave
+        try:
+            self.wav = wave.open(filename, 'wb')
+        except IOError as ex:
+            sys.stderr.write('%s: %s\n' % (filename, ex))
+            return -1
+        return 0
+
+    def close(self):
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+        return 0
+
+    def setup(self, pcm_format, pcm_channels, pcm_rate, pcm_buffer_size):
+        self.wav.setnchannels(pcm_channels)
+        self.wav.setsampwidth(2)    # S16_LE
+        self.wav.setframerate(pcm_rate)
+        return 0
+
+    def write(self, pcm_data):
+        try:
+            self.wav.writeframesraw(pcm_data)
+        except IOError:
+            return -1
+        return 0
+
+    def drain(self):
+        return 0
+
+    def drop(self):
+        return 0
+
+    def check(self):
+        return 0
+
+    def dump(self):
+        pass
+
+# Jitter buffer of one channel (TDMA slot) of audio.  Packets arrive in
+# bursts; the channel starts playing once the target depth is buffered, and
+# is then played out one frame per FRAME_MS.  A frame missing while playing
+# (underrun) is concealed by repeating the last one, fading, for up to
+# PLC_FRAMES; audio that arrives for a frame already concealed is late and
+# discarded, keeping the channel aligned with the playout clock.
+#
+# The samples are kept in a ring allocated once, a whole number of frames
+# long, and read a frame at a time from frame boundaries: pull() returns a
+# view of the ring (or of the concealment frame), valid until the next
+# push() or pull().
+class jitter_buffer(object):
+    def __init__(self, target):
+        self.target = target        # frames
+        self.capacity = (target + JITTER_SLACK + 1) * FRAME_SAMPLES
+        self.ring = np.zeros(self.capacity, dtype=np.int16)
+        self.last = np.zeros(FRAME_SAMPLES, dtype=np.int16)
+        self.fill = np.zeros(FRAME_SAMPLES, dtype=np.int16)
+        self.read = 0               # ring position of the next frame
+        self.count = 0              # samples buffered
+        self.state = 'idle'         # idle, priming, playing, or ending (flushing out after end of call)
+        self.owed = 0               # samples concealed that are still to arrive
+        self.concealing = 0         # frames concealed in a row
+        self.packets = 0
+        self.frames = 0
+        self.late = 0
+        self.dropped = 0
+        self.underruns = 0
+        self.concealed = 0
+
+    def reset(self):
+        self.read = 0
+        self.count = 0
+        self.state = 'idle'
+        self.owed = 0
+        self.concealing = 0
+        self.last[:] = 0
+
+    def playing(self):
+        return self.state in ('playing', 'ending')
+
+    def push(self, data):
+        self.packets += 1
+        samples = np.frombuffer(data, dtype=np.int16, count=len(data) // 2)
+        if self.owed:
+            n = min(self.owed, len(samples))
+            samples = samples[n:]
+            self.owed -= n
+            self.late += 1
+        n = len(samples)
+        if not n:
+            return
+        if self.count + n > (self.target + JITTER_SLACK) * FRAME_SAMPLES:
+            k = min(self.count, self.count + n - self.target * FRAME_SAMPLES) // FRAME_SAMPLES
+            self.read = (self.read + k * FRAME_SAMPLES) % self.capacity
+            self.count -= k * FRAME_SAMPLES
+            self.dropped += k
+            if n > self.capacity - self.count:
+                samples = samples[n - (self.capacity - self.count):]
+                n = len(samples)
+        w = (self.read + self.count) % self.capacity
+        first = min(n, self.capacity - w)
+        self.ring[w:w + first] = samples[:first]
+        self.ring[:n - first] = samples[first:]
+        self.count += n
+        if self.state == 'idle':
+            self.state = 'priming'
+        if self.state == 'priming' and self.count >= self.target * FRAME_SAMPLES:
+            self.state = 'playing'
+
+    def end(self):
+        # end of call: play out what is buffered, without waiting for more
+        if self.state == 'idle':
+            return
+        if self.count:
+            self.state = 'ending'
+        else:
+            self.reset()
+
+    def pull(self):
+        # the next frame, when the playout clock asks for one
+        if not self.playing():
+            return SILENCE
+        r = self.read
+        n = self.count
+        self.read = (r + FRAME_SAMPLES) % self.capacity
+        if n >= FRAME_SAMPLES:
+            frame = self.ring[r:r + FRAME_SAMPLES]
+            self.count -= FRAME_SAMPLES
+            self.frames += 1
+            self.concealing = 0
+            np.copyto(self.last, frame)
+            if self.state == 'ending' and not self.count:
+                self.reset()
+            return frame
+        self.fill[:n] = self.ring[r:r + n]
+        if self.state == 'ending':
+            self.fill[n:] = 0
+            self.frames += 1
+            self.reset()
+            return self.fill
+        if self.concealing == 0:
+            self.underruns += 1
+        self.concealing += 1
+        if self.concealing > PLC_FRAMES:
+            self.reset()
+            return SILENCE
+        self.concealed += 1
+        np.right_shift(self.last[n:], self.concealing, out=self.fill[n:])
+        self.count = 0
+        self.owed += FRAME_SAMPLES - n
+        return self.fill
+
+    def stats(self):
+        return {'state': self.state, 'depth_ms': self.count * 1000 // PCM_RATE, 'target_ms': self.target * FRAME_MS,
+                'packets': self.packets, 'frames': self.frames, 'late': self.late, 'dropped': self.dropped,
+                'underruns': self.underruns, 'concealed': self.concealed}
+
+# The jitter buffers of slots A and B (or of nslots slots) on one playout
+# clock: while any slot plays, a frame of each (silence for a slot that
+# does not) is due every FRAME_MS of the monotonic clock, so they stay
+# aligned however their packets arrive.  The clock goes on for linger
+# frames of silence after the last slot stops.
+class audio_mixer(object):
+    def __init__(self, jitter_ms=JITTER_MS, nslots=2, linger=0):
+        target = max(1, int(round(float(jitter_ms) / FRAME_MS)))
+        self.slots = [jitter_buffer(target) for i in range(nslots)]
+        self.linger = linger
+        self.idle = linger          # frames of silence since the last slot stopped
+        self.next_frame = None      # monotonic time the next frame is due, None while the clock is stopped
+        self.drain_pending = False
+        self.skipped = 0
+
+    def playing(self):
+        return any([s.playing() for s in self.slots])
+
+    def receive(self, slot, data):
+        # a udp packet: 320 bytes or less of audio, or 2 bytes of flag
+        # (0 end of call, 1 stop); returns 'drop' when the pcm device should stop now
+        if len(data) == 2:
+            flag = struct.unpack('<h', data)[0]
+            if flag == 0:
+                self.slots[slot].end()
+                self.drain_pending = True
+            elif flag == 1:
+                self.slots[slot].reset()
+                if not self.playing():
+                    return 'drop'
+        elif len(data) > 0:
+            self.slots[slot].push(data)
+        return None
+
+    def timeout(self, now):
+        # sec. until the next frame is due, None while the clock is stopped
+        if self.next_frame is None:
+            return None if not self.playing() else 0
+        return max(0, self.next_frame - now)
+
+    def due(self, now):
+        # generates the frames of each slot due by now, each to be used
+        # before the next is asked for (they are views of the jitter buffers)
+        if self.next_frame is None:
+            if not self.playing():
+                return
+            self.next_frame = now
+        if now - self.next_frame > MAX_CATCHUP:
+            self.skipped += int((now - self.next_frame) * 1000) // FRAME_MS
+            self.next_frame = now
+        while self.next_frame <= now:
+            if self.playing():
+                self.idle = 0
+            elif self.idle >= self.linger:
+                self.next_frame = None
+                break
+            else:
+                self.idle += 1
+            yield tuple([s.pull() for s in self.slots])
+            self.next_frame += FRAME_MS / 1000.0
+
+    def drained(self):
+        # true once after an end of call, when the last frame has been played out
+        if self.drain_pending and not self.playing():
+            self.drain_pending = False
+            return True
+        return False
+
+    def stats(self):
+        return {'a': self.slots[0].stats(), 'b': self.slots[1].stats(), 'skipped': self.skipped}
+
+def rc_value(rc):
+    if isinstance(rc, ctypes.c_int):
+        rc = rc.value
+    return rc
+
 # Main class that receives UDP audio samples and sends them to a PCM subsystem (currently ALSA or STDOUT)
 class socket_audio(object):
-    def __init__(self, udp_host, udp_port, pcm_device, two_channels = False, audio_gain = 1.0, dest_stdout = False, silent_flag=False, **kwds):
+    def __init__(self, udp_host, udp_port, pcm_device, two_channels = False, audio_gain = 1.0, dest_stdout = False, silent_flag=False, jitter_ms=JITTER_MS, **kwds):
         self.keep_running = True
         self.two_channels = two_channels
         self.audio_gain = audio_gain
+        self.mixer = audio_mixer(jitter_ms)
+        self.setup_output()
         self.dest_stdout = dest_stdout
         self.sock_a = None
         self.sock_b = None
@@ -409,94 +664,79 @@ class socket_audio(object):
 
     def run(self):
         rc = 0
+        socks = [self.sock_a, self.sock_b]
         while self.keep_running and (rc >= 0):
-            readable, writable, exceptional = select.select( [self.sock_a, self.sock_b], [], [self.sock_a, self.sock_b], 5.0)
-            in_a = None
-            in_b = None
-            data_a = ""
-            data_b = ""
-            flag_a = -1
-            flag_b = -1
+            timeout = self.mixer.timeout(time.monotonic())
+            readable, writable, exceptional = select.select(socks, [], socks, 5.0 if timeout is None else timeout)
 
             # Check for select() polling timeout and pcm self-check
-            if (not readable) and (not writable) and (not exceptional):
+            if (not readable) and (not exceptional) and (timeout is None):
                 if self.silent_flag:
                     rc = 0 # suppress additional zeros to preserve timing 
                 else:
-                    rc = self.pcm.check()
-                if isinstance(rc, ctypes.c_int):
-                    rc = rc.value
+                    rc = rc_value(self.pcm.check())
                 continue
 
-            # Data received on the udp port is 320 bytes for an audio frame or 2 bytes for a flag
-            if self.sock_a in readable:
-                in_a = self.sock_a.recvfrom(MAX_SUPERFRAME_SIZE)
-
-            if self.sock_b in readable:
-                in_b = self.sock_b.recvfrom(MAX_SUPERFRAME_SIZE)
-
-            if in_a is not None:
-                len_a = len(in_a[0])
-                if len_a == 2:
-                    flag_a = np.frombuffer(in_a[0], dtype=np.int16)[0]
-                elif len_a > 0:
-                    data_a = in_a[0]
-
-            if in_b is not None:
-                len_b = len(in_b[0])
-                if len_b == 2:
-                    flag_b = np.frombuffer(in_b[0], dtype=np.int16)[0]
-                elif len_b > 0:
-                    data_b = in_b[0]
-
-            if (flag_a == 0) or (flag_b == 0):
-                rc = self.pcm.drain()
-                if isinstance(rc, ctypes.c_int):
-                    rc = rc.value
-                continue
+            for slot in range(len(socks)):
+                if socks[slot] in readable:
+                    rc = self.receive(slot, socks[slot])
 
-            if (((flag_a == 1) and (flag_b == 1)) or
-                ((flag_a == 1) and (in_b is None)) or 
-                ((flag_b == 1) and (in_a is None))):
-                rc = self.pcm.drop()
-                if isinstance(rc, ctypes.c_int):
-                    rc = rc.value
-                continue
+            for data_a, data_b in self.mixer.due(time.monotonic()):
+                if not self.two_channels:
+                    data_b = data_a
+                rc = self.write_frame(data_a, data_b)
 
-            if not self.two_channels:
-                data_a = self.scale(data_a)
-                rc = self.pcm.write(self.interleave(data_a, data_a))
-                if isinstance(rc, ctypes.c_int):
-                    rc = rc.value
-            else:
-                data_a = self.scale(data_a)
-                data_b = self.scale(data_b)
-                rc = self.pcm.write(self.interleave(data_a, data_b))
-                if isinstance(rc, ctypes.c_int):
-                    rc = rc.value
+            if self.mixer.drained():
+                rc = rc_value(self.pcm.drain())
 
         self.close_sockets()
         self.close_pcm()
         return
 
-    def scale(self, data):  # crude amplitude scaler (volume) for S16_LE samples
-        arr = np.array(np.frombuffer(data, dtype=np.int16), dtype=np.float32)
-        result = np.zeros(len(arr), dtype=np.int16)
-        arr = np.clip(arr*self.audio_gain, -32767, 32766, out=result)
-        return result.tobytes('C')
-
-    def interleave(self, data_a, data_b):
-        arr_a = np.frombuffer(data_a, dtype=np.int16)
-        arr_b = np.frombuffer(data_b, dtype=np.int16)
-        d_len = max(len(arr_a), len(arr_b))
-        result = np.zeros(d_len*2, dtype=np.int16)
-        if len(arr_a):
-            # copy arr_a to result[0,2,4, ...]
-            result[ range(0, len(arr_a)*2, 2) ] = arr_a
-        if len(arr_b):
-            # copy arr_b to result[1,3,5, ...]
-            result[ range(1, len(arr_b)*2, 2) ] = arr_b
-        return result.tobytes('C')
+    def receive(self, slot, sock):
+        # everything waiting on the socket of a slot, into its jitter buffer
+        # (slot b audio is ignored unless two_channels)
+        rc = 0
+        while True:
+            try:
+                data = sock.recvfrom(MAX_SUPERFRAME_SIZE)[0]
+            except (BlockingIOError, InterruptedError):
+                return rc
+            if slot == 1 and not self.two_channels and len(data) != 2:
+                continue
+            if self.mixer.receive(slot, data) == 'drop':
+                rc = rc_value(self.pcm.drop())
+
+    def stats(self):
+        # jitter buffer counters of each slot, and underruns of the pcm device
+        d = self.mixer.stats()
+        d['pcm_underruns'] = getattr(self.pcm, 'underruns', 0)
+        return d
+
+    def setup_output(self):
+        # the stereo frame written to the pcm device, allocated once, and
+        # strided views of it for each slot
+        self.out = (c_char * (FRAME_BYTES * 2))()
+        frame = np.frombuffer(self.out, dtype=np.int16)
+        self.out_a = frame[0::2]
+        self.out_b = frame[1::2]
+        self.gained = np.zeros(FRAME_SAMPLES, dtype=np.float32)
+
+    def write_frame(self, data_a, data_b):
+        # scale (volume) and interleave a frame of each slot into the output
+        # buffer, in place, and write it to the pcm device
+        self.scale(self.out_a, data_a)
+        self.scale(self.out_b, data_b)
+        return rc_value(self.pcm.write(self.out))
+
+    def scale(self, out, data):  # crude amplitude scaler (volume) for S16_LE samples
+        if self.audio_gain == 1.0:
+            np.copyto(out, data)
+            return
+        np.multiply(data, np.float32(self.audio_gain), out=self.gained)
+        np.minimum(self.gained, 32766, out=self.gained)   # np.clip costs twice as much
+        np.maximum(self.gained, -32767, out=self.gained)
+        np.copyto(out, self.gained, casting='unsafe')
 
     def stop(self):
         self.keep_running = False
@@ -540,11 +780,11 @@ class socket_audio(object):
         return
 
 class audio_thread(threading.Thread):
-    def __init__(self, udp_host, udp_port, pcm_device, two_channels = False, audio_gain = 1.0, dest_stdout = False, **kwds):
+    def __init__(self, udp_host, udp_port, pcm_device, two_channels = False, audio_gain = 1.0, dest_stdout = False, jitter_ms=JITTER_MS, **kwds):
         threading.Thread.__init__(self, **kwds)
         self.setDaemon(True)
         self.keep_running = True
-        self.sock_audio = socket_audio(udp_host, udp_port, pcm_device, two_channels, audio_gain, dest_stdout, **kwds)
+        self.sock_audio = socket_audio(udp_host, udp_port, pcm_device, two_channels, audio_gain, dest_stdout, jitter_ms=jitter_ms, **kwds)
         self.start()
         return
 
@@ -554,3 +794,199 @@ class audio_thread(threading.Thread):
     def stop(self):
         self.sock_audio.stop()
 
+
+# Captures of the udp audio of slots a and b, to replay through the
+# jitter buffers with jitter injected (the playout clock simulated, no
+# sound device needed):
+#
+#     ./sockaudio.py capture <file> [host] [port]     until ctrl-c
+#     ./sockaudio.py replay <file> [max delay ms] [jitter buffer ms]
+#     ./sockaudio.py check                            synthetic captures
+#
+# A capture file is a sequence of (sec. since start, slot, length, packet).
+
+CAPTURE_RECORD = struct.Struct('<dBH')
+
+def write_capture(filename, packets):
+    with open(filename, 'wb') as f:
+        for t, slot, data in packets:
+            f.write(CAPTURE_RECORD.pack(t, slot, len(data)))
+            f.write(data)
+
+def read_capture(filename):
+    packets = []
+    with open(filename, 'rb') as f:
+        while True:
+            hdr = f.read(CAPTURE_RECORD.size)
+            if len(hdr) < CAPTURE_RECORD.size:
+                break
+            t, slot, n = CAPTURE_RECORD.unpack(hdr)
+            packets.append((t, slot, f.read(n)))
+    return packets
+
+def capture(filename, udp_host='127.0.0.1', udp_port=23456):
+    socks = []
+    for port in [udp_port, udp_port + 2]:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((udp_host, port))
+        socks.append(sock)
+    packets = []
+    t0 = time.monotonic()
+    try:
+        while True:
+            readable, writable, exceptional = select.select(socks, [], [], 1.0)
+            for slot in range(len(socks)):
+                if socks[slot] in readable:
+                    packets.append((time.monotonic() - t0, slot, socks[slot].recvfrom(MAX_SUPERFRAME_SIZE)[0]))
+    except KeyboardInterrupt:
+        pass
+    write_capture(filename, packets)
+    sys.stderr.write('%s: %d packets\n' % (filename, len(packets)))
+
+def synthetic_capture(rng, calls=10):
+    # calls on one or both slots, each frame a distinct nonzero ramp, sent
+    # two frames at a time every 40 ms as tdma does, then an end of call flag
+    packets = []
+    t = 0.0
+    n = 0
+    for call in range(calls):
+        slots = rng.choice([[0], [1], [0, 1]])
+        for i in range(rng.randrange(25, 150)):
+            t += 2 * FRAME_MS / 1000.0
+            for slot in slots:
+                for k in range(2):
+                    n += 1
+                    frame = (np.arange(FRAME_SAMPLES) + n * 37) % 30000 + 1
+                    packets.append((t, slot, frame.astype(np.int16).tobytes()))
+        for slot in slots:
+            packets.append((t, slot, struct.pack('<h', 0)))
+        t += rng.uniform(0.2, 2.0)
+    return packets
+
+def replay(packets, max_delay_ms, jitter_ms=JITTER_MS, rng=None):
+    # each packet delayed by up to max_delay_ms (in order within its slot);
+    # returns the mixer and what was played out on each slot
+    import random
+    rng = rng or random.Random(1)
+    arrivals = []
+    last = [0.0, 0.0]
+    for t, slot, data in packets:
+        last[slot] = max(last[slot], t + rng.uniform(0, max_delay_ms / 1000.0))
+        arrivals.append((last[slot], slot, data))
+    arrivals.sort(key=lambda p: p[0])
+    mixer = audio_mixer(jitter_ms)
+    out = [bytearray(), bytearray()]
+    now = 0.0
+    i = 0
+    while i < len(arrivals) or mixer.playing():
+        timeout = mixer.timeout(now)
+        wakeups = [now + timeout] if timeout is not None else []
+        if i < len(arrivals):
+            wakeups.append(arrivals[i][0])
+        now = max(now, min(wakeups))
+        while i < len(arrivals) and arrivals[i][0] <= now:
+            mixer.receive(arrivals[i][1], arrivals[i][2])
+            i += 1
+        for data_a, data_b in mixer.due(now):
+            out[0] += data_a.tobytes()
+            out[1] += data_b.tobytes()
+        mixer.drained()
+    return mixer, out
+
+def played_audio(data):
+    # the frames played out, without the silence between calls
+    silence = bytes(FRAME_BYTES)
+    return b''.join([data[i:i + FRAME_BYTES] for i in range(0, len(data), FRAME_BYTES) if data[i:i + FRAME_BYTES] != silence])
+
+def replay_report(packets, max_delay_ms, jitter_ms=JITTER_MS):
+    mixer, out = replay(packets, max_delay_ms, jitter_ms)
+    d = mixer.stats()
+    intact = []
+    for slot in range(2):
+        sent = b''.join([p[2] for p in packets if p[1] == slot and len(p[2]) != 2])
+        intact.append(played_audio(out[slot]) == sent)
+    sys.stderr.write('delay %3d ms, buffer %3d ms: late %d/%d, dropped %d/%d, underruns %d/%d, concealed %d/%d, audio intact %s/%s\n' % (
+        max_delay_ms, jitter_ms, d['a']['late'], d['b']['late'], d['a']['dropped'], d['b']['dropped'],
+        d['a']['underruns'], d['b']['underruns'], d['a']['concealed'], d['b']['concealed'], intact[0], intact[1]))
+    return d, intact
+
+def check():
+    # synthetic tdma captures replayed with jitter within and beyond what
+    # the buffer absorbs (its depth less the 40 ms of a burst), and in
+    # bursts that overflow it
+    import random
+    packets = synthetic_capture(random.Random(1))
+    for max_delay_ms, jitter_ms in [(0, 60), (20, 60), (40, 60), (80, 120)]:
+        d, intact = replay_report(packets, max_delay_ms, jitter_ms)
+        assert intact == [True, True]
+        assert d['a']['underruns'] == d['b']['underruns'] == 0
+    d, intact = replay_report(packets, 200, 40)
+    assert d['a']['underruns'] > 0 and d['a']['concealed'] > 0 and d['a']['late'] > 0
+    assert intact == [False, False]
+    burst = [(0.0, 0, p[2]) for p in packets[:200] if p[1] == 0 and len(p[2]) != 2] + [(0.0, 0, struct.pack('<h', 0))]
+    d, intact = replay_report(burst, 0, 60)
+    assert d['a']['dropped'] > 0 and d['a']['dropped'] + d['a']['frames'] == len(burst) - 1 and d['a']['underruns'] == 0
+    sys.stderr.write('ok\n')
+
+def bench(n=100000):
+    # frames/s of the output path: scale and interleave of the two slots,
+    # as allocated per frame before (float32 copy, zeroed int16, bytes, and
+    # another zeroed array scattered into by index lists), and in place
+    # into the preallocated buffer handed to the pcm device; then of the
+    # whole path, packets through the jitter buffers to the pcm device
+    class null_pcm(object):
+        def write(self, pcm_data):
+            return 0
+    def scale(data, audio_gain):
+        arr = np.array(np.frombuffer(data, dtype=np.int16), dtype=np.float32)
+        result = np.zeros(len(arr), dtype=np.int16)
+        np.clip(arr*audio_gain, -32767, 32766, out=result, casting='unsafe')
+        return result.tobytes('C')
+    def interleave(data_a, data_b):
+        arr_a = np.frombuffer(data_a, dtype=np.int16)
+        arr_b = np.frombuffer(data_b, dtype=np.int16)
+        result = np.zeros(max(len(arr_a), len(arr_b))*2, dtype=np.int16)
+        result[ range(0, len(arr_a)*2, 2) ] = arr_a
+        result[ range(1, len(arr_b)*2, 2) ] = arr_b
+        return result.tobytes('C')
+    sa = socket_audio.__new__(socket_audio)    # no sockets or sound device
+    sa.audio_gain = 1.5
+    sa.pcm = null_pcm()
+    sa.mixer = audio_mixer()
+    sa.setup_output()
+    data_a = (np.arange(FRAME_SAMPLES) * 100).astype(np.int16)
+    data_b = data_a[::-1].copy()
+    bytes_a = data_a.tobytes()
+    bytes_b = data_b.tobytes()
+    def run(name, f):
+        t0 = time.time()
+        for i in range(n):
+            f()
+        dt = time.time() - t0
+        sys.stderr.write('%-28s %8.0f frames/s (%.1f us/frame)\n' % (name, n / dt, dt / n * 1e6))
+    run('before: scale, interleave', lambda: interleave(scale(bytes_a, sa.audio_gain), scale(bytes_b, sa.audio_gain)))
+    assert interleave(scale(bytes_a, sa.audio_gain), scale(bytes_b, sa.audio_gain)) == (sa.write_frame(data_a, data_b) or sa.out.raw)
+    run('after: write_frame', lambda: sa.write_frame(data_a, data_b))
+    sa.audio_gain = 1.0
+    run('after: write_frame, gain 1', lambda: sa.write_frame(data_a, data_b))
+    def path():
+        sa.mixer.receive(0, bytes_a)
+        sa.mixer.receive(1, bytes_b)
+        for a, b in sa.mixer.due(sa.mixer.next_frame or 0.0):
+            sa.write_frame(a, b)
+    run('after: jitter buffers, pcm', path)
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == 'capture':
+        capture(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else '127.0.0.1', int(sys.argv[4]) if len(sys.argv) > 4 else 23456)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'replay':
+        replay_report(read_capture(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else 0, int(sys.argv[4]) if len(sys.argv) > 4 else JITTER_MS)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'check':
+        check()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(float(sys.argv[2])) if len(sys.argv) > 2 else 100000)
+    else:
+        sys.stderr.write('usage: %s capture <file> [host] [port] | replay <file> [max delay ms] [jitter buffer ms] | check | bench [frames]\n' % sys.argv[0])
+
+if __name__ == '__main__':
+    main()
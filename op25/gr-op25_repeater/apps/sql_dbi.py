@@ -22,81 +22,299 @@
 import sys
 import os
 import time
-import json
 import threading
 import traceback
 import sqlite3
 
-import op25
-from gnuradio import gr
+try:
+	import queue
+except ImportError:	# python 2
+	import Queue as queue
 
-from emap import events_map, cc_events
+import sqlite_store
+from emap import events_map, cc_events, event_columns
 
 _def_db_file = 'op25-data.db'
-_def_msgq_size = 100
-_def_uncommitted = 25
+_def_msgq_size = 20000		# events waiting for the writer thread
+_def_batch_rows = 1000		# write when this many events are pending,
+_def_flush_interval = 0.5	# or when the oldest has waited this long (sec.)
+_def_max_batch_rows = 5000	# events written per transaction, at most
+_def_rollup_interval = 2.0	# add the written events to the rollups this often (sec.)
+_def_spill_rows = 200000	# events held in memory while the db can't be written
+_def_retry_min = 0.5		# retry delay after a failed write, doubling
+_def_retry_max = 30.0		# up to this (sec.)
+_def_retention_interval = 600	# check the retention policy this often (sec.)
+_stop = object()		# du_queue_runner.stop() marker
 
 class du_queue_runner(threading.Thread):
-	def __init__(self, msgq,  **kwds):
+	# writer thread: takes (column names, row) tuples from q, groups the
+	# rows by column names and writes each group with one executemany(),
+	# all groups in one transaction of up to _def_max_batch_rows; q is
+	# emptied between transactions, so a backlog waits in memory rather
+	# than filling q.  When a write fails (database locked past the busy
+	# timeout, disk full, file replaced ...) the rows stay in memory - up
+	# to _def_spill_rows - and the write is retried on a new connection
+	# with increasing delay.
+	#
+	# The rollups (sqlite_store) are brought up to date every
+	# _def_rollup_interval, in transactions of their own between the
+	# writes, and before the thread exits.
+	#
+	# Retention policy: every _def_retention_interval, whole days older
+	# than retention_days, and the oldest days while the data takes more
+	# than max_size_mb, are deleted, then the freed pages returned to the
+	# file system (0: no limit).  One batch per transaction, between the
+	# writes, so the events keep flowing.
+	def __init__(self, q, db_filename=_def_db_file, retention_days=0, max_size_mb=0, **kwds):
 		threading.Thread.__init__ (self, **kwds)
 		self.setDaemon(1)
-		self.msgq = msgq
-		self.db_filename = _def_db_file
+		self.q = q
+		self.db_filename = db_filename
+		self.retention_days = retention_days
+		self.max_size_mb = max_size_mb
+		self.retain_at = time.time() + 60 if retention_days or max_size_mb else None
+		self.retain_day = None	# a day partly deleted, to be finished (and its rollups rebuilt)
+		self.rollup_at = None	# written rows not yet in the rollups: update them at this time
 		self.conn = None
 		self.cursor = None
 		self.failed = False
-		self.keep_running = True
-		self.uncommitted = 0
-		self.max_q = 0
-		self.next_t = time.time()
+		self.pending = {}	# column names -> list of rows
+		self.npending = 0
+		self.first_pending = 0
+		self.retry_at = 0
+		self.retry_delay = 0
+		self.commands = {}	# column names -> INSERT statement
+		self.counters = {'rows': 0, 'batches': 0, 'max_batch': 0, 'max_q': 0, 'commit_ms': 0.0, 'max_commit_ms': 0.0,
+				'errors': 0, 'reconnects': 0, 'max_pending': 0, 'spill_dropped': 0, 'rejected': 0,
+				'retention_deleted': 0, 'retention_ms': 0.0, 'rollup_ms': 0.0}
 		self.start()
 
 	def run(self):
-		self.connect()
-		while self.keep_running and not self.failed:
-			self.max_q = max(self.max_q, self.msgq.count())
-			if time.time() > self.next_t:
-				self.next_t = time.time() + 2
-			msg = self.msgq.delete_head()
-			if self.failed or not self.keep_running:
+		# connects on the first write: sql_dbi.event() queues nothing
+		# until the db file exists, and connecting would create it
+		while not self.failed:
+			timeout = None
+			if self.npending:
+				timeout = max(0, self.flush_due() - time.time())
+			for at in (self.retain_at, self.rollup_at):
+				if at is not None:
+					timeout = max(0, min(timeout if timeout is not None else _def_retention_interval, at - time.time()))
+			if not self.get_rows(timeout):
 				break
-			self.insert_row(msg)
+			if self.npending and time.time() >= self.flush_due():
+				self.flush()
+			if self.rollup_at is not None and time.time() >= self.rollup_at and self.npending < _def_batch_rows and not self.retry_delay:
+				if not self.roll_up():
+					self.rollup_at = None
+			if self.retain_at is not None and time.time() >= self.retain_at and self.npending < _def_batch_rows and not self.retry_delay:
+				if not self.retain():
+					self.retain_at = time.time() + _def_retention_interval
+		while self.npending and not self.failed and self.flush():
+			pass
+		while self.rollup_at is not None and self.roll_up():
+			pass
+		self.disconnect()
+
+	def get_rows(self, timeout):
+		# move the rows in q to pending, waiting up to timeout for the
+		# first; returns False once stop() was called
+		try:
+			item = self.q.get(timeout=timeout)
+			self.counters['max_q'] = max(self.counters['max_q'], self.q.qsize() + 1)
+			while item is not _stop:
+				self.add_row(item[0], item[1])
+				item = self.q.get_nowait()
+		except queue.Empty:
+			return True
+		return False
+
+	def stop(self):
+		# write what is queued and exit
+		self.q.put(_stop)
 
 	def disconnect(self):
-		self.conn.close()
+		if self.conn is not None:
+			try:
+				self.conn.close()
+			except sqlite3.Error:
+				pass
 		self.cursor = None
 		self.conn = None
 
 	def connect(self):
-		self.conn = sqlite3.connect(self.db_filename)
+		self.conn = sqlite_store.connect(self.db_filename, writer=True)
 		self.cursor = self.conn.cursor()
 
-	def insert_row(self, msg):
-		if self.cursor is None or self.conn is None:
+	def add_row(self, column_names, row):
+		if self.npending >= _def_spill_rows:
+			self.counters['spill_dropped'] += 1
 			return
-		d = json.loads(msg.to_string())
+		if not self.npending:
+			self.first_pending = time.time()
+		if column_names not in self.pending:
+			self.pending[column_names] = []
+		self.pending[column_names].append(row)
+		self.npending += 1
+		self.counters['max_pending'] = max(self.counters['max_pending'], self.npending)
+
+	def flush_due(self):
+		# time of the next write
+		t = self.first_pending + _def_flush_interval
+		if self.npending >= _def_batch_rows:
+			t = 0
+		return max(t, self.retry_at)
+
+	def insert_command(self, column_names):
+		# one statement text per event shape, so sqlite3's statement cache
+		# compiles it once
+		if column_names not in self.commands:
+			self.commands[column_names] = "INSERT INTO data_store(%s) VALUES(%s)" % (','.join(column_names), ','.join(['?'] * len(column_names)))
+		return self.commands[column_names]
+
+	def write_rows(self, command, rows):
 		try:
-			self.cursor.execute(d['command'], d['row'])
-			# optimization: only commit when no more msgs queued (or limit reached)
-			if self.uncommitted < _def_uncommitted and self.msgq.count():
-				self.uncommitted += 1
-			else:
-				self.conn.commit()
-				self.uncommitted = 0
+			self.cursor.execute('SAVEPOINT rows')
+			self.cursor.executemany(command, rows)
+		except (sqlite3.IntegrityError, sqlite3.InterfaceError):
+			# a bad row fails the whole group: write the others one by one
+			self.cursor.execute('ROLLBACK TO rows')
+			for row in rows:
+				try:
+					self.cursor.execute(command, row)
+				except (sqlite3.IntegrityError, sqlite3.InterfaceError):
+					self.counters['rejected'] += 1
+		self.cursor.execute('RELEASE rows')
+
+	def batch(self):
+		# the pending rows of the next transaction: {column names: rows}
+		rows = {}
+		n = 0
+		for column_names in self.pending:
+			rows[column_names] = self.pending[column_names][:_def_max_batch_rows - n]
+			n += len(rows[column_names])
+			if n >= _def_max_batch_rows:
+				break
+		return rows, n
+
+	def flush(self):
+		# one transaction of pending rows; returns False if it failed
+		t0 = time.time()
+		rows, n = self.batch()
+		try:
+			if self.conn is None:
+				self.counters['reconnects'] += 1
+				self.connect()
+			self.cursor.execute('BEGIN IMMEDIATE')
+			rollups = sqlite_store.track_rollups(self.cursor)	# not until upgrade_db on an old db
+			for column_names in rows:
+				self.write_rows(self.insert_command(column_names), rows[column_names])
+			self.conn.commit()
+		except sqlite3.Error as e:
+			self.write_failed(e)
+			return False
 		except:
 			self.failed = True
 			traceback.print_exc(limit=None, file=sys.stdout)
 			traceback.print_exc(limit=None, file=sys.stderr)
-			sys.stderr.write('sql_dbi: db logging stopped due to error (or db not initialized)\n')
-			# TODO - add error recovery?
+			sys.stderr.write('sql_dbi: db logging stopped due to error\n')
+			return False
+		ms = (time.time() - t0) * 1000.0
+		c = self.counters
+		if self.retry_delay:
+			sys.stderr.write('sql_dbi: db logging resumed after %d errors, %d events held\n' % (c['errors'], self.npending))
+			self.retry_delay = 0
+			self.retry_at = 0
+		c['rows'] += n
+		c['batches'] += 1
+		c['max_batch'] = max(c['max_batch'], n)
+		c['commit_ms'] += ms
+		c['max_commit_ms'] = max(c['max_commit_ms'], ms)
+		for column_names in rows:
+			del self.pending[column_names][:len(rows[column_names])]
+			if not self.pending[column_names]:
+				del self.pending[column_names]
+		self.npending -= n
+		if rollups and self.rollup_at is None:
+			self.rollup_at = time.time() + _def_rollup_interval
+		return True
+
+	def roll_up(self):
+		# one transaction of the rollup update; returns True if there is more
+		t0 = time.time()
+		try:
+			if self.conn is None:
+				return False
+			self.cursor.execute('BEGIN IMMEDIATE')
+			more = sqlite_store.update_rollups(self.cursor, sqlite_store.ROLLUP_ROWS)
+			self.conn.commit()
+		except sqlite3.Error as e:
+			try:
+				self.conn.rollback()
+			except sqlite3.Error:
+				pass
+			sys.stderr.write('sql_dbi: rollup update failed (%s), retrying later\n' % e)
+			return False
+		self.counters['rollup_ms'] += (time.time() - t0) * 1000.0
+		return more
+
+	def retain(self):
+		# one step of the retention policy; returns True if there may be more
+		t0 = time.time()
+		try:
+			if self.conn is None:
+				if not os.access(self.db_filename, os.W_OK):
+					return False
+				self.connect()
+			first = self.cursor.execute('SELECT MIN(time) FROM data_store').fetchone()[0]
+			due = False
+			if first is not None:
+				day = int(first) // sqlite_store.DAY
+				if self.retention_days:
+					due = day < int(time.time()) // sqlite_store.DAY - self.retention_days
+				if self.max_size_mb:
+					due = due or sqlite_store.used_bytes(self.cursor) > self.max_size_mb << 20
+				due = due or day == self.retain_day
+			if not due:
+				return sqlite_store.release_space(self.conn) > 0
+			self.cursor.execute('BEGIN IMMEDIATE')
+			n = sqlite_store.delete_batch(self.cursor, 'time < ?', ((day + 1) * sqlite_store.DAY,))
+			self.retain_day = day
+			if n < sqlite_store.DELETE_ROWS:
+				sqlite_store.rebuild_rollups(self.cursor, day, day)	# the day is gone
+				self.retain_day = None
+			self.conn.commit()
+		except sqlite3.Error as e:
+			try:
+				self.conn.rollback()
+			except sqlite3.Error:
+				pass
+			sys.stderr.write('sql_dbi: retention policy failed (%s), retrying later\n' % e)
+			return False
+		self.counters['retention_deleted'] += n
+		self.counters['retention_ms'] += (time.time() - t0) * 1000.0
+		return True
+
+	def write_failed(self, e):
+		# keep the pending rows and retry on a new connection
+		if self.conn is not None:
+			try:
+				self.conn.rollback()
+			except sqlite3.Error:
+				pass
+		self.disconnect()
+		self.counters['errors'] += 1
+		if not self.retry_delay:
+			sys.stderr.write('sql_dbi: db write failed (%s), holding %d events and retrying\n' % (e, self.npending))
+		self.retry_delay = min(max(2 * self.retry_delay, _def_retry_min), _def_retry_max)
+		self.retry_at = time.time() + self.retry_delay
 
 class sql_dbi:
-	def __init__(self, db_filename=_def_db_file):
+	def __init__(self, db_filename=_def_db_file, retention_days=0, max_size_mb=0):
 		self.conn = None
 		self.cursor = None
 		self.db_filename = db_filename
-		self.db_msgq = gr.msg_queue(_def_msgq_size)
-		self.q_runner = du_queue_runner(self.db_msgq)
+		self.db_q = queue.Queue(_def_msgq_size)
+		self.q_runner = du_queue_runner(self.db_q, db_filename, retention_days=retention_days, max_size_mb=max_size_mb)
 		self.db_msgq_overflow = 0
 
 		self.sql_commands = {
@@ -160,13 +378,12 @@ class sql_dbi:
 		self.conn = None
 
 	def connect(self):
-		self.conn = sqlite3.connect(self.db_filename)
+		self.conn = sqlite_store.connect(self.db_filename)
 		self.cursor = self.conn.cursor()
 
 	def reset_db(self):	# any data in db will be destroyed!
-		if os.access(self.db_filename, os.W_OK):
-			os.remove(self.db_filename)
-		self.conn = sqlite3.connect(self.db_filename)
+		sqlite_store.remove_db(self.db_filename)
+		self.conn = sqlite_store.connect(self.db_filename, writer=True)
 		self.cursor = self.conn.cursor()
 		self.execute('create_sysid')
 		self.execute('create_2b_rv')
@@ -178,8 +395,17 @@ class sql_dbi:
 		self.execute_lines('create_index')
 		self.conn.commit()
 		self.populate_event_keys()
+		sqlite_store.upgrade(self.conn)
 		self.conn.close()
 
+	def upgrade_db(self):
+		# bring a database made by an older version to the current schema
+		# (rollups, indexes, incremental vacuum); existing data is kept.
+		# Building the indexes and the VACUUM of a large db take a while,
+		# the event writer holds its rows
+		old, new = sqlite_store.upgrade(self.conn)
+		sys.stderr.write('%s: schema version %d -> %d\n' % (self.db_filename, old, new))
+
 	def execute(self, q):
 		self.cursor.execute(self.sql_commands[q])
 		self.conn.commit()
@@ -210,49 +436,39 @@ class sql_dbi:
 	def event(self, d):
 		if d['cc_event'] not in events_map:
 			return
-		if not os.access(_def_db_file, os.W_OK):	# if DB not (yet) set up or not writable
+		if not os.access(self.db_filename, os.W_OK):	# if DB not (yet) set up or not writable
 			return
-		mapl = events_map[d['cc_event']]
-		row = []
-		column_names = []
-		for col in mapl:
-			colname = col[0]
-			k = col[1]
-			# special mappings: unwrap tgid and srcid objects
-			if colname.startswith('tgid') and type(d[k]) is dict:
-				val = d[k]['tg_id']
-			elif colname.startswith('suid') and type(d[k]) is dict:
-				val = d[k]['unit_id']
-			elif type(d[k]) is not dict:
-				val = d[k]
-			else:
-				sys.stderr.write('value retrieval error %s %s %s\n' % (d['cc_event'], type(d[k]) is dict, k))
-				val = -1
-			# special mappings: map cc_event tag to an int
-			if colname == 'cc_event':
-				val = cc_events[d[k]]
-			# special mappings: map affiliation to int
-			if k == 'affiliation':
-				if d[k] == 'global':
-					val = 1
-				elif d[k] == 'local':
-					val = 0
-				else:
-					val = -1
-			# special mappings: map duration to int(msec).
-			if k == 'duration':
-				val = int(d[k] * 1000)
-			row.append(val)
-			column_names.append(colname)
-		command = "INSERT INTO data_store(%s) VALUES(%s)" % (','.join(column_names), ','.join(['?'] * len(row)))
-		js = json.dumps({'command': command, 'row': row})
-		if not self.db_msgq.full_p():
-			msg = gr.message().make_from_string(js, 0, 0, 0)
-			self.db_msgq.insert_tail(msg)
-		else:
+		column_names, row = event_columns(d)
+		try:
+			self.db_q.put_nowait((tuple(column_names), tuple(row)))
+		except queue.Full:
 			self.db_msgq_overflow += 1
 
+	def stats(self):
+		# writer counters: rows written, batches (transactions) and the
+		# largest one, commit time, queue high water mark and drops
+		# (sent to the terminals as json_type db_stats with each update)
+		d = dict(self.q_runner.counters)
+		d['queued'] = self.db_q.qsize()
+		d['dropped'] = self.db_msgq_overflow
+		d['failed'] = self.q_runner.failed
+		return d
+
+	def import_events(self, batch):
+		# bulk insert of a tsbk_batch.cc_event_batch (offline replay)
+		column_names, rows = batch.data_store_rows()
+		command = "INSERT INTO data_store(%s) VALUES(%s)" % (','.join(column_names), ','.join(['?'] * len(column_names)))
+		self.cursor.execute('BEGIN IMMEDIATE')
+		rollups = sqlite_store.track_rollups(self.cursor)
+		self.cursor.executemany(command, rows)
+		if rollups:
+			sqlite_store.update_rollups(self.cursor)
+		self.conn.commit()
+		return len(rows)
+
 	def import_tsv(self, argv):
+		# import_tgid / import_unit <file> <sysid> [sync]: upsert the tags of
+		# the file (sync: and delete the tags of sysid that are not in it)
 		cmd = argv[1]
 		filename = argv[2]
 		sysid = int(argv[3])
@@ -265,27 +481,28 @@ class sql_dbi:
 		else:
 			print('%s unsupported' % (cmd))
 			return
-		q = 'INSERT INTO ' + table + '(rid, sysid, tag, priority) VALUES(?,?,?,?)'
-		if table == 'sysid_tags':
-			q = 'INSERT INTO ' + table + '(sysid, tag) VALUES(?,?)'
 		rows = []
 		with open(filename, 'r') as f:
 			lines = f.read().rstrip().split('\n')
 			for i in range(len(lines)):
 				a = lines[i].split('\t')
-				if i == 0:	# check hdr
-					if not a[0].strip().isdigit():
-						continue
+				if not a[0].strip().isdigit():	# header, wildcards
+					continue
 				rid = int(a[0])
 				tag = a[1]
 				priority = 0 if len(a) < 3 else int(a[2])
-				s = (rid, sysid, tag, priority)
-				if table == 'sysid_tags':
-					s = (rid, tag)
-				rows.append(s)
-		if len(rows):
-			self.cursor.executemany(q, rows)
-			self.conn.commit()
+				rows.append((rid, tag, priority))
+		if table == 'sysid_tags':
+			if len(rows):
+				self.cursor.executemany('INSERT INTO sysid_tags(sysid, tag) VALUES(?,?)', [s[:2] for s in rows])
+				self.conn.commit()
+			return
+		diff = sqlite_store.import_tags(self.conn, table, sysid, rows, delete_missing=len(argv) > 4 and argv[4] == 'sync')
+		for kind, sign in (('added', '+'), ('changed', '~'), ('deleted', '-')):
+			for rid, old, new in diff['changes'].get(kind, []):
+				print('%s %d\t%s' % (sign, rid, new if old is None else old if new is None else '%s -> %s' % (old, new)))
+		print('%d added, %d changed, %d deleted, %d unchanged' % (diff['added'], diff['changed'], diff['deleted'], diff['unchanged']))
+		return diff
 
 	def populate_event_keys(self):
 		d = {cc_events[k]:k for k in cc_events}
@@ -294,14 +511,200 @@ class sql_dbi:
 			self.cursor.execute(query, [k, d[k]])
 		self.conn.commit()
 
+def synthetic_events(n, rng):
+	# n cc_event dicts of the logged types, with field values drawn from
+	# a busy site's worth of systems, talkgroups, units and channels
+	ranges = {'sysid': 3, 'tgid': 2000, 'tgid2': 2000, 'suid': 20000, 'suid2': 20000, 'frequency': 20}
+	templates = []
+	for cc_event in sorted(events_map):
+		fields = [(k, colname) for colname, k in events_map[cc_event] if k != 'cc_event']
+		templates.append((cc_event, fields))
+	events = []
+	for i in range(n):
+		cc_event, fields = templates[rng.randrange(len(templates))]
+		d = {'cc_event': cc_event}
+		for k, colname in fields:
+			d[k] = rng.randrange(ranges.get(colname, 256))
+			if colname == 'frequency':
+				d[k] = 851000000 + 12500 * d[k]
+		events.append(d)
+	return events
+
+def scratch_db(tmpdir):
+	# an empty op25 database in tmpdir, without a writer thread
+	db_filename = os.path.join(tmpdir, 'scratch.db')
+	db = sql_dbi(db_filename)
+	db.q_runner.stop()
+	db.reset_db()
+	return db_filename
+
+def bench(n=200000, rate=0):
+	# events through event() into a scratch db, paced at rate events/s
+	# (0: as fast as possible); reports writer throughput and drops
+	import random
+	import shutil
+	import tempfile
+	tmpdir = tempfile.mkdtemp()
+	try:
+		db_filename = scratch_db(tmpdir)
+		events = synthetic_events(n, random.Random(1))
+		db = sql_dbi(db_filename)
+		t0 = time.time()
+		for i, d in enumerate(events):
+			d['time'] = time.time()
+			db.event(d)
+			if rate and i % 100 == 99:
+				delay = t0 + (i + 1) / float(rate) - time.time()
+				if delay > 0:
+					time.sleep(delay)
+		t1 = time.time()
+		db.q_runner.stop()
+		db.q_runner.join()
+		t2 = time.time()
+		st = db.stats()
+		db.connect()
+		count = db.cursor.execute('SELECT COUNT(*) FROM data_store').fetchone()[0]
+		db.disconnect()
+	finally:
+		shutil.rmtree(tmpdir)
+	assert count == st['rows'] == n - st['dropped']
+	print('%d events offered in %.2f s (%.0f/s), %d written in %.2f s (%.0f/s), %d dropped' % (n, t1 - t0, n / (t1 - t0), count, t2 - t0, count / (t2 - t0), st['dropped']))
+	print('%d batches, largest %d rows, commit %.1f ms avg %.1f ms max, queue high water %d' % (st['batches'], st['max_batch'], st['commit_ms'] / max(1, st['batches']), st['max_commit_ms'], st['max_q']))
+
+def stress(seconds=20, nreaders=4, rate=5000):
+	# the event writer at rate events/s and nreaders threads running
+	# oplog-style queries (and tag edits) on the same file.  A third of
+	# the way in, a write lock is held past the writer's busy timeout, as
+	# an oplog purge batch or rollup rebuild might; the writer must hold
+	# its rows and catch up afterwards without losing any.  The tag edits
+	# wait for the lock and the writer's catch-up, within their busy
+	# timeout.
+	import random
+	import shutil
+	import tempfile
+	tmpdir = tempfile.mkdtemp()
+	queries = [
+		('SELECT COUNT(*) FROM data_store', ()),
+		('SELECT d.sysid, s.tag, d.tgid, t.tag, COUNT(d.tgid) FROM data_store d'
+			' LEFT JOIN sysid_tags s ON d.sysid = s.sysid LEFT JOIN tgid_tags t ON d.tgid = t.rid'
+			' WHERE d.tgid != 0 AND d.frequency IS NOT NULL AND d.time >= ? GROUP BY d.tgid ORDER BY 5 DESC LIMIT 10', 'since'),
+		('SELECT d.time, s.tag, d.tgid, t.tag, d.frequency, d.suid FROM data_store d'
+			' JOIN event_keys e ON e.id = d.cc_event AND e.tag IN ("grp_v_ch_grant", "grp_v_ch_grant_mbt")'
+			' LEFT JOIN tgid_tags t ON t.rid = d.tgid AND t.sysid = d.sysid LEFT JOIN sysid_tags s ON d.sysid = s.sysid'
+			' WHERE d.time >= ? ORDER BY d.time DESC LIMIT 25', 'since'),
+	]
+	results = {'queries': 0, 'edits': 0, 'errors': 0, 'latency': []}
+	done = threading.Event()
+	lock_seconds = 2 * sqlite_store.WRITER_BUSY_TIMEOUT_MS / 1000.0
+
+	def reader(n):
+		rng = random.Random(n)
+		conn = sqlite_store.connect(db_filename)
+		while not done.is_set():
+			q, args = queries[rng.randrange(len(queries))]
+			if args == 'since':
+				args = (time.time() - rng.choice([10, 60, 3600]),)
+			t0 = time.time()
+			try:
+				conn.execute(q, args).fetchall()
+				if n == 0 and rng.random() < 0.1:	# tag edit, as oplog /utd
+					conn.execute('UPDATE tgid_tags SET tag = ? WHERE rid = ?', ('tg %d' % rng.randrange(100), rng.randrange(1, 100)))
+					conn.commit()
+					results['edits'] += 1
+			except sqlite3.Error as e:
+				sys.stderr.write('reader %d: %s\n' % (n, e))
+				results['errors'] += 1
+			results['latency'].append(time.time() - t0)
+			results['queries'] += 1
+		conn.close()
+
+	def locker():
+		time.sleep(seconds / 3.0)
+		conn = sqlite_store.connect(db_filename)
+		conn.execute('BEGIN IMMEDIATE')
+		time.sleep(lock_seconds)
+		conn.rollback()
+		conn.close()
+
+	try:
+		db_filename = scratch_db(tmpdir)
+		conn = sqlite_store.connect(db_filename)
+		conn.executemany('INSERT INTO tgid_tags(rid, sysid, tag, priority) VALUES(?, 1, ?, 0)', [(i, 'tg %d' % i) for i in range(1, 100)])
+		conn.commit()
+		conn.close()
+		n = int(seconds * rate)
+		events = synthetic_events(n, random.Random(1))
+		db = sql_dbi(db_filename)
+		threads = [threading.Thread(target=reader, args=(i,)) for i in range(nreaders)] + [threading.Thread(target=locker)]
+		for t in threads:
+			t.start()
+		t0 = time.time()
+		for i, d in enumerate(events):
+			d['time'] = time.time()
+			db.event(d)
+			if i % 100 == 99:
+				delay = t0 + (i + 1) / float(rate) - time.time()
+				if delay > 0:
+					time.sleep(delay)
+		db.q_runner.stop()
+		db.q_runner.join()
+		done.set()
+		for t in threads:
+			t.join()
+		st = db.stats()
+		conn = sqlite_store.connect(db_filename)
+		count = conn.execute('SELECT COUNT(*) FROM data_store').fetchone()[0]
+		journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+		rollups = [conn.execute('SELECT * FROM %s ORDER BY 1, 2, 3' % t).fetchall() for t in ('data_store_days', 'rollup_sysid', 'rollup_tgid', 'rollup_suid', 'rollup_cc_event')]
+		sqlite_store.rebuild_rollups(conn.cursor())
+		rebuilt = [conn.execute('SELECT * FROM %s ORDER BY 1, 2, 3' % t).fetchall() for t in ('data_store_days', 'rollup_sysid', 'rollup_tgid', 'rollup_suid', 'rollup_cc_event')]
+		conn.close()
+	finally:
+		shutil.rmtree(tmpdir)
+	lat = sorted(results['latency'])
+	print('journal_mode %s: %d events offered, %d written, %d dropped, %d write errors, %d reconnects, %d held at most' % (journal_mode, n, count, st['dropped'] + st['spill_dropped'], st['errors'], st['reconnects'], st['max_pending']))
+	print('%d readers: %d queries, %d tag edits, %d errors, latency p50 %.1f ms p95 %.1f ms max %.1f ms' % (nreaders, results['queries'], results['edits'], results['errors'],
+		lat[len(lat) // 2] * 1000, lat[int(len(lat) * 0.95)] * 1000, lat[-1] * 1000))
+	assert journal_mode == 'wal' and not st['failed']
+	assert count == st['rows'] == n - st['dropped'] - st['spill_dropped'] - st['rejected']
+	assert st['errors'] > 0 and results['errors'] == 0
+	assert st['dropped'] == st['spill_dropped'] == 0 and count == n, 'events dropped'
+	assert rollups == rebuilt and sum([r[1] for r in rollups[0]]) == count, 'rollups differ from data_store'
+	print('ok')
+
 def main():
+	if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+		bench(*[int(x) for x in sys.argv[2:4]])
+		return
+
+	if len(sys.argv) > 1 and sys.argv[1] == 'stress':
+		stress(*[int(x) for x in sys.argv[2:5]])
+		return
+
 	if len(sys.argv) > 1 and sys.argv[1] == 'reset_db':
 		sql_dbi().reset_db()
 		return
 
+	if len(sys.argv) > 2 and sys.argv[1] == 'retain':	# retain <days> [max_size_mb]: apply a retention policy now
+		db = sql_dbi(retention_days=int(sys.argv[2]), max_size_mb=int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+		db.q_runner.stop()
+		db.q_runner.join()
+		while db.q_runner.retain():
+			pass
+		print('%d events deleted' % db.q_runner.counters['retention_deleted'])
+		return
+
+	if len(sys.argv) > 2 and sys.argv[1] == 'backup':	# backup <file>: consistent copy while the db is in use
+		sqlite_store.backup(_def_db_file, sys.argv[2])
+		return
+
 	db1 = sql_dbi()
 	db1.connect()
 
+	if len(sys.argv) > 1 and sys.argv[1] == 'upgrade_db':
+		db1.upgrade_db()
+		return
+
 	if len(sys.argv) > 1 and sys.argv[1] == 'setup':
 		db1.cursor.execute(db1.sql_commands['create_tgid'])
 		db1.cursor.execute(db1.sql_commands['create_unit_id'])
@@ -321,6 +724,12 @@ def main():
 		db1.write('joins', (555, 5555, 5555555))
 		return
 
+	if len(sys.argv) > 2 and sys.argv[1] == 'replay_tsbk':
+		import tsbk_batch
+		batch = tsbk_batch.decode_records(tsbk_batch.load_records(sys.argv[2]), track_calls='nocalls' not in sys.argv[3:])
+		print('%d events imported' % db1.import_events(batch))
+		return
+
 	if len(sys.argv) > 3 and sys.argv[1].startswith('import_'):
 		db1.import_tsv(sys.argv)
 		return
@@ -0,0 +1,411 @@
+
+# This file is part of OP25
+#
+# OP25 is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# OP25 is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OP25; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Boston, MA
+# 02110-1301, USA.
+
+# sqlite connection settings shared by the sql_dbi event writer and the
+# oplog web app, which use op25-data.db at the same time.
+#
+# The writer puts the file in WAL mode (a persistent property of the
+# database), so oplog queries read a snapshot and never block the writer
+# nor wait for it.  Connections wait up to BUSY_TIMEOUT_MS for a write
+# lock (oplog tag edits, purge, VACUUM) instead of failing at once; the
+# event writer waits less, as it keeps its rows and retries.
+#
+# data_store_days holds the row count and first/last time of each day
+# (UTC) of data_store; days are found by time (ds_time_idx), not by id,
+# as imports (replay_tsbk, log_archive) append past days with new ids.
+# Rollup tables hold per-day event counts and first/last seen times for
+# each sysid, (sysid, tgid), (sysid, suid) and (sysid, cc_event).  They
+# count the data_store rows up to id data_store_state.rolled_up; the
+# writer adds the rows past it every few seconds, in a transaction of
+# its own after the inserts (update_rollups()), so a batch of inserts
+# holds the write lock no longer than its inserts take.  Whatever
+# deletes rows from data_store must rebuild_rollups() for the days it
+# touched.  The oplog statistics pages read these instead of
+# aggregating data_store.  data_store_state.deleted counts the
+# data_store rows ever deleted (delete_batch()): readers that keep
+# results across requests (oplog's /data page ends) check it to know
+# when rows before those results may have gone.
+#
+# Rows are removed a batch at a time (delete_rows(), and the retention
+# policy of the sql_dbi writer), each batch its own short transaction, so
+# the writer never waits long for the lock.  Databases are made with
+# auto_vacuum = INCREMENTAL so the freed pages can be given back to the
+# file system a few at a time (release_space()) instead of by a VACUUM,
+# which rewrites the whole file and locks out the writer until it ends.
+
+import os
+import sqlite3
+
+BUSY_TIMEOUT_MS = 5000
+WRITER_BUSY_TIMEOUT_MS = 1000	# the event writer holds its rows and retries instead
+CACHE_KB = 8192			# page cache per connection
+MMAP_BYTES = 64 << 20		# reads straight from the page cache of the os
+DELETE_ROWS = 5000		# rows deleted per transaction
+ROLLUP_ROWS = 20000		# rows added to the rollups per transaction
+VACUUM_PAGES = 1000		# pages returned to the file system per transaction
+
+def configure(conn, writer=False):
+	# apply the pragmas to a new sqlite3 (dbapi) connection
+	cursor = conn.cursor()
+	cursor.execute('PRAGMA busy_timeout = %d' % (WRITER_BUSY_TIMEOUT_MS if writer else BUSY_TIMEOUT_MS))
+	cursor.execute('PRAGMA cache_size = -%d' % CACHE_KB)
+	cursor.execute('PRAGMA mmap_size = %d' % MMAP_BYTES)
+	cursor.execute('PRAGMA synchronous = NORMAL')	# safe with WAL: a crash loses at most the last commits
+	if writer:
+		cursor.execute('PRAGMA journal_mode = WAL')
+	cursor.close()
+
+DAY = 86400
+
+ROLLUP_TABLES = [
+	'CREATE TABLE IF NOT EXISTS data_store_days (day INTEGER PRIMARY KEY, events INTEGER NOT NULL, first_time REAL NOT NULL, last_time REAL NOT NULL)',
+	'CREATE TABLE IF NOT EXISTS rollup_sysid (day INTEGER NOT NULL, sysid INTEGER NOT NULL, events INTEGER NOT NULL, first_time REAL NOT NULL, last_time REAL NOT NULL, PRIMARY KEY(day, sysid))',
+	'CREATE TABLE IF NOT EXISTS rollup_tgid (day INTEGER NOT NULL, sysid INTEGER NOT NULL, tgid INTEGER NOT NULL, events INTEGER NOT NULL, first_time REAL NOT NULL, last_time REAL NOT NULL, PRIMARY KEY(day, sysid, tgid))',
+	'CREATE TABLE IF NOT EXISTS rollup_suid (day INTEGER NOT NULL, sysid INTEGER NOT NULL, suid INTEGER NOT NULL, events INTEGER NOT NULL, first_time REAL NOT NULL, last_time REAL NOT NULL, PRIMARY KEY(day, sysid, suid))',
+	'CREATE TABLE IF NOT EXISTS rollup_cc_event (day INTEGER NOT NULL, sysid INTEGER NOT NULL, cc_event INTEGER NOT NULL, events INTEGER NOT NULL, first_time REAL NOT NULL, last_time REAL NOT NULL, PRIMARY KEY(day, sysid, cc_event))',
+]
+DATA_STORE_STATE = 'CREATE TABLE IF NOT EXISTS data_store_state (id INTEGER PRIMARY KEY CHECK (id = 0), rolled_up INTEGER NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)'
+
+# (table, key columns besides day, rows counted)
+_rollups = [
+	('data_store_days', [], '1'),
+	('rollup_sysid', ['sysid'], '1'),
+	('rollup_tgid', ['sysid', 'tgid'], 'tgid IS NOT NULL'),
+	('rollup_suid', ['sysid', 'suid'], 'suid IS NOT NULL'),
+	('rollup_cc_event', ['sysid', 'cc_event'], '1'),
+]
+
+def _rollup_upsert(table, keys, where, rows):
+	# INSERT ... SELECT aggregating the data_store rows matching rows,
+	# merged into the existing rollup rows
+	columns = ['day'] + keys + ['events', 'first_time', 'last_time']
+	select = ['CAST(time / %d AS INTEGER)' % DAY] + keys + ['COUNT(*)', 'MIN(time)', 'MAX(time)']
+	updates = ['events + excluded.events', 'MIN(first_time, excluded.first_time)', 'MAX(last_time, excluded.last_time)']
+	return 'INSERT INTO %s(%s) SELECT %s FROM data_store WHERE %s AND %s GROUP BY %s ON CONFLICT(%s) DO UPDATE SET %s' % (
+		table, ', '.join(columns), ', '.join(select), where, rows,
+		', '.join([str(i + 1) for i in range(1 + len(keys))]), ', '.join(['day'] + keys),
+		', '.join(['%s = %s' % (c, u) for c, u in zip(['events', 'first_time', 'last_time'], updates)]))
+
+def create_rollups(cursor):
+	for q in ROLLUP_TABLES:
+		cursor.execute(q)
+
+def has_rollups(cursor):
+	return cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'data_store_days'").fetchone()[0] > 0
+
+def last_id(cursor):
+	return cursor.execute('SELECT MAX(id) FROM data_store').fetchone()[0] or 0
+
+def _present(cursor):
+	# the _rollups whose table exists: a database that is not yet upgraded
+	# has only some of them
+	names = [r[0] for r in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+	return [r for r in _rollups if r[0] in names]
+
+def rolled_up(cursor):
+	# id of the last data_store row the rollups count, None if the
+	# database has no data_store_state (yet)
+	names = [r[0] for r in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'data_store_state'")]
+	if not names:
+		return None
+	row = cursor.execute('SELECT rolled_up FROM data_store_state WHERE id = 0').fetchone()
+	return row[0] if row else None
+
+def _set_rolled_up(cursor, last):
+	cursor.execute('UPDATE data_store_state SET rolled_up = ? WHERE id = 0', (last,))
+
+def track_rollups(cursor):
+	# returns True if the database has rollups.  Up to schema version 5
+	# the writers updated them in the inserting transaction, so they count
+	# every row so far: that is where data_store_state starts.  Call in a
+	# write transaction, before adding rows
+	if not has_rollups(cursor):
+		return False
+	if rolled_up(cursor) is None:
+		cursor.execute(DATA_STORE_STATE)
+		cursor.execute('INSERT OR IGNORE INTO data_store_state(id, rolled_up) VALUES(0, ?)', (last_id(cursor),))
+	return True
+
+def update_rollups(cursor, rows=None):
+	# add the data_store rows past data_store_state.rolled_up to the
+	# rollups, at most rows of them (default: all); returns True if there
+	# are more
+	after = rolled_up(cursor)
+	if after is None:
+		return False
+	end = last_id(cursor)
+	upto = end if rows is None else min(end, after + rows)
+	if upto <= after:
+		return False
+	for table, keys, where in _present(cursor):
+		cursor.execute(_rollup_upsert(table, keys, where, 'id > ? AND id <= ?'), (after, upto))
+	_set_rolled_up(cursor, upto)
+	return upto < end
+
+def rebuild_rollups(cursor, first_day=None, last_day=None, tables=None):
+	# recompute the rollups of days first_day .. last_day from data_store,
+	# e.g. after rows were deleted; tables limits it to those rollup
+	# tables.  The rows past data_store_state.rolled_up are left to
+	# update_rollups(), unless it is all of the days and tables, which
+	# then count every row
+	days, rows, args = '1', '1', ()
+	if first_day is not None:
+		days, rows, args = 'day >= %d AND day <= %d' % (first_day, last_day), 'time >= ? AND time < ?', (first_day * DAY, (last_day + 1) * DAY)
+	last = rolled_up(cursor)
+	if last is not None and first_day is None and tables is None:
+		_set_rolled_up(cursor, last_id(cursor))
+	elif last is not None:
+		rows, args = '%s AND id <= ?' % rows, args + (last,)
+	for table, keys, where in _present(cursor):
+		if tables is not None and table not in tables:
+			continue
+		cursor.execute('DELETE FROM %s WHERE %s' % (table, days))
+		cursor.execute(_rollup_upsert(table, keys, where, rows), args)
+
+# indexes for the oplog data() queries: time ranges, optionally with a
+# sysid, event type or opcode; per talkgroup / unit id views (covering:
+# the grouped column is in the index); tag lookups on (rid, sysid)
+INDEXES = [
+	'CREATE INDEX IF NOT EXISTS ds_time_idx ON data_store(time)',
+	'CREATE INDEX IF NOT EXISTS ds_sysid_time_idx ON data_store(sysid, time)',
+	'CREATE INDEX IF NOT EXISTS ds_cc_event_time_idx ON data_store(cc_event, time)',
+	'CREATE INDEX IF NOT EXISTS ds_opcode_time_idx ON data_store(opcode, time)',
+	'CREATE INDEX IF NOT EXISTS ds_tgid_sysid_time_idx ON data_store(tgid, sysid, time, suid)',
+	'CREATE INDEX IF NOT EXISTS ds_suid_sysid_time_idx ON data_store(suid, sysid, time, tgid)',
+	'CREATE INDEX IF NOT EXISTS tgid_tags_rid_sysid_idx ON tgid_tags(rid, sysid, tag)',
+	'CREATE INDEX IF NOT EXISTS unit_id_tags_rid_sysid_idx ON unit_id_tags(rid, sysid, tag)',
+	'CREATE INDEX IF NOT EXISTS sysid_tags_sysid_idx ON sysid_tags(sysid, tag)',
+	'CREATE INDEX IF NOT EXISTS event_keys_tag_idx ON event_keys(tag, id)',
+]
+# made redundant by the above (their columns are a prefix of another index)
+REDUNDANT_INDEXES = ['tgid_idx', 'suid_idx', 't_tgid_idx', 't_unit_id_idx']
+
+def _add_rollups(cursor):
+	create_rollups(cursor)
+	rebuild_rollups(cursor)
+
+def _add_indexes(cursor):
+	for q in INDEXES:
+		cursor.execute(q)
+	for name in REDUNDANT_INDEXES:
+		cursor.execute('DROP INDEX IF EXISTS %s' % name)
+
+def _add_cc_event_rollup(cursor):
+	# (already built if _add_rollups ran in the same upgrade)
+	create_rollups(cursor)
+	table, keys, where = _rollups[-1]
+	cursor.execute('DELETE FROM %s' % table)
+	cursor.execute(_rollup_upsert(table, keys, where, '1'))
+
+# one tag per (rid, sysid): imports upsert on it (import_tags())
+TAG_TABLES = ['tgid_tags', 'unit_id_tags']
+UNIQUE_TAG_INDEXES = ['CREATE UNIQUE INDEX IF NOT EXISTS %s_rid_sysid_key ON %s(rid, sysid)' % (t, t) for t in TAG_TABLES]
+
+def _unique_tags(cursor):
+	# older imports appended a row per import; the last one imported wins
+	for table in TAG_TABLES:
+		cursor.execute('DELETE FROM %s WHERE id NOT IN (SELECT MAX(id) FROM %s GROUP BY rid, sysid)' % (table, table))
+	for q in UNIQUE_TAG_INDEXES:
+		cursor.execute(q)
+
+def _columns(cursor, table):
+	return [r[1] for r in cursor.execute('PRAGMA table_info(%s)' % table)]
+
+def _drop_day_id_ranges(cursor):
+	# data_store_days had first_id/last_id, which imports of past days
+	# made overlap; nothing read them
+	if 'first_id' not in _columns(cursor, 'data_store_days'):
+		return
+	cursor.execute('DROP TABLE data_store_days')
+	create_rollups(cursor)
+	rebuild_rollups(cursor, tables=['data_store_days'])
+
+def _add_data_store_state(cursor):
+	track_rollups(cursor)
+
+def _count_deletes(cursor):
+	if rolled_up(cursor) is not None and 'deleted' not in _columns(cursor, 'data_store_state'):
+		cursor.execute('ALTER TABLE data_store_state ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0')
+
+# schema version n (PRAGMA user_version) is reached by MIGRATIONS[n - 1]
+MIGRATIONS = [_add_rollups, _add_indexes, _add_cc_event_rollup, _unique_tags, _drop_day_id_ranges, _add_data_store_state, _count_deletes]
+
+def schema_version(cursor):
+	version = cursor.execute('PRAGMA user_version').fetchone()[0]
+	if version == 0 and has_rollups(cursor):
+		version = 1	# rollups were added before the version was kept
+	return version
+
+def upgrade(conn):
+	# bring a database to the current schema in place, one transaction per
+	# step, and to auto_vacuum = INCREMENTAL (a VACUUM, once); returns
+	# (old version, new version)
+	cursor = conn.cursor()
+	version = schema_version(cursor)
+	for n in range(version, len(MIGRATIONS)):
+		cursor.execute('BEGIN IMMEDIATE')
+		MIGRATIONS[n](cursor)
+		cursor.execute('PRAGMA user_version = %d' % (n + 1))
+		conn.commit()
+	enable_incremental_vacuum(conn)
+	if version < len(MIGRATIONS) and last_id(cursor):
+		# planner statistics for the new indexes (sampled, so quick on a large db)
+		cursor.execute('PRAGMA analysis_limit = 1000')
+		cursor.execute('ANALYZE')
+		conn.commit()
+	return version, len(MIGRATIONS)
+
+DIFF_LIMIT = 100	# changes listed by import_tags(), of each kind
+
+def import_tags(conn, table, sysid, rows, delete_missing=False):
+	# make the tags of sysid in table (tgid_tags or unit_id_tags) those of
+	# rows [(rid, tag, priority)], in one transaction: rows are loaded into
+	# a temp table and upserted on (rid, sysid), rows left unchanged are
+	# not written; with delete_missing the tags of sysid that are not in
+	# rows are deleted.  A rid given twice takes its last row.  Returns the
+	# diff: counts of added, changed, deleted and unchanged tags and
+	# changes, up to DIFF_LIMIT (rid, old tag, new tag) of each kind
+	assert table in TAG_TABLES
+	cursor = conn.cursor()
+	cursor.execute('CREATE TEMP TABLE IF NOT EXISTS tag_import (rid INTEGER PRIMARY KEY, tag TEXT, priority INTEGER)')
+	cursor.execute('BEGIN IMMEDIATE')
+	try:
+		cursor.execute('DELETE FROM temp.tag_import')
+		cursor.executemany('INSERT OR REPLACE INTO temp.tag_import(rid, tag, priority) VALUES(?, ?, ?)', rows)
+		kinds = {
+			'added': 'SELECT i.rid, NULL, i.tag FROM temp.tag_import i WHERE NOT EXISTS (SELECT 1 FROM %s t WHERE t.rid = i.rid AND t.sysid = ?)',
+			'changed': 'SELECT i.rid, t.tag, i.tag FROM temp.tag_import i JOIN %s t ON t.rid = i.rid AND t.sysid = ? WHERE t.tag IS NOT i.tag OR t.priority IS NOT i.priority',
+			'deleted': 'SELECT t.rid, t.tag, NULL FROM %s t WHERE t.sysid = ? AND t.rid NOT IN (SELECT rid FROM temp.tag_import)',
+		}
+		if not delete_missing:
+			del kinds['deleted']
+		diff = {'added': 0, 'changed': 0, 'deleted': 0, 'changes': {}}
+		for kind, q in kinds.items():
+			q = q % table
+			diff[kind] = cursor.execute('SELECT COUNT(*) FROM (%s)' % q, (sysid,)).fetchone()[0]
+			diff['changes'][kind] = cursor.execute('%s ORDER BY 1 LIMIT %d' % (q, DIFF_LIMIT), (sysid,)).fetchall()
+		diff['unchanged'] = cursor.execute('SELECT COUNT(*) FROM temp.tag_import').fetchone()[0] - diff['added'] - diff['changed']
+		cursor.execute('INSERT INTO %s(rid, sysid, tag, priority) SELECT rid, ?, tag, priority FROM temp.tag_import WHERE 1'
+			' ON CONFLICT(rid, sysid) DO UPDATE SET tag = excluded.tag, priority = excluded.priority'
+			' WHERE tag IS NOT excluded.tag OR priority IS NOT excluded.priority' % table, (sysid,))
+		if delete_missing:
+			cursor.execute('DELETE FROM %s WHERE sysid = ? AND rid NOT IN (SELECT rid FROM temp.tag_import)' % table, (sysid,))
+		cursor.execute('DELETE FROM temp.tag_import')
+		conn.commit()
+	except:
+		conn.rollback()
+		raise
+	return diff
+
+def delete_batch(cursor, where, args, rows=DELETE_ROWS):
+	# delete up to rows data_store rows matching where; returns the number deleted
+	cursor.execute('DELETE FROM data_store WHERE id IN (SELECT id FROM data_store WHERE %s LIMIT %d)' % (where, rows), args)
+	n = cursor.rowcount
+	last = rolled_up(cursor)
+	if n and last is not None:
+		if 'deleted' in _columns(cursor, 'data_store_state'):	# (schema version 7)
+			cursor.execute('UPDATE data_store_state SET deleted = deleted + ? WHERE id = 0', (n,))
+		if last_id(cursor) < last:
+			# the newest rows are gone and their ids will be given out
+			# again, to rows the rollups do not count yet
+			_set_rolled_up(cursor, last_id(cursor))
+	return n
+
+def delete_rows(conn, first_time, last_time, where='1', args=(), progress=None, rows=DELETE_ROWS):
+	# delete the data_store rows from first_time to last_time that match
+	# where, one batch per transaction, then rebuild the rollups of those
+	# days, one table and day per transaction (a day of the larger rollups
+	# is a write lock of about half a second).  progress(deleted) is called
+	# after each batch.  Returns the number of rows deleted.
+	cursor = conn.cursor()
+	where = 'time >= ? AND time <= ? AND (%s)' % where
+	args = (first_time, last_time) + tuple(args)
+	deleted = 0
+	while True:
+		cursor.execute('BEGIN IMMEDIATE')
+		n = delete_batch(cursor, where, args, rows)
+		conn.commit()
+		deleted += n
+		if progress:
+			progress(deleted)
+		if n < rows:
+			break
+	for day in range(int(first_time) // DAY, int(last_time) // DAY + 1):
+		for spec in _present(cursor):
+			cursor.execute('BEGIN IMMEDIATE')
+			rebuild_rollups(cursor, day, day, [spec[0]])
+			conn.commit()
+	return deleted
+
+def used_bytes(cursor):
+	# size of the database less its free pages
+	page_count, freelist_count, page_size = [cursor.execute('PRAGMA %s' % p).fetchone()[0] for p in ('page_count', 'freelist_count', 'page_size')]
+	return (page_count - freelist_count) * page_size
+
+def incremental_vacuum(cursor):
+	return cursor.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+def enable_incremental_vacuum(conn):
+	# auto_vacuum can only change on an empty database or by a VACUUM;
+	# returns True if the database was rewritten
+	cursor = conn.cursor()
+	if incremental_vacuum(cursor):
+		return False
+	cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+	if not cursor.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0]:
+		return False
+	cursor.execute('VACUUM')
+	return True
+
+def release_space(conn, pages=VACUUM_PAGES):
+	# return up to pages free pages to the file system; returns the number
+	# of free pages left (0 as well if the db is not auto_vacuum = INCREMENTAL)
+	cursor = conn.cursor()
+	if not incremental_vacuum(cursor):
+		return 0
+	conn.executescript('PRAGMA incremental_vacuum(%d)' % pages)	# (execute() would free one page)
+	return cursor.execute('PRAGMA freelist_count').fetchone()[0]
+
+def truncate_wal(conn):
+	# after a purge: the WAL has grown to hold the deletes and vacuum, and
+	# otherwise keeps that size on disk
+	conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+def backup(filename, destination):
+	# consistent copy of the database at filename while it is in use, with
+	# the sqlite backup api.  In one step: a step-wise backup starts over
+	# whenever the writer commits.  In WAL mode this is a read transaction,
+	# which doesn't block the writer.
+	src = connect(filename)
+	dst = sqlite3.connect(destination)
+	try:
+		src.backup(dst)
+	finally:
+		dst.close()
+		src.close()
+
+def connect(filename, writer=False):
+	conn = sqlite3.connect(filename)
+	configure(conn, writer)
+	return conn
+
+def remove_db(filename):
+	# the database file and its WAL and shared memory files
+	for suffix in ('', '-wal', '-shm', '-journal'):
+		if os.access(filename + suffix, os.W_OK):
+			os.remove(filename + suffix)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+# This file is part of OP25
+#
+# OP25 is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# OP25 is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OP25; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Boston, MA
+# 02110-1301, USA.
+
+# Cache of the files served by http_server.static_file().
+#
+# Each file is kept in memory, with gzip (and, if the brotli module is
+# installed, br) variants of the text types, until its mtime or size
+# changes - status.png is rewritten every second and the tsv/json config
+# files by config-tsvsave, so every request does one os.stat().  Files
+# larger than max_file are not cached; the caller streams them from disk.
+# Responses carry ETag and Last-Modified, and a conditional GET that
+# matches gets 304 without a body.
+#
+# Files made in memory by this process (status.png, see create_image's
+# status_renderer) are publish()ed by name and served from there, with
+# the same validators, without going through the disk.  They can change
+# more than once a second, so only their ETag is checked: If-Modified-Since
+# has whole seconds.
+#
+# usage:
+#     ./static_cache.py [check]	self check
+
+import os
+import sys
+import gzip
+import time
+import threading
+import collections
+from email.utils import formatdate, parsedate_tz, mktime_tz
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_TYPES = 'text/html text/css text/plain text/tab-separated-values application/javascript application/json'.split()
+MIN_COMPRESS = 256	# smaller files are sent as is
+
+published = {}	# name -> function returning (data, mtime), or None if there is nothing yet
+
+def publish(name, source):
+    published[name] = source
+
+class cached_file(object):
+    def __init__(self, pathname, mtime, size, data=None):
+        self.pathname = pathname
+        self.key = (mtime, size)
+        self.size = size
+        self.mtime = int(mtime)
+        self.etag = '"%x-%x"' % (int(mtime * 1000), size)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.data = data	# None: too large to cache, stream from pathname
+        self.variants = {}	# content-encoding -> compressed data
+
+    def nbytes(self):
+        if self.data is None:
+            return 0
+        return len(self.data) + sum([len(v) for v in self.variants.values()])
+
+class static_cache(object):
+    def __init__(self, max_bytes=32 << 20, max_file=1 << 20):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.files = collections.OrderedDict()	# pathname -> cached_file, LRU order
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'loads': 0, 'not_modified': 0, 'streamed': 0, 'evicted': 0, 'published': 0}
+
+    def get(self, pathname, content_type):
+        # current cached_file for pathname (raises OSError if it can't be read)
+        st = os.stat(pathname)
+        with self.lock:
+            e = self.files.get(pathname)
+            if e is not None and e.key == (st.st_mtime, st.st_size):
+                self.files[pathname] = self.files.pop(pathname)
+                self.counts['hits'] += 1
+                return e
+        if st.st_size > self.max_file:
+            with self.lock:
+                old = self.files.pop(pathname, None)	# it grew past max_file
+                if old is not None:
+                    self.nbytes -= old.nbytes()
+                self.counts['streamed'] += 1
+            return cached_file(pathname, st.st_mtime, st.st_size)
+        with open(pathname, 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        e = cached_file(pathname, st.st_mtime, st.st_size, data)
+        if len(data) != st.st_size:	# rewritten while we read it; serve but don't keep
+            e.size = len(data)
+            return e
+        if content_type in COMPRESS_TYPES and len(data) >= MIN_COMPRESS:
+            e.variants['gzip'] = gzip.compress(data, 6)
+            if brotli is not None:
+                e.variants['br'] = brotli.compress(data)
+        with self.lock:
+            old = self.files.pop(pathname, None)
+            if old is not None:
+                self.nbytes -= old.nbytes()
+            self.files[pathname] = e
+            self.nbytes += e.nbytes()
+            self.counts['loads'] += 1
+            while self.nbytes > self.max_bytes and len(self.files) > 1:
+                k, old = self.files.popitem(last=False)
+                self.nbytes -= old.nbytes()
+                self.counts['evicted'] += 1
+        return e
+
+    def response(self, environ, pathname, content_type):
+        # (status, output, headers) for a GET of pathname; output is bytes,
+        # or for a file that is not cached an open file the caller streams
+        return self.respond(environ, self.get(pathname, content_type), pathname)
+
+    def published_response(self, environ, name):
+        # as response(), for a file published in memory; None if there is none
+        source = published.get(name)
+        item = source() if source is not None else None
+        if item is None:
+            return None
+        data, mtime = item
+        self.counts['published'] += 1
+        return self.respond(environ, cached_file(name, mtime, len(data), data), name, by_date=False)
+
+    def respond(self, environ, e, pathname, by_date=True):
+        headers = [('ETag', e.etag), ('Last-Modified', e.last_modified), ('Cache-Control', 'no-cache')]
+        encoding = None
+        if e.variants:
+            headers.append(('Vary', 'Accept-Encoding'))
+            accept = [s.split(';')[0].strip() for s in environ.get('HTTP_ACCEPT_ENCODING', '').split(',')]
+            for enc in ('br', 'gzip'):
+                if enc in e.variants and enc in accept:
+                    encoding = enc
+                    break
+        etag = e.etag
+        if encoding:
+            etag = '%s-%s"' % (e.etag[:-1], encoding)	# each representation gets its own validator
+            headers[0] = ('ETag', etag)
+        if self.not_modified(environ, etag, e.mtime if by_date else None):
+            self.counts['not_modified'] += 1
+            return '304 Not Modified', b'', headers
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+            output = e.variants[encoding]
+        elif e.data is not None:
+            output = e.data
+        else:
+            output = open(pathname, 'rb')
+        headers.append(('Content-Length', str(len(output) if e.data is not None or encoding else e.size)))
+        return '200 OK', output, headers
+
+    def not_modified(self, environ, etag, mtime):
+        # mtime None: the ETag only
+        inm = environ.get('HTTP_IF_NONE_MATCH')
+        if inm is not None:
+            return etag in [s.strip() for s in inm.split(',')] or inm.strip() == '*'
+        ims = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if ims is not None and mtime is not None:
+            t = parsedate_tz(ims)
+            return t is not None and mtime <= mktime_tz(t)
+        return False
+
+    def stats(self):
+        with self.lock:
+            d = dict(self.counts)
+            d.update({'files': len(self.files), 'bytes': self.nbytes})
+        return d
+
+def check():
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    try:
+        c = static_cache(max_bytes=64 << 10, max_file=32 << 10)
+        js = os.path.join(tmpdir, 'a.js')
+        with open(js, 'w') as f:
+            f.write('var x = 1;\n' * 1000)
+        status, output, headers = c.response({'HTTP_ACCEPT_ENCODING': 'gzip, deflate'}, js, 'application/javascript')
+        h = dict(headers)
+        assert status == '200 OK' and h['Content-Encoding'] == 'gzip' and gzip.decompress(output) == b'var x = 1;\n' * 1000
+        status, output, headers = c.response({'HTTP_IF_NONE_MATCH': h['ETag'], 'HTTP_ACCEPT_ENCODING': 'gzip'}, js, 'application/javascript')
+        assert status == '304 Not Modified' and output == b''
+        status, output, headers = c.response({}, js, 'application/javascript')
+        assert status == '200 OK' and 'Content-Encoding' not in dict(headers) and len(output) == 11000
+        status, output, headers = c.response({'HTTP_IF_MODIFIED_SINCE': h['Last-Modified']}, js, 'application/javascript')
+        assert status == '304 Not Modified'
+        # rewriting the file invalidates it
+        with open(js, 'w') as f:
+            f.write('var x = 2;\n' * 1001)
+        os.utime(js, (time.time() + 5, time.time() + 5))
+        status, output, headers = c.response({'HTTP_IF_NONE_MATCH': h['ETag']}, js, 'application/javascript')
+        assert status == '200 OK' and output == b'var x = 2;\n' * 1001
+        # images are not compressed; large files are streamed
+        png = os.path.join(tmpdir, 'b.png')
+        with open(png, 'wb') as f:
+            f.write(os.urandom(1000))
+        status, output, headers = c.response({'HTTP_ACCEPT_ENCODING': 'gzip'}, png, 'image/png')
+        assert 'Content-Encoding' not in dict(headers) and len(output) == 1000
+        tsv = os.path.join(tmpdir, 'c.tsv')
+        with open(tsv, 'w') as f:
+            f.write('1\tname\n' * 10000)
+        status, output, headers = c.response({'HTTP_ACCEPT_ENCODING': 'gzip'}, tsv, 'text/tab-separated-values')
+        assert hasattr(output, 'read') and int(dict(headers)['Content-Length']) == 70000
+        output.close()
+        for i in range(20):
+            p = os.path.join(tmpdir, '%d.txt' % i)
+            with open(p, 'wb') as f:
+                f.write(os.urandom(10000))
+            c.response({}, p, 'text/plain')
+        assert c.nbytes <= c.max_bytes
+        # a cached file that grows too large is dropped from the cache
+        c.response({}, png, 'image/png')
+        assert png in c.files
+        with open(png, 'wb') as f:
+            f.write(os.urandom(40000))
+        os.utime(png, (time.time() + 10, time.time() + 10))
+        nbytes = c.nbytes
+        status, output, headers = c.response({}, png, 'image/png')
+        assert hasattr(output, 'read') and png not in c.files
+        output.close()
+        assert c.nbytes == sum([e.nbytes() for e in c.files.values()]) <= nbytes
+        # published in memory
+        assert c.published_response({}, 'mem.png') is None
+        image = [b'\x89PNG one', 1700000000.5]
+        publish('mem.png', lambda: tuple(image))
+        status, output, headers = c.response({}, png, 'image/png')	# (files are unaffected)
+        status, output, headers = c.published_response({}, 'mem.png')
+        h = dict(headers)
+        assert status == '200 OK' and output == b'\x89PNG one' and h['Content-Length'] == '8'
+        assert c.published_response({'HTTP_IF_NONE_MATCH': h['ETag']}, 'mem.png')[0] == '304 Not Modified'
+        image[:] = [b'\x89PNG two!', 1700000000.9]	# re-rendered within the same second
+        status, output, headers = c.published_response({'HTTP_IF_MODIFIED_SINCE': h['Last-Modified']}, 'mem.png')
+        assert status == '200 OK' and output == b'\x89PNG two!'
+        h = dict(headers)
+        image[:] = [b'\x89PNG three', 1700000001.5]
+        status, output, headers = c.published_response({'HTTP_IF_NONE_MATCH': h['ETag'], 'HTTP_IF_MODIFIED_SINCE': h['Last-Modified']}, 'mem.png')
+        assert status == '200 OK' and output == b'\x89PNG three'
+        del published['mem.png']
+        sys.stderr.write('%s\n' % c.stats())
+    finally:
+        shutil.rmtree(tmpdir)
+    sys.stderr.write('ok\n')
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] == 'check':
+        check()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+#! /usr/bin/env python
+
+# This file is part of OP25
+#
+# OP25 is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# OP25 is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OP25; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Boston, MA
+# 02110-1301, USA.
+
+# Incremental trunk_update messages for the http clients.
+#
+# rx_ctl.to_json() sends the complete state of every trunked system once
+# a second.  http_server keeps the latest one in a trunk_state, which
+# numbers each update (seq) and remembers which keys each update changed.
+# A client that has seen update N is then sent only what changed since N:
+#
+#     {'json_type': 'trunk_update', 'seq': 12, 'base': 9, 'time': ..., 'data': {...},
+#      'delta': {'1006': {'set': {'tsbks': 1234},	# per-system keys replaced
+#                         'unset': [],			# per-system keys deleted
+#                         'update': {'talkgroup_data': {'100': {...}}},	# dict entries replaced
+#                         'remove': {'frequency_tracking': ['851012500']}},	# dict entries deleted
+#                '1007': {'replace': {...}}}}		# new (or, if None, removed) system
+#
+# Messages without 'base' are complete snapshots, sent on connect, to a
+# client that has fallen further behind than the change log goes, and
+# after a client's reconnect when its Last-Event-ID is no longer known.
+# The SSE id of each message carrying a trunk_update is
+# '<server start time>:<seq>' so that a browser reconnecting with
+# Last-Event-ID can resume with a delta.  apply_update() is the reference
+# client (main.js trunk_delta_apply()).
+#
+# usage:
+#     ./trunk_delta.py [check]	self check: client reconstruction == to_dict()
+
+import sys
+import time
+import json
+import threading
+import collections
+
+_MISSING = object()
+
+def is_system(key, value):
+    # per-nac entries of a trunk_update, keyed by the nac (as a string, after json)
+    return isinstance(value, dict) and str(key).isdigit()
+
+class trunk_state(object):
+    def __init__(self, log_len=64):
+        self.epoch = '%x' % int(time.time())
+        self.seq = 0
+        self.msg = None		# latest complete trunk_update
+        self.log = collections.deque(maxlen=log_len)	# (seq, set of paths changed by that update)
+        self.encoded = {}	# base seq -> json text of delta_since(base) for the current update
+        self.lock = threading.Lock()
+
+    def event_id(self, seq):
+        return '%s:%d' % (self.epoch, seq)
+
+    def parse_event_id(self, event_id):
+        # seq of an event_id() from this trunk_state, None otherwise
+        if not event_id or ':' not in event_id:
+            return None
+        epoch, seq = event_id.split(':', 1)
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def update(self, msg):
+        # record a complete trunk_update (decoded json); msg is kept, not copied
+        with self.lock:
+            old = self.msg if self.msg is not None else {}
+            changed = set()
+            for nac in set([k for k in old if is_system(k, old[k])] + [k for k in msg if is_system(k, msg[k])]):
+                o = old.get(nac)
+                n = msg.get(nac)
+                if not is_system(nac, o) or not is_system(nac, n):
+                    changed.add((nac,))
+                    continue
+                self.diff_system(nac, o, n, changed)
+            self.seq += 1
+            msg['seq'] = self.seq
+            self.msg = msg
+            self.log.append((self.seq, changed))
+            self.encoded = {}
+
+    def diff_system(self, nac, o, n, changed):
+        for k in n:
+            nv = n[k]
+            ov = o.get(k, _MISSING)
+            if isinstance(ov, dict) and isinstance(nv, dict):
+                for e in nv:
+                    if ov.get(e, _MISSING) != nv[e]:
+                        changed.add((nac, k, e))
+                for e in ov:
+                    if e not in nv:
+                        changed.add((nac, k, e))
+            elif ov != nv:
+                changed.add((nac, k))
+        for k in o:
+            if k not in n:
+                changed.add((nac, k))
+
+    def delta_since(self, seq):
+        # message bringing a client that has seen update seq up to date,
+        # None if there is nothing newer
+        with self.lock:
+            return self._delta_since(seq)
+
+    def encoded_since(self, seq):
+        # delta_since() as json text and the seq it brings the client to;
+        # clients at the same seq share one encoding
+        with self.lock:
+            if self.msg is None or seq == self.seq:
+                return None, seq
+            if seq is None or seq > self.seq or seq < self.seq - len(self.log):
+                seq = None	# all get the complete snapshot
+            if seq not in self.encoded:
+                self.encoded[seq] = json.dumps(self._delta_since(seq))
+            return self.encoded[seq], self.seq
+
+    def _delta_since(self, seq):
+        if self.msg is None or seq == self.seq:
+            return None
+        if seq is None or seq > self.seq or seq < self.seq - len(self.log):
+            return self.msg
+        paths = set()
+        for s, changed in self.log:
+            if s > seq:
+                paths.update(changed)
+        return self.make_delta(seq, paths)
+
+    def make_delta(self, base, paths):
+        msg = self.msg
+        d = dict([(k, msg[k]) for k in msg if not is_system(k, msg[k])])
+        d['base'] = base
+        delta = {}
+        for path in paths:
+            if len(path) == 1:
+                delta[path[0]] = {'replace': msg.get(path[0])}
+        for path in paths:
+            nac = path[0]
+            if len(path) == 1 or 'replace' in delta.get(nac, {}):
+                continue
+            sysd = msg[nac]
+            dd = delta.setdefault(nac, {})
+            k = path[1]
+            v = sysd.get(k, _MISSING)
+            if len(path) == 3 and (nac, k) not in paths and isinstance(v, dict):
+                e = path[2]
+                if e in v:
+                    dd.setdefault('update', {}).setdefault(k, {})[e] = v[e]
+                else:
+                    dd.setdefault('remove', {}).setdefault(k, []).append(e)
+            elif v is _MISSING:
+                if k not in dd.get('unset', []):
+                    dd.setdefault('unset', []).append(k)
+            else:
+                dd.setdefault('set', {})[k] = v
+        d['delta'] = delta
+        return d
+
+def apply_update(state, msg):
+    # client side: returns the complete trunk_update after msg, or None
+    # if msg does not follow state (the client must resync)
+    if 'base' not in msg:
+        return msg
+    if state is None or state.get('seq') != msg['base']:
+        return None
+    for k in msg:
+        if k not in ('base', 'delta'):
+            state[k] = msg[k]
+    for nac in msg['delta']:
+        dd = msg['delta'][nac]
+        if 'replace' in dd:
+            if dd['replace'] is None:
+                state.pop(nac, None)
+            else:
+                state[nac] = dd['replace']
+            continue
+        sysd = state[nac]
+        for k in dd.get('set', {}):
+            sysd[k] = dd['set'][k]
+        for k in dd.get('unset', []):
+            sysd.pop(k, None)
+        for k in dd.get('update', {}):
+            sysd[k].update(dd['update'][k])
+        for k in dd.get('remove', {}):
+            for e in dd['remove'][k]:
+                sysd[k].pop(e, None)
+    return state
+
+def check():
+    # replay the tsbk_batch synthetic control channel through two trunked
+    # systems with small state limits (so entries are evicted), feed a
+    # trunk_update per second of replay time to a trunk_state and follow
+    # it with clients that poll at different rates
+    import copy
+    import random
+    import trunking
+    import tsbk_batch
+    records = tsbk_batch.synthetic_records(8000)
+    clock = tsbk_batch._replay_clock()
+    saved_time = trunking.time
+    trunking.time = clock
+    rng = random.Random(3)
+    server = trunk_state(log_len=8)
+    clients = [{'every': n, 'state': None, 'seq': None, 'bytes': 0, 'full': 0} for n in (1, 1, 2, 5, 13)]
+    full_bytes = 0
+    systems = {}
+    updates = 0
+    try:
+        next_update = float(records[0]['time'])
+        for r in records:
+            clock.now = float(r['time'])
+            nac = int(r['nac'])
+            if rng.random() < 0.3:
+                nac += 1	# second system sharing the traffic
+            if nac not in systems:
+                systems[nac] = trunking.trunked_system(send_event=lambda d: None, nac=nac)
+                systems[nac].limits.update({'max_talkgroups': 300, 'max_frequency_tracking': 6, 'max_voice_frequencies': 6})
+            systems[nac].decode_tsbk(trunking.get_ordinals(r['data'][:r['length']].tobytes()))
+            if clock.now < next_update:
+                continue
+            next_update = clock.now + 1.0
+            d = {'json_type': 'trunk_update'}
+            for n in systems:
+                d[n] = systems[n].to_dict()
+            d['data'] = {'last_command': None, 'tgid_hold': None}
+            d['time'] = clock.now
+            js = json.dumps(d)
+            full_bytes += len(js)
+            server.update(json.loads(js))
+            updates += 1
+            expect = json.loads(js)
+            for c in clients:
+                if updates % c['every']:
+                    continue
+                js, seq = server.encoded_since(c['seq'])	# as sent to the browser
+                msg = json.loads(js)
+                assert msg['seq'] == seq
+                c['bytes'] += len(js)
+                c['full'] += 'base' not in msg
+                c['state'] = apply_update(c['state'], msg)
+                assert c['state'] is not None
+                c['seq'] = c['state']['seq']
+                expect['seq'] = server.seq
+                assert c['state'] == expect, 'client %d diverged at update %d' % (c['every'], updates)
+                c['state'] = copy.deepcopy(c['state'])	# client state must not share the server's
+        assert apply_update({'seq': 1}, {'base': 2, 'delta': {}}) is None
+        assert server.parse_event_id(server.event_id(5)) == 5
+        assert server.parse_event_id('0:5') is None and server.parse_event_id(None) is None
+    finally:
+        trunking.time = saved_time
+    sys.stderr.write('%d updates, complete snapshots %d bytes\n' % (updates, full_bytes))
+    for c in clients:
+        sys.stderr.write('client every %d: %d bytes (%.1f%%), %d complete snapshots\n' % (c['every'], c['bytes'], 100.0 * c['bytes'] * c['every'] / full_bytes, c['full']))
+    sys.stderr.write('ok\n')
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] == 'check':
+        check()
+
+if __name__ == '__main__':
+    main()
@@ -24,11 +24,13 @@ import sys
 import os
 import time
 import collections
+import heapq
+import itertools
 import json
 sys.path.append('tdma')
 import lfsr
-from tsvfile import make_config, load_tsv, id_registry, read_tags_file
-from create_image import create_image
+from tsvfile import make_config, load_tsv, id_registry, open_tags, STATE_LIMITS
+from create_image import status_renderer
 
 FILTERED_CC_EVENT = 'mot_grg_add_cmd grp_v_ch_grant_updt grp_v_ch_grant_updt_exp'.split()
 
@@ -55,6 +57,28 @@ def get_ordinals(s):
 			t = (t << 8) + ord(c)
 	return t
 
+def deep_sizeof(obj):
+    # bytes held by obj and the containers nested inside it
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += deep_sizeof(k) + deep_sizeof(v)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += deep_sizeof(v)
+    return size
+
+def approx_sizeof(obj, sample=32):
+    # estimate deep_sizeof(obj) from its first few members, cheap enough for every status update
+    size = sys.getsizeof(obj)
+    if not obj:
+        return size
+    if isinstance(obj, dict):
+        member = sum([deep_sizeof(k) + deep_sizeof(v) for k, v in itertools.islice(obj.items(), sample)])
+    else:
+        member = sum([deep_sizeof(v) for v in itertools.islice(obj, sample)])
+    return size + member * len(obj) // min(len(obj), sample)
+
 class trunked_system (object):
     def __init__(self, debug=0, config=None, send_event=None, nac=None):
         self.debug = debug
@@ -65,7 +89,7 @@ class trunked_system (object):
         self.tsbk_cache = {}
         self.secondary = {}
         self.adjacent = {}
-        self.adjacent_data = {}
+        self.adjacent_data = collections.OrderedDict()	# least recently updated first
         self.rfss_syid = 0
         self.rfss_rfid = 0
         self.rfss_stid = 0
@@ -96,10 +120,23 @@ class trunked_system (object):
         self.last_voice_time = 0.0
 
         self.talkgroups = {}
+        self.talkgroup_order = {}	# tgid -> order of first use, None if not whitelisted
+        self.talkgroup_count = 0
+        self.active_talkgroups = []	# heap of (prio, order, time, tgid), one entry per update
+        self.active_start_time = 0
+        self.recent_talkgroups = collections.OrderedDict()	# tgid -> time, least recently updated first
+        self.blacklist_expiry = []	# heap of (end_time, tgid)
         self.frequency_table = {}
+        self.frequency_order = {}	# frequency -> order of first use
+        self.frequency_count = 0
+        self.tgid_calls = {}	# tgid -> set of (frequency, slot) in frequency_table
+        self.call_expire_heap = []	# (deadline, frequency, slot)
+        self.call_expire_at = {}	# (frequency, slot) -> deadline of its heap entry
         self.CALL_TIMEOUT = 0.7	# call expiration time (sec.)
         self.CHECK_INTERVAL = 0.1 # freq tracking check interval
         self.next_frequency_tracking_expire = 0
+        self.limits = dict(STATE_LIMITS)
+        self.evicted = dict.fromkeys(['talkgroups', 'voice_frequencies', 'frequency_tracking', 'adjacent_sites'], 0)
         if config:
             self.blacklist = config['blacklist']
             self.whitelist = config['whitelist']
@@ -111,6 +148,9 @@ class trunked_system (object):
             self.cc_list   = config['cclist']
             self.center_frequency = config['center_frequency']
             self.modulation = config['modulation']
+            for k in STATE_LIMITS:
+                if k in config:
+                    self.limits[k] = int(config[k])
 
         self.current_srcaddr = 0
         self.current_grpaddr = 0	# from P25 LCW
@@ -154,6 +194,23 @@ class trunked_system (object):
         self.frequency_tracking_expire(always=True)
         d['frequency_tracking'] = self.frequency_table
         d['harris_supergroups'] = self.harris_sgs
+        d['state_sizes'] = self.state_sizes()
+        return d
+
+    def state_sizes(self):
+        # entries, configured limit, evictions and approx. bytes of the state that grows with traffic
+        d = {}
+        for k, n, containers in [
+                ('talkgroups', len(self.talkgroups), [self.talkgroups, self.talkgroup_order, self.recent_talkgroups, self.active_talkgroups]),
+                ('voice_frequencies', len(self.voice_frequencies), [self.voice_frequencies]),
+                ('frequency_tracking', len(self.frequency_table), [self.frequency_table, self.frequency_order, self.tgid_calls, self.call_expire_heap, self.call_expire_at]),
+                ('adjacent_sites', len(self.adjacent_data), [self.adjacent_data, self.adjacent])]:
+            d[k] = {'entries': n, 'limit': self.limits['max_%s' % k], 'evicted': self.evicted[k], 'bytes': sum([approx_sizeof(c) for c in containers])}
+        d['talkgroups']['max_age'] = self.limits['max_talkgroup_age']
+        for k, reg in [('tgid_map', self.tgid_map), ('unit_id_map', self.unit_id_map)]:
+            if isinstance(reg, id_registry):
+                d[k] = reg.size_report()
+                d[k]['bytes'] = approx_sizeof(reg.ranges) + approx_sizeof(reg.intervals) + approx_sizeof(reg.lookups) + approx_sizeof(reg.wildcards)
         return d
 
     def to_json(self):
@@ -278,24 +335,70 @@ class trunked_system (object):
         if current_time < self.next_frequency_tracking_expire and not always:
             return
         self.next_frequency_tracking_expire = current_time + self.CHECK_INTERVAL
-        for f in self.frequency_table.keys():
-            freq = self.frequency_table[f]
-            for i in range(len(freq['calls'])):
-                call = freq['calls'][i]
-                if call is not None and call['end_time'] == 0 and call['last_active'] + self.CALL_TIMEOUT < current_time:
-                    call['end_time'] = current_time
-                    self.end_call(call, 1)
+        expired = []
+        while self.call_expire_heap and self.call_expire_heap[0][0] < current_time:
+            deadline, frequency, slot = heapq.heappop(self.call_expire_heap)
+            if self.call_expire_at.get((frequency, slot)) != deadline:
+                continue	# stale entry
+            del self.call_expire_at[(frequency, slot)]
+            call = self.frequency_table[frequency]['calls'][slot]
+            if call is None or call['end_time'] != 0:
+                continue
+            if call['last_active'] + self.CALL_TIMEOUT < current_time:
+                expired.append((self.frequency_order[frequency], slot, call))
+            else:	# refreshed since it was scheduled
+                self.schedule_call_expire(frequency, slot)
+        # end calls in frequency_table order
+        for order, slot, call in sorted(expired, key=lambda e: (e[0], e[1])):
+            call['end_time'] = current_time
+            self.end_call(call, 1)
+
+    def schedule_call_expire(self, frequency, slot):
+        # at most one heap entry per (frequency, slot); entries are checked
+        # against the call's last_active when they come due
+        if (frequency, slot) in self.call_expire_at:
+            return
+        deadline = self.frequency_table[frequency]['calls'][slot]['last_active'] + self.CALL_TIMEOUT
+        self.call_expire_at[(frequency, slot)] = deadline
+        heapq.heappush(self.call_expire_heap, (deadline, frequency, slot))
+
+    def set_call(self, frequency, slot, tgid, call):
+        # all changes to frequency_table tgids/calls go through here to keep tgid_calls current
+        freq = self.frequency_table[frequency]
+        old_tgid = freq['tgids'][slot]
+        if old_tgid is not None and freq['calls'][slot] is not None:
+            positions = self.tgid_calls[old_tgid]
+            positions.discard((frequency, slot))
+            if not positions:
+                del self.tgid_calls[old_tgid]
+        freq['tgids'][slot] = tgid
+        freq['calls'][slot] = call
+        if tgid is not None and call is not None:
+            self.tgid_calls.setdefault(tgid, set()).add((frequency, slot))
+        if call is not None and call['end_time'] == 0:
+            self.schedule_call_expire(frequency, slot)
+
+    def find_calls(self, tgid):
+        # (frequency, slot) of the calls recorded for tgid, in frequency_table order
+        positions = self.tgid_calls.get(tgid)
+        if not positions:
+            return []
+        if len(positions) == 1:
+            return list(positions)
+        return sorted(positions, key=lambda p: (self.frequency_order[p[0]], p[1]))
 
     def frequency_tracking(self, frequency, tgid, tdma_slot, srcaddr, protected):
         current_time = time.time()
         is_tdma = tdma_slot is not None
         slot = tdma_slot if is_tdma else 0
-        if frequency not in self.frequency_table.keys():
+        if frequency not in self.frequency_table:
             self.frequency_table[frequency] = {'counter':0,
                                                'calls': [None,None],
                                                'tgids': [None,None],
                                                'last_active': current_time}
             self.frequency_table[frequency]['tdma'] = is_tdma
+            self.frequency_order[frequency] = self.frequency_count
+            self.frequency_count += 1
             call = {'srcaddr': self.mk_src_dict(srcaddr),
                     'protected': protected,
                     'tgid': self.mk_tg_dict(tgid),
@@ -304,37 +407,37 @@ class trunked_system (object):
                     'last_active': current_time,
                     'end_time': 0}
 
-            self.frequency_table[frequency]['tgids'][slot] = tgid
-            self.frequency_table[frequency]['calls'][slot] = call
+            self.set_call(frequency, slot, tgid, call)
+            limit = self.limits['max_frequency_tracking']
+            while limit and len(self.frequency_table) > limit:
+                oldest = min([f for f in self.frequency_table if f != frequency], key=lambda f: self.frequency_table[f]['last_active'])
+                self.evict_frequency_tracking(oldest, current_time)
             return
 
         self.frequency_table[frequency]['counter'] += 1
         self.frequency_table[frequency]['last_active'] = current_time
         found = 0
-        for f in self.frequency_table.keys():
+        for f, i in self.find_calls(tgid):
             freq = self.frequency_table[f]
-            for i in range(len(freq['tgids'])):
-                tg   = freq['tgids'][i]
-                call = freq['calls'][i]
-                if tg is None or call is None or tg != tgid:
-                    continue
-                # general housekeeping: expire calls
-                if call['end_time'] == 0 and call['last_active'] + self.CALL_TIMEOUT < current_time:
+            call = freq['calls'][i]
+            # general housekeeping: expire calls
+            if call['end_time'] == 0 and call['last_active'] + self.CALL_TIMEOUT < current_time:
+                call['end_time'] = current_time
+                self.end_call(call, 2)
+            if f == frequency and freq['tdma'] == is_tdma and i == slot :
+                found = 1
+                call['last_active'] = current_time
+                call['end_time'] = 0
+                call['count'] += 1
+                if srcaddr is not None:
+                    call['srcaddr'] = self.mk_src_dict(srcaddr)
+                if protected is not None:
+                    call['protected'] = protected
+                self.schedule_call_expire(f, i)
+            else:	# found other entry with matching tgid but freq and/or tdma is wrong
+                if call['end_time'] == 0:
                     call['end_time'] = current_time
-                    self.end_call(call, 2)
-                if f == frequency and freq['tdma'] == is_tdma and i == slot :
-                    found = 1
-                    call['last_active'] = current_time
-                    call['end_time'] = 0
-                    call['count'] += 1
-                    if srcaddr is not None:
-                        call['srcaddr'] = self.mk_src_dict(srcaddr)
-                    if protected is not None:
-                        call['protected'] = protected
-                else:	# found other entry with matching tgid but freq and/or tdma is wrong
-                    if call['end_time'] == 0:
-                        call['end_time'] = current_time
-                        self.end_call(call, 3)
+                    self.end_call(call, 3)
         if found:
             return
 
@@ -346,15 +449,26 @@ class trunked_system (object):
                 'last_active': current_time,
                 'end_time': 0}
         self.frequency_table[frequency]['tdma'] = is_tdma
-        self.frequency_table[frequency]['tgids'][slot] = tgid
-        self.frequency_table[frequency]['calls'][slot] = call
+        self.set_call(frequency, slot, tgid, call)
         if not is_tdma:
-            self.frequency_table[frequency]['tgids'][1] = None
             call = self.frequency_table[frequency]['calls'][1]
+            self.set_call(frequency, 1, None, None)
             if call and call['end_time'] == 0:
                 call['end_time'] = current_time
                 self.end_call(call, 4)
-            self.frequency_table[frequency]['calls'][1] = None
+
+    def evict_frequency_tracking(self, frequency, current_time):
+        freq = self.frequency_table[frequency]
+        for slot in (0, 1):
+            call = freq['calls'][slot]
+            if call is not None and call['end_time'] == 0:
+                call['end_time'] = current_time
+                self.end_call(call, 1)
+            self.set_call(frequency, slot, None, None)
+            self.call_expire_at.pop((frequency, slot), None)	# leaves its heap entry stale
+        del self.frequency_table[frequency]
+        del self.frequency_order[frequency]
+        self.evicted['frequency_tracking'] += 1
 
     def update_talkgroup(self, frequency, tgid, tdma_slot, srcaddr, uplink):
         if self.debug >= 5:
@@ -362,6 +476,9 @@ class trunked_system (object):
 
         if tgid not in self.talkgroups:
             self.talkgroups[tgid] = {'counter':0}
+            # whitelist is fixed by the config, so decide once per tgid
+            self.talkgroup_order[tgid] = self.talkgroup_count if not (self.whitelist and tgid not in self.whitelist) else None
+            self.talkgroup_count += 1
             if self.debug >= 5:
                 sys.stderr.write('%f new tgid: %s %s prio %d\n' % (time.time(), tgid, self.get_tag(tgid), self.get_prio(tgid)))
         self.talkgroups[tgid]['time'] = time.time()
@@ -370,6 +487,9 @@ class trunked_system (object):
         self.talkgroups[tgid]['prio'] = self.get_prio(tgid)
         self.talkgroups[tgid]['tag_color'] = self.get_tag_color(tgid)
         self.talkgroups[tgid]['uplink'] = uplink
+        self.recent_talkgroups.pop(tgid, None)
+        self.recent_talkgroups[tgid] = self.talkgroups[tgid]['time']
+        self.activate_talkgroup(tgid)
 
         if srcaddr is None or not srcaddr:
             self.talkgroups[tgid]['srcaddr'] = 0
@@ -379,6 +499,20 @@ class trunked_system (object):
             self.talkgroups[tgid]['srcaddr'] = srcaddr
             self.talkgroups[tgid]['srcaddr_tag'] = self.get_unit_id_tag(srcaddr)
             self.talkgroups[tgid]['srcaddr_color'] = self.get_unit_id_color(srcaddr)
+        self.expire_talkgroups(self.talkgroups[tgid]['time'])
+
+    def expire_talkgroups(self, current_time):
+        # drop least recently updated talkgroups over the count limit or past the age limit
+        limit = self.limits['max_talkgroups']
+        max_age = self.limits['max_talkgroup_age']
+        while self.recent_talkgroups:
+            tgid = next(iter(self.recent_talkgroups))
+            if not (limit and len(self.talkgroups) > limit) and not (max_age and self.recent_talkgroups[tgid] < current_time - max_age):
+                break
+            del self.recent_talkgroups[tgid]
+            del self.talkgroups[tgid]
+            del self.talkgroup_order[tgid]	# its active_talkgroups entries are now stale
+            self.evicted['talkgroups'] += 1
 
     def update_voice_frequency(self, frequency, tgid=None, tdma_slot=None, srcaddr=None, protected=None, uplink=None):
         if not frequency:	# e.g., channel identifier not yet known
@@ -408,19 +542,90 @@ class trunked_system (object):
             self.voice_frequencies[frequency]['srcaddr'][tdma_slot] = srcaddr
             self.voice_frequencies[frequency]['srcaddr_tag'][tdma_slot] = self.get_unit_id_tag(srcaddr)
             self.voice_frequencies[frequency]['srcaddr_color'][tdma_slot] = self.get_unit_id_color(srcaddr)
+        limit = self.limits['max_voice_frequencies']
+        while limit and len(self.voice_frequencies) > limit:
+            oldest = min([f for f in self.voice_frequencies if f != frequency], key=lambda f: self.voice_frequencies[f]['time'])
+            del self.voice_frequencies[oldest]
+            self.evicted['voice_frequencies'] += 1
+
+    def update_adjacent(self, frequency, desc, data):
+        self.adjacent[frequency] = desc
+        self.adjacent_data.pop(frequency, None)
+        self.adjacent_data[frequency] = data
+        limit = self.limits['max_adjacent_sites']
+        while limit and len(self.adjacent_data) > limit:
+            f, _ = self.adjacent_data.popitem(last=False)
+            self.adjacent.pop(f, None)
+            self.evicted['adjacent_sites'] += 1
+
+    def activate_talkgroup(self, tgid):
+        # index a talkgroup update for find_talkgroup()
+        order = self.talkgroup_order[tgid]
+        if order is None:	# not whitelisted
+            return
+        tg = self.talkgroups[tgid]
+        heapq.heappush(self.active_talkgroups, (tg['prio'], order, tg['time'], tgid))
+        if len(self.active_talkgroups) > 2 * len(self.talkgroups) + 64:
+            # drop superseded, evicted and expired entries
+            self.active_talkgroups = [e for e in self.active_talkgroups if self.active_entry_current(e) and e[2] >= self.active_start_time]
+            heapq.heapify(self.active_talkgroups)
+
+    def active_entry_current(self, e):
+        # True if heap entry e is the latest update of a talkgroup still in self.talkgroups
+        prio, order, t, tgid = e
+        tg = self.talkgroups.get(tgid)
+        return tg is not None and t == tg['time'] and order == self.talkgroup_order[tgid]
 
     def get_updated_talkgroups(self, start_time):
-        return [tgid for tgid in self.talkgroups if (
-                       self.talkgroups[tgid]['time'] >= start_time and
-                       tgid not in self.blacklist and
-                       not (self.whitelist and tgid not in self.whitelist))]
+        updated = []
+        for tgid in reversed(self.recent_talkgroups):	# most recently updated first
+            if self.recent_talkgroups[tgid] < start_time:
+                break
+            if tgid not in self.blacklist and self.talkgroup_order[tgid] is not None:
+                updated.append(tgid)
+        return sorted(updated, key=lambda tgid: self.talkgroup_order[tgid])
 
     def blacklist_update(self, start_time):
-        expired_tgs = [tg for tg in self.blacklist.keys()
-                            if self.blacklist[tg] is not None
-                            and self.blacklist[tg] < start_time]
-        for tg in expired_tgs:
-            self.blacklist.pop(tg)
+        while self.blacklist_expiry and self.blacklist_expiry[0][0] < start_time:
+            end_time, tg = heapq.heappop(self.blacklist_expiry)
+            if tg in self.blacklist and self.blacklist[tg] == end_time:
+                self.blacklist.pop(tg)
+
+    def find_active_talkgroup(self, start_time):
+        # highest priority (lowest prio value, then first seen) talkgroup
+        # updated since start_time that may be followed now
+        if start_time < self.active_start_time:	# entries older than active_start_time are gone
+            return self.scan_active_talkgroups(start_time)
+        self.active_start_time = start_time
+        heap = self.active_talkgroups
+        skipped = []
+        result = None
+        while heap:
+            prio, order, t, tgid = heap[0]
+            if not self.active_entry_current(heap[0]) or t < start_time:	# superseded, evicted or no longer active
+                heapq.heappop(heap)
+                continue
+            tg = self.talkgroups[tgid]
+            if tgid in self.blacklist or (tg['tdma_slot'] is not None and (self.ns_syid < 0 or self.ns_wacn < 0)):
+                skipped.append(heapq.heappop(heap))
+                continue
+            result = tgid
+            break
+        for e in skipped:
+            heapq.heappush(heap, e)
+        return result
+
+    def scan_active_talkgroups(self, start_time):
+        result = None
+        for tgid in self.talkgroups:
+            tg = self.talkgroups[tgid]
+            if tg['time'] < start_time or self.talkgroup_order[tgid] is None or tgid in self.blacklist:
+                continue
+            if tg['tdma_slot'] is not None and (self.ns_syid < 0 or self.ns_wacn < 0):
+                continue
+            if result is None or tg['prio'] < self.talkgroups[result]['prio']:
+                result = tgid
+        return result
 
     def find_talkgroup(self, start_time, tgid=None, hold=False):
         tgt_tgid = None
@@ -429,22 +634,11 @@ class trunked_system (object):
         if tgid is not None and tgid in self.talkgroups:
             tgt_tgid = tgid
 
-        for active_tgid in self.talkgroups:
-            if hold:
-                break
-            if self.talkgroups[active_tgid]['time'] < start_time:
-                continue
-            if active_tgid in self.blacklist:
-                continue
-            if self.whitelist and active_tgid not in self.whitelist:
-                continue
-            if self.talkgroups[active_tgid]['tdma_slot'] is not None and (self.ns_syid < 0 or self.ns_wacn < 0):
-                continue
-            if tgt_tgid is None:
-                tgt_tgid = active_tgid
-            elif self.talkgroups[active_tgid]['prio'] < self.talkgroups[tgt_tgid]['prio']:
+        if not hold:
+            active_tgid = self.find_active_talkgroup(start_time)
+            if active_tgid is not None and (tgt_tgid is None or self.talkgroups[active_tgid]['prio'] < self.talkgroups[tgt_tgid]['prio']):
                 tgt_tgid = active_tgid
-                   
+
         if tgt_tgid is not None and self.talkgroups[tgt_tgid]['time'] >= start_time:
             return self.talkgroups[tgt_tgid]['frequency'], tgt_tgid, self.talkgroups[tgt_tgid]['tdma_slot'], self.talkgroups[tgt_tgid]['srcaddr'], self.talkgroups[tgt_tgid]['uplink']
         return None, None, None, None, None
@@ -459,90 +653,104 @@ class trunked_system (object):
         if not tgid:
             return
         self.blacklist[tgid] = end_time
+        if end_time is not None:
+            heapq.heappush(self.blacklist_expiry, (end_time, tgid))
 
     def decode_mbt_data(self, opcode, src, header, mbt_data):
         self.cc_timeouts = 0
         self.last_tsbk = time.time()
-        updated = 0
         if self.debug > 10:
             sys.stderr.write('decode_mbt_data: %x %x\n' %(opcode, mbt_data))
-        if opcode == 0x0:  # grp voice channel grant
-            mfrid = (header >> 72) & 0xff
-            srcaddr = (header >> 48) & 0xffffff
-            opts = (header >> 24) & 0xff
-            ch1  = (mbt_data >> 64) & 0xffff
-            ch2  = (mbt_data >> 48) & 0xffff
-            ga   = (mbt_data >> 32) & 0xffff
-            f = self.channel_id_to_frequency(ch1)
-            uplink = self.channel_id_to_frequency(ch2)
-            if self.debug > 0 and src != srcaddr:
-                sys.stderr.write('decode_mbt_data: grp_v_ch_grant: src %d does not match srcaddr %d\n' % (src, srcaddr))
-            d = {'cc_event': 'grp_v_ch_grant_mbt', 'mfrid': mfrid, 'options': opts, 'frequency': f, 'group': self.mk_tg_dict(ga), 'srcaddr': self.mk_src_dict(srcaddr), 'opcode': opcode, 'tdma_slot': self.get_tdma_slot(ch1) }
-            self.post_event(d)
-            self.update_voice_frequency(f, tgid=ga, tdma_slot=self.get_tdma_slot(ch1), srcaddr=srcaddr, protected=opts&64 == 64, uplink=uplink)
-            if f:
-                updated += 1
-            if self.debug > 10:
-                sys.stderr.write('mbt00 voice grant ch1 %x ch2 %x addr 0x%x\n' %(ch1, ch2, ga))
-        elif opcode == 0x3c:  # adjacent status
-            syid = (header >> 48) & 0xfff
-            rfid = (header >> 24) & 0xff
-            stid = (header >> 16) & 0xff
-            ch1  = (mbt_data >> 80) & 0xffff
-            ch2  = (mbt_data >> 64) & 0xffff
-            f1 = self.channel_id_to_frequency(ch1)
-            f2 = self.channel_id_to_frequency(ch2)
-            if f1 and f2:
-                self.adjacent[f1] = 'rfid: %d stid:%d uplink:%f' % (rfid, stid, f2 / 1000000.0)
-                self.adjacent_data[f1] = {'rfid': rfid, 'stid':stid, 'uplink': f2, 'table': None, 'sysid': syid}
-            if self.debug > 10:
-                sys.stderr.write('mbt3c adjacent sys %x rfid %x stid %x ch1 %x ch2 %x f1 %s f2 %s\n' % (syid, rfid, stid, ch1, ch2, self.channel_id_to_string(ch1), self.channel_id_to_string(ch2)))
-        elif opcode == 0x3b:  # network status
-            syid = (header >> 48) & 0xfff
-            wacn = (mbt_data >> 76) & 0xfffff
-            ch1  = (mbt_data >> 56) & 0xffff
-            ch2  = (mbt_data >> 40) & 0xffff
-            f1 = self.channel_id_to_frequency(ch1)
-            f2 = self.channel_id_to_frequency(ch2)
-            if f1 and f2:
-                self.ns_syid = syid
-                self.ns_wacn = wacn
-                self.ns_chan = f1
-            if self.debug > 10:
-                sys.stderr.write('mbt3b net stat sys %x wacn %x ch1 %s ch2 %s\n' %(syid, wacn, self.channel_id_to_string(ch1), self.channel_id_to_string(ch2)))
-        elif opcode == 0x3a:  # rfss status
-            syid = (header >> 48) & 0xfff
-            rfid = (mbt_data >> 88) & 0xff
-            stid = (mbt_data >> 80) & 0xff
-            ch1  = (mbt_data >> 64) & 0xffff
-            ch2  = (mbt_data >> 48) & 0xffff
-            f1 = self.channel_id_to_frequency(ch1)
-            f2 = self.channel_id_to_frequency(ch2)
-            if f1 and f2:
-                self.rfss_syid = syid
-                self.rfss_rfid = rfid
-                self.rfss_stid = stid
-                self.rfss_chan = f1
-                self.rfss_txchan = f2
-            if self.debug > 10:
-                sys.stderr.write('mbt3a rfss stat sys %x rfid %x stid %x ch1 %s ch2 %s\n' %(syid, rfid, stid, self.channel_id_to_string(ch1), self.channel_id_to_string(ch2)))
-        elif opcode == 0x31:  # AUTH_DMD
-            mfrid = (header >> 72) & 0xff
-            target_address = (header >> 48) & 0xffffff
-            wacn_p1 = (header >> 16) & 0xffff
-            msg_wacn = (wacn_p1 << 4) | (mbt_data >> 188) & 0xf
-            msg_sysid = (mbt_data >> 176) & 0xfff
-            target_id = (mbt_data >> 152) & 0xffffff
-            rs = (mbt_data >> 72) & 0x3ff
-            rand1 = (mbt_data >> 32) & 0x1f
-            d = {'cc_event': 'auth_dmd', 'mfrid': mfrid, 'target_address': self.mk_src_dict(target_address), 'target_id': self.mk_src_dict(target_id), 'opcode': opcode, 'msg_sysid': msg_sysid, 'msg_wacn': msg_wacn, 'rs': rs, 'rand1': rand1 }
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('mbt31 auth_dmd target %d wacn 0x%x sysid 0x%x target id %d rs 0x%x rand1 0x%x\n' % (target_address, msg_wacn, msg_sysid, target_id, rs, rand1))
-        else:
+        handler = mbt_handlers.get(opcode)
+        if handler is None:
             sys.stderr.write('decode_mbt_data(): received unsupported mbt opcode %x\n' % opcode)
+            return 0
+        return handler(self, opcode, src, header, mbt_data)
+
+    def mbt_grp_v_ch_grant(self, opcode, src, header, mbt_data):	# grp voice channel grant
+        updated = 0
+        mfrid = (header >> 72) & 0xff
+        srcaddr = (header >> 48) & 0xffffff
+        opts = (header >> 24) & 0xff
+        ch1  = (mbt_data >> 64) & 0xffff
+        ch2  = (mbt_data >> 48) & 0xffff
+        ga   = (mbt_data >> 32) & 0xffff
+        f = self.channel_id_to_frequency(ch1)
+        uplink = self.channel_id_to_frequency(ch2)
+        if self.debug > 0 and src != srcaddr:
+            sys.stderr.write('decode_mbt_data: grp_v_ch_grant: src %d does not match srcaddr %d\n' % (src, srcaddr))
+        d = {'cc_event': 'grp_v_ch_grant_mbt', 'mfrid': mfrid, 'options': opts, 'frequency': f, 'group': self.mk_tg_dict(ga), 'srcaddr': self.mk_src_dict(srcaddr), 'opcode': opcode, 'tdma_slot': self.get_tdma_slot(ch1) }
+        self.post_event(d)
+        self.update_voice_frequency(f, tgid=ga, tdma_slot=self.get_tdma_slot(ch1), srcaddr=srcaddr, protected=opts&64 == 64, uplink=uplink)
+        if f:
+            updated += 1
+        if self.debug > 10:
+            sys.stderr.write('mbt00 voice grant ch1 %x ch2 %x addr 0x%x\n' %(ch1, ch2, ga))
         return updated
 
+    def mbt_adjacent_status(self, opcode, src, header, mbt_data):	# adjacent status
+        syid = (header >> 48) & 0xfff
+        rfid = (header >> 24) & 0xff
+        stid = (header >> 16) & 0xff
+        ch1  = (mbt_data >> 80) & 0xffff
+        ch2  = (mbt_data >> 64) & 0xffff
+        f1 = self.channel_id_to_frequency(ch1)
+        f2 = self.channel_id_to_frequency(ch2)
+        if f1 and f2:
+            self.update_adjacent(f1, 'rfid: %d stid:%d uplink:%f' % (rfid, stid, f2 / 1000000.0),
+                {'rfid': rfid, 'stid':stid, 'uplink': f2, 'table': None, 'sysid': syid})
+        if self.debug > 10:
+            sys.stderr.write('mbt3c adjacent sys %x rfid %x stid %x ch1 %x ch2 %x f1 %s f2 %s\n' % (syid, rfid, stid, ch1, ch2, self.channel_id_to_string(ch1), self.channel_id_to_string(ch2)))
+        return 0
+
+    def mbt_net_status(self, opcode, src, header, mbt_data):	# network status
+        syid = (header >> 48) & 0xfff
+        wacn = (mbt_data >> 76) & 0xfffff
+        ch1  = (mbt_data >> 56) & 0xffff
+        ch2  = (mbt_data >> 40) & 0xffff
+        f1 = self.channel_id_to_frequency(ch1)
+        f2 = self.channel_id_to_frequency(ch2)
+        if f1 and f2:
+            self.ns_syid = syid
+            self.ns_wacn = wacn
+            self.ns_chan = f1
+        if self.debug > 10:
+            sys.stderr.write('mbt3b net stat sys %x wacn %x ch1 %s ch2 %s\n' %(syid, wacn, self.channel_id_to_string(ch1), self.channel_id_to_string(ch2)))
+        return 0
+
+    def mbt_rfss_status(self, opcode, src, header, mbt_data):	# rfss status
+        syid = (header >> 48) & 0xfff
+        rfid = (mbt_data >> 88) & 0xff
+        stid = (mbt_data >> 80) & 0xff
+        ch1  = (mbt_data >> 64) & 0xffff
+        ch2  = (mbt_data >> 48) & 0xffff
+        f1 = self.channel_id_to_frequency(ch1)
+        f2 = self.channel_id_to_frequency(ch2)
+        if f1 and f2:
+            self.rfss_syid = syid
+            self.rfss_rfid = rfid
+            self.rfss_stid = stid
+            self.rfss_chan = f1
+            self.rfss_txchan = f2
+        if self.debug > 10:
+            sys.stderr.write('mbt3a rfss stat sys %x rfid %x stid %x ch1 %s ch2 %s\n' %(syid, rfid, stid, self.channel_id_to_string(ch1), self.channel_id_to_string(ch2)))
+        return 0
+
+    def mbt_auth_dmd(self, opcode, src, header, mbt_data):	# AUTH_DMD
+        mfrid = (header >> 72) & 0xff
+        target_address = (header >> 48) & 0xffffff
+        wacn_p1 = (header >> 16) & 0xffff
+        msg_wacn = (wacn_p1 << 4) | (mbt_data >> 188) & 0xf
+        msg_sysid = (mbt_data >> 176) & 0xfff
+        target_id = (mbt_data >> 152) & 0xffffff
+        rs = (mbt_data >> 72) & 0x3ff
+        rand1 = (mbt_data >> 32) & 0x1f
+        d = {'cc_event': 'auth_dmd', 'mfrid': mfrid, 'target_address': self.mk_src_dict(target_address), 'target_id': self.mk_src_dict(target_id), 'opcode': opcode, 'msg_sysid': msg_sysid, 'msg_wacn': msg_wacn, 'rs': rs, 'rand1': rand1 }
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('mbt31 auth_dmd target %d wacn 0x%x sysid 0x%x target id %d rs 0x%x rand1 0x%x\n' % (target_address, msg_wacn, msg_sysid, target_id, rs, rand1))
+        return 0
+
     def decode_tdma_blk(self, blk):
         self.stats['tsbks'] += 1
         msg0 = get_ordinals(blk[:1])
@@ -621,8 +829,8 @@ class trunked_system (object):
             cls = msg & 0xff
             f1 = self.channel_id_to_frequency(ch1)
             if f1 and table in self.freq_table:
-                self.adjacent[f1] = 'rfid: %d stid:%d uplink:%f tbl:%d sysid:0x%x' % (rfid, stid, (f1 + self.freq_table[table]['offset']) / 1000000.0, table, syid)
-                self.adjacent_data[f1] = {'rfid': rfid, 'stid':stid, 'uplink': f1 + self.freq_table[table]['offset'], 'table': table, 'sysid':syid}
+                self.update_adjacent(f1, 'rfid: %d stid:%d uplink:%f tbl:%d sysid:0x%x' % (rfid, stid, (f1 + self.freq_table[table]['offset']) / 1000000.0, table, syid),
+                    {'rfid': rfid, 'stid':stid, 'uplink': f1 + self.freq_table[table]['offset'], 'table': table, 'sysid':syid})
             if self.debug > 10:
                 sys.stderr.write('tsbk3c adjacent: rfid %x stid %d ch1 %x(%s)\n' %(rfid, stid, ch1, self.channel_id_to_string(ch1)))
                 if table in self.freq_table:
@@ -738,12 +946,424 @@ class trunked_system (object):
                 break
             blk = blk[rc:]
 
-    def decode_tsbk_harris(self, tsbk, opcode, mfrid):
+    def decode_tsbk(self, tsbk):
+        self.cc_timeouts = 0
+        self.last_tsbk = time.time()
+        self.stats['tsbks'] += 1
+        tsbk = tsbk << 16	# for missing crc
+        opcode = (tsbk >> 88) & 0x3f
+        mfrid = (tsbk >> 80) & 0xff # mfrid
+        if self.debug > 10:
+            sys.stderr.write('TSBK: 0x%02x 0x%024x mfrid %02x\n' % (opcode, tsbk, mfrid))
+        handler = tsbk_handlers.get((mfrid, opcode))
+        if handler is None:
+            return self.tsbk_unsupported(tsbk, opcode, mfrid)
+        return handler(self, tsbk, opcode, mfrid)
+
+    def tsbk_unsupported(self, tsbk, opcode, mfrid):
+        if mfrid == 0:
+            if self.debug > 1:
+                sys.stderr.write('received unsupported TSBK opcode %x (%x)\n' % (opcode, tsbk))
+        elif mfrid == 0x90:
+            if self.debug > 10:
+                sys.stderr.write('decode_tsbk: unsupported opcode %02x mfrid %02x\n' % (opcode, mfrid))
+        elif mfrid == 0xa4:
+            sys.stderr.write('decode_tsbk: unsupported opcode %02x mfrid %02x\n' % (opcode, mfrid))
+        else:
+            sys.stderr.write('unsupported tsbk mfrid: 0x%02x opcode 0x%02x\n' % (mfrid, opcode))
+        return 0
+
+    def tsbk_grp_v_ch_grant(self, tsbk, opcode, mfrid):	# group voice chan grant
+        updated = 0
+        opts  = (tsbk >> 72) & 0xff
+        ch   = (tsbk >> 56) & 0xffff
+        ga   = (tsbk >> 40) & 0xffff
+        sa   = (tsbk >> 16) & 0xffffff
+        f = self.channel_id_to_frequency(ch)
+        uplink = self.channel_id_to_frequency(ch, uplink=True)
+        d = {'cc_event': 'grp_v_ch_grant', 'mfrid': mfrid, 'options': opts, 'frequency': f, 'group': self.mk_tg_dict(ga), 'srcaddr': self.mk_src_dict(sa), 'opcode': opcode, 'tdma_slot': self.get_tdma_slot(ch) }
+        self.post_event(d)
+        self.update_voice_frequency(f, tgid=ga, tdma_slot=self.get_tdma_slot(ch), srcaddr=sa, protected=opts&64 == 64, uplink=uplink)
+        if f:
+            updated += 1
+        if self.debug > 10:
+            sys.stderr.write('tsbk00 grant freq %s ga %d sa %d\n' % (self.channel_id_to_string(ch), ga, sa))
+        return updated
+
+    def tsbk_grp_v_ch_grant_updt(self, tsbk, opcode, mfrid):	# group voice chan grant update
+        updated = 0
+        ch1  = (tsbk >> 64) & 0xffff
+        ga1  = (tsbk >> 48) & 0xffff
+        ch2  = (tsbk >> 32) & 0xffff
+        ga2  = (tsbk >> 16) & 0xffff
+        f1 = self.channel_id_to_frequency(ch1)
+        f2 = self.channel_id_to_frequency(ch2)
+        uplink1 = self.channel_id_to_frequency(ch1, uplink=True)
+        uplink2 = self.channel_id_to_frequency(ch2, uplink=True)
+        d = {'cc_event': 'grp_v_ch_grant_updt', 'mfrid': mfrid, 'frequency1': f1, 'group1': self.mk_tg_dict(ga1), 'opcode': opcode, 'tdma_slot': self.get_tdma_slot(ch1) }
+        self.update_voice_frequency(f1, tgid=ga1, tdma_slot=self.get_tdma_slot(ch1), uplink=uplink1)
+        if f1 != f2:
+            self.update_voice_frequency(f2, tgid=ga2, tdma_slot=self.get_tdma_slot(ch2), uplink=uplink2)
+            d['frequency2'] = f2
+            d['group2'] = self.mk_tg_dict(ga2)
+        if f1:
+            updated += 1
+        if f2:
+            updated += 1
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk02 grant update: chan %s %d %s %d\n' %(self.channel_id_to_string(ch1), ga1, self.channel_id_to_string(ch2), ga2))
+        return updated
+
+    def tsbk_grp_v_ch_grant_updt_exp(self, tsbk, opcode, mfrid):	# group voice chan grant update exp : TIA.102-AABC-B-2005 page 56
+        updated = 0
+        opts  = (tsbk >> 72) & 0xff
+        ch1  = (tsbk >> 48) & 0xffff
+        ch2   = (tsbk >> 32) & 0xffff
+        ga  = (tsbk >> 16) & 0xffff
+        f = self.channel_id_to_frequency(ch1)
+        uplink = self.channel_id_to_frequency(ch2)
+        d = {'cc_event': 'grp_v_ch_grant_updt_exp', 'mfrid': mfrid, 'options': opts, 'frequency': f, 'group': self.mk_tg_dict(ga), 'opcode': opcode, 'tdma_slot': self.get_tdma_slot(ch1) }
+        self.post_event(d)
+        self.update_voice_frequency(f, tgid=ga, tdma_slot=self.get_tdma_slot(ch1), uplink=uplink)
+        if f:
+            updated += 1
+        if self.debug > 10:
+            sys.stderr.write('tsbk03: freq-t %s freq-r %s ga:%d\n' % (self.channel_id_to_string(ch1), self.channel_id_to_string(ch2), ga))
+        return updated
+
+    def tsbk_sndcp_data_ch(self, tsbk, opcode, mfrid):	# sndcp data ch
+        ch1  = (tsbk >> 48) & 0xffff
+        ch2  = (tsbk >> 32) & 0xffff
+        if self.debug > 10:
+            sys.stderr.write('tsbk16 sndcp data ch: chan %x %x\n' % (ch1, ch2))
+        return 0
+
+    def tsbk_iden_up_vu(self, tsbk, opcode, mfrid):	# iden_up vhf uhf
+        iden = (tsbk >> 76) & 0xf
+        bwvu = (tsbk >> 72) & 0xf
+        toff0 = (tsbk >> 58) & 0x3fff
+        spac = (tsbk >> 48) & 0x3ff
+        freq = (tsbk >> 16) & 0xffffffff
+        toff_sign = (toff0 >> 13) & 1
+        toff = toff0 & 0x1fff
+        if toff_sign == 0:
+            toff = 0 - toff
+        txt = ["mob Tx-", "mob Tx+"]
+        self.freq_table[iden] = {}
+        self.freq_table[iden]['offset'] = toff * spac * 125
+        self.freq_table[iden]['step'] = spac * 125
+        self.freq_table[iden]['frequency'] = freq * 5
+        d = {'cc_event': 'iden_up_vu', 'iden': iden, 'bwvu': bwvu, 'offset': self.freq_table[iden]['offset'], 'step':  self.freq_table[iden]['step'], 'freq': self.freq_table[iden]['frequency'], 'opcode': opcode }
+        self.post_event(d)                          
+        if self.debug > 10:
+            sys.stderr.write('tsbk34 iden vhf/uhf id %d toff %f spac %f freq %f [%s]\n' % (iden, toff * spac * 0.125 * 1e-3, spac * 0.125, freq * 0.000005, txt[toff_sign]))
+        return 0
+
+    def tsbk_iden_up_tdma(self, tsbk, opcode, mfrid):	# iden_up_tdma
+        iden = (tsbk >> 76) & 0xf
+        channel_type = (tsbk >> 72) & 0xf
+        toff0 = (tsbk >> 58) & 0x3fff
+        spac = (tsbk >> 48) & 0x3ff
+        toff_sign = (toff0 >> 13) & 1
+        toff = toff0 & 0x1fff
+        if toff_sign == 0:
+            toff = 0 - toff
+        f1   = (tsbk >> 16) & 0xffffffff
+        slots_per_carrier = [1,1,1,2,4,2]
+        self.freq_table[iden] = {}
+        self.freq_table[iden]['offset'] = toff * spac * 125
+        self.freq_table[iden]['step'] = spac * 125
+        self.freq_table[iden]['frequency'] = f1 * 5
+        if slots_per_carrier[channel_type] > 1:
+            self.freq_table[iden]['tdma'] = slots_per_carrier[channel_type]
+        d = {'cc_event': 'iden_up_tdma', 'iden': iden, 'offset': self.freq_table[iden]['offset'], 'step':  self.freq_table[iden]['step'], 'freq': self.freq_table[iden]['frequency'], 'slots': slots_per_carrier[channel_type], 'opcode': opcode }
+        self.post_event(d)          
+        if self.debug > 10:
+            sys.stderr.write('tsbk33 iden up tdma id %d f %d offset %d spacing %d slots/carrier %d\n' % (iden, self.freq_table[iden]['frequency'], self.freq_table[iden]['offset'], self.freq_table[iden]['step'], self.freq_table[iden]['tdma']))
+        return 0
+
+    def tsbk_iden_up(self, tsbk, opcode, mfrid):	# iden_up
+        iden = (tsbk >> 76) & 0xf
+        bw   = (tsbk >> 67) & 0x1ff
+        toff0 = (tsbk >> 58) & 0x1ff
+        spac = (tsbk >> 48) & 0x3ff
+        freq = (tsbk >> 16) & 0xffffffff
+        toff_sign = (toff0 >> 8) & 1
+        toff = toff0 & 0xff
+        if toff_sign == 0:
+            toff = 0 - toff
+        txt = ["mob xmit < recv", "mob xmit > recv"]
+        self.freq_table[iden] = {}
+        self.freq_table[iden]['offset'] = toff * 250000
+        self.freq_table[iden]['step'] = spac * 125
+        self.freq_table[iden]['frequency'] = freq * 5
+        d = {'cc_event': 'iden_up', 'iden': iden, 'offset': self.freq_table[iden]['offset'], 'step':  self.freq_table[iden]['step'], 'freq': self.freq_table[iden]['frequency'], 'opcode': opcode }
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk3d iden id %d toff %f spac %f freq %f\n' % (iden, toff * 0.25, spac * 0.125, freq * 0.000005))
+        return 0
+
+    def tsbk_rfss_status(self, tsbk, opcode, mfrid):	# rfss status
+        syid = (tsbk >> 56) & 0xfff
+        rfid = (tsbk >> 48) & 0xff
+        stid = (tsbk >> 40) & 0xff
+        chan = (tsbk >> 24) & 0xffff
+        f1 = self.channel_id_to_frequency(chan)
+        if f1:
+            self.rfss_syid = syid
+            self.rfss_rfid = rfid
+            self.rfss_stid = stid
+            self.rfss_chan = f1
+            self.rfss_txchan = f1 + self.freq_table[chan >> 12]['offset']
+        if self.debug > 10:
+            sys.stderr.write('tsbk3a rfss status: syid: %x rfid %x stid %d ch1 %x(%s)\n' %(syid, rfid, stid, chan, self.channel_id_to_string(chan)))
+        return 0
+
+    def tsbk_sccb_exp(self, tsbk, opcode, mfrid):	# secondary cc explicit
+        rfid = (tsbk >> 72) & 0xff	# octet 2
+        stid = (tsbk >> 64) & 0xff	# octet 3
+        ch_t = (tsbk >> 48) & 0xffff	# octet 4,5
+        ch_r = (tsbk >> 24) & 0xffff	# octet 7,8
+        ss = (tsbk >> 16) & 0xff		# octet 9
+        ft = self.channel_id_to_frequency(ch_t)
+        if ft:
+            self.secondary[ft] = 1
+        if self.debug > 10:
+            sys.stderr.write('tsbk29 sccb_exp: rfid %x stid %d %x(%s) %x(%s)\n' %(rfid, stid, ch_t, self.channel_id_to_string(ch_t), ch_r, self.channel_id_to_string(ch_r)))
+        return 0
+
+    def tsbk_time_date(self, tsbk, opcode, mfrid):	# time and date
+        flags = (tsbk >> 76) & 0xf	# octet 2 upper nib
+        local_time_offset = (tsbk >> 64) & 0xfff	# octet 2 lower nib and octet 3
+        dt = (tsbk >> 40) & 0xffffff	# octet 4-6
+        tm = (tsbk >> 16) & 0xffffff	# octet 7-9
+        # TODO: FIXME: check 'flags' bits to verify time/date/offset valid prior to use
+        yy = (dt >> 2) & 0x1fff
+        dd = (dt >> 15) & 0x1f
+        mm = (dt >> 20) & 0xf
+        hh = (tm >> 19) & 0x1f
+        mn = (tm >> 13) & 0x3f
+        ss = (tm >> 7) & 0x3f
+        if self.debug > 10:
+            sys.stderr.write('tsbk35 time and date: flags %x offset %d %02d/%02d/%02d %02d:%02d:%02d\n' % (flags, local_time_offset, yy, mm, dd, hh, mn, ss))
+        return 0
+
+    def tsbk_sccb(self, tsbk, opcode, mfrid):	# secondary cc
+        rfid = (tsbk >> 72) & 0xff
+        stid = (tsbk >> 64) & 0xff
+        ch1  = (tsbk >> 48) & 0xffff
+        ch2  = (tsbk >> 24) & 0xffff
+        f1 = self.channel_id_to_frequency(ch1)
+        f2 = self.channel_id_to_frequency(ch2)
+        if f1 and f2:
+            self.secondary[ f1 ] = 1
+            self.secondary[ f2 ] = 1
+            sorted_freqs = collections.OrderedDict(sorted(self.secondary.items()))
+            self.secondary = sorted_freqs
+        if self.debug > 10:
+            sys.stderr.write('tsbk39 secondary cc: rfid %x stid %d ch1 %x(%s) ch2 %x(%s)\n' %(rfid, stid, ch1, self.channel_id_to_string(ch1), ch2, self.channel_id_to_string(ch2)))
+        return 0
+
+    def tsbk_net_status(self, tsbk, opcode, mfrid):	# network status
+        wacn = (tsbk >> 52) & 0xfffff
+        syid = (tsbk >> 40) & 0xfff
+        ch1  = (tsbk >> 24) & 0xffff
+        f1 = self.channel_id_to_frequency(ch1)
+        if f1:
+            self.ns_syid = syid
+            self.ns_wacn = wacn
+            self.ns_chan = f1
+        if self.debug > 10:
+            sys.stderr.write('tsbk3b net stat: wacn %x syid %x ch1 %x(%s)\n' %(wacn, syid, ch1, self.channel_id_to_string(ch1)))
+        return 0
+
+    def tsbk_adjacent_status(self, tsbk, opcode, mfrid):	# adjacent status
+        syid = (tsbk >> 56) & 0xfff
+        rfid = (tsbk >> 48) & 0xff
+        stid = (tsbk >> 40) & 0xff
+        ch1  = (tsbk >> 24) & 0xffff
+        table = (ch1 >> 12) & 0xf
+        f1 = self.channel_id_to_frequency(ch1)
+        if f1 and table in self.freq_table:
+            self.update_adjacent(f1, 'rfid: %d stid:%d uplink:%f tbl:%d' % (rfid, stid, (f1 + self.freq_table[table]['offset']) / 1000000.0, table),
+                {'rfid': rfid, 'stid':stid, 'uplink': f1 + self.freq_table[table]['offset'], 'table': table, 'sysid':syid})
+        if self.debug > 10:
+            sys.stderr.write('tsbk3c adjacent: rfid %x stid %d ch1 %x(%s) sysid 0x%x\n' %(rfid, stid, ch1, self.channel_id_to_string(ch1), syid))
+            if table in self.freq_table:
+                sys.stderr.write('tsbk3c : %s %s\n' % (self.freq_table[table]['frequency'] , self.freq_table[table]['step'] ))
+        return 0
+
+    def tsbk_ack_resp_fne(self, tsbk, opcode, mfrid):	# ACK_RESP_FNE
+        aiv = (tsbk >> 79) & 1
+        ex  = (tsbk >> 78) & 1
+        addl = (tsbk >> 40) & 0xffffffff
+        wacn = None
+        sysid = None
+        srcaddr = None
+        if ex:
+            wacn = (addl > 12) & 0xfffff
+            sysid = addl & 0xfff
+        else:
+            srcaddr = addl & 0xffffff
+        target = (tsbk >> 16) & 0xffffff
+        d = {'cc_event': 'ack_resp_fne', 'aiv': aiv, 'ex': ex, 'addl': addl, 'wacn': wacn, 'tsbk_sysid': sysid, 'source': self.mk_src_dict(srcaddr), 'target': self.mk_src_dict(target), 'opcode': opcode}
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk20 ack_resp_fne: aiv %d ex %d wacn %s sysid %s src %s\n' % (aiv, ex, wacn, sysid, srcaddr))
+        return 0
+
+    def tsbk_deny_resp(self, tsbk, opcode, mfrid):	# DENY_RESP
+        aiv = (tsbk >> 79) & 1
+        reason = (tsbk >> 64) & 0xff
+        addl = (tsbk >> 40) & 0xffffff
+        target = (tsbk >> 16) & 0xffffff
+        d = {'cc_event': 'deny_resp', 'aiv': aiv, 'reason': reason, 'additional': addl, 'target': self.mk_src_dict(target), 'opcode': opcode}
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk27 deny_resp: aiv %d reason %02x additional %x target %d\n' % (aiv, reason, addl, target))
+        return 0
+
+    def tsbk_grp_aff_resp(self, tsbk, opcode, mfrid):	# grp_aff_rsp
+        lg     = (tsbk >> 79) & 0x01
+        gav    = (tsbk >> 72) & 0x03
+        aga    = (tsbk >> 56) & 0xffff
+        ga     = (tsbk >> 40) & 0xffff
+        ta     = (tsbk >> 16) & 0xffffff
+        d = {'cc_event': 'grp_aff_resp', 'affiliation': ['local', 'global'][lg], 'group_aff_value': gav, 'announce_group': self.mk_tg_dict(aga), 'group': self.mk_tg_dict(ga), 'target': self.mk_src_dict(ta), 'opcode': opcode}
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk28 grp_aff_resp: mfrid: 0x%x, gav: %d, aga: %d, ga: %d, ta: %d\n' % (mfrid, gav, aga, ga, ta))
+        return 0
+
+    def tsbk_grp_aff_q(self, tsbk, opcode, mfrid):	# GRP_AFF_Q
+        target = (tsbk >> 40) & 0xffffff
+        source = (tsbk >> 16) & 0xffffff
+        d = {'cc_event': 'grp_aff_q', 'source': self.mk_src_dict(source), 'target': self.mk_src_dict(target), 'opcode': opcode}
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk2a grp_aff_q: mfrid: 0x%x, target %d source %d\n' % (mfrid, target, source))
+        return 0
+
+    def tsbk_loc_reg_resp(self, tsbk, opcode, mfrid):	# LOC_REG_RESP
+        rv  = (tsbk >> 72) & 3
+        ga  = (tsbk >> 56) & 0xffff
+        rfss  = (tsbk >> 48) & 0xff
+        siteid  = (tsbk >> 40) & 0xff
+        target = (tsbk >> 16) & 0xffffff
+        d = {'cc_event': 'loc_reg_resp', 'rv': rv, 'rfss': rfss, 'siteid': siteid, 'group': self.mk_tg_dict(ga), 'target': self.mk_src_dict(target), 'opcode': opcode}
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk2b loc_reg_resp: mfrid: 0x%x, rv %d group %d rfss 0x%x siteid 0x%x target %d\n' % (mfrid, rv, ga, rfss, siteid, target))
+        return 0
+
+    def tsbk_u_reg_resp(self, tsbk, opcode, mfrid):	# U_REG_RESP
+        rv  = (tsbk >> 76) & 1
+        sysid = (tsbk >> 64) & 0xfff
+        target = (tsbk >> 40) & 0xffffff
+        source = (tsbk >> 16) & 0xffffff
+        d = {'cc_event': 'u_reg_resp', 'rv': rv, 'tsbk_sysid': sysid, 'source': self.mk_src_dict(source), 'target': self.mk_src_dict(target), 'opcode': opcode}
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk2c u_reg_resp: mfrid: 0x%x, rv %d sysid %x target %d source %d\n' % (mfrid, rv, sysid, target, source))
+        return 0
+
+    def tsbk_u_reg_cmd(self, tsbk, opcode, mfrid):	# U_REG_CMD
+        target = (tsbk >> 40) & 0xffffff
+        source = (tsbk >> 16) & 0xffffff
+        d = {'cc_event': 'u_reg_cmd', 'source': self.mk_src_dict(source), 'target': self.mk_src_dict(target), 'opcode': opcode}
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk2d u_reg_cmd: mfrid: 0x%x, target %d source %d\n' % (mfrid, target, source))
+        return 0
+
+    def tsbk_u_de_reg_ack(self, tsbk, opcode, mfrid):	# U_DE_REG_ACK
+        wacn  = (tsbk >> 52) & 0xfffff
+        sysid  = (tsbk >> 40) & 0xfff
+        source = (tsbk >> 16) & 0xffffff
+        d = {'cc_event': 'u_de_reg_ack', 'wacn': wacn, 'tsbk_sysid': sysid, 'source': self.mk_src_dict(source), 'opcode': opcode}
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk2f u_de_reg_ack: mfrid: 0x%x, wacn 0x%x sysid 0x%x source %d\n' % (mfrid, wacn, sysid, source))
+        return 0
+
+    def tsbk_ext_fnct_cmd(self, tsbk, opcode, mfrid):	# EXT_FNCT_CMD
+        efclass = (tsbk >> 72) & 0xff
+        efoperand = (tsbk >> 64) & 0xff
+        efargs  = (tsbk >> 40) & 0xffffff
+        target  = (tsbk >> 16) & 0xffffff
+        d = {'cc_event': 'ext_fnct_cmd', 'mfrid': mfrid, 'efclass': efclass, 'efoperand': efoperand, 'efargs': self.mk_src_dict(efargs), 'target': target, 'opcode': opcode}
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('tsbk24 ext_fnct_cmd: efclass %d efoperand %d efargs %s target %s\n' % (efclass, efoperand, efargs, target))
+        return 0
+
+    def tsbk_mot_grg_add_cmd(self, tsbk, opcode, mfrid):	# MOT_GRG_ADD_CMD
+        sg  = (tsbk >> 64) & 0xffff
+        ga1   = (tsbk >> 48) & 0xffff
+        ga2   = (tsbk >> 32) & 0xffff
+        ga3   = (tsbk >> 16) & 0xffff
+        d = {'cc_event': 'mot_grg_add_cmd', 'mfrid': mfrid, 'sg': self.mk_tg_dict(sg), 'ga1': self.mk_tg_dict(ga1), 'ga2': self.mk_tg_dict(ga2), 'ga3': self.mk_tg_dict(ga3), 'opcode': opcode }
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('MOT_GRG_ADD_CMD(0x00): sg:%d ga1:%d ga2:%d ga3:%d\n' % (sg, ga1, ga2, ga3))
+        return 0
+
+    def tsbk_mot_grg_del_cmd(self, tsbk, opcode, mfrid):	# MOT_GRG_DEL_CMD
+        sg  = (tsbk >> 64) & 0xffff
+        ga1   = (tsbk >> 48) & 0xffff
+        ga2   = (tsbk >> 32) & 0xffff
+        ga3   = (tsbk >> 16) & 0xffff
+        d = {'cc_event': 'mot_grg_del_cmd', 'mfrid': mfrid, 'sg': self.mk_tg_dict(sg), 'ga1': self.mk_tg_dict(ga1), 'ga2': self.mk_tg_dict(ga2), 'ga3': self.mk_tg_dict(ga3), 'opcode': opcode }
+        self.post_event(d)
+        if self.debug > 10:
+            sys.stderr.write('MOT_GRG_DEL_CMD(0x01): sg:%d ga1:%d ga2:%d ga3:%d\n' % (sg, ga1, ga2, ga3))
+        return 0
+
+    def tsbk_mot_grg_cn_grant(self, tsbk, opcode, mfrid):	# MOT_GRG_CN_CRANT
+        updated = 0
+        ch  = (tsbk >> 56) & 0xffff
+        sg  = (tsbk >> 40) & 0xffff
+        sa  = (tsbk >> 16) & 0xffffff
+        f = self.channel_id_to_frequency(ch)
+        uplink = self.channel_id_to_frequency(ch, uplink=True)
+        d = {'cc_event': 'mot_grg_cn_grant', 'mfrid': mfrid, 'frequency': f, 'sg': self.mk_tg_dict(sg), 'sa': self.mk_src_dict(sa), 'opcode': opcode }
+        self.post_event(d)
+        self.update_voice_frequency(f, tgid=sg, tdma_slot=self.get_tdma_slot(ch), srcaddr=sa, uplink=uplink)
+        if f:
+            updated += 1
+        if self.debug > 10:
+            sys.stderr.write('MOT_GRG_CN_GRANT(0x02): freq %s sg:%d sa:%d\n' % (self.channel_id_to_string(ch), sg, sa))
+        return updated
+
+    def tsbk_mot_grg_cn_grant_updt(self, tsbk, opcode, mfrid):	# MOT_GRG_CN_GRANT_UPDT
+        updated = 0
+        ch1   = (tsbk >> 64) & 0xffff
+        sg1  = (tsbk >> 48) & 0xffff
+        ch2   = (tsbk >> 32) & 0xffff
+        sg2  = (tsbk >> 16) & 0xffff
+        f1 = self.channel_id_to_frequency(ch1)
+        f2 = self.channel_id_to_frequency(ch2)
+        uplink1 = self.channel_id_to_frequency(ch1, uplink=True)
+        uplink2 = self.channel_id_to_frequency(ch2, uplink=True)
+        d = {'cc_event': 'mot_grg_cn_grant_updt', 'mfrid': mfrid, 'frequency1': f1, 'sg1': self.mk_tg_dict(sg1), 'opcode': opcode }
+        self.update_voice_frequency(f1, tgid=sg1, tdma_slot=self.get_tdma_slot(ch1), uplink=uplink1)
+        if f1 != f2:
+            self.update_voice_frequency(f2, tgid=sg2, tdma_slot=self.get_tdma_slot(ch2), uplink=uplink2)
+            d['sg2'] = self.mk_tg_dict(sg2)
+            d['frequency2'] = f2
+        self.post_event(d)
+        if f1:
+            updated += 1
+        if f2:
+            updated += 1
+        if self.debug > 10:
+            sys.stderr.write('MOT_GRG_CN_GRANT_UPDT(0x03): freq %s sg1:%d freq %s sg2:%d\n' % (self.channel_id_to_string(ch1), sg1, self.channel_id_to_string(ch2), sg2))
+        return updated
+
+    def tsbk_harris_grg_exenc_cmd(self, tsbk, opcode, mfrid):	# GRG_EXENC_CMD
         HARRIS_SGS_EXPIRES = 5.0	# sec.
         updated = 0
-        if opcode != 0x30: # GRG_EXENC_CMD
-            sys.stderr.write('decode_tsbk: unsupported opcode %02x mfrid %02x\n' % (opcode, mfrid))
-            return updated
         grg_options = (tsbk >> 72) & 0xff
         opt_2way = (grg_options & 0x80) == 0
         opt_group = (grg_options & 0x40) != 0
@@ -766,372 +1386,6 @@ class trunked_system (object):
             self.harris_sgs[sgkey] = {'supergroup': self.mk_tg_dict(sg), 'target_group': self.mk_tg_dict(target), 'algid': algid, 'keyid': keyid, 'expires': time.time() + HARRIS_SGS_EXPIRES}
         return updated
 
-    def decode_tsbk_mot(self, tsbk, opcode, mfrid):
-        updated = 0
-        if opcode == 0x00: # MOT_GRG_ADD_CMD
-            sg  = (tsbk >> 64) & 0xffff
-            ga1   = (tsbk >> 48) & 0xffff
-            ga2   = (tsbk >> 32) & 0xffff
-            ga3   = (tsbk >> 16) & 0xffff
-            d = {'cc_event': 'mot_grg_add_cmd', 'mfrid': mfrid, 'sg': self.mk_tg_dict(sg), 'ga1': self.mk_tg_dict(ga1), 'ga2': self.mk_tg_dict(ga2), 'ga3': self.mk_tg_dict(ga3), 'opcode': opcode }
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('MOT_GRG_ADD_CMD(0x00): sg:%d ga1:%d ga2:%d ga3:%d\n' % (sg, ga1, ga2, ga3))
-        elif opcode == 0x01: #MOT_GRG_DEL_CMD
-            sg  = (tsbk >> 64) & 0xffff
-            ga1   = (tsbk >> 48) & 0xffff
-            ga2   = (tsbk >> 32) & 0xffff
-            ga3   = (tsbk >> 16) & 0xffff
-            d = {'cc_event': 'mot_grg_del_cmd', 'mfrid': mfrid, 'sg': self.mk_tg_dict(sg), 'ga1': self.mk_tg_dict(ga1), 'ga2': self.mk_tg_dict(ga2), 'ga3': self.mk_tg_dict(ga3), 'opcode': opcode }
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('MOT_GRG_DEL_CMD(0x01): sg:%d ga1:%d ga2:%d ga3:%d\n' % (sg, ga1, ga2, ga3))
-        elif opcode == 0x02: # MOT_GRG_CN_CRANT
-            ch  = (tsbk >> 56) & 0xffff
-            sg  = (tsbk >> 40) & 0xffff
-            sa  = (tsbk >> 16) & 0xffffff
-            f = self.channel_id_to_frequency(ch)
-            uplink = self.channel_id_to_frequency(ch, uplink=True)
-            d = {'cc_event': 'mot_grg_cn_grant', 'mfrid': mfrid, 'frequency': f, 'sg': self.mk_tg_dict(sg), 'sa': self.mk_src_dict(sa), 'opcode': opcode }
-            self.post_event(d)
-            self.update_voice_frequency(f, tgid=sg, tdma_slot=self.get_tdma_slot(ch), srcaddr=sa, uplink=uplink)
-            if f:
-                updated += 1
-            if self.debug > 10:
-                sys.stderr.write('MOT_GRG_CN_GRANT(0x02): freq %s sg:%d sa:%d\n' % (self.channel_id_to_string(ch), sg, sa))
-        elif opcode == 0x03: #MOT_GRG_CN_GRANT_UPDT
-            ch1   = (tsbk >> 64) & 0xffff
-            sg1  = (tsbk >> 48) & 0xffff
-            ch2   = (tsbk >> 32) & 0xffff
-            sg2  = (tsbk >> 16) & 0xffff
-            f1 = self.channel_id_to_frequency(ch1)
-            f2 = self.channel_id_to_frequency(ch2)
-            uplink1 = self.channel_id_to_frequency(ch1, uplink=True)
-            uplink2 = self.channel_id_to_frequency(ch2, uplink=True)
-            d = {'cc_event': 'mot_grg_cn_grant_updt', 'mfrid': mfrid, 'frequency1': f1, 'sg1': self.mk_tg_dict(sg1), 'opcode': opcode }
-            self.update_voice_frequency(f1, tgid=sg1, tdma_slot=self.get_tdma_slot(ch1), uplink=uplink1)
-            if f1 != f2:
-                self.update_voice_frequency(f2, tgid=sg2, tdma_slot=self.get_tdma_slot(ch2), uplink=uplink2)
-                d['sg2'] = self.mk_tg_dict(sg2)
-                d['frequency2'] = f2
-            self.post_event(d)
-            if f1:
-                updated += 1
-            if f2:
-                updated += 1
-            if self.debug > 10:
-                sys.stderr.write('MOT_GRG_CN_GRANT_UPDT(0x03): freq %s sg1:%d freq %s sg2:%d\n' % (self.channel_id_to_string(ch1), sg1, self.channel_id_to_string(ch2), sg2))
-        else:
-            if self.debug > 10:
-                sys.stderr.write('decode_tsbk: unsupported opcode %02x mfrid %02x\n' % (opcode, mfrid))
-        return updated
-
-    def decode_tsbk(self, tsbk):
-        self.cc_timeouts = 0
-        self.last_tsbk = time.time()
-        self.stats['tsbks'] += 1
-        updated = 0
-        tsbk = tsbk << 16	# for missing crc
-        opcode = (tsbk >> 88) & 0x3f
-        mfrid = (tsbk >> 80) & 0xff # mfrid
-        if self.debug > 10:
-            sys.stderr.write('TSBK: 0x%02x 0x%024x mfrid %02x\n' % (opcode, tsbk, mfrid))
-
-        if mfrid == 0x90:
-            return self.decode_tsbk_mot(tsbk, opcode, mfrid)
-        elif mfrid == 0xa4:
-            return self.decode_tsbk_harris(tsbk, opcode, mfrid)
-        elif mfrid != 0:
-            sys.stderr.write('unsupported tsbk mfrid: 0x%02x opcode 0x%02x\n' % (mfrid, opcode))
-            return updated
-
-        if opcode == 0x00:   # group voice chan grant
-            opts  = (tsbk >> 72) & 0xff
-            ch   = (tsbk >> 56) & 0xffff
-            ga   = (tsbk >> 40) & 0xffff
-            sa   = (tsbk >> 16) & 0xffffff
-            f = self.channel_id_to_frequency(ch)
-            uplink = self.channel_id_to_frequency(ch, uplink=True)
-            d = {'cc_event': 'grp_v_ch_grant', 'mfrid': mfrid, 'options': opts, 'frequency': f, 'group': self.mk_tg_dict(ga), 'srcaddr': self.mk_src_dict(sa), 'opcode': opcode, 'tdma_slot': self.get_tdma_slot(ch) }
-            self.post_event(d)
-            self.update_voice_frequency(f, tgid=ga, tdma_slot=self.get_tdma_slot(ch), srcaddr=sa, protected=opts&64 == 64, uplink=uplink)
-            if f:
-                updated += 1
-            if self.debug > 10:
-                sys.stderr.write('tsbk00 grant freq %s ga %d sa %d\n' % (self.channel_id_to_string(ch), ga, sa))
-        elif opcode == 0x02:   # group voice chan grant update
-            ch1  = (tsbk >> 64) & 0xffff
-            ga1  = (tsbk >> 48) & 0xffff
-            ch2  = (tsbk >> 32) & 0xffff
-            ga2  = (tsbk >> 16) & 0xffff
-            f1 = self.channel_id_to_frequency(ch1)
-            f2 = self.channel_id_to_frequency(ch2)
-            uplink1 = self.channel_id_to_frequency(ch1, uplink=True)
-            uplink2 = self.channel_id_to_frequency(ch2, uplink=True)
-            d = {'cc_event': 'grp_v_ch_grant_updt', 'mfrid': mfrid, 'frequency1': f1, 'group1': self.mk_tg_dict(ga1), 'opcode': opcode, 'tdma_slot': self.get_tdma_slot(ch1) }
-            self.update_voice_frequency(f1, tgid=ga1, tdma_slot=self.get_tdma_slot(ch1), uplink=uplink1)
-            if f1 != f2:
-                self.update_voice_frequency(f2, tgid=ga2, tdma_slot=self.get_tdma_slot(ch2), uplink=uplink2)
-                d['frequency2'] = f2
-                d['group2'] = self.mk_tg_dict(ga2)
-            if f1:
-                updated += 1
-            if f2:
-                updated += 1
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk02 grant update: chan %s %d %s %d\n' %(self.channel_id_to_string(ch1), ga1, self.channel_id_to_string(ch2), ga2))
-        elif opcode == 0x03:   # group voice chan grant update exp : TIA.102-AABC-B-2005 page 56
-            opts  = (tsbk >> 72) & 0xff
-            ch1  = (tsbk >> 48) & 0xffff
-            ch2   = (tsbk >> 32) & 0xffff
-            ga  = (tsbk >> 16) & 0xffff
-            f = self.channel_id_to_frequency(ch1)
-            uplink = self.channel_id_to_frequency(ch2)
-            d = {'cc_event': 'grp_v_ch_grant_updt_exp', 'mfrid': mfrid, 'options': opts, 'frequency': f, 'group': self.mk_tg_dict(ga), 'opcode': opcode, 'tdma_slot': self.get_tdma_slot(ch1) }
-            self.post_event(d)
-            self.update_voice_frequency(f, tgid=ga, tdma_slot=self.get_tdma_slot(ch1), uplink=uplink)
-            if f:
-                updated += 1
-            if self.debug > 10:
-                sys.stderr.write('tsbk03: freq-t %s freq-r %s ga:%d\n' % (self.channel_id_to_string(ch1), self.channel_id_to_string(ch2), ga))
-
-        elif opcode == 0x16:   # sndcp data ch
-            ch1  = (tsbk >> 48) & 0xffff
-            ch2  = (tsbk >> 32) & 0xffff
-            if self.debug > 10:
-                sys.stderr.write('tsbk16 sndcp data ch: chan %x %x\n' % (ch1, ch2))
-        elif opcode == 0x34:   # iden_up vhf uhf
-            iden = (tsbk >> 76) & 0xf
-            bwvu = (tsbk >> 72) & 0xf
-            toff0 = (tsbk >> 58) & 0x3fff
-            spac = (tsbk >> 48) & 0x3ff
-            freq = (tsbk >> 16) & 0xffffffff
-            toff_sign = (toff0 >> 13) & 1
-            toff = toff0 & 0x1fff
-            if toff_sign == 0:
-                toff = 0 - toff
-            txt = ["mob Tx-", "mob Tx+"]
-            self.freq_table[iden] = {}
-            self.freq_table[iden]['offset'] = toff * spac * 125
-            self.freq_table[iden]['step'] = spac * 125
-            self.freq_table[iden]['frequency'] = freq * 5
-            d = {'cc_event': 'iden_up_vu', 'iden': iden, 'bwvu': bwvu, 'offset': self.freq_table[iden]['offset'], 'step':  self.freq_table[iden]['step'], 'freq': self.freq_table[iden]['frequency'], 'opcode': opcode }
-            self.post_event(d)                          
-            if self.debug > 10:
-                sys.stderr.write('tsbk34 iden vhf/uhf id %d toff %f spac %f freq %f [%s]\n' % (iden, toff * spac * 0.125 * 1e-3, spac * 0.125, freq * 0.000005, txt[toff_sign]))
-        elif opcode == 0x33:   # iden_up_tdma
-            iden = (tsbk >> 76) & 0xf
-            channel_type = (tsbk >> 72) & 0xf
-            toff0 = (tsbk >> 58) & 0x3fff
-            spac = (tsbk >> 48) & 0x3ff
-            toff_sign = (toff0 >> 13) & 1
-            toff = toff0 & 0x1fff
-            if toff_sign == 0:
-                toff = 0 - toff
-            f1   = (tsbk >> 16) & 0xffffffff
-            slots_per_carrier = [1,1,1,2,4,2]
-            self.freq_table[iden] = {}
-            self.freq_table[iden]['offset'] = toff * spac * 125
-            self.freq_table[iden]['step'] = spac * 125
-            self.freq_table[iden]['frequency'] = f1 * 5
-            if slots_per_carrier[channel_type] > 1:
-                self.freq_table[iden]['tdma'] = slots_per_carrier[channel_type]
-            d = {'cc_event': 'iden_up_tdma', 'iden': iden, 'offset': self.freq_table[iden]['offset'], 'step':  self.freq_table[iden]['step'], 'freq': self.freq_table[iden]['frequency'], 'slots': slots_per_carrier[channel_type], 'opcode': opcode }
-            self.post_event(d)          
-            if self.debug > 10:
-                sys.stderr.write('tsbk33 iden up tdma id %d f %d offset %d spacing %d slots/carrier %d\n' % (iden, self.freq_table[iden]['frequency'], self.freq_table[iden]['offset'], self.freq_table[iden]['step'], self.freq_table[iden]['tdma']))
-        elif opcode == 0x3d:   # iden_up
-            iden = (tsbk >> 76) & 0xf
-            bw   = (tsbk >> 67) & 0x1ff
-            toff0 = (tsbk >> 58) & 0x1ff
-            spac = (tsbk >> 48) & 0x3ff
-            freq = (tsbk >> 16) & 0xffffffff
-            toff_sign = (toff0 >> 8) & 1
-            toff = toff0 & 0xff
-            if toff_sign == 0:
-                toff = 0 - toff
-            txt = ["mob xmit < recv", "mob xmit > recv"]
-            self.freq_table[iden] = {}
-            self.freq_table[iden]['offset'] = toff * 250000
-            self.freq_table[iden]['step'] = spac * 125
-            self.freq_table[iden]['frequency'] = freq * 5
-            d = {'cc_event': 'iden_up', 'iden': iden, 'offset': self.freq_table[iden]['offset'], 'step':  self.freq_table[iden]['step'], 'freq': self.freq_table[iden]['frequency'], 'opcode': opcode }
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk3d iden id %d toff %f spac %f freq %f\n' % (iden, toff * 0.25, spac * 0.125, freq * 0.000005))
-        elif opcode == 0x3a:   # rfss status
-            syid = (tsbk >> 56) & 0xfff
-            rfid = (tsbk >> 48) & 0xff
-            stid = (tsbk >> 40) & 0xff
-            chan = (tsbk >> 24) & 0xffff
-            f1 = self.channel_id_to_frequency(chan)
-            if f1:
-                self.rfss_syid = syid
-                self.rfss_rfid = rfid
-                self.rfss_stid = stid
-                self.rfss_chan = f1
-                self.rfss_txchan = f1 + self.freq_table[chan >> 12]['offset']
-            if self.debug > 10:
-                sys.stderr.write('tsbk3a rfss status: syid: %x rfid %x stid %d ch1 %x(%s)\n' %(syid, rfid, stid, chan, self.channel_id_to_string(chan)))
-        elif opcode == 0x29:   # secondary cc explicit
-            rfid = (tsbk >> 72) & 0xff	# octet 2
-            stid = (tsbk >> 64) & 0xff	# octet 3
-            ch_t = (tsbk >> 48) & 0xffff	# octet 4,5
-            ch_r = (tsbk >> 24) & 0xffff	# octet 7,8
-            ss = (tsbk >> 16) & 0xff		# octet 9
-            ft = self.channel_id_to_frequency(ch_t)
-            if ft:
-                self.secondary[ft] = 1
-            if self.debug > 10:
-                sys.stderr.write('tsbk29 sccb_exp: rfid %x stid %d %x(%s) %x(%s)\n' %(rfid, stid, ch_t, self.channel_id_to_string(ch_t), ch_r, self.channel_id_to_string(ch_r)))
-        elif opcode == 0x35:   # time and date
-            flags = (tsbk >> 76) & 0xf	# octet 2 upper nib
-            local_time_offset = (tsbk >> 64) & 0xfff	# octet 2 lower nib and octet 3
-            dt = (tsbk >> 40) & 0xffffff	# octet 4-6
-            tm = (tsbk >> 16) & 0xffffff	# octet 7-9
-            # TODO: FIXME: check 'flags' bits to verify time/date/offset valid prior to use
-            yy = (dt >> 2) & 0x1fff
-            dd = (dt >> 15) & 0x1f
-            mm = (dt >> 20) & 0xf
-            hh = (tm >> 19) & 0x1f
-            mn = (tm >> 13) & 0x3f
-            ss = (tm >> 7) & 0x3f
-            if self.debug > 10:
-                sys.stderr.write('tsbk35 time and date: flags %x offset %d %02d/%02d/%02d %02d:%02d:%02d\n' % (flags, local_time_offset, yy, mm, dd, hh, mn, ss))
-        elif opcode == 0x39:   # secondary cc
-            rfid = (tsbk >> 72) & 0xff
-            stid = (tsbk >> 64) & 0xff
-            ch1  = (tsbk >> 48) & 0xffff
-            ch2  = (tsbk >> 24) & 0xffff
-            f1 = self.channel_id_to_frequency(ch1)
-            f2 = self.channel_id_to_frequency(ch2)
-            if f1 and f2:
-                self.secondary[ f1 ] = 1
-                self.secondary[ f2 ] = 1
-                sorted_freqs = collections.OrderedDict(sorted(self.secondary.items()))
-                self.secondary = sorted_freqs
-            if self.debug > 10:
-                sys.stderr.write('tsbk39 secondary cc: rfid %x stid %d ch1 %x(%s) ch2 %x(%s)\n' %(rfid, stid, ch1, self.channel_id_to_string(ch1), ch2, self.channel_id_to_string(ch2)))
-        elif opcode == 0x3b:   # network status
-            wacn = (tsbk >> 52) & 0xfffff
-            syid = (tsbk >> 40) & 0xfff
-            ch1  = (tsbk >> 24) & 0xffff
-            f1 = self.channel_id_to_frequency(ch1)
-            if f1:
-                self.ns_syid = syid
-                self.ns_wacn = wacn
-                self.ns_chan = f1
-            if self.debug > 10:
-                sys.stderr.write('tsbk3b net stat: wacn %x syid %x ch1 %x(%s)\n' %(wacn, syid, ch1, self.channel_id_to_string(ch1)))
-        elif opcode == 0x3c:   # adjacent status
-            syid = (tsbk >> 56) & 0xfff
-            rfid = (tsbk >> 48) & 0xff
-            stid = (tsbk >> 40) & 0xff
-            ch1  = (tsbk >> 24) & 0xffff
-            table = (ch1 >> 12) & 0xf
-            f1 = self.channel_id_to_frequency(ch1)
-            if f1 and table in self.freq_table:
-                self.adjacent[f1] = 'rfid: %d stid:%d uplink:%f tbl:%d' % (rfid, stid, (f1 + self.freq_table[table]['offset']) / 1000000.0, table)
-                self.adjacent_data[f1] = {'rfid': rfid, 'stid':stid, 'uplink': f1 + self.freq_table[table]['offset'], 'table': table, 'sysid':syid}
-            if self.debug > 10:
-                sys.stderr.write('tsbk3c adjacent: rfid %x stid %d ch1 %x(%s) sysid 0x%x\n' %(rfid, stid, ch1, self.channel_id_to_string(ch1), syid))
-                if table in self.freq_table:
-                    sys.stderr.write('tsbk3c : %s %s\n' % (self.freq_table[table]['frequency'] , self.freq_table[table]['step'] ))
-        elif opcode == 0x20:   # ACK_RESP_FNE
-            aiv = (tsbk >> 79) & 1
-            ex  = (tsbk >> 78) & 1
-            addl = (tsbk >> 40) & 0xffffffff
-            wacn = None
-            sysid = None
-            srcaddr = None
-            if ex:
-                wacn = (addl > 12) & 0xfffff
-                sysid = addl & 0xfff
-            else:
-                srcaddr = addl & 0xffffff
-            target = (tsbk >> 16) & 0xffffff
-            d = {'cc_event': 'ack_resp_fne', 'aiv': aiv, 'ex': ex, 'addl': addl, 'wacn': wacn, 'tsbk_sysid': sysid, 'source': self.mk_src_dict(srcaddr), 'target': self.mk_src_dict(target), 'opcode': opcode}
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk20 ack_resp_fne: aiv %d ex %d wacn %s sysid %s src %s\n' % (aiv, ex, wacn, sysid, srcaddr))
-        elif opcode == 0x27:   # DENY_RESP
-            aiv = (tsbk >> 79) & 1
-            reason = (tsbk >> 64) & 0xff
-            addl = (tsbk >> 40) & 0xffffff
-            target = (tsbk >> 16) & 0xffffff
-            d = {'cc_event': 'deny_resp', 'aiv': aiv, 'reason': reason, 'additional': addl, 'target': self.mk_src_dict(target), 'opcode': opcode}
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk27 deny_resp: aiv %d reason %02x additional %x target %d\n' % (aiv, reason, addl, target))
-        elif opcode == 0x28:   # grp_aff_rsp
-            lg     = (tsbk >> 79) & 0x01
-            gav    = (tsbk >> 72) & 0x03
-            aga    = (tsbk >> 56) & 0xffff
-            ga     = (tsbk >> 40) & 0xffff
-            ta     = (tsbk >> 16) & 0xffffff
-            d = {'cc_event': 'grp_aff_resp', 'affiliation': ['local', 'global'][lg], 'group_aff_value': gav, 'announce_group': self.mk_tg_dict(aga), 'group': self.mk_tg_dict(ga), 'target': self.mk_src_dict(ta), 'opcode': opcode}
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk28 grp_aff_resp: mfrid: 0x%x, gav: %d, aga: %d, ga: %d, ta: %d\n' % (mfrid, gav, aga, ga, ta))
-        elif opcode == 0x2a:   # GRP_AFF_Q
-            target = (tsbk >> 40) & 0xffffff
-            source = (tsbk >> 16) & 0xffffff
-            d = {'cc_event': 'grp_aff_q', 'source': self.mk_src_dict(source), 'target': self.mk_src_dict(target), 'opcode': opcode}
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk2a grp_aff_q: mfrid: 0x%x, target %d source %d\n' % (mfrid, target, source))
-        elif opcode == 0x2b:   # LOC_REG_RESP
-            rv  = (tsbk >> 72) & 3
-            ga  = (tsbk >> 56) & 0xffff
-            rfss  = (tsbk >> 48) & 0xff
-            siteid  = (tsbk >> 40) & 0xff
-            target = (tsbk >> 16) & 0xffffff
-            d = {'cc_event': 'loc_reg_resp', 'rv': rv, 'rfss': rfss, 'siteid': siteid, 'group': self.mk_tg_dict(ga), 'target': self.mk_src_dict(target), 'opcode': opcode}
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk2b loc_reg_resp: mfrid: 0x%x, rv %d group %d rfss 0x%x siteid 0x%x target %d\n' % (mfrid, rv, ga, rfss, siteid, target))
-        elif opcode == 0x2c:   # U_REG_RESP
-            rv  = (tsbk >> 76) & 1
-            sysid = (tsbk >> 64) & 0xfff
-            target = (tsbk >> 40) & 0xffffff
-            source = (tsbk >> 16) & 0xffffff
-            d = {'cc_event': 'u_reg_resp', 'rv': rv, 'tsbk_sysid': sysid, 'source': self.mk_src_dict(source), 'target': self.mk_src_dict(target), 'opcode': opcode}
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk2c u_reg_resp: mfrid: 0x%x, rv %d sysid %x target %d source %d\n' % (mfrid, rv, sysid, target, source))
-        elif opcode == 0x2d:   # U_REG_CMD
-            target = (tsbk >> 40) & 0xffffff
-            source = (tsbk >> 16) & 0xffffff
-            d = {'cc_event': 'u_reg_cmd', 'source': self.mk_src_dict(source), 'target': self.mk_src_dict(target), 'opcode': opcode}
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk2d u_reg_cmd: mfrid: 0x%x, target %d source %d\n' % (mfrid, target, source))
-        elif opcode == 0x2f:   # U_DE_REG_ACK
-            wacn  = (tsbk >> 52) & 0xfffff
-            sysid  = (tsbk >> 40) & 0xfff
-            source = (tsbk >> 16) & 0xffffff
-            d = {'cc_event': 'u_de_reg_ack', 'wacn': wacn, 'tsbk_sysid': sysid, 'source': self.mk_src_dict(source), 'opcode': opcode}
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk2f u_de_reg_ack: mfrid: 0x%x, wacn 0x%x sysid 0x%x source %d\n' % (mfrid, wacn, sysid, source))
-
-        elif opcode == 0x24:   # EXT_FNCT_CMD
-            efclass = (tsbk >> 72) & 0xff
-            efoperand = (tsbk >> 64) & 0xff
-            efargs  = (tsbk >> 40) & 0xffffff
-            target  = (tsbk >> 16) & 0xffffff
-            d = {'cc_event': 'ext_fnct_cmd', 'mfrid': mfrid, 'efclass': efclass, 'efoperand': efoperand, 'efargs': self.mk_src_dict(efargs), 'target': target, 'opcode': opcode}
-            self.post_event(d)
-            if self.debug > 10:
-                sys.stderr.write('tsbk24 ext_fnct_cmd: efclass %d efoperand %d efargs %s target %s\n' % (efclass, efoperand, efargs, target))
-
-
-        else:
-            if self.debug > 1:
-                sys.stderr.write('received unsupported TSBK opcode %x (%x)\n' % (opcode, tsbk))
-        return updated
-
     def hunt_cc(self, curr_time):
         # return True if a tune request for frequency=self.trunk_cc should be issued
         HUNT_HOLD_TIME = 8.0
@@ -1182,8 +1436,57 @@ class trunked_system (object):
                 'effective_time': curr_time }
         return params
 
+# TSBK and MBT dispatch tables
+# tsbk handlers are keyed by (mfrid, opcode) and called as handler(tsys, tsbk, opcode, mfrid)
+# mbt handlers are keyed by opcode and called as handler(tsys, opcode, src, header, mbt_data)
+# handlers return the number of voice channel updates (nonzero triggers a tuning decision)
+tsbk_handlers = {
+    (0x00, 0x00): trunked_system.tsbk_grp_v_ch_grant,
+    (0x00, 0x02): trunked_system.tsbk_grp_v_ch_grant_updt,
+    (0x00, 0x03): trunked_system.tsbk_grp_v_ch_grant_updt_exp,
+    (0x00, 0x16): trunked_system.tsbk_sndcp_data_ch,
+    (0x00, 0x20): trunked_system.tsbk_ack_resp_fne,
+    (0x00, 0x24): trunked_system.tsbk_ext_fnct_cmd,
+    (0x00, 0x27): trunked_system.tsbk_deny_resp,
+    (0x00, 0x28): trunked_system.tsbk_grp_aff_resp,
+    (0x00, 0x29): trunked_system.tsbk_sccb_exp,
+    (0x00, 0x2a): trunked_system.tsbk_grp_aff_q,
+    (0x00, 0x2b): trunked_system.tsbk_loc_reg_resp,
+    (0x00, 0x2c): trunked_system.tsbk_u_reg_resp,
+    (0x00, 0x2d): trunked_system.tsbk_u_reg_cmd,
+    (0x00, 0x2f): trunked_system.tsbk_u_de_reg_ack,
+    (0x00, 0x33): trunked_system.tsbk_iden_up_tdma,
+    (0x00, 0x34): trunked_system.tsbk_iden_up_vu,
+    (0x00, 0x35): trunked_system.tsbk_time_date,
+    (0x00, 0x39): trunked_system.tsbk_sccb,
+    (0x00, 0x3a): trunked_system.tsbk_rfss_status,
+    (0x00, 0x3b): trunked_system.tsbk_net_status,
+    (0x00, 0x3c): trunked_system.tsbk_adjacent_status,
+    (0x00, 0x3d): trunked_system.tsbk_iden_up,
+    (0x90, 0x00): trunked_system.tsbk_mot_grg_add_cmd,
+    (0x90, 0x01): trunked_system.tsbk_mot_grg_del_cmd,
+    (0x90, 0x02): trunked_system.tsbk_mot_grg_cn_grant,
+    (0x90, 0x03): trunked_system.tsbk_mot_grg_cn_grant_updt,
+    (0xa4, 0x30): trunked_system.tsbk_harris_grg_exenc_cmd,
+}
+
+mbt_handlers = {
+    0x00: trunked_system.mbt_grp_v_ch_grant,
+    0x31: trunked_system.mbt_auth_dmd,
+    0x3a: trunked_system.mbt_rfss_status,
+    0x3b: trunked_system.mbt_net_status,
+    0x3c: trunked_system.mbt_adjacent_status,
+}
+
+def register_tsbk_handler(mfrid, opcode, handler):
+    # add (or replace) the decoder for a vendor or standard TSBK
+    tsbk_handlers[(mfrid, opcode)] = handler
+
+def register_mbt_handler(opcode, handler):
+    mbt_handlers[opcode] = handler
+
 class rx_ctl (object):
-    def __init__(self, debug=0, frequency_set=None, conf_file=None, logfile_workers=None, send_event=None):
+    def __init__(self, debug=0, frequency_set=None, conf_file=None, logfile_workers=None, send_event=None, tsbk_file=None, call_recorder=None):
         class _states(object):
             ACQ = 0
             CC = 1
@@ -1211,6 +1514,8 @@ class rx_ctl (object):
         self.logfile_workers = logfile_workers
         self.active_talkgroups = {}
         self.working_frequencies = {}
+        self.call_recorder = call_recorder	# call_recorder.py, in place of the .wav files of the logfile workers
+        self.recordings = {}	# (frequency, tgid) -> (tsys, recording, decoder, index)
         self.xor_cache = {}
         self.last_garbage_collect = 0
         self.last_command = {'command': None, 'time': time.time()}
@@ -1218,9 +1523,14 @@ class rx_ctl (object):
             self.input_rate = self.logfile_workers[0]['demod'].input_rate
         self.enabled_nacs = None
         self.next_status_png = time.time()
+        self.status_png = None	# status_renderer, started with the first status
         self.send_event = send_event
         self.status_msg = ''
         self.next_hunt_time = time.time()
+        self.tsbk_recorder = None
+        if tsbk_file:	# raw TSBK/MBT log for offline replay (tsbk_batch.py)
+            from tsbk_batch import tsbk_recorder
+            self.tsbk_recorder = tsbk_recorder(tsbk_file)
 
         if conf_file:
             if conf_file.endswith('.tsv'):
@@ -1266,6 +1576,8 @@ class rx_ctl (object):
                     'modulation': chan['demod_type'],
                     'tgid_map': {int(tgid): chan['tgids'][tgid] for tgid in chan['tgids'].keys()}}
                   for chan in chans}
+        for chan in chans:
+            self.configs[chan['nac']].update({k: chan[k] for k in STATE_LIMITS if k in chan})
         for nac in self.configs.keys():
             self.add_trunked_system(nac)
 
@@ -1315,16 +1627,12 @@ class rx_ctl (object):
             return
         tsys = self.trunked_systems[nac]
         tgid_tags_file = self.configs[nac]['tgid_tags_file']
-        new_reg = id_registry()
-        read_tags_file(tgid_tags_file, new_reg)
-        tsys.tgid_map = new_reg
+        tsys.tgid_map = open_tags(tgid_tags_file, tsys.limits['max_id_lookups'])
         sys.stderr.write('reloaded %s nac 0x%x\n' % (tgid_tags_file, nac))
         unit_id_tags_file = self.configs[nac]['unit_id_tags_file']
         if unit_id_tags_file is None:
             return
-        new_reg = id_registry()
-        read_tags_file(unit_id_tags_file, new_reg)
-        tsys.unit_id_map = new_reg
+        tsys.unit_id_map = open_tags(unit_id_tags_file, tsys.limits['max_id_lookups'])
         sys.stderr.write('reloaded %s nac 0x%x\n' % (unit_id_tags_file, nac))
 
     def add_default_config(self, nac, cclist=[], offset=0, whitelist=None, blacklist={}, tgid_map=None, unit_id_map=None,sysname=None, center_frequency=None, modulation='cqpsk'):
@@ -1390,9 +1698,10 @@ class rx_ctl (object):
         return json.dumps(d)
 
     def make_status_png(self):
+        # only the text is made here; status_renderer draws and saves it
+        # in the background, unless it is the same as last time
         PNG_UPDATE_INTERVAL = 1.0
         output_file = '../www/images/status.png'
-        tmp_output_file = '../www/images/tmp-status.png'
         if time.time() < self.next_status_png:
             return
         self.next_status_png = time.time() + PNG_UPDATE_INTERVAL
@@ -1401,14 +1710,16 @@ class rx_ctl (object):
         status_str += self.to_string()
         status = status_str.split('\n')
         status = [s for s in status if not s.startswith('tbl-id')]
-        create_image(status, imgfile=tmp_output_file, bgcolor="#c0c0c0", windowsize=(640,480))
-        if not os.access(tmp_output_file, os.R_OK):
-            return
-        os.rename(tmp_output_file, output_file)
+        if self.status_png is None:
+            imgfile = output_file if os.access(os.path.dirname(output_file), os.W_OK) else None
+            self.status_png = status_renderer('status.png', imgfile=imgfile, bgcolor="#c0c0c0", windowsize=(640,480))
+        self.status_png.update(status)
 
     def frequency_tracking_expire(self):
+        curr_time = time.time()
         for nac in self.trunked_systems.keys():
             self.trunked_systems[nac].frequency_tracking_expire()
+            self.trunked_systems[nac].expire_talkgroups(curr_time)	# by age, also while none is updated (cheap: looks at the oldest)
 
     def in_voice_state(self):
         rc = self.current_state == self.states.TO_VC or self.current_state == self.states.VC
@@ -1418,6 +1729,12 @@ class rx_ctl (object):
         for nac in self.trunked_systems.keys():
             self.trunked_systems[nac].dump_tgids()
 
+    def close(self):
+        recorder = self.tsbk_recorder
+        self.tsbk_recorder = None	# late queue messages skip the closed file
+        if recorder is not None:
+            recorder.close()
+
     def to_string(self):
         s = ''
         for nac in self.trunked_systems:
@@ -1529,6 +1846,9 @@ class rx_ctl (object):
             sys.stderr.write('received invalid nac 0xffff, mtype %d msgq_id %s\n' % (mtype, msgq_id))
             return
         s = s[2:]
+        recorder = self.tsbk_recorder
+        if recorder is not None and (mtype == 7 or mtype == 12):
+            recorder.write(curr_time, nac, mtype, s)
         if self.debug > 10:
             sys.stderr.write('nac %x type %d at %f state %d len %d\n' %(nac, mtype, time.time(), self.current_state, len(s)))
         if (mtype == 7 or mtype == 12) and nac not in self.trunked_systems:
@@ -1604,9 +1924,45 @@ class rx_ctl (object):
         index = tdma_slot
         if tdma_slot is None:
             index = 0
+        self.end_recording(frequency, tgid, curr_time)
         self.working_frequencies[frequency]['tgids'].pop(tgid)
         sys.stderr.write('%f release tgid %d frequency %d\n' % (curr_time, tgid, frequency))
 
+    def find_call(self, tsys, frequency, tgid, index):
+        # the frequency_tracking call record of tgid on frequency and slot, if any
+        freq = tsys.frequency_table.get(frequency)
+        if freq is None:
+            return None
+        call = freq['calls'][index]
+        if call is None or call['tgid']['tg_id'] != tgid:
+            return None
+        return call
+
+    def start_recording(self, tsys, frequency, tgid, tdma_slot, decoder, index, curr_time):
+        self.end_recording(frequency, tgid, curr_time)	# slot switch
+        call = self.find_call(tsys, frequency, tgid, index)
+        rec = self.call_recorder.start_call(tgid, frequency=frequency, slot=tdma_slot, sysid=tsys.rfss_syid, nac=self.current_nac,
+                                            srcaddr=call['srcaddr']['unit_id'] if call else None,
+                                            encrypted=call['protected'] if call else None,
+                                            tag=tsys.get_tag(tgid), start=curr_time)
+        decoder.set_recording(rec, index=index)
+        self.recordings[(frequency, tgid)] = (tsys, rec, decoder, index)
+
+    def end_recording(self, frequency, tgid, curr_time):
+        # the talkgroup is released TGID_HOLD_TIME after its last grant: the
+        # call ended when its record was last active
+        entry = self.recordings.pop((frequency, tgid), None)
+        if entry is None:
+            return
+        tsys, rec, decoder, index = entry
+        decoder.set_recording(None, index=index)
+        call = self.find_call(tsys, frequency, tgid, index)
+        if call is None:
+            self.call_recorder.end_call(rec, end=curr_time)
+            return
+        self.call_recorder.end_call(rec, end=max(rec.meta['start'], min(call['last_active'], curr_time)),
+                                    srcaddr=call['srcaddr']['unit_id'], encrypted=call['protected'])
+
     def logging_scheduler(self, curr_time):
         tsys = self.trunked_systems[self.current_nac]
         for tgid in tsys.get_updated_talkgroups(curr_time):
@@ -1652,7 +2008,7 @@ class rx_ctl (object):
             self.working_frequencies[frequency]['tgids'][tgid] = {'updated': curr_time, 'tdma_slot': tdma_slot}
             if not update:
                 continue
-            filename = 'tgid-%d-%f.wav' % (tgid, curr_time)
+            filename = 'tgid-%d-%f.wav' % (tgid, curr_time) if self.call_recorder is None else self.call_recorder.directory
             sys.stderr.write('%f update frequency %d tg %d slot %s file %s\n' % (curr_time, frequency, tgid, tdma_slot, filename))
             # set demod speed, decoder slot, output file name
             demod = worker['demod']
@@ -1670,7 +2026,10 @@ class rx_ctl (object):
                 decoder.set_xormask(self.xor_cache[xorhash], xorhash, index=index)
                 decoder.set_nac(self.current_nac, index=index)
             demod.set_omega(symbol_rate)
-            decoder.set_output(filename, index=index)
+            if self.call_recorder is None:
+                decoder.set_output(filename, index=index)
+            else:
+                self.start_recording(tsys, frequency, tgid, tdma_slot, decoder, index, curr_time)
 
         # garbage collection
         if self.last_garbage_collect + 1 > curr_time:
@@ -1921,7 +2280,70 @@ class rx_ctl (object):
             self.status_msg = 'F %f TG %s %s at %s\n' % (params['freq'] / 1000000.0, params['tgid'], params['tag'], time.asctime())
             self.set_frequency(params)
 
+def _mk_tsbk(opcode, mfrid, *fields):
+    # build a crc-less TSBK as passed to decode_tsbk(); fields are
+    # (value, shift) pairs using the bit positions seen inside decode_tsbk
+    t = (opcode << 88) | (mfrid << 80)
+    for val, shift in fields:
+        t |= val << shift
+    return t >> 16
+
+def synthetic_tsbk_corpus(n=20000):
+    import random
+    rng = random.Random(25)
+    setup = [_mk_tsbk(0x3d, 0, (1, 76), (0x64, 67), (0x114, 58), (100, 48), (851006250 // 5, 16)),	# iden_up
+             _mk_tsbk(0x3a, 0, (0x3ae, 56), (1, 48), (1, 40), (0x1010, 24)),	# rfss status
+             _mk_tsbk(0x3b, 0, (0xbee00, 52), (0x3ae, 40), (0x1010, 24))]	# network status
+    mix = [(40, lambda: _mk_tsbk(0x02, 0, (0x1000 + rng.randrange(28), 64), (rng.randrange(1, 2000), 48), (0x1000 + rng.randrange(28), 32), (rng.randrange(1, 2000), 16))),
+           (15, lambda: _mk_tsbk(0x00, 0, (0, 72), (0x1000 + rng.randrange(28), 56), (rng.randrange(1, 2000), 40), (rng.randrange(1, 1 << 24), 16))),
+           (10, lambda: setup[rng.randrange(1, 3)]),
+           (5, lambda: _mk_tsbk(0x3c, 0, (0x3ae, 56), (1, 48), (rng.randrange(2, 20), 40), (0x1020 + rng.randrange(8), 24))),
+           (5, lambda: _mk_tsbk(0x39, 0, (1, 72), (1, 64), (0x1011, 48), (0x1012, 24))),
+           (10, lambda: _mk_tsbk(0x28, 0, (0, 79), (0, 72), (0, 56), (rng.randrange(1, 2000), 40), (rng.randrange(1, 1 << 24), 16))),
+           (5, lambda: _mk_tsbk(0x2c, 0, (0, 76), (0x3ae, 64), (rng.randrange(1, 1 << 24), 40), (rng.randrange(1, 1 << 24), 16))),
+           (5, lambda: _mk_tsbk(0x2f, 0, (0xbee00, 52), (0x3ae, 40), (rng.randrange(1, 1 << 24), 16))),
+           (5, lambda: _mk_tsbk(0x03, 0x90, (0x1000 + rng.randrange(28), 64), (rng.randrange(1, 2000), 48), (0x1000 + rng.randrange(28), 32), (rng.randrange(1, 2000), 16)))]
+    weights = []
+    for w, fn in mix:
+        weights += [fn] * w
+    return setup + [rng.choice(weights)() for i in range(n)]
+
+def read_tsbk_corpus(filename):
+    # one TSBK per line, either as hex (crc-less, as passed to decode_tsbk)
+    # or as a "TSBK: 0x.. 0x.. mfrid .." line from the -v 11 debug log
+    corpus = []
+    with open(filename) as f:
+        for line in f:
+            a = line.split()
+            if not a:
+                continue
+            if a[0] == 'TSBK:':
+                corpus.append(int(a[2], 16) >> 16)
+            else:
+                corpus.append(int(a[0], 16))
+    return corpus
+
+def bench_tsbk(corpus_file=None, passes=5):
+    if corpus_file:
+        corpus = read_tsbk_corpus(corpus_file)
+    else:
+        corpus = synthetic_tsbk_corpus()
+    tsys = trunked_system(debug=0, send_event=lambda d: None)
+    best = None
+    for i in range(passes):
+        t0 = time.time()
+        for tsbk in corpus:
+            tsys.decode_tsbk(tsbk)
+        elapsed = time.time() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    sys.stderr.write('decode_tsbk: %d tsbks, best of %d passes: %.0f ns/tsbk\n' % (len(corpus), passes, best * 1e9 / len(corpus)))
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench_tsbk(sys.argv[2] if len(sys.argv) > 2 else None)
+        return
+
     q = 0x3a000012ae01013348704a54
     rc = crc16(q,12)
     sys.stderr.write('should be zero: %x\n' % rc)
@@ -0,0 +1,816 @@
+#! /usr/bin/env python
+
+# This file is part of OP25
+#
+# OP25 is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# OP25 is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OP25; see the file COPYING. If not, write to the Free
+# Software Foundation, Inc., 51 Franklin Street, Boston, MA
+# 02110-1301, USA.
+
+# Offline control channel replay.
+#
+# rx_ctl can record every TSBK and MBT it receives (rx.py --tsbk-file) as
+# fixed size records.  decode_records() turns a file of those records back
+# into the cc_events the live path would have posted.  The common TSBKs
+# (grants, registrations, affiliations, ...) are decoded a whole column at
+# a time with numpy; the rest (iden_up, status, MBT, unknown opcodes) still
+# go through the trunked_system handlers, which also supply the frequency
+# tables and sysid in effect at each record.  Call tracking (end_call) is
+# replayed afterwards in record order.
+#
+# Call tracking is the slow part: it runs frequency_tracking() once per
+# grant or update, as live, and takes about 13 us/record against 2 us
+# without it (live decoding is about 45 us/record).  It is on by default
+# so that a replay posts the same events as live; nocalls skips it and
+# leaves out end_call.  Only the call state of the trunked_system is
+# replayed, not the per-talkgroup display state.
+#
+# usage:
+#     ./tsbk_batch.py [check]                         self check against decode_tsbk()
+#     ./tsbk_batch.py replay <file> [nocalls]         decode a record file, print event counts
+#     ./tsbk_batch.py bench [<file>]                  decode throughput
+#     ./sql_dbi.py replay_tsbk <file> [nocalls]       decode a record file into the database
+
+import sys
+import time
+import bisect
+import struct
+import collections
+
+import numpy as np
+
+import trunking
+from trunking import get_ordinals
+from emap import events_map, cc_events, event_columns
+
+RECORD_DATA_LEN = 50
+RECORD_FMT = '<dHhH%ds' % RECORD_DATA_LEN
+record_dtype = np.dtype([('time', '<f8'), ('nac', '<u2'), ('mtype', '<i2'), ('length', '<u2'), ('data', 'u1', (RECORD_DATA_LEN,))])
+
+DATA_STORE_COLUMNS = 'time cc_event opcode sysid mfrid p p2 p3 wacn frequency tgid tgid2 suid suid2 tsbk_sysid'.split()
+
+# ordering of events posted while handling one record
+SEQ_EXPIRE = 0		# frequency_tracking_expire() ahead of the record
+SEQ_PRE_EVENT = 1	# call tracking done before the event is posted
+SEQ_EVENT = 2
+SEQ_POST_EVENT = 3	# call tracking done after the event is posted
+
+class tsbk_recorder(object):
+    def __init__(self, filename):
+        self.fp = open(filename, 'ab')
+        self.records = 0
+        self.dropped = 0
+        self.next_flush = time.time() + 1.0
+
+    def write(self, t, nac, mtype, s):
+        # s is the message text following the nac, as seen by rx_ctl.process_qmsg()
+        if len(s) > RECORD_DATA_LEN:
+            self.dropped += 1
+            return
+        self.fp.write(struct.pack(RECORD_FMT, t, nac, mtype, len(s), s))
+        self.records += 1
+        if t > self.next_flush:
+            self.fp.flush()
+            self.next_flush = t + 1.0
+
+    def close(self):
+        self.fp.close()
+
+def load_records(filename):
+    return np.fromfile(filename, dtype=record_dtype)
+
+def make_records(msgs):
+    # msgs: iterable of (time, nac, mtype, message text)
+    msgs = list(msgs)
+    records = np.zeros(len(msgs), dtype=record_dtype)
+    for i, (t, nac, mtype, s) in enumerate(msgs):
+        records[i] = (t, nac, mtype, len(s), np.frombuffer(s.ljust(RECORD_DATA_LEN, b'\0'), dtype=np.uint8))
+    return records
+
+class _replay_clock(object):
+    # stands in for the time module inside trunking during a replay so
+    # that handlers stamp events and call state with the recorded time
+    def __init__(self):
+        self.now = 0.0
+        self.row = 0
+        self.seq = SEQ_EVENT
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class _column(object):
+    # one event field for a block of rows.  kind is 'const', 'int', 'tg', 'src'
+    # or 'aff'; rows where valid is False give None, rows where omit is True
+    # leave the key out of the event
+    def __init__(self, kind, values, valid=None, omit=None):
+        self.kind = kind
+        self.values = values
+        self.valid = valid
+        self.omit = omit
+
+class _freq_snapshots(object):
+    # trunked_system.freq_table and rfss_syid after each sequentially handled record
+    def __init__(self):
+        self.rows = []
+        self.syid = []
+        self.tables = []
+
+    def add(self, row, tsys):
+        self.rows.append(row)
+        self.syid.append(tsys.rfss_syid if tsys.rfss_syid else 0)
+        self.tables.append(dict([(k, dict(v)) for k, v in tsys.freq_table.items()]))
+
+    def changed(self, tsys):
+        syid = tsys.rfss_syid if tsys.rfss_syid else 0
+        return syid != self.syid[-1] or tsys.freq_table != self.tables[-1]
+
+    def finish(self):
+        n = len(self.rows)
+        self.row_array = np.array(self.rows, dtype=np.int64)
+        self.syid_array = np.array(self.syid, dtype=np.int64)
+        self.present = np.zeros((n, 16), dtype=bool)
+        self.base = np.zeros((n, 16), dtype=np.int64)
+        self.step = np.zeros((n, 16), dtype=np.int64)
+        self.offset = np.zeros((n, 16), dtype=np.int64)
+        self.tdma = np.zeros((n, 16), dtype=np.int64)
+        for i, table in enumerate(self.tables):
+            for k, v in table.items():
+                self.present[i, k] = True
+                self.base[i, k] = v['frequency']
+                self.step[i, k] = v['step']
+                self.offset[i, k] = v['offset']
+                self.tdma[i, k] = v.get('tdma', 0)
+
+    def segment(self, rows):
+        return np.searchsorted(self.row_array, rows, side='left') - 1
+
+class _tsbk_fields(object):
+    # vectorized bit field access for a block of TSBKs with the same (mfrid, opcode)
+    def __init__(self, body, seg, snap, mfrid, opcode):
+        self.body = body
+        self.seg = seg
+        self.snap = snap
+        self.mfrid = mfrid
+        self.opcode = opcode
+
+    def field(self, shift, mask):
+        # shift as used in decode_tsbk, i.e. after tsbk << 16
+        return ((self.body >> np.uint64(shift - 16)) & np.uint64(mask)).astype(np.int64)
+
+    def freq(self, ch, uplink=False):
+        # vectorized trunked_system.channel_id_to_frequency()
+        table = (ch >> 12) & 0xf
+        channel = ch & 0xfff
+        tdma = self.snap.tdma[self.seg, table]
+        f = self.snap.base[self.seg, table] + self.snap.step[self.seg, table] * np.where(tdma > 0, channel // np.maximum(tdma, 1), channel)
+        if uplink:
+            f = f + self.snap.offset[self.seg, table]
+        return f, self.snap.present[self.seg, table]
+
+    def slot(self, ch):
+        # vectorized trunked_system.get_tdma_slot()
+        table = (ch >> 12) & 0xf
+        valid = self.snap.present[self.seg, table] & (self.snap.tdma[self.seg, table] > 0)
+        return ch & 1, valid
+
+# vectorized equivalents of the trunked_system.tsbk_* handlers.  Each returns
+# (columns, calls): the event fields in the order the handler builds them,
+# and the update_voice_frequency() calls it makes as tuples of
+# (seq, rows mask, frequency, tgid, tdma_slot, srcaddr, protected, uplink)
+# where each value is None or (values, valid)
+
+def _grp_v_ch_grant(t):
+    opts = t.field(72, 0xff)
+    ch = t.field(56, 0xffff)
+    ga = t.field(40, 0xffff)
+    sa = t.field(16, 0xffffff)
+    f = t.freq(ch)
+    slot = t.slot(ch)
+    columns = [('mfrid', _column('const', t.mfrid)),
+               ('options', _column('int', opts)),
+               ('frequency', _column('int', f[0], f[1])),
+               ('group', _column('tg', ga)),
+               ('srcaddr', _column('src', sa)),
+               ('opcode', _column('const', t.opcode)),
+               ('tdma_slot', _column('int', slot[0], slot[1]))]
+    calls = [(SEQ_POST_EVENT, None, f, (ga, None), slot, (sa, None), ((opts & 64) == 64, None), t.freq(ch, uplink=True))]
+    return columns, calls
+
+def _grp_v_ch_grant_updt(t):
+    ch1 = t.field(64, 0xffff)
+    ga1 = t.field(48, 0xffff)
+    ch2 = t.field(32, 0xffff)
+    ga2 = t.field(16, 0xffff)
+    f1 = t.freq(ch1)
+    f2 = t.freq(ch2)
+    differ = np.where(f1[1] & f2[1], f1[0] != f2[0], f1[1] != f2[1])
+    columns = [('mfrid', _column('const', t.mfrid)),
+               ('frequency1', _column('int', f1[0], f1[1])),
+               ('group1', _column('tg', ga1)),
+               ('opcode', _column('const', t.opcode)),
+               ('tdma_slot', _column('int', *t.slot(ch1))),
+               ('frequency2', _column('int', f2[0], f2[1], ~differ)),
+               ('group2', _column('tg', ga2, None, ~differ))]
+    calls = [(SEQ_PRE_EVENT, None, f1, (ga1, None), t.slot(ch1), None, None, t.freq(ch1, uplink=True)),
+             (SEQ_PRE_EVENT, differ, f2, (ga2, None), t.slot(ch2), None, None, t.freq(ch2, uplink=True))]
+    return columns, calls
+
+def _grp_v_ch_grant_updt_exp(t):
+    opts = t.field(72, 0xff)
+    ch1 = t.field(48, 0xffff)
+    ch2 = t.field(32, 0xffff)
+    ga = t.field(16, 0xffff)
+    f = t.freq(ch1)
+    slot = t.slot(ch1)
+    columns = [('mfrid', _column('const', t.mfrid)),
+               ('options', _column('int', opts)),
+               ('frequency', _column('int', f[0], f[1])),
+               ('group', _column('tg', ga)),
+               ('opcode', _column('const', t.opcode)),
+               ('tdma_slot', _column('int', slot[0], slot[1]))]
+    calls = [(SEQ_POST_EVENT, None, f, (ga, None), slot, None, None, t.freq(ch2))]
+    return columns, calls
+
+def _ack_resp_fne(t):
+    aiv = t.field(79, 1)
+    ex = t.field(78, 1)
+    addl = t.field(40, 0xffffffff)
+    columns = [('aiv', _column('int', aiv)),
+               ('ex', _column('int', ex)),
+               ('addl', _column('int', addl)),
+               ('wacn', _column('int', (addl > 12) & 0xfffff, ex == 1)),	# as computed by tsbk_ack_resp_fne
+               ('tsbk_sysid', _column('int', addl & 0xfff, ex == 1)),
+               ('source', _column('src', addl & 0xffffff, ex == 0)),
+               ('target', _column('src', t.field(16, 0xffffff))),
+               ('opcode', _column('const', t.opcode))]
+    return columns, []
+
+def _ext_fnct_cmd(t):
+    columns = [('mfrid', _column('const', t.mfrid)),
+               ('efclass', _column('int', t.field(72, 0xff))),
+               ('efoperand', _column('int', t.field(64, 0xff))),
+               ('efargs', _column('src', t.field(40, 0xffffff))),
+               ('target', _column('int', t.field(16, 0xffffff))),
+               ('opcode', _column('const', t.opcode))]
+    return columns, []
+
+def _deny_resp(t):
+    columns = [('aiv', _column('int', t.field(79, 1))),
+               ('reason', _column('int', t.field(64, 0xff))),
+               ('additional', _column('int', t.field(40, 0xffffff))),
+               ('target', _column('src', t.field(16, 0xffffff))),
+               ('opcode', _column('const', t.opcode))]
+    return columns, []
+
+def _grp_aff_resp(t):
+    columns = [('affiliation', _column('aff', t.field(79, 1))),
+               ('group_aff_value', _column('int', t.field(72, 3))),
+               ('announce_group', _column('tg', t.field(56, 0xffff))),
+               ('group', _column('tg', t.field(40, 0xffff))),
+               ('target', _column('src', t.field(16, 0xffffff))),
+               ('opcode', _column('const', t.opcode))]
+    return columns, []
+
+def _grp_aff_q(t):
+    columns = [('source', _column('src', t.field(16, 0xffffff))),
+               ('target', _column('src', t.field(40, 0xffffff))),
+               ('opcode', _column('const', t.opcode))]
+    return columns, []
+
+def _loc_reg_resp(t):
+    columns = [('rv', _column('int', t.field(72, 3))),
+               ('rfss', _column('int', t.field(48, 0xff))),
+               ('siteid', _column('int', t.field(40, 0xff))),
+               ('group', _column('tg', t.field(56, 0xffff))),
+               ('target', _column('src', t.field(16, 0xffffff))),
+               ('opcode', _column('const', t.opcode))]
+    return columns, []
+
+def _u_reg_resp(t):
+    columns = [('rv', _column('int', t.field(76, 1))),
+               ('tsbk_sysid', _column('int', t.field(64, 0xfff))),
+               ('source', _column('src', t.field(16, 0xffffff))),
+               ('target', _column('src', t.field(40, 0xffffff))),
+               ('opcode', _column('const', t.opcode))]
+    return columns, []
+
+def _u_reg_cmd(t):
+    columns = [('source', _column('src', t.field(16, 0xffffff))),
+               ('target', _column('src', t.field(40, 0xffffff))),
+               ('opcode', _column('const', t.opcode))]
+    return columns, []
+
+def _u_de_reg_ack(t):
+    columns = [('wacn', _column('int', t.field(52, 0xfffff))),
+               ('tsbk_sysid', _column('int', t.field(40, 0xfff))),
+               ('source', _column('src', t.field(16, 0xffffff))),
+               ('opcode', _column('const', t.opcode))]
+    return columns, []
+
+def _mot_grg_cmd(t):
+    columns = [('mfrid', _column('const', t.mfrid)),
+               ('sg', _column('tg', t.field(64, 0xffff))),
+               ('ga1', _column('tg', t.field(48, 0xffff))),
+               ('ga2', _column('tg', t.field(32, 0xffff))),
+               ('ga3', _column('tg', t.field(16, 0xffff))),
+               ('opcode', _column('const', t.opcode))]
+    return columns, []
+
+def _mot_grg_cn_grant(t):
+    ch = t.field(56, 0xffff)
+    sg = t.field(40, 0xffff)
+    sa = t.field(16, 0xffffff)
+    f = t.freq(ch)
+    columns = [('mfrid', _column('const', t.mfrid)),
+               ('frequency', _column('int', f[0], f[1])),
+               ('sg', _column('tg', sg)),
+               ('sa', _column('src', sa)),
+               ('opcode', _column('const', t.opcode))]
+    calls = [(SEQ_POST_EVENT, None, f, (sg, None), t.slot(ch), (sa, None), None, t.freq(ch, uplink=True))]
+    return columns, calls
+
+def _mot_grg_cn_grant_updt(t):
+    ch1 = t.field(64, 0xffff)
+    sg1 = t.field(48, 0xffff)
+    ch2 = t.field(32, 0xffff)
+    sg2 = t.field(16, 0xffff)
+    f1 = t.freq(ch1)
+    f2 = t.freq(ch2)
+    differ = np.where(f1[1] & f2[1], f1[0] != f2[0], f1[1] != f2[1])
+    columns = [('mfrid', _column('const', t.mfrid)),
+               ('frequency1', _column('int', f1[0], f1[1])),
+               ('sg1', _column('tg', sg1)),
+               ('opcode', _column('const', t.opcode)),
+               ('sg2', _column('tg', sg2, None, ~differ)),
+               ('frequency2', _column('int', f2[0], f2[1], ~differ))]
+    calls = [(SEQ_PRE_EVENT, None, f1, (sg1, None), t.slot(ch1), None, None, t.freq(ch1, uplink=True)),
+             (SEQ_PRE_EVENT, differ, f2, (sg2, None), t.slot(ch2), None, None, t.freq(ch2, uplink=True))]
+    return columns, calls
+
+# (mfrid, opcode): (cc_event, stock handler, vectorized decoder).  A TSBK is only
+# decoded here while tsbk_handlers still maps it to the stock handler.
+batch_decoders = {
+    (0x00, 0x00): ('grp_v_ch_grant', trunking.trunked_system.tsbk_grp_v_ch_grant, _grp_v_ch_grant),
+    (0x00, 0x02): ('grp_v_ch_grant_updt', trunking.trunked_system.tsbk_grp_v_ch_grant_updt, _grp_v_ch_grant_updt),
+    (0x00, 0x03): ('grp_v_ch_grant_updt_exp', trunking.trunked_system.tsbk_grp_v_ch_grant_updt_exp, _grp_v_ch_grant_updt_exp),
+    (0x00, 0x20): ('ack_resp_fne', trunking.trunked_system.tsbk_ack_resp_fne, _ack_resp_fne),
+    (0x00, 0x24): ('ext_fnct_cmd', trunking.trunked_system.tsbk_ext_fnct_cmd, _ext_fnct_cmd),
+    (0x00, 0x27): ('deny_resp', trunking.trunked_system.tsbk_deny_resp, _deny_resp),
+    (0x00, 0x28): ('grp_aff_resp', trunking.trunked_system.tsbk_grp_aff_resp, _grp_aff_resp),
+    (0x00, 0x2a): ('grp_aff_q', trunking.trunked_system.tsbk_grp_aff_q, _grp_aff_q),
+    (0x00, 0x2b): ('loc_reg_resp', trunking.trunked_system.tsbk_loc_reg_resp, _loc_reg_resp),
+    (0x00, 0x2c): ('u_reg_resp', trunking.trunked_system.tsbk_u_reg_resp, _u_reg_resp),
+    (0x00, 0x2d): ('u_reg_cmd', trunking.trunked_system.tsbk_u_reg_cmd, _u_reg_cmd),
+    (0x00, 0x2f): ('u_de_reg_ack', trunking.trunked_system.tsbk_u_de_reg_ack, _u_de_reg_ack),
+    (0x90, 0x00): ('mot_grg_add_cmd', trunking.trunked_system.tsbk_mot_grg_add_cmd, _mot_grg_cmd),
+    (0x90, 0x01): ('mot_grg_del_cmd', trunking.trunked_system.tsbk_mot_grg_del_cmd, _mot_grg_cmd),
+    (0x90, 0x02): ('mot_grg_cn_grant', trunking.trunked_system.tsbk_mot_grg_cn_grant, _mot_grg_cn_grant),
+    (0x90, 0x03): ('mot_grg_cn_grant_updt', trunking.trunked_system.tsbk_mot_grg_cn_grant_updt, _mot_grg_cn_grant_updt),
+}
+
+class _event_block(object):
+    # events of one cc_event type decoded by a batch decoder
+    def __init__(self, tsys, cc_event, rows, times, sysids, columns):
+        self.tsys = tsys
+        self.cc_event = cc_event
+        self.rows = rows
+        self.times = times
+        self.sysids = sysids
+        self.columns = columns
+
+    def event(self, i, lists):
+        # lists: from pylists()
+        values, times, sysids = lists
+        d = {'cc_event': self.cc_event}
+        for (key, c), v in zip(self.columns, values):
+            if c.omit is not None and c.omit[i]:
+                continue
+            if c.kind != 'const':
+                v = v[i]
+            if c.valid is not None and not c.valid[i]:
+                v = None
+            if c.kind == 'tg':
+                v = self.tsys.mk_tg_dict(v)
+            elif c.kind == 'src':
+                v = self.tsys.mk_src_dict(v)
+            elif c.kind == 'aff':
+                v = ['local', 'global'][v]
+            d[key] = v
+        d['json_type'] = 'cc_event'
+        d['sysid'] = sysids[i]
+        d['sysname'] = self.tsys.sysname
+        d['time'] = times[i]
+        d['nac'] = self.tsys.nac
+        return d
+
+    def pylists(self):
+        values = [c.values if c.kind == 'const' else c.values.tolist() for key, c in self.columns]
+        return values, self.times.tolist(), self.sysids.tolist()
+
+    def data_store_columns(self):
+        # returns object array (rows x DATA_STORE_COLUMNS) for the data_store table
+        n = len(self.rows)
+        out = np.empty((n, len(DATA_STORE_COLUMNS)), dtype=object)
+        columns = dict(self.columns)
+        for colname, k in events_map[self.cc_event]:
+            if k == 'time':
+                vals = self.times.tolist()
+            elif k == 'sysid':
+                vals = self.sysids.tolist()
+            elif k == 'cc_event':
+                vals = cc_events[self.cc_event]
+            else:
+                c = columns[k]
+                if c.kind == 'const':
+                    vals = c.values
+                else:
+                    vals = np.array(c.values.tolist(), dtype=object)
+                    if c.valid is not None:
+                        vals[~c.valid] = None
+                    if c.omit is not None:
+                        vals[c.omit] = None
+            out[:, DATA_STORE_COLUMNS.index(colname)] = vals
+        return out
+
+class cc_event_batch(object):
+    # events decoded from a record file, kept as columns per cc_event type
+    # (blocks) plus the individual events posted by trunked_system (extra).
+    # Events are ordered by record, then by seq (SEQ_*) within a record.
+    def __init__(self):
+        self.blocks = []
+        self.extra = []	# (row, seq, event)
+
+    def __len__(self):
+        return sum([len(b.rows) for b in self.blocks]) + len(self.extra)
+
+    def counts(self):
+        d = collections.defaultdict(int)
+        for b in self.blocks:
+            d[b.cc_event] += len(b.rows)
+        for row, seq, e in self.extra:
+            d[e['cc_event']] += 1
+        return d
+
+    def _order(self):
+        # returns (source, index) arrays sorted into event order; source -1 is self.extra
+        keys = [np.array([row * 4 + seq for row, seq, e in self.extra], dtype=np.int64)]
+        sources = [np.full(len(self.extra), -1, dtype=np.int64)]
+        for i, b in enumerate(self.blocks):
+            keys.append(b.rows * 4 + SEQ_EVENT)
+            sources.append(np.full(len(b.rows), i, dtype=np.int64))
+        keys = np.concatenate(keys)
+        sources = np.concatenate(sources)
+        index = np.concatenate([np.arange(len(s), dtype=np.int64) for s in [self.extra] + [b.rows for b in self.blocks]])
+        order = np.argsort(keys, kind='mergesort')
+        return sources[order], index[order]
+
+    def events(self):
+        # yields the event dicts in the order trunked_system.post_event() would send them
+        lists = [b.pylists() for b in self.blocks]
+        sources, index = self._order()
+        for src, i in zip(sources.tolist(), index.tolist()):
+            if src < 0:
+                yield self.extra[i][2]
+            else:
+                yield self.blocks[src].event(i, lists[src])
+
+    def send(self, send_event):
+        for d in self.events():
+            send_event(d)
+
+    def data_store_rows(self):
+        # returns (column names, list of row tuples) for the data_store table
+        parts = []
+        keys = []
+        rows = []
+        for row, seq, d in self.extra:
+            r = event_columns(d)
+            if r is None:
+                continue
+            out = [None] * len(DATA_STORE_COLUMNS)
+            for colname, val in zip(*r):
+                out[DATA_STORE_COLUMNS.index(colname)] = val
+            rows.append(out)
+            keys.append(row * 4 + seq)
+        if rows:
+            a = np.empty((len(rows), len(DATA_STORE_COLUMNS)), dtype=object)
+            a[:] = rows
+            parts.append(a)
+        for b in self.blocks:
+            if b.cc_event not in cc_events:
+                continue
+            parts.append(b.data_store_columns())
+            keys += (b.rows * 4 + SEQ_EVENT).tolist()
+        if not parts:
+            return DATA_STORE_COLUMNS, []
+        table = np.concatenate(parts)[np.argsort(np.array(keys, dtype=np.int64), kind='mergesort')]
+        return DATA_STORE_COLUMNS, [tuple(r) for r in table.tolist()]
+
+def decode_mbt(tsys, s):
+    # as in rx_ctl.process_qmsg()
+    header = get_ordinals(s[:10])
+    mbt_data = get_ordinals(s[12:])
+    fmt = (header >> 72) & 0x1f
+    src = (header >> 48) & 0xffffff
+    if fmt != 0x17:	# only Extended Format MBT presently supported
+        return
+    opcode = (header >> 16) & 0x3f
+    tsys.decode_mbt_data(opcode, src, header << 16, mbt_data << 32)
+
+class _replay(object):
+    def __init__(self, records, track_calls):
+        self.records = records
+        self.times = records['time'].astype(np.float64)
+        self.time_list = self.times.tolist()
+        self.track_calls = track_calls
+        self.clock = _replay_clock()
+        self.batch = cc_event_batch()
+
+    def capture(self, d):
+        if d is not None:
+            self.batch.extra.append((self.clock.row, self.clock.seq, d))
+
+    def set_clock(self, row, seq):
+        self.clock.now = self.time_list[row]
+        self.clock.row = row
+        self.clock.seq = seq
+
+    def decode_system(self, tsys, rows, first_check):
+        records = self.records
+        mtype = records['mtype'][rows]
+        length = records['length'][rows]
+        data = records['data'][rows]
+        is_tsbk = (mtype == 7) & (length == 10)
+        opcode = (data[:, 0] & 0x3f).astype(np.int64)
+        mfrid = data[:, 1].astype(np.int64)
+        key = (mfrid << 8) | opcode
+        vector = np.zeros(len(rows), dtype=bool)
+        for (m, o), (cc_event, handler, decoder) in batch_decoders.items():
+            if trunking.tsbk_handlers.get((m, o)) == handler:
+                vector |= is_tsbk & (key == ((m << 8) | o))
+        serial = np.nonzero(~vector & ((mtype == 7) | (mtype == 12)))[0]
+
+        # pass 1: records needing trunked_system state, in order.  voice
+        # frequency updates are queued and replayed with the others in pass 2
+        pending = []
+        def update_voice_frequency(*args, **kwds):
+            pending.append((self.clock.row, SEQ_POST_EVENT, args, kwds))
+        snap = _freq_snapshots()
+        snap.add(-1, tsys)
+        tsys.update_voice_frequency = update_voice_frequency
+        try:
+            for i in serial.tolist():
+                row = int(rows[i])
+                self.set_clock(row, SEQ_EVENT)
+                s = data[i, :length[i]].tobytes()
+                if mtype[i] == 7:
+                    tsys.decode_tsbk(get_ordinals(s))
+                else:
+                    decode_mbt(tsys, s)
+                if snap.changed(tsys):
+                    snap.add(row, tsys)
+        finally:
+            del tsys.update_voice_frequency
+        snap.finish()
+
+        # vectorized decode
+        body = np.ascontiguousarray(data[:, 2:10]).view('>u8').reshape(-1).astype(np.uint64)
+        calls = []
+        for (m, o), (cc_event, handler, decoder) in sorted(batch_decoders.items()):
+            sel = np.nonzero(vector & (key == ((m << 8) | o)))[0]
+            if not len(sel):
+                continue
+            brows = rows[sel].astype(np.int64)
+            seg = snap.segment(brows)
+            columns, bcalls = decoder(_tsbk_fields(body[sel], seg, snap, m, o))
+            if cc_event not in trunking.FILTERED_CC_EVENT:
+                self.batch.blocks.append(_event_block(tsys, cc_event, brows, self.times[brows], snap.syid_array[seg], columns))
+            for c in bcalls:
+                calls.append((brows, c))
+        tsys.stats['tsbks'] += int(np.count_nonzero(vector))
+        if np.count_nonzero(is_tsbk | (mtype == 12)):
+            tsys.last_tsbk = max(tsys.last_tsbk, float(self.times[rows[np.nonzero(is_tsbk | (mtype == 12))[0][-1]]]))
+            tsys.cc_timeouts = 0
+
+        # pass 2: call tracking
+        if self.track_calls:
+            self.track(tsys, snap, pending, calls, first_check)
+
+    def track(self, tsys, snap, pending, calls, first_check):
+        queue = [(row, seq, args, kwds) for row, seq, args, kwds in pending]
+        for brows, (seq, mask, f, tgid, slot, srcaddr, protected, uplink) in calls:
+            sel = np.arange(len(brows)) if mask is None else np.nonzero(mask)[0]
+            cols = []
+            for v in (f, tgid, slot, srcaddr, protected, uplink):
+                if v is None:
+                    cols.append([None] * len(sel))
+                    continue
+                vals = np.array(v[0][sel].tolist(), dtype=object)
+                if v[1] is not None:
+                    vals[~v[1][sel]] = None
+                cols.append(vals.tolist())
+            for row, fv, tg, sl, sa, pr, up in zip(brows[sel].tolist(), *cols):
+                queue.append((row, seq, (fv,), {'tgid': tg, 'tdma_slot': sl, 'srcaddr': sa, 'protected': pr, 'uplink': up}))
+        queue.sort(key=lambda q: (q[0], q[1]))	# stable: keeps handler call order within a record
+
+        # only frequency_tracking() posts events (end_call): the talkgroup
+        # and voice frequency bookkeeping of update_voice_frequency() is
+        # left out, and the expiry checks are run only when a call is due
+        final_syid = tsys.rfss_syid
+        send_event = tsys.send_event
+        tsys.send_event = self.capture
+        try:
+            checks = self.check_rows(tsys, first_check)
+            j = 0
+            syids = snap.syid_array[snap.segment(np.array([q[0] for q in queue], dtype=np.int64))].tolist()
+            for (row, seq, args, kwds), syid in zip(queue, syids):
+                j = self.expire(tsys, snap, checks, j, row)
+                if not args[0]:	# e.g., channel identifier not yet known
+                    continue
+                self.set_clock(row, seq)
+                tsys.rfss_syid = syid
+                tsys.frequency_tracking(args[0], kwds['tgid'], kwds['tdma_slot'], kwds['srcaddr'], kwds['protected'])
+            self.expire(tsys, snap, checks, j, len(self.times) - 1)
+            if checks:
+                tsys.next_frequency_tracking_expire = self.time_list[checks[-1]] + tsys.CHECK_INTERVAL
+        finally:
+            tsys.send_event = send_event
+            tsys.rfss_syid = final_syid
+
+    def check_rows(self, tsys, first_check):
+        # rx_ctl.process_qmsg() calls frequency_tracking_expire() ahead of
+        # every message: the rows at which its check runs
+        rows = []
+        k = max(first_check, bisect.bisect_left(self.time_list, tsys.next_frequency_tracking_expire))
+        while k < len(self.time_list):
+            rows.append(k)
+            k = bisect.bisect_left(self.time_list, self.time_list[k] + tsys.CHECK_INTERVAL, k + 1)
+        return rows
+
+    def expire(self, tsys, snap, checks, j, last_row):
+        # the checks from checks[j] up to and including last_row that find
+        # a call due; returns the index of the next check
+        heap = tsys.call_expire_heap
+        while j < len(checks) and checks[j] <= last_row:
+            k = checks[j]
+            if heap and heap[0][0] < self.time_list[k]:
+                self.set_clock(k, SEQ_EXPIRE)
+                tsys.rfss_syid = snap.syid[bisect.bisect_left(snap.rows, k) - 1]
+                tsys.frequency_tracking_expire(always=True)
+            j += 1
+        return j
+
+def decode_records(records, systems=None, track_calls=True, debug=0):
+    # systems: optional {nac: trunked_system}; missing nacs get a default trunked_system
+    if systems is None:
+        systems = {}
+    order = np.argsort(records['time'], kind='mergesort')
+    if np.any(order != np.arange(len(records))):
+        records = records[order]
+    replay = _replay(records, track_calls)
+    saved_time = trunking.time
+    trunking.time = replay.clock
+    try:
+        for nac in np.unique(records['nac']).tolist():
+            if nac == 0xffff:
+                continue
+            rows = np.nonzero(records['nac'] == nac)[0]
+            first_check = 0
+            if nac not in systems:
+                # as rx_ctl.add_trunked_system(): created on the first message, checked from the next one
+                systems[nac] = trunking.trunked_system(debug=debug, nac=nac)
+                first_check = int(rows[0]) + 1
+            tsys = systems[nac]
+            send_event = tsys.send_event
+            tsys.send_event = replay.capture
+            try:
+                replay.decode_system(tsys, rows, first_check)
+            finally:
+                tsys.send_event = send_event
+    finally:
+        trunking.time = saved_time
+    return replay.batch
+
+def live_events(records, debug=0):
+    # reference decode: one record at a time through trunked_system, as rx_ctl does
+    events = []
+    clock = _replay_clock()
+    systems = {}
+    saved_time = trunking.time
+    trunking.time = clock
+    try:
+        for r in records:
+            clock.now = float(r['time'])
+            for tsys in systems.values():
+                tsys.frequency_tracking_expire()
+            nac = int(r['nac'])
+            if nac == 0xffff:
+                continue
+            if nac not in systems:
+                systems[nac] = trunking.trunked_system(debug=debug, send_event=events.append, nac=nac)
+            tsys = systems[nac]
+            s = r['data'][:r['length']].tobytes()
+            if r['mtype'] == 7:
+                tsys.decode_tsbk(get_ordinals(s))
+            elif r['mtype'] == 12:
+                decode_mbt(tsys, s)
+    finally:
+        trunking.time = saved_time
+    return events
+
+def synthetic_records(n=20000, nac=0x3ae, rate=40.0):
+    import random
+    rng = random.Random(2)
+    mk = trunking._mk_tsbk
+    corpus = trunking.synthetic_tsbk_corpus(n)
+    corpus += [mk(0x33, 0, (2, 76), (3, 72), (0x114, 58), (100, 48), (852006250 // 5, 16)),	# iden_up_tdma
+               mk(0x20, 0, (1, 79), (1, 78), (0x12345678, 40), (99, 16)),	# ack_resp_fne
+               mk(0x20, 0, (1, 79), (0, 78), (0x345678, 40), (99, 16)),
+               mk(0x24, 0, (1, 72), (2, 64), (1234, 40), (99, 16)),	# ext_fnct_cmd
+               mk(0x27, 0, (1, 79), (0x2f, 64), (1234, 40), (99, 16)),	# deny_resp
+               mk(0x28, 0, (1, 79), (1, 72), (100, 56), (200, 40), (99, 16)),	# grp_aff_resp global
+               mk(0x2a, 0, (1234, 40), (99, 16)),	# grp_aff_q
+               mk(0x2b, 0, (2, 72), (100, 56), (1, 48), (2, 40), (99, 16)),	# loc_reg_resp
+               mk(0x2d, 0, (1234, 40), (99, 16)),	# u_reg_cmd
+               mk(0x00, 0x90, (100, 64), (1, 48), (2, 32), (3, 16)),	# mot_grg_add_cmd
+               mk(0x01, 0x90, (100, 64), (1, 48), (2, 32), (3, 16)),	# mot_grg_del_cmd
+               mk(0x30, 0xa4, (0x60, 72), (100, 56), (1, 40), (0x841234, 16)),	# harris grg_exenc_cmd
+               mk(0x3e, 0, (1, 16))]	# unsupported
+    for i in range(n // 10):	# grants on the tdma table
+        corpus.append(mk(0x00, 0, (0, 72), (0x2000 + rng.randrange(8), 56), (rng.randrange(1, 2000), 40), (rng.randrange(1, 1 << 24), 16)))
+        corpus.append(mk(0x02, 0x90, (0x2000 + rng.randrange(8), 56), (rng.randrange(1, 2000), 40), (rng.randrange(1, 1 << 24), 16)))
+    head = corpus[:3]
+    tail = corpus[3:]
+    rng.shuffle(tail)
+    corpus = head + tail
+    msgs = []
+    t = 1600000000.0
+    for tsbk in corpus:
+        t += rng.expovariate(rate)
+        msgs.append((t, nac, 7, struct.pack('>QH', tsbk >> 16, tsbk & 0xffff)))
+    # an mbt grant (extended format) and an mbt rfss status
+    header = (0x17 << 72) | (1234 << 48) | (0x00 << 16)
+    mbt = (0x1005 << 64) | (0x1006 << 48) | (777 << 32)
+    msgs.append((t + 0.01, nac, 12, struct.pack('>QH', header >> 16, header & 0xffff) + b'\0\0' + struct.pack('>QQ', mbt >> 64, mbt & ((1 << 64) - 1))[4:]))
+    return make_records(msgs)
+
+def check():
+    records = synthetic_records()
+    live = live_events(records)
+    batch = decode_records(records)
+    replayed = list(batch.events())
+    sys.stderr.write('%d records, %d live events, %d batch events\n' % (len(records), len(live), len(replayed)))
+    assert len(live) == len(replayed)
+    for a, b in zip(live, replayed):
+        assert a == b, '%s != %s' % (a, b)
+    rows = batch.data_store_rows()[1]
+    live_rows = [event_columns(d) for d in live]
+    live_rows = [r for r in live_rows if r is not None]
+    assert len(rows) == len(live_rows)
+    for r, (names, vals) in zip(rows, live_rows):
+        assert dict([(n, v) for n, v in zip(DATA_STORE_COLUMNS, r) if v is not None]) == dict([(n, v) for n, v in zip(names, vals) if v is not None])
+    kinds = batch.counts()
+    sys.stderr.write('ok: %s\n' % ', '.join(['%s %d' % (k, kinds[k]) for k in sorted(kinds)]))
+
+def bench(filename=None):
+    records = load_records(filename) if filename else synthetic_records(200000)
+    for track_calls in (False, True):
+        t0 = time.time()
+        batch = decode_records(records, track_calls=track_calls)
+        t1 = time.time()
+        rows = batch.data_store_rows()[1]
+        t2 = time.time()
+        sys.stderr.write('track_calls %s: %d records, %d events: decode %.2fs (%.0f ns/record), data_store rows %.2fs\n' % (track_calls, len(records), len(batch), t1 - t0, (t1 - t0) * 1e9 / len(records), t2 - t1))
+    if not filename:
+        t0 = time.time()
+        live_events(records)
+        elapsed = time.time() - t0
+        sys.stderr.write('live: %.2fs (%.0f ns/record)\n' % (elapsed, elapsed * 1e9 / len(records)))
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == 'replay':
+        batch = decode_records(load_records(sys.argv[2]), track_calls='nocalls' not in sys.argv[3:])
+        kinds = batch.counts()
+        for k in sorted(kinds):
+            print('%s\t%d' % (k, kinds[k]))
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(sys.argv[2] if len(sys.argv) > 2 else None)
+        return
+    check()
+
+if __name__ == '__main__':
+    main()
@@ -20,7 +20,25 @@
 
 import sys
 import os
+import time
 import csv
+import mmap
+import array
+import heapq
+import bisect
+import struct
+import collections
+
+# default caps on per-system state that grows with what is heard on the air;
+# each can be overridden per system in the trunking config.  0 = no limit.
+STATE_LIMITS = {
+    'max_talkgroups': 5000,		# talkgroups, least recently updated evicted first
+    'max_talkgroup_age': 0,		# sec. since last update before a talkgroup is dropped
+    'max_voice_frequencies': 256,
+    'max_frequency_tracking': 256,
+    'max_adjacent_sites': 256,
+    'max_id_lookups': 4096,		# cached wildcard/negative results per id_registry
+}
 
 def get_frequency(f):	# return frequency in Hz
     if f.find('.') == -1:	# assume in Hz
@@ -61,41 +79,93 @@ def utf_ascii(ustr):
     return (ustr.decode("utf-8")).encode("ascii", "ignore")
 
 class id_registry:
-    def __init__(self):
-        self.cache = {}
+    # ids and ranges are kept as rules in the order added, and looked up by a
+    # binary search of the disjoint intervals they flatten to (where rules
+    # overlap, the one added last wins); wildcards are looked up in a trie of
+    # their prefix digits (the first wildcard added that matches wins)
+    def __init__(self, max_lookups=STATE_LIMITS['max_id_lookups']):
+        self.ranges = []	# (first, last, {'tag', 'color'}) in the order added
+        self.intervals = None	# flatten_ranges(self.ranges) as (lo, hi, values), built on first lookup
         self.wildcards = {}
+        self.trie = [{}, None, None]	# [digit -> node, '*' rule, {len: '.' rule}], rule = (order, id_str)
+        self.lookups = collections.OrderedDict()	# wildcard matches and misses, least recently used first
+        self.max_lookups = max_lookups
+        self.evicted = 0
 
     def add(self, id_str, tag, color):
-        if '-' in id_str:
-            a = [int(x) for x in id_str.split('-')]
-            if a[0] >= a[1]:
-                raise AssertionError('invalid ID range in %s' % id_str)
-            for i in range(a[0], a[1]+1):
-                self.cache[i] = {'tag': tag, 'color': color}
-        elif '.' in id_str:
-            rc = id_str.find('.')
-            self.wildcards[id_str] = {'prefix': id_str[:rc], 'len': len(id_str), 'tag': tag, 'color': color, 'type': '.'}
-        elif '*' in id_str:
-            rc = id_str.find('*')
-            self.wildcards[id_str] = {'prefix': id_str[:rc], 'len': 0, 'tag': tag, 'color': color, 'type':  '*'}
+        rule = parse_id(id_str)
+        if rule[0] == 'wildcard':
+            if id_str not in self.wildcards:
+                self.add_wildcard(rule[1], rule[2], rule[3], (len(self.wildcards), id_str))
+            self.wildcards[id_str] = {'prefix': rule[1], 'len': rule[2], 'tag': tag, 'color': color, 'type': rule[3]}
         else:
-            self.cache[int(id_str)] = {'tag': tag, 'color': color}
+            self.ranges.append((rule[1], rule[-1], {'tag': tag, 'color': color}))
+            self.intervals = None
+        self.lookups.clear()
 
-    def lookup(self, id):
-        if id in self.cache.keys():
-            return self.cache[id]
+    def add_wildcard(self, prefix, length, wtype, rule):
+        node = self.trie
+        for c in prefix:
+            node = node[0].setdefault(c, [{}, None, None])
+        if wtype == '*':
+            if node[1] is None:
+                node[1] = rule
+        else:
+            if node[2] is None:
+                node[2] = {}
+            node[2].setdefault(length, rule)
+
+    def match_wildcard(self, id):
+        # the first rule among the wildcards whose prefix the id starts with
         id_str = '%d' % id
-        for w in self.wildcards.keys():
-            if not id_str.startswith(self.wildcards[w]['prefix']):
-                continue
-            if self.wildcards[w]['type'] == '.' and len(id_str) != self.wildcards[w]['len']:
-                continue
-            # wildcard matched
-            self.cache[id] = {'tag': self.wildcards[w]['tag'], 'color': self.wildcards[w]['color']}
-            return self.cache[id]
-        # not found in cache, and no wildcard matched
-        self.cache[id] = None
-        return None
+        ndigits = len(id_str)
+        best = None
+        node = self.trie
+        for i in range(ndigits + 1):
+            for rule in (node[1], node[2] and node[2].get(ndigits)):
+                if rule and (best is None or rule < best):
+                    best = rule
+            if i == ndigits:
+                break
+            node = node[0].get(id_str[i])
+            if node is None:
+                break
+        if best is None:
+            return None
+        w = self.wildcards[best[1]]
+        return {'tag': w['tag'], 'color': w['color']}
+
+    def build_intervals(self):
+        intervals = flatten_ranges(self.ranges)
+        self.intervals = (array.array('q', [i[0] for i in intervals]), array.array('q', [i[1] for i in intervals]), [i[2] for i in intervals])
+
+    def lookup(self, id):
+        if self.intervals is None:
+            self.build_intervals()
+        lo, hi, values = self.intervals
+        i = bisect.bisect_right(lo, id) - 1
+        if i >= 0 and id <= hi[i]:
+            return values[i]
+        if not self.wildcards:	# nothing to match, so nothing worth caching
+            return None
+        if id in self.lookups:
+            result = self.lookups.pop(id)
+            self.lookups[id] = result
+            return result
+        result = self.match_wildcard(id)
+        # misses are cached too, they are as costly to repeat as matches
+        self.lookups[id] = result
+        if self.max_lookups and len(self.lookups) > self.max_lookups:
+            self.lookups.popitem(last=False)
+            self.evicted += 1
+        return result
+
+    def size_report(self):
+        if self.intervals is None:
+            self.build_intervals()
+        n = len(self.intervals[0])
+        return {'entries': n + len(self.lookups), 'tags': n, 'wildcards': len(self.wildcards),
+                'lookups': len(self.lookups), 'limit': self.max_lookups, 'evicted': self.evicted}
 
     def get_color(self, id):
         d = self.lookup(id)
@@ -109,6 +179,210 @@ class id_registry:
             return ""
         return d['tag']
 
+def parse_id(id_str):
+    # an id of a tags file: ('id', n), ('range', first, last) for "first-last",
+    # or ('wildcard', prefix, len, type) for "prefix..." (ids of len digits)
+    # and "prefix*" (len 0: ids of any length)
+    if '-' in id_str:
+        a = [int(x) for x in id_str.split('-')]
+        if a[0] >= a[1]:
+            raise AssertionError('invalid ID range in %s' % id_str)
+        return ('range', a[0], a[1])
+    elif '.' in id_str:
+        return ('wildcard', id_str[:id_str.find('.')], len(id_str), '.')
+    elif '*' in id_str:
+        return ('wildcard', id_str[:id_str.find('*')], 0, '*')
+    return ('id', int(id_str))
+
+# Compiled tags files.
+#
+# Each process builds its own id_registry (intervals and wildcard trie)
+# from the tsv, which takes a while for big files.  compile_tags() writes
+# the rules of one or more tags files instead as a binary file that every
+# receiver process maps read-only (the os shares the pages), and that opens
+# in no time whatever its size:
+#
+#   header      magic, number of intervals, tags, wildcards; size of strings
+#   lo, hi      int64[intervals]: disjoint id intervals in id order, ids
+#               and ranges alike (where rules overlap, the one read last
+#               wins, as in id_registry)
+#   value       uint32[intervals]: tag number of each interval
+#   tags        int32[tags][3]: offset and length in strings, color
+#   keys        int64[wildcards]: the prefix of each wildcard, as
+#               len(prefix) * PREFIX_KEY + int(prefix), in order
+#   wildcards   int32[wildcards][4]: rule number (the first rule that
+#               matches wins), len, type (0 '.', 1 '*'), tag number
+#   strings     utf-8
+#
+# Each section starts on an 8 byte boundary.  compiled_tags.lookup() is a
+# binary search of the intervals, then of the wildcard keys for each
+# prefix of the id.  open_tags() picks a compiled file over its tsv.
+#
+#     ./tsvfile.py compile <out.tagdb> <tags.tsv>...
+#
+# The compiled file of units.tsv is looked for as units.tsv.tagdb, and
+# used while it is newer than units.tsv.  A new file replaces the old one
+# by a rename, so processes reading the old one are not disturbed.
+
+TAGDB_MAGIC = b'OP25TAG1'
+TAGDB_SUFFIX = '.tagdb'
+TAGDB_HEADER = struct.Struct('<8sIIII')
+WILDCARD_TYPES = '.*'
+PREFIX_KEY = 10 ** 10	# more than any id (32 bits)
+
+def align8(n):
+    return (n + 7) & ~7
+
+def flatten_ranges(entries):
+    # entries [(first, last, value)] in the order read, later entries taking
+    # precedence where they overlap; returns the disjoint intervals
+    # [(first, last, value)] in id order, neighbours of equal value merged
+    bounds = sorted(set([e[0] for e in entries] + [e[1] + 1 for e in entries]))
+    starts = sorted(range(len(entries)), key=lambda i: entries[i][0])
+    active = []	# heap of (-entry number, last); the top is the latest entry
+    result = []
+    j = 0
+    for k in range(len(bounds) - 1):
+        lo = bounds[k]
+        while j < len(starts) and entries[starts[j]][0] == lo:
+            heapq.heappush(active, (-starts[j], entries[starts[j]][1]))
+            j += 1
+        while active and active[0][1] < lo:
+            heapq.heappop(active)
+        if not active:
+            continue
+        value = entries[-active[0][0]][2]
+        if result and result[-1][1] == lo - 1 and result[-1][2] == value:
+            result[-1] = (result[-1][0], bounds[k + 1] - 1, value)
+        else:
+            result.append((lo, bounds[k + 1] - 1, value))
+    return result
+
+class tag_rules(object):
+    # the rules of tags files in the order read (read_tags_file target)
+    def __init__(self):
+        self.ranges = []	# (first, last, (tag, color))
+        self.wildcards = {}	# id_str -> (prefix, len, type, (tag, color)), in first read order
+
+    def add(self, id_str, tag, color):
+        rule = parse_id(id_str)
+        if rule[0] == 'range':
+            self.ranges.append((rule[1], rule[2], (tag, color)))
+        elif rule[0] == 'wildcard':
+            self.wildcards[id_str] = (rule[1], rule[2], rule[3], (tag, color))
+        else:
+            self.ranges.append((rule[1], rule[1], (tag, color)))
+
+def compile_tags(out_filename, tags_files):
+    # returns (intervals, wildcards)
+    rules = tag_rules()
+    for f in tags_files:
+        read_tags_file(f, rules)
+    strings = bytearray()
+    tag_numbers = {}
+    tags = array.array('i')
+    def tag_number(value):
+        if value not in tag_numbers:
+            b = value[0].encode('utf-8')
+            tag_numbers[value] = len(tag_numbers)
+            tags.extend([len(strings), len(b), value[1]])
+            strings.extend(b)
+        return tag_numbers[value]
+    intervals = flatten_ranges(rules.ranges)
+    lo = array.array('q', [i[0] for i in intervals])
+    hi = array.array('q', [i[1] for i in intervals])
+    values = array.array('I', [tag_number(i[2]) for i in intervals])
+    wildcards = []
+    for n, (prefix, length, wtype, value) in enumerate(rules.wildcards.values()):
+        wildcards.append((len(prefix) * PREFIX_KEY + int(prefix or 0), n, length, WILDCARD_TYPES.index(wtype), tag_number(value)))
+    wildcards.sort()
+    keys = array.array('q', [w[0] for w in wildcards])
+    wild = array.array('i')
+    for w in wildcards:
+        wild.extend(w[1:])
+    sections = [lo.tobytes(), hi.tobytes(), values.tobytes(), tags.tobytes(), keys.tobytes(), wild.tobytes(), bytes(strings)]
+    tmp_filename = out_filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(TAGDB_HEADER.pack(TAGDB_MAGIC, len(intervals), len(tag_numbers), len(wildcards), len(strings)))
+        for b in sections:
+            f.write(b'\0' * (align8(f.tell()) - f.tell()))
+            f.write(b)
+    os.replace(tmp_filename, out_filename)
+    return len(intervals), len(wildcards)
+
+class compiled_tags(id_registry):
+    # an id_registry on a compiled tags file, mapped read-only
+    def __init__(self, filename, max_lookups=STATE_LIMITS['max_id_lookups']):
+        id_registry.__init__(self, max_lookups)
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, ntags, nwild, nstrings = TAGDB_HEADER.unpack_from(self.mm, 0)
+        if magic != TAGDB_MAGIC:
+            raise ValueError('%s is not a compiled tags file' % filename)
+        mv = memoryview(self.mm)
+        views = []
+        offset = TAGDB_HEADER.size
+        for fmt, size in [('q', 8 * n), ('q', 8 * n), ('I', 4 * n), ('i', 12 * ntags), ('q', 8 * nwild), ('i', 16 * nwild), ('B', nstrings)]:
+            offset = align8(offset)
+            views.append(mv[offset:offset + size].cast(fmt))
+            offset += size
+        self.lo, self.hi, self.values, self.tags, self.keys, self.wild, self.strings = views
+        self.nintervals = n
+        self.nwildcards = nwild
+
+    def add(self, id_str, tag, color):
+        raise TypeError('%s: compiled tags are read-only, recompile the tsv' % self.filename)
+
+    def tag(self, t):
+        offset, length, color = self.tags[3 * t:3 * t + 3]
+        return {'tag': self.strings[offset:offset + length].tobytes().decode('utf-8'), 'color': color}
+
+    def match_wildcard(self, id):
+        # the first rule among the wildcards whose prefix the id starts with
+        ndigits = len('%d' % id)
+        best = None
+        for k in range(ndigits + 1):
+            key = k * PREFIX_KEY + id // 10 ** (ndigits - k)
+            w = bisect.bisect_left(self.keys, key)
+            while w < self.nwildcards and self.keys[w] == key:
+                n, length, wtype, t = self.wild[4 * w:4 * w + 4]
+                if (wtype == 1 or length == ndigits) and (best is None or n < best[0]):
+                    best = (n, t)
+                w += 1
+        return self.tag(best[1]) if best else None
+
+    def lookup(self, id):
+        i = bisect.bisect_right(self.lo, id) - 1
+        if i >= 0 and id <= self.hi[i]:
+            return self.tag(self.values[i])
+        if not self.nwildcards:
+            return None
+        if id in self.lookups:
+            result = self.lookups.pop(id)
+            self.lookups[id] = result
+            return result
+        result = self.match_wildcard(id)
+        self.lookups[id] = result
+        if self.max_lookups and len(self.lookups) > self.max_lookups:
+            self.lookups.popitem(last=False)
+            self.evicted += 1
+        return result
+
+    def size_report(self):
+        return {'entries': self.nintervals + len(self.lookups), 'tags': self.nintervals, 'wildcards': self.nwildcards,
+                'lookups': len(self.lookups), 'limit': self.max_lookups, 'evicted': self.evicted, 'mapped_bytes': len(self.mm)}
+
+def open_tags(tags_file, max_lookups=STATE_LIMITS['max_id_lookups']):
+    # the id_registry of a tags file: a compiled file if tags_file is one,
+    # or if tags_file + TAGDB_SUFFIX is newer than tags_file; else the tsv
+    compiled = tags_file if tags_file.endswith(TAGDB_SUFFIX) else tags_file + TAGDB_SUFFIX
+    if os.access(compiled, os.R_OK) and (compiled == tags_file or not os.access(tags_file, os.R_OK) or os.path.getmtime(compiled) >= os.path.getmtime(tags_file)):
+        return compiled_tags(compiled, max_lookups)
+    result = id_registry(max_lookups)
+    read_tags_file(tags_file, result)
+    return result
+
 def load_tsv(tsv_filename):
     hdrmap = []
     configs = {}
@@ -151,7 +425,10 @@ def read_tags_file(tags_file, result):
 def make_config(configs):
     result_config = {}
     for nac in configs:
-        result_config[nac] = {'cclist':[], 'offset':0, 'whitelist':None, 'blacklist':{}, 'tgid_map':id_registry(), 'unit_id_map': id_registry(), 'sysname': configs[nac]['sysname'], 'center_frequency': None}
+        limits = {k: int(configs[nac][k]) for k in STATE_LIMITS if k in configs[nac]}
+        max_lookups = limits.get('max_id_lookups', STATE_LIMITS['max_id_lookups'])
+        result_config[nac] = {'cclist':[], 'offset':0, 'whitelist':None, 'blacklist':{}, 'tgid_map':id_registry(max_lookups), 'unit_id_map': id_registry(max_lookups), 'sysname': configs[nac]['sysname'], 'center_frequency': None}
+        result_config[nac].update(limits)
         for f in configs[nac]['control_channel_list'].split(','):
             result_config[nac]['cclist'].append(get_frequency(f))
         if 'offset' in configs[nac]:
@@ -174,15 +451,177 @@ def make_config(configs):
                 unit_id_tags_file = None
             result_config[nac]['tgid_tags_file'] = tgid_tags_file
             result_config[nac]['unit_id_tags_file'] = unit_id_tags_file
-            read_tags_file(tgid_tags_file, result_config[nac]['tgid_map'])
-            if unit_id_tags_file is not None and os.access(unit_id_tags_file, os.R_OK):
-                read_tags_file(unit_id_tags_file, result_config[nac]['unit_id_map'])
+            result_config[nac]['tgid_map'] = open_tags(tgid_tags_file, max_lookups)
+            if unit_id_tags_file is not None and (os.access(unit_id_tags_file, os.R_OK) or os.access(unit_id_tags_file + TAGDB_SUFFIX, os.R_OK)):
+                result_config[nac]['unit_id_map'] = open_tags(unit_id_tags_file, max_lookups)
             
         if 'center_frequency' in configs[nac]:
             result_config[nac]['center_frequency'] = get_frequency(configs[nac]['center_frequency'])
     return result_config
 
+def random_rules(rng, n, id_bits=24):
+    # n tags file rows of all kinds, with overlapping ranges and wildcards
+    rows = []
+    for i in range(n):
+        k = rng.randrange(10)
+        if k < 5:
+            id_str = '%d' % rng.randrange(1 << id_bits)
+        elif k < 8:
+            first = rng.randrange(1 << id_bits)
+            id_str = '%d-%d' % (first, first + rng.randrange(1, 1 << rng.randrange(4, 16)))
+        else:
+            prefix = '%d' % rng.randrange(1, 10 ** rng.randrange(1, 5))
+            id_str = prefix + ('*' if k == 8 else '.' * rng.randrange(1, 5))
+        rows.append((id_str, 'tag %d' % i, rng.randrange(100)))
+    return rows
+
+def write_tags(filename, rows):
+    with open(filename, 'w') as f:
+        for id_str, tag, color in rows:
+            f.write('%s\t%s\t%d\n' % (id_str, tag, color))
+
+def linear_lookup(rules, id):
+    # the lookup of a tag_rules by a scan of every rule, for check(): the
+    # last id or range that holds the id, else the first wildcard that matches
+    for first, last, value in reversed(rules.ranges):
+        if first <= id <= last:
+            return {'tag': value[0], 'color': value[1]}
+    id_str = '%d' % id
+    for prefix, length, wtype, value in rules.wildcards.values():
+        if id_str.startswith(prefix) and (wtype == '*' or len(id_str) == length):
+            return {'tag': value[0], 'color': value[1]}
+    return None
+
+def check():
+    # id_registry and compiled lookups against linear_lookup(), on random
+    # rules with overlapping ranges, the same id and wildcard given twice,
+    # and ids around every bound
+    import random
+    import tempfile
+    overlapping = [('100-199', 'outer', 1), ('120-129', 'inner', 2), ('150', 'single', 3), ('190-250', 'straddle', 4),
+            ('100-199', 'outer again', 5), ('125', 'after', 6), ('300-310', 'a', 7), ('311-320', 'a', 7), ('305-315', 'b', 8),
+            ('1*', 'one', 9), ('1..', 'one hundreds', 10), ('12*', 'twelve', 11), ('1*', 'one again', 12), ('*', 'any', 13)]
+    rng = random.Random(1)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for trial in range(21):
+            if trial == 0:
+                rows = overlapping
+            else:
+                rows = random_rules(rng, rng.randrange(1, 300), id_bits=rng.choice([8, 16, 24]))
+                rows += [rows[rng.randrange(len(rows))][:1] + ('again', 1) for i in range(5)]
+            tsv = os.path.join(tmpdir, 'tags.tsv')
+            write_tags(tsv, rows)
+            rules = tag_rules()
+            read_tags_file(tsv, rules)
+            reg = id_registry(0)
+            read_tags_file(tsv, reg)
+            compile_tags(tsv + TAGDB_SUFFIX, [tsv])
+            tagdb = open_tags(tsv)
+            assert isinstance(tagdb, compiled_tags)
+            ids = set([rng.randrange(1 << 24) for i in range(2000)])
+            for id_str, tag, color in rows:
+                for x in id_str.replace('*', '').replace('.', '').split('-'):
+                    if x:
+                        ids.update([int(x) - 1, int(x), int(x) + 1, int(x) * 10, int(x) * 100 + 99])
+            for id in sorted(ids):
+                expected = linear_lookup(rules, id)
+                assert reg.lookup(id) == expected, (trial, id, reg.lookup(id), expected)
+                assert tagdb.lookup(id) == expected, (trial, id, tagdb.lookup(id), expected)
+            if trial == 0:
+                for id, tag in [(99, 'any'), (100, 'outer again'), (121, 'outer again'), (125, 'after'), (150, 'outer again'),
+                        (199, 'outer again'), (200, 'straddle'), (250, 'straddle'), (251, 'any'), (304, 'a'),
+                        (305, 'b'), (315, 'b'), (316, 'a'), (12, 'one again'), (1234, 'one again'), (2, 'any')]:
+                    assert reg.get_tag(id) == tag, (id, reg.get_tag(id), tag)
+            del tagdb
+    finally:
+        import shutil
+        shutil.rmtree(tmpdir)
+    sys.stderr.write('ok\n')
+
+def bench(n=1000000):
+    # a tags file with n unit ids in ranges, 1000 ids and 100 wildcards:
+    # load time and memory of an id_registry and of the compiled file
+    import random
+    import tempfile
+    import tracemalloc
+    rng = random.Random(1)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tsv = os.path.join(tmpdir, 'units.tsv')
+        rows = [('%d-%d' % (1000000 + i, 1000000 + i + 9999), 'range %d' % i, 0) for i in range(0, n, 10000)]
+        rows += [('%d' % rng.randrange(1 << 24), 'unit %d' % i, 0) for i in range(1000)]
+        rows += [('%d*' % rng.randrange(100, 1000), 'wildcard %d' % i, 0) for i in range(100)]
+        write_tags(tsv, rows)
+        probe = [rng.randrange(1 << 24) for i in range(100000)]
+        for name in ['tsv', 'compiled']:
+            if name == 'compiled':
+                t0 = time.time()
+                compile_tags(tsv + TAGDB_SUFFIX, [tsv])
+                sys.stderr.write('compile: %.2f s, %d bytes\n' % (time.time() - t0, os.path.getsize(tsv + TAGDB_SUFFIX)))
+            tracemalloc.start()
+            t0 = time.time()
+            reg = open_tags(tsv, 0)
+            t1 = time.time()
+            mem = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            for id in probe:
+                reg.lookup(id)
+            t2 = time.time()
+            sys.stderr.write('%-8s load %.3f s, %.1f MB private, lookup %.2f us\n' % (name, t1 - t0, mem / 1e6, (t2 - t1) / len(probe) * 1e6))
+            del reg
+    finally:
+        import shutil
+        shutil.rmtree(tmpdir)
+
+def bench_rules(n=100000):
+    # lookups of never seen ids among n random rules (random_rules): the
+    # id_registry, and the scan of every rule it replaces
+    import random
+    import tempfile
+    rng = random.Random(1)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tsv = os.path.join(tmpdir, 'units.tsv')
+        write_tags(tsv, random_rules(rng, n))
+        rules = tag_rules()
+        read_tags_file(tsv, rules)
+        probe = [rng.randrange(1 << 24) for i in range(100000)]
+        t0 = time.time()
+        reg = id_registry(0)
+        read_tags_file(tsv, reg)
+        reg.lookup(0)
+        t1 = time.time()
+        for id in probe:
+            reg.lookup(id)
+        t2 = time.time()
+        for id in probe:
+            reg.lookup(id)
+        t3 = time.time()
+        sys.stderr.write('%d rules: %d intervals, %d wildcards, load %.2f s\n' % (n, len(reg.intervals[0]), len(reg.wildcards), t1 - t0))
+        sys.stderr.write('id_registry lookup %.2f us, cached %.2f us\n' % ((t2 - t1) / len(probe) * 1e6, (t3 - t2) / len(probe) * 1e6))
+        t0 = time.time()
+        for id in probe[:200]:
+            linear_lookup(rules, id)
+        sys.stderr.write('linear scan lookup %.2f us\n' % ((time.time() - t0) / 200 * 1e6))
+    finally:
+        import shutil
+        shutil.rmtree(tmpdir)
+
 def main():
+    if len(sys.argv) > 3 and sys.argv[1] == 'compile':
+        intervals, wildcards = compile_tags(sys.argv[2], sys.argv[3:])
+        sys.stderr.write('%s: %d intervals, %d wildcards\n' % (sys.argv[2], intervals, wildcards))
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        check()
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(float(sys.argv[2])) if len(sys.argv) > 2 else 1000000)
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench-rules':
+        bench_rules(int(float(sys.argv[2])) if len(sys.argv) > 2 else 100000)
+        return
     import json
     result = make_config(load_tsv(sys.argv[1]))
     print (json.dumps(result, indent=4, separators=[',',':'], sort_keys=True))
@@ -52,6 +52,7 @@ var chsize = 1;
 var evsize = 1;
 var ersize = 1;
 var event_source = null;  // must be in global scope for Babysitter to work.
+var trunk_state = null;   // complete trunk_update, rebuilt from the deltas sent by http_server
 
 window.g_change_freq = [];
 window.g_cc_event = [];
@@ -115,6 +116,49 @@ function eventsource_listener(event) {
     dispatch_commands(event.data);
 }
 
+// apply a trunk_update from /stream - see apps/trunk_delta.py for the format.
+// returns the complete trunk_update, or null if an update was missed
+function trunk_delta_apply(d) {
+    if (!('base' in d)) {   // complete snapshot
+        trunk_state = d;
+        return d;
+    }
+    if (trunk_state == null || trunk_state['seq'] != d['base']) {
+        // out of step - the watchdog reconnects and the server sends a complete snapshot
+        trunk_state = null;
+        event_source.close();
+        return null;
+    }
+    for (var k in d) {
+        if (k != 'base' && k != 'delta')
+            trunk_state[k] = d[k];
+    }
+    for (var nac in d['delta']) {
+        var dd = d['delta'][nac];
+        if ('replace' in dd) {
+            if (dd['replace'] == null)
+                delete trunk_state[nac];
+            else
+                trunk_state[nac] = dd['replace'];
+            continue;
+        }
+        var sys = trunk_state[nac];
+        for (k in dd['set'])
+            sys[k] = dd['set'][k];
+        for (var i = 0; dd['unset'] && i < dd['unset'].length; i++)
+            delete sys[dd['unset'][i]];
+        for (k in dd['update']) {
+            for (var e in dd['update'][k])
+                sys[k][e] = dd['update'][k][e];
+        }
+        for (k in dd['remove']) {
+            for (i = 0; i < dd['remove'][k].length; i++)
+                delete sys[k][dd['remove'][k][i]];
+        }
+    }
+    return trunk_state;
+}
+
 // Watchdog - watches /stream, reacts when lost/restored
 function setReconnect() {
 	// readyState values: 0 = connecting, 1 = open, 2 = closed
@@ -1099,6 +1143,11 @@ function dispatch_commands(txt) {
             continue;
         if (!(d['json_type'] in dispatch))
             continue;
+        if (d['json_type'] == 'trunk_update') {
+            d = trunk_delta_apply(d);
+            if (d == null)
+                continue;
+        }
         var j_type = d['json_type'];
         var time = getTime(new Date());
         if (d.time)